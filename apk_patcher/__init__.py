@@ -3,4 +3,10 @@ import sys
 if sys.hexversion < 0x03080000:
     raise Exception('python 3.8 or newer required')
 
-from apk_patcher.apk_patcher import APKPatcher
+
+def __getattr__(name: str):
+    # APKPatcher imports every tool, submodules like the job queue or the benchmarks are imported without them
+    if name == 'APKPatcher':
+        from apk_patcher.apk_patcher import APKPatcher
+        return APKPatcher
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
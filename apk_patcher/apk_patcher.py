@@ -1,28 +1,107 @@
-import math
+import binascii
+import functools
+import inspect
 import os
 import shutil
-from dataclasses import dataclass
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Type
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple, Type, TypeVar, Union
 
-from tqdm import tqdm
-
-from apk_patcher.lib.apk_provider import APKInfo, APKProvider
-from apk_patcher.lib.certificate import Certificate
+from apk_patcher.lib.apk_inspector import inspect_apk
+from apk_patcher.lib.apk_optimizer import OptimizeResult, optimize_apk
+from apk_patcher.lib.apk_provider import APKInfo, APKProvider, APKSplitInfo
+from apk_patcher.lib.apk_resolver import APKResolver, verify_download
+from apk_patcher.lib.apk_set import write_apk_set
+from apk_patcher.lib.apk_store import APKStore
+from apk_patcher.lib.arsc import ResourceTable
+from apk_patcher.lib.artifact_cache import ArtifactBackend, ArtifactCache, DirectoryBackend, HTTPBackend
+from apk_patcher.lib.axml import InvalidResourceChunk
 from apk_patcher.lib.di import di_class_init
+from apk_patcher.lib.downloader import Downloader
+from apk_patcher.lib.file_lock import FileLock
+from apk_patcher.lib.jvm_profile import JVMProfile
+from apk_patcher.lib.metrics import JSONLinesSink, MetricEvent, Metrics, MetricsSink, OpenMetricsFileSink
 from apk_patcher.lib.patch import Patch
-from apk_patcher.lib.progress import ProgressData, ProgressStage, ProgressType
-from apk_patcher.lib.tool import ToolType
-from apk_patcher.lib.util import dotenv_get_set, print_subprocess_output
+from apk_patcher.lib.patch_cache import PatchCache
+from apk_patcher.lib.pipeline import Pipeline, PipelineStage, StagePlan
+from apk_patcher.lib.process_supervisor import ProcessSupervisor, SupervisedProcess
+from apk_patcher.lib.profiler import Profiler
+from apk_patcher.lib.progress import ProgressCancelled, ProgressData
+from apk_patcher.lib.progress_bus import LogSubscriber, MetricsSubscriber, ProgressBus, TqdmSubscriber
+from apk_patcher.lib.provider_cache import ProviderInfoCache
+from apk_patcher.lib.raw_zip import UnsupportedZip
+from apk_patcher.lib.settings import Settings
+from apk_patcher.lib.tool import Tool, ToolType
+from apk_patcher.lib.util import dotenv_get_set, hash_file
+from apk_patcher.lib.workspace import Workspace
+from apk_patcher.lib.zip_align import zip_align
 from apk_patcher.tools.android_jar import AndroidJar
 from apk_patcher.tools.apksigner import APKSigner
 from apk_patcher.tools.apktool import APKTool
 from apk_patcher.tools.baksmali import Baksmali
 from apk_patcher.tools.dx import DX
 from apk_patcher.tools.java import Java
+from apk_patcher.tools.local_folder import LocalFolder
 from apk_patcher.tools.qooapp import QooApp
 
 
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def apk_folder_locked(method: Callable[..., R]) -> Callable[..., R]:
+    """
+    Holds the lock of the APK's version folder while a build stage runs, see APKPatcher.lock_apk
+    """
+    @functools.wraps(method)
+    def wrapper(self: 'APKPatcher', apk: 'APK', *args, **kwargs) -> R:
+        with self.lock_apk(apk):
+            return method(self, apk, *args, **kwargs)
+    return wrapper
+
+
+def measured_stage(stage: str, tool: Optional[str] = None,
+                   profiled: bool = True) -> Callable[[Callable[..., R]], Callable[..., R]]:
+    """
+    Records the duration and input size of a build stage, see APKPatcher.metrics, and profiles it
+    when profiling is enabled, see APKPatcher.profiling
+
+    :param tool: APKPatcher attribute of the tool the stage runs, its version is added as a label
+    :param profiled: False for stages that profile their own parts
+    """
+    def decorator(method: Callable[..., R]) -> Callable[..., R]:
+        @functools.wraps(method)
+        def wrapper(self: 'APKPatcher', apk: 'APK', *args, **kwargs) -> R:
+            tool_version = getattr(self, tool).version if tool is not None else None
+            with self.metrics.measure('stage', stage=stage, package=apk.info.package_name, tool=tool,
+                                      tool_version=tool_version) as event:
+                input_file_paths = [apk.file_path] + [split.file_path for split in apk.splits]
+                event.values['input_bytes'] = sum(
+                    os.path.getsize(file_path) for file_path in input_file_paths if os.path.exists(file_path)
+                )
+                try:
+                    with self.profile_region(stage) if profiled else nullcontext():
+                        return method(self, apk, *args, **kwargs)
+                finally:
+                    self.metrics.flush()
+        return wrapper
+    return decorator
+
+
+@dataclass
+class APKSplit:
+    BASE_NAME = 'base'
+
+    info: APKSplitInfo
+    file_path: str
+    unpack_folder_path: str
+    pack_file_path: str
+    signed_file_path: str
+
+
 @dataclass
 class APK:
     info: APKInfo
@@ -31,10 +110,31 @@ class APK:
     unpack_folder_path: str
     pack_file_path: str
     signed_file_path: str
+    apk_set_file_path: str
+    splits: List[APKSplit] = field(default_factory=list)
+    # Inputs and stages the current build was made from, used as artifact cache key
+    recipe: List[Dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def pack_file_paths(self) -> Dict[str, Tuple[str, str]]:
+        """
+        (packed, signed) file paths of the base APK followed by its splits, by split name
+        """
+        return {
+            APKSplit.BASE_NAME: (self.pack_file_path, self.signed_file_path),
+            **{split.info.name: (split.pack_file_path, split.signed_file_path) for split in self.splits}
+        }
+
+    def get_split(self, split_name: str) -> APKSplit:
+        for split in self.splits:
+            if split.info.name == split_name:
+                return split
+        raise Exception(f'{self.info.package_name} has no split {split_name}')
 
 
 class APKPatcher:
-    DIST_FOLDER: str = dotenv_get_set('DIST_FOLDER', os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'dist')))
+    settings: Settings = Settings()
+    DIST_FOLDER: str = settings.get('DIST_FOLDER', os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'dist')))
     JAVA_FOLDER: str = os.path.join(DIST_FOLDER, 'java')
     JRE_FOLDER: str = os.path.join(JAVA_FOLDER, 'jre')
     JDK_FOLDER: str = os.path.join(JAVA_FOLDER, 'jdk')
@@ -44,17 +144,53 @@ class APKPatcher:
     DX_FOLDER: str = os.path.join(DIST_FOLDER, 'dx')
     BAKSMALI_FOLDER: str = os.path.join(DIST_FOLDER, 'baksmali')
     APK_FOLDER: str = os.path.join(DIST_FOLDER, 'apks')
-    JAVA_VERSION: str = dotenv_get_set('JAVA_VERSION', 'latest')
-    APKTOOL_VERSION: str = dotenv_get_set('APKTOOL_VERSION', 'latest')
-    APKSIGNER_VERSION: str = dotenv_get_set('APKSIGNER_VERSION', 'latest')
-    ANDROIDJAR_VERSION: str = dotenv_get_set('ANDROIDJAR_VERSION', 'latest')
-    DX_VERSION: str = dotenv_get_set('DX_VERSION', 'latest')
-    BAKSMALI_VERSION: str = dotenv_get_set('BAKSMALI_VERSION', 'latest')
-    QOOAPP_TOKEN: Optional[str] = dotenv_get_set('QOOAPP_TOKEN', None)
-    QOOAPP_DEVICE_ID: Optional[str] = dotenv_get_set('QOOAPP_DEVICE_ID', None)
+    PATCH_CACHE_FOLDER: str = settings.get('PATCH_CACHE_FOLDER', os.path.join(DIST_FOLDER, 'patch_cache'))
+    PATCH_CACHE_MAX_SIZE: Optional[str] = settings.get('PATCH_CACHE_MAX_SIZE', None)
+    # Megabytes, least recently used APK versions are deleted above it, empty for no limit
+    APK_STORE_MAX_SIZE: Optional[str] = settings.get('APK_STORE_MAX_SIZE', None)
+    # Folder on a RAM backed filesystem for decoded APK's, e.g. /dev/shm/apk_patcher, empty to decode in APK_FOLDER
+    WORKSPACE_FOLDER: Optional[str] = settings.get('WORKSPACE_FOLDER', None)
+    # Megabytes, versions that don't fit are decoded in APK_FOLDER, empty for the free space of the filesystem
+    WORKSPACE_MAX_SIZE: Optional[str] = settings.get('WORKSPACE_MAX_SIZE', None)
+    JAVA_VERSION: str = settings.get('JAVA_VERSION', 'latest')
+    APKTOOL_VERSION: str = settings.get('APKTOOL_VERSION', 'latest')
+    APKSIGNER_VERSION: str = settings.get('APKSIGNER_VERSION', 'latest')
+    ANDROIDJAR_VERSION: str = settings.get('ANDROIDJAR_VERSION', 'latest')
+    DX_VERSION: str = settings.get('DX_VERSION', 'latest')
+    BAKSMALI_VERSION: str = settings.get('BAKSMALI_VERSION', 'latest')
+    QOOAPP_TOKEN: Optional[str] = settings.get('QOOAPP_TOKEN', None)
+    QOOAPP_DEVICE_ID: Optional[str] = settings.get('QOOAPP_DEVICE_ID', None)
+    LOCAL_APK_FOLDER: Optional[str] = settings.get('LOCAL_APK_FOLDER', None)
+    LOCAL_APK_INDEX: str = os.path.join(DIST_FOLDER, 'local_apk_index.json')
+    PROVIDER_CACHE_FILE: str = os.path.join(DIST_FOLDER, 'provider_cache.json')
+    PROVIDER_CACHE_TTL: int = int(settings.get('PROVIDER_CACHE_TTL', '3600'))
+    RESOLVE_TIMEOUT: float = float(settings.get('RESOLVE_TIMEOUT', '30'))
+    ARTIFACT_CACHE_FOLDER: Optional[str] = settings.get('ARTIFACT_CACHE_FOLDER', None)
+    ARTIFACT_CACHE_URL: Optional[str] = settings.get('ARTIFACT_CACHE_URL', None)
+    ARTIFACT_CACHE_TOKEN: Optional[str] = settings.get('ARTIFACT_CACHE_TOKEN', None)
+    JOB_QUEUE_FILE: str = os.path.join(DIST_FOLDER, 'jobs.sqlite')
+    JOB_ARTIFACT_FOLDER: str = os.path.join(DIST_FOLDER, 'job_artifacts')
+    JOB_QUEUE_URL: Optional[str] = settings.get('JOB_QUEUE_URL', None)
+    JOB_QUEUE_TOKEN: Optional[str] = settings.get('JOB_QUEUE_TOKEN', None)
+    JOB_LEASE_TIMEOUT: float = float(settings.get('JOB_LEASE_TIMEOUT', '600'))
+    METRICS_JSONL_FILE: Optional[str] = settings.get('METRICS_JSONL_FILE', None)
+    METRICS_OPENMETRICS_FILE: Optional[str] = settings.get('METRICS_OPENMETRICS_FILE', None)
+    PROFILE_FOLDER: Optional[str] = settings.get('PROFILE_FOLDER', None)
+    # auto, bar, log or none. auto draws bars on a terminal and logs otherwise
+    PROGRESS_OUTPUT: str = settings.get('PROGRESS_OUTPUT', 'auto')
+    # Limits of every java tool run, in seconds and megabytes of resident memory, 0 for none
+    TOOL_TIMEOUT: Optional[str] = settings.get('TOOL_TIMEOUT', '3600')
+    TOOL_MEMORY_LIMIT: Optional[str] = settings.get('TOOL_MEMORY_LIMIT', None)
+    # JVM launch profiles, see JVMProfile
+    JVM_PROFILE_APKTOOL: Optional[str] = settings.get('JVM_PROFILE_APKTOOL', 'heap_min=128m,heap_max=1g,gc=parallel,cds=true')
+    JVM_PROFILE_APKSIGNER: Optional[str] = settings.get('JVM_PROFILE_APKSIGNER', 'heap_max=256m,gc=serial,tiered_stop_at_level=1,cds=true')
+    JVM_PROFILE_DX: Optional[str] = settings.get('JVM_PROFILE_DX', 'heap_max=512m,gc=serial,cds=true')
+    JVM_PROFILE_BAKSMALI: Optional[str] = settings.get('JVM_PROFILE_BAKSMALI', 'heap_max=512m,gc=parallel,cds=true')
+    JVM_PROFILE_DEFAULT: Optional[str] = settings.get('JVM_PROFILE_DEFAULT', None)
+    SPLIT_MAX_WORKERS = 4
     KEY_SIZE = 2048
-    SIGN_KEY: str = dotenv_get_set('SIGN_KEY', os.path.join(APKSIGNER_FOLDER, 'key.pk8'))
-    SIGN_CERT: str = dotenv_get_set('SIGN_CERT', os.path.join(APKSIGNER_FOLDER, 'cert.x509.pem'))
+    SIGN_KEY: str = settings.get('SIGN_KEY', os.path.join(APKSIGNER_FOLDER, 'key.pk8'))
+    SIGN_CERT: str = settings.get('SIGN_CERT', os.path.join(APKSIGNER_FOLDER, 'cert.x509.pem'))
 
     java: Java
     apktool: APKTool
@@ -63,52 +199,140 @@ class APKPatcher:
     dx: DX
     baksmali: Baksmali
     qooapp: QooApp
+    local_folder: Optional[LocalFolder]
     tools: Dict[Type[ToolType], ToolType]
+    provider_cache: ProviderInfoCache
+    artifact_cache: ArtifactCache
+    apk_store: APKStore
+    workspace: Workspace
+    patch_cache: PatchCache
+    metrics: Metrics
+    profiler: Optional[Profiler] = None
+    progress: ProgressBus
+    supervisor: ProcessSupervisor
 
-    progressbar: tqdm
-
-    def __init__(self):
+    def __init__(self, save_default_settings: bool = True):
+        """
+        :param save_default_settings: add missing keys with their defaults to the .env
+        """
+        if save_default_settings:
+            self.settings.save_defaults()
         self.tools = {}
+        self.provider_cache = ProviderInfoCache(self.PROVIDER_CACHE_FILE, self.PROVIDER_CACHE_TTL)
+        backends: List[ArtifactBackend] = []
+        if self.ARTIFACT_CACHE_FOLDER is not None:
+            backends.append(DirectoryBackend(self.ARTIFACT_CACHE_FOLDER))
+        if self.ARTIFACT_CACHE_URL is not None:
+            backends.append(HTTPBackend(self.ARTIFACT_CACHE_URL, token=self.ARTIFACT_CACHE_TOKEN))
+        self.artifact_cache = ArtifactCache(backends)
+        self.apk_store = APKStore(self.APK_FOLDER, int(self.APK_STORE_MAX_SIZE or 0) * 1024 * 1024 or None)
+        self.patch_cache = PatchCache(self.PATCH_CACHE_FOLDER,
+                                      int(self.PATCH_CACHE_MAX_SIZE or 0) * 1024 * 1024 or None)
+        self.workspace = Workspace(self.apk_store, self.WORKSPACE_FOLDER,
+                                   int(self.WORKSPACE_MAX_SIZE or 0) * 1024 * 1024 or None)
+        sinks: List[MetricsSink] = []
+        if self.METRICS_JSONL_FILE is not None:
+            sinks.append(JSONLinesSink(self.METRICS_JSONL_FILE))
+        if self.METRICS_OPENMETRICS_FILE is not None:
+            sinks.append(OpenMetricsFileSink(self.METRICS_OPENMETRICS_FILE))
+        self.metrics = Metrics(sinks)
+        self.progress = self.create_progress_bus()
+        self.supervisor = ProcessSupervisor(
+            float(self.TOOL_TIMEOUT or 0) or None,
+            int(self.TOOL_MEMORY_LIMIT or 0) * 1024 * 1024 or None
+        )
         self.java = self.register_tool(Java, self.JRE_FOLDER, self.JDK_FOLDER, self.JAVA_VERSION)
+        self.java.set_supervisor(self.supervisor)
         self.apktool = self.register_tool(APKTool, self.java, self.APKTOOL_FOLDER, self.APKTOOL_VERSION)
         self.apksigner = self.register_tool(APKSigner, self.java, self.APKSIGNER_FOLDER, self.APKSIGNER_VERSION)
         self.android_jar = self.register_tool(AndroidJar, self.ANDROIDJAR_FOLDER, self.ANDROIDJAR_VERSION)
         self.dx = self.register_tool(DX, self.java, self.DX_FOLDER, self.DX_VERSION)
         self.baksmali = self.register_tool(Baksmali, self.java, self.BAKSMALI_FOLDER, self.BAKSMALI_VERSION)
+        self.init_jvm_profiles()
         self.qooapp = self.register_tool(QooApp, self.QOOAPP_DEVICE_ID, self.QOOAPP_TOKEN)
         if self.QOOAPP_TOKEN is None or self.QOOAPP_DEVICE_ID is None:
             dotenv_get_set('QOOAPP_DEVICE_ID', self.qooapp.device_id)
             dotenv_get_set('QOOAPP_TOKEN', self.qooapp.token)
+        self.local_folder = None
+        if self.LOCAL_APK_FOLDER is not None:
+            self.local_folder = self.register_tool(LocalFolder, self.LOCAL_APK_FOLDER, self.LOCAL_APK_INDEX)
         self.init_sign_key()
 
+    def init_jvm_profiles(self):
+        """
+        :raises InvalidJVMProfile: a JVM_PROFILE_* value can't be parsed
+        """
+        self.java.set_jvm_profile(self.apktool.file_path, JVMProfile.parse(self.JVM_PROFILE_APKTOOL))
+        self.java.set_jvm_profile(self.apksigner.file_path, JVMProfile.parse(self.JVM_PROFILE_APKSIGNER))
+        self.java.set_jvm_profile(self.dx.file_path, JVMProfile.parse(self.JVM_PROFILE_DX))
+        self.java.set_jvm_profile(self.baksmali.file_path, JVMProfile.parse(self.JVM_PROFILE_BAKSMALI))
+        if self.JVM_PROFILE_DEFAULT is not None:
+            self.java.set_default_jvm_profile(JVMProfile.parse(self.JVM_PROFILE_DEFAULT))
+
     def register_tool(self, tool: Type[ToolType], *args, **kwargs) -> ToolType:
         print(f'Initializing {tool.__name__}...')
         p = tool(*args, **kwargs)
+        p.set_artifact_cache(self.artifact_cache)
         if not p.is_ready():
             p.setup(APKPatcher.on_progress, self)
+            self.progress.flush()
         print(f'Initializing {tool.__name__}...done')
         self.tools[tool] = p
+        if isinstance(p, APKProvider):
+            p.info_cache = self.provider_cache
         return p
 
+    @contextmanager
+    def profiling(self, output_folder: str, python: bool = True, memory: bool = True,
+                  jvm: bool = True) -> Iterator[Profiler]:
+        """
+        Profiles every stage, patch and java tool run inside the block, reports are written to output_folder
+
+        :param python: cProfile the stages and patches
+        :param memory: trace Python allocations with tracemalloc, slows Python code down considerably
+        :param jvm: record java tools with Flight Recorder and log their garbage collection
+        """
+        profiler = Profiler(output_folder, python, memory, jvm)
+        previous = self.profiler
+        self.profiler = profiler
+        self.java.set_profiler(profiler)
+        try:
+            yield profiler
+        finally:
+            self.profiler = previous
+            self.java.set_profiler(previous)
+
+    def cancel(self):
+        """
+        Stops running downloads and extractions, and kills running tool processes with everything they started
+        """
+        self.progress.cancel()
+        self.supervisor.cancel()
+
+    def profile_region(self, name: str) -> ContextManager:
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.profile(name)
+
+    def create_progress_bus(self) -> ProgressBus:
+        output = self.PROGRESS_OUTPUT
+        if output == 'auto':
+            output = 'bar' if sys.stdout.isatty() else 'log'
+        bus = ProgressBus([MetricsSubscriber(self.metrics)])
+        if output == 'bar':
+            bus.subscribe(TqdmSubscriber())
+        elif output == 'log':
+            bus.subscribe(LogSubscriber())
+        elif output != 'none':
+            raise Exception(f'unknown PROGRESS_OUTPUT {output}, expected auto, bar, log or none')
+        return bus
+
     def on_progress(self, progress: ProgressData) -> bool:
-        if progress.stage == ProgressStage.START or progress.stage == ProgressStage.RESET:
-            if hasattr(self, 'progressbar'):
-                self.progressbar.close()
-            config = {
-                'desc': progress.description
-            }
-            if progress.type == ProgressType.FILE:
-                config['unit'] = 'B'
-                config['unit_scale'] = True
-            self.progressbar = tqdm(**config)
-            self.progressbar.update()
-        elif progress.stage == ProgressStage.PROGRESS:
-            self.progressbar.total = progress.total
-            self.progressbar.update(progress.delta)
-        elif progress.stage == ProgressStage.STOP:
-            self.progressbar.update(progress.total - progress.current)
-            self.progressbar.close()
-        return True
+        """
+        ProgressCallback for tools, with the APKPatcher as user var. Events go to self.progress, call
+        self.progress.cancel() to stop running downloads and extractions.
+        """
+        return self.progress.publish(progress)
 
     def init_sign_key(self):
         print('Initializing signing keys...', end='')
@@ -117,10 +341,14 @@ class APKPatcher:
             print('done')
             return
 
-        if os.path.exists(self.SIGN_KEY) != os.path.exists(self.SIGN_CERT):
-            raise Exception(f'Missing sign key or cert! Delete the remaining one to regenerate.')
+        # Only one worker generates the key pair, the others wait and use it
+        with FileLock(f'{self.SIGN_KEY}.lock'):
+            if os.path.exists(self.SIGN_KEY) != os.path.exists(self.SIGN_CERT):
+                raise Exception(f'Missing sign key or cert! Delete the remaining one to regenerate.')
 
-        Certificate(self.KEY_SIZE).save(self.SIGN_KEY, self.SIGN_CERT)
+            if not os.path.exists(self.SIGN_KEY):
+                from apk_patcher.lib.certificate import Certificate
+                Certificate(self.KEY_SIZE).save(self.SIGN_KEY, self.SIGN_CERT)
         print('done')
 
     def get_apk_info(self, provider: Type[APKProvider], package_name: str,
@@ -131,29 +359,128 @@ class APKPatcher:
 
         apk_provider: APKProvider = self.tools[provider]
 
-        return apk_provider.get_apk_info(package_name, min_sdk_version, available_abi)
+        apk_info = apk_provider.get_cached_apk_info(package_name, min_sdk_version, available_abi)
+        self.provider_cache.save()
+        return apk_info
+
+    def get_apk_infos(self, provider: Type[APKProvider], package_names: List[str],
+                      min_sdk_version: int = APKProvider.COMMON_MIN_SDK,
+                      available_abi: List[str] = APKProvider.COMMON_ABI,
+                      max_workers: Optional[int] = None) -> Dict[str, Union[APKInfo, Exception]]:
+        if provider not in self.tools:
+            raise Exception(f'APK provider {provider.__name__} not registered')
+
+        apk_provider: APKProvider = self.tools[provider]
+
+        return apk_provider.get_apk_infos(package_names, min_sdk_version, available_abi, max_workers)
+
+    def resolve_apk_info(self, package_name: str,
+                         min_sdk_version: int = APKProvider.COMMON_MIN_SDK,
+                         available_abi: List[str] = APKProvider.COMMON_ABI,
+                         providers: Optional[List[Type[APKProvider]]] = None) -> APKInfo:
+        """
+        Queries every registered provider, or only the given ones, at the same time and returns the newest
+        version from the fastest provider. Other providers with the same version are kept as download fallbacks.
+        """
+        if providers is None:
+            providers = [tool for tool in self.tools if issubclass(tool, APKProvider)]
+        for provider in providers:
+            if provider not in self.tools:
+                raise Exception(f'APK provider {provider.__name__} not registered')
+
+        resolver = APKResolver([self.tools[provider] for provider in providers], self.RESOLVE_TIMEOUT)
+        try:
+            with self.metrics.measure('resolve', package=package_name):
+                return resolver.resolve(package_name, min_sdk_version, available_abi)
+        finally:
+            self.provider_cache.save()
+            self.record_provider_lookups(resolver, package_name)
+            self.metrics.flush()
+
+    def record_provider_lookups(self, resolver: APKResolver, package_name: str):
+        """
+        Lookups that didn't finish are recorded as timeouts
+        """
+        now = datetime.utcnow().timestamp()
+        for provider in resolver.providers:
+            name = type(provider).__name__
+            latency, succeeded = resolver.lookup_times.get(name, (resolver.timeout or 0, False))
+            result = 'ok' if succeeded else 'error' if name in resolver.lookup_times else 'timeout'
+            self.metrics.record(MetricEvent('provider_lookup', {'provider': name, 'package': package_name},
+                                            now - latency, latency, result))
 
     def get_apk(self, apk_info: APKInfo) -> APK:
         print(f'Loading latest version of {apk_info.package_name}...', end='')
 
         apk_version_folder = os.path.join(self.APK_FOLDER, apk_info.package_name, apk_info.version_name)
-        apk_unpack_folder_path = os.path.join(apk_version_folder, f'{apk_info.package_name}')
         apk_download_path = os.path.join(apk_version_folder, f'{apk_info.package_name}.apk')
 
-        apk_provider: APKProvider = self.tools[apk_info.provider]
+        # Workers loading the same version wait for the one downloading it
+        with self.lock_version_folder(apk_version_folder):
+            sources = [apk_info] + apk_info.mirrors
+            for i, source in enumerate(sources):
+                try:
+                    self.download_apk_files(source, apk_download_path, apk_version_folder)
+                    break
+                except ProgressCancelled:
+                    raise
+                except Exception as e:
+                    if i == len(sources) - 1:
+                        raise
+                    split_file_paths = self.split_file_paths(source, apk_version_folder)
+                    for file_path in [apk_download_path] + list(split_file_paths.values()):
+                        if os.path.exists(file_path):
+                            os.remove(file_path)
+                    print(f'\n\t{source.provider.__name__}: {e}, '
+                          f'falling back to {sources[i + 1].provider.__name__}', end='')
+            # noinspection PyUnboundLocalVariable
+            apk_info = source
 
-        if not os.path.exists(apk_download_path):
-            apk_provider.download_apk(apk_info, apk_download_path, APKPatcher.on_progress, self)
+            verify_download(apk_download_path, sources)
 
-        if not apk_provider.is_download_valid(apk_download_path, apk_info):
-            raise Exception('downloaded apk is invalid')
+            metadata = inspect_apk(apk_download_path)
+            if metadata.package_name != apk_info.package_name or metadata.version_code != int(apk_info.version_code):
+                raise Exception(f'downloaded apk {metadata.package_name} v{metadata.version_code} does not match '
+                                f'{apk_info.package_name} v{apk_info.version_code}')
+
+            split_file_paths = self.split_file_paths(apk_info, apk_version_folder)
+            for split_name, split_file_path in split_file_paths.items():
+                metadata = inspect_apk(split_file_path)
+                if metadata.package_name != apk_info.package_name or metadata.split_name != split_name:
+                    raise Exception(f'downloaded split {metadata.package_name} {metadata.split_name} does not match '
+                                    f'{apk_info.package_name} {split_name}')
+
+            digests = {
+                name: binascii.hexlify(hash_file(file_path, 'sha256')).decode()
+                for name, file_path in {APKSplit.BASE_NAME: apk_download_path, **split_file_paths}.items()
+            }
+            for name, file_path in {APKSplit.BASE_NAME: apk_download_path, **split_file_paths}.items():
+                self.apk_store.deduplicate(file_path, digests[name])
 
         load_time = datetime.utcnow()
+        self.touch_apk(apk_info.package_name, os.path.basename(apk_version_folder))
 
         apk_version_folder = os.path.join(self.APK_FOLDER, apk_info.package_name, apk_info.version_name)
-        apk_pack_file_name = f'{apk_info.package_name}-{apk_info.version_name}-{math.trunc(load_time.timestamp())}'
+        # Decoded trees go to the RAM workspace, unless this version was already decoded on disk
+        workspace_folder = apk_version_folder
+        if not os.path.exists(os.path.join(apk_version_folder, apk_info.package_name)):
+            input_size = sum(os.path.getsize(file_path)
+                             for file_path in [apk_download_path] + list(split_file_paths.values()))
+            workspace_folder = self.workspace.allocate(apk_info.package_name, apk_info.version_name,
+                                                       input_size) or apk_version_folder
+        apk_unpack_folder_path = os.path.join(workspace_folder, f'{apk_info.package_name}')
+        # Output names don't change between runs, so the pipeline can tell whether they are up to date
+        apk_pack_file_name = f'{apk_info.package_name}-{apk_info.version_name}'
         apk_pack_file_path = os.path.join(apk_version_folder, f'{apk_pack_file_name}.apk')
         apk_sign_file_path = os.path.join(apk_version_folder, f'{apk_pack_file_name}.signed.apk')
+        apk_set_file_path = os.path.join(apk_version_folder, f'{apk_pack_file_name}.apks')
+
+        recipe = [{
+            'stage': 'apk',
+            'package_name': apk_info.package_name,
+            'version_code': int(apk_info.version_code),
+            'sha256': digests
+        }]
 
         print('done')
         return APK(
@@ -162,46 +489,499 @@ class APKPatcher:
             load_time,
             apk_unpack_folder_path,
             apk_pack_file_path,
-            apk_sign_file_path
+            apk_sign_file_path,
+            apk_set_file_path,
+            [
+                APKSplit(
+                    split,
+                    split_file_paths[split.name],
+                    os.path.join(workspace_folder, f'{apk_info.package_name}.{split.name}'),
+                    os.path.join(apk_version_folder, f'{apk_pack_file_name}.{split.name}.apk'),
+                    os.path.join(apk_version_folder, f'{apk_pack_file_name}.{split.name}.signed.apk')
+                )
+                for split in apk_info.splits
+            ],
+            recipe
+        )
+
+    @staticmethod
+    def lock_version_folder(apk_version_folder: str) -> FileLock:
+        """
+        Lock of an APK version folder, held while downloading into it or running a build stage on it
+        """
+        return FileLock(f'{apk_version_folder}.lock')
+
+    def lock_apk(self, apk: APK) -> FileLock:
+        return self.lock_version_folder(os.path.dirname(apk.file_path))
+
+    def touch_apk(self, package_name: str, version_name: str):
+        """
+        Marks the version as used in the APK store, RAM workspaces of the versions it evicted are deleted too
+        """
+        for name in self.apk_store.touch(package_name, version_name):
+            self.workspace.remove(*name.split('/'))
+
+    @staticmethod
+    def open_resource_table(apk_file_path: str) -> Optional[ResourceTable]:
+        """
+        None for APK's without a resource table, e.g. native library splits
+        """
+        try:
+            return ResourceTable.open(apk_file_path)
+        except (InvalidResourceChunk, UnsupportedZip):
+            return None
+
+    def pin_apk(self, apk_info: APKInfo) -> ContextManager[str]:
+        """
+        Keeps the APK's version folder from being evicted from the APK store, from before get_apk until the
+        build outputs are no longer needed
+        """
+        return self.apk_store.pinned(apk_info.package_name, apk_info.version_name)
+
+    @staticmethod
+    def split_file_paths(apk_info: APKInfo, apk_version_folder: str) -> Dict[str, str]:
+        return {
+            split.name: os.path.join(apk_version_folder, f'{apk_info.package_name}.{split.name}.apk')
+            for split in apk_info.splits
+        }
+
+    def download_apk_files(self, apk_info: APKInfo, apk_download_path: str, apk_version_folder: str):
+        """
+        Downloads the base APK and its splits concurrently, only the base APK reports progress
+        """
+        apk_provider: APKProvider = self.tools[apk_info.provider]
+        split_file_paths = self.split_file_paths(apk_info, apk_version_folder)
+
+        def download(split: Optional[APKSplitInfo]):
+            file_path = apk_download_path if split is None else split_file_paths[split.name]
+            key = self.download_artifact_key(apk_info, split)
+            downloaded = False
+            if not os.path.exists(file_path):
+                with self.metrics.measure('download', provider=apk_info.provider.__name__,
+                                          package=apk_info.package_name, split=split and split.name) as event:
+                    event.labels['source'] = 'artifact_cache'
+                    if key is None or not self.artifact_cache.fetch_file(key, file_path):
+                        event.labels['source'] = 'provider'
+                        if split is None:
+                            apk_provider.download_apk(apk_info, file_path, APKPatcher.on_progress, self)
+                        else:
+                            apk_provider.download_split(apk_info, split, file_path, None, None)
+                        downloaded = True
+                    event.values['bytes'] = os.path.getsize(file_path)
+            valid = apk_provider.is_download_valid(file_path, split or apk_info)
+            if valid and downloaded and key is not None:
+                self.artifact_cache.store_file(key, file_path)
+            return valid
+
+        valid = self.run_parallel(download, [None] + apk_info.splits)
+        self.progress.flush()
+        if not all(valid):
+            # The cached info may be stale, look it up again next time
+            self.provider_cache.invalidate(apk_info.provider, apk_info.package_name, apk_info.sdk_version,
+                                           apk_info.available_abi)
+            self.provider_cache.save()
+            raise Exception('downloaded apk is invalid')
+
+    def download_artifact_key(self, apk_info: APKInfo, split: Optional[APKSplitInfo]) -> Optional[str]:
+        """
+        Downloads are only shared when the provider gives a file hash, otherwise the file can't be identified
+        """
+        info = split or apk_info
+        if not self.artifact_cache.enabled or info.file_hash is None or info.file_hash_type is None:
+            return None
+        return ArtifactCache.recipe_key('apk', package_name=apk_info.package_name,
+                                        version_code=int(apk_info.version_code),
+                                        split=split.name if split is not None else None,
+                                        hash_type=info.file_hash_type.name,
+                                        hash=binascii.hexlify(info.file_hash).decode())
+
+    @staticmethod
+    def min_sdk_version(file_path: str) -> int:
+        """
+        minSdkVersion of the APK's manifest, Android defaults it to 1 when the manifest leaves it out
+        """
+        return inspect_apk(file_path).min_sdk_version or 1
+
+    @staticmethod
+    def build_artifact_key(apk: APK, kind: str, target: str) -> str:
+        return ArtifactCache.recipe_key(kind, recipe=apk.recipe, target=target)
+
+    @staticmethod
+    def patch_cache_key(apk: APK, patch: Type[Patch], config: Optional[Dict[str, Any]],
+                        split_name: Optional[str], code: str) -> str:
+        """
+        The recipe so far stands for the decoded APK the patch gets, its digests and the stages before
+
+        :param code: PatchCache.code_digest of the patch
+        """
+        return ArtifactCache.recipe_key(
+            'patch', recipe=apk.recipe, split=split_name,
+            patch=f'{patch.__module__}.{patch.__qualname__}', code=code, config=config or {}
         )
 
-    def unpack_apk(self, apk: APK, clean: bool = False):
+    def run_parallel(self, fn: Callable[[T], R], items: List[T]) -> List[R]:
+        """
+        Runs fn for the base APK and its splits at the same time, the first exception is raised
+        """
+        if len(items) == 1:
+            return [fn(items[0])]
+        with ThreadPoolExecutor(self.SPLIT_MAX_WORKERS) as executor:
+            return list(executor.map(fn, items))
+
+    def measure_tool(self, tool: Tool, target: str):
+        """
+        Records a tool run, a process exiting with an error is recorded as failed
+        """
+        return self.metrics.measure('tool', tool=type(tool).__name__,
+                                    tool_version=tool.version if isinstance(tool, Downloader) else None,
+                                    target=target)
+
+    def run_tool(self, tool: Tool, target: str, job: Callable[[], SupervisedProcess], print_output: bool) -> List[str]:
+        """
+        :return: the last output lines, empty when printed as they arrived
+        :raises ProcessFailed: the tool exited with an error, or was killed by the supervisor
+        """
+        with self.measure_tool(tool, target):
+            proc = job()
+            if print_output:
+                for line in proc.follow():
+                    print(f'\t{line}')
+            proc.check()
+            return [] if print_output else proc.tail
+
+    def run_tools(self, tool: Tool, jobs: Dict[str, Callable[[], SupervisedProcess]]):
+        """
+        Starts the tool processes concurrently and prints their output once each has finished
+        """
+        if len(jobs) == 1:
+            name, job = next(iter(jobs.items()))
+            self.run_tool(tool, name, job, True)
+            return
+        names = list(jobs.keys())
+        outputs = self.run_parallel(lambda name: self.run_tool(tool, name, jobs[name], False), names)
+        for name, lines in zip(names, outputs):
+            for line in lines:
+                print(f'\t[{name}] {line}')
+
+    @apk_folder_locked
+    @measured_stage('unpack', 'apktool')
+    def unpack_apk(self, apk: APK, clean: bool = False, splits: bool = False, resources: bool = True,
+                   sources: bool = True):
+        """
+        :param splits: also decode the split APK's, otherwise they are signed again as they are
+        :param resources: decode resources.arsc and res/, without it they are packed again as they are and
+                          patches look resources up with ResourceTable
+        :param sources: disassemble the dex files to smali, without it they are packed again as they are, see
+                        DexPatch
+        """
         print('Unpacking apk...', end='')
-        if os.path.exists(apk.unpack_folder_path):
-            if clean:
-                print('Deleting existing data...')
-                shutil.rmtree(apk.unpack_folder_path)
-            else:
-                print('done')
-                return
+        apk.recipe.append({'stage': 'unpack', 'apktool': self.apktool.version, 'splits': splits,
+                           'resources': resources, 'sources': sources})
+        targets = {APKSplit.BASE_NAME: (apk.file_path, apk.unpack_folder_path)}
+        if splits:
+            targets.update({split.info.name: (split.file_path, split.unpack_folder_path) for split in apk.splits})
+        for name, (_, unpack_folder_path) in list(targets.items()):
+            if os.path.exists(unpack_folder_path):
+                if clean:
+                    print('Deleting existing data...')
+                    shutil.rmtree(unpack_folder_path)
+                else:
+                    del targets[name]
+                    continue
+            if self.artifact_cache.fetch_tree(self.build_artifact_key(apk, 'decode', name), unpack_folder_path):
+                del targets[name]
+        if len(targets) == 0:
+            print('done')
+            return
         print('')
-        proc = self.apktool.unpack_apk(apk.file_path, apk.unpack_folder_path)
-        print_subprocess_output(proc)
+        options = ([] if resources else ['--no-res']) + ([] if sources else ['--no-src'])
+        self.run_tools(self.apktool, {
+            name: functools.partial(self.apktool.unpack_apk, file_path, unpack_folder_path, options or None)
+            for name, (file_path, unpack_folder_path) in targets.items()
+        })
+        for name, (_, unpack_folder_path) in targets.items():
+            if os.path.exists(unpack_folder_path):
+                self.artifact_cache.store_tree(self.build_artifact_key(apk, 'decode', name), unpack_folder_path)
         print('Unpacking apk...done')
 
-    def apply_patch(self, apk: APK, patch: Type[Patch], config: Optional[Dict[str, Any]] = None):
+    @apk_folder_locked
+    @measured_stage('patch', profiled=False)
+    def apply_patch(self, apk: APK, patch: Type[Patch], config: Optional[Dict[str, Any]] = None,
+                    split_name: Optional[str] = None):
+        """
+        :param split_name: patch a decoded split APK instead of the base APK
+        """
         print(f'Applying {patch.__name__} patch...', end='')
-        if not os.path.exists(apk.unpack_folder_path):
+        unpack_folder_path = apk.unpack_folder_path
+        if split_name is not None:
+            unpack_folder_path = apk.get_split(split_name).unpack_folder_path
+        if not os.path.exists(unpack_folder_path):
             raise Exception('Unable to apply patch, APK has not been unpacked')
-        p = di_class_init(patch, self.tools)
-        if config is not None and len(config) > 0:
-            p.config(**config)
-        p.apply(apk.unpack_folder_path)
-        print('done')
+        replayed = False
+        # Resources of the APK being patched, straight from the APK file
+        container = dict(self.tools)
+        resources = self.open_resource_table(
+            apk.file_path if split_name is None else apk.get_split(split_name).file_path
+        )
+        if resources is not None:
+            container[ResourceTable] = resources
+        # Part of the recipe, so the pack and sign artifacts change with the patch's source and input files
+        code = PatchCache.code_digest(patch)
+        with self.profile_region(f'patch-{patch.__name__}'), resources or nullcontext():
+            p = di_class_init(patch, container)
+            if config is not None and len(config) > 0:
+                p.config(**config)
+            if not patch.cacheable:
+                p.apply(unpack_folder_path)
+            else:
+                key = self.patch_cache_key(apk, patch, config, split_name, code)
+                replayed = self.patch_cache.replay(key, unpack_folder_path)
+                if not replayed:
+                    with self.patch_cache.record(key, unpack_folder_path):
+                        p.apply(unpack_folder_path)
+        apk.recipe.append({
+            'stage': 'patch',
+            'patch': f'{patch.__module__}.{patch.__qualname__}',
+            'code': code,
+            'config': config or {},
+            'split': split_name
+        })
+        print('replayed' if replayed else 'done')
 
+    @apk_folder_locked
+    @measured_stage('pack', 'apktool')
     def pack_apk(self, apk: APK, debuggable: bool = False, clean: bool = False):
+        """
+        Decoded split APK's are built together with the base APK, the others are copied unchanged
+        """
         print('Packing apk...')
+        apk.recipe.append({'stage': 'pack', 'apktool': self.apktool.version, 'debuggable': debuggable})
         options = None
         if debuggable:
             options = [
                 '--debug'
             ]
-        proc = self.apktool.pack_apk(apk.unpack_folder_path, apk.pack_file_path, clean, options)
-        print_subprocess_output(proc)
+        jobs = {
+            APKSplit.BASE_NAME: functools.partial(self.apktool.pack_apk, apk.unpack_folder_path, apk.pack_file_path,
+                                                  clean, options)
+        }
+        for split in apk.splits:
+            if os.path.exists(split.unpack_folder_path):
+                jobs[split.info.name] = functools.partial(self.apktool.pack_apk, split.unpack_folder_path,
+                                                          split.pack_file_path, clean)
+            else:
+                shutil.copyfile(split.file_path, split.pack_file_path)
+        pack_file_paths = apk.pack_file_paths
+        for name in list(jobs.keys()):
+            if self.artifact_cache.fetch_file(self.build_artifact_key(apk, 'pack', name), pack_file_paths[name][0]):
+                print(f'\t[{name}] reused from artifact cache')
+                del jobs[name]
+        self.run_tools(self.apktool, jobs)
+        for name in jobs:
+            if os.path.exists(pack_file_paths[name][0]):
+                self.artifact_cache.store_file(self.build_artifact_key(apk, 'pack', name), pack_file_paths[name][0])
         print('Packing apk...done')
 
-    def sign_apk(self, apk: APK):
+    @apk_folder_locked
+    @measured_stage('optimize')
+    def optimize_apk(self, apk: APK, strip_abi: bool = True, compress_level: int = 9) -> OptimizeResult:
+        print('Optimizing apk...', end='')
+        target_abi = apk.info.available_abi if strip_abi else None
+        apk.recipe.append({'stage': 'optimize', 'target_abi': target_abi, 'compress_level': compress_level})
+        result = OptimizeResult.total(self.run_parallel(
+            lambda pack_file_path: optimize_apk(pack_file_path, target_abi, compress_level),
+            [pack_file_path for pack_file_path, _ in apk.pack_file_paths.values()]
+        ))
+        print(f'done, saved {result.bytes_saved} bytes ({len(result.removed_entries)} entries removed, '
+              f'{result.recompressed_entries} recompressed)')
+        return result
+
+    @apk_folder_locked
+    @measured_stage('align')
+    def align_apk(self, apk: APK, uncompress_native_libs: bool = False, uncompress_resources: bool = False):
+        """
+        Storing native libraries uncompressed only avoids extraction on devices when the manifest
+        sets android:extractNativeLibs="false"
+        """
+        print('Aligning apk...', end='')
+        apk.recipe.append({
+            'stage': 'align',
+            'uncompress_native_libs': uncompress_native_libs,
+            'uncompress_resources': uncompress_resources
+        })
+        self.run_parallel(
+            lambda pack_file_path: zip_align(pack_file_path, uncompress_native_libs, uncompress_resources),
+            [pack_file_path for pack_file_path, _ in apk.pack_file_paths.values()]
+        )
+        print('done')
+
+    @apk_folder_locked
+    @measured_stage('sign')
+    def sign_apk(self, apk: APK, use_apksigner: bool = False):
+        """
+        The base APK and its splits are signed with the same key, as required to install them together
+        """
+        from apk_patcher.lib.signer import UnsupportedSigning, sign_apk
         print('Signing apk...', end='')
-        proc = self.apksigner.sign_apk(apk.pack_file_path, apk.signed_file_path, self.SIGN_KEY, self.SIGN_CERT)
-        print_subprocess_output(proc)
+        min_sdk_version = self.min_sdk_version(apk.pack_file_path)
+        apk.recipe.append({
+            'stage': 'sign',
+            'cert': binascii.hexlify(hash_file(self.SIGN_CERT, 'sha256')).decode(),
+            'apksigner': self.apksigner.version if use_apksigner else None,
+            'min_sdk_version': min_sdk_version
+        })
+
+        def sign(name: str) -> Optional[List[str]]:
+            pack_file_path, signed_file_path = apk.pack_file_paths[name]
+            key = self.build_artifact_key(apk, 'sign', name)
+            if self.artifact_cache.fetch_file(key, signed_file_path):
+                return None
+            output = None
+            if not use_apksigner:
+                try:
+                    sign_apk(pack_file_path, signed_file_path, self.SIGN_KEY, self.SIGN_CERT, min_sdk_version)
+                except (UnsupportedSigning, UnsupportedZip) as e:
+                    print(f'\n\t{e}, falling back to apksigner', end='')
+                    output = []
+            if use_apksigner or output is not None:
+                output = self.run_tool(self.apksigner, name, functools.partial(
+                    self.apksigner.sign_apk, pack_file_path, signed_file_path, self.SIGN_KEY, self.SIGN_CERT
+                ), False)
+            if os.path.exists(signed_file_path):
+                self.artifact_cache.store_file(key, signed_file_path)
+            return output
+
+        outputs = self.run_parallel(sign, list(apk.pack_file_paths.keys()))
+        if all(output is None for output in outputs):
+            print('done')
+            return
+        print('')
+        for output in outputs:
+            for line in output or []:
+                print(f'\t{line}')
         print('...done')
+
+    @apk_folder_locked
+    @measured_stage('bundle')
+    def bundle_apk(self, apk: APK) -> str:
+        """
+        Writes the signed base and split APK's to one .apks archive
+
+        :return: path of the .apks archive
+        """
+        print('Bundling apk...', end='')
+        write_apk_set(apk.apk_set_file_path, apk.signed_file_path,
+                      {split.info.name: split.signed_file_path for split in apk.splits})
+        print('done')
+        return apk.apk_set_file_path
+
+    @apk_folder_locked
+    @measured_stage('build', profiled=False)
+    def build(self, apk: APK, patches: Optional[List[Tuple[Type[Patch], Optional[Dict[str, Any]]]]] = None,
+              splits: bool = False, debuggable: bool = False, optimize: bool = False, align: bool = True,
+              use_apksigner: bool = False, dry_run: bool = False, resources: bool = True,
+              sources: bool = True) -> List[StagePlan]:
+        """
+        Runs unpack + patches, pack (+ optimize, align), sign and bundle as a pipeline. Only the stages whose
+        inputs (files, tool versions, patch classes and configs, options) changed since the last build run again.
+
+        :param patches: (Patch class, config) pairs applied in order to the base APK
+        :param splits: decode the split APK's too
+        :param dry_run: only print which stages would run and why
+        :param resources: decode the resources, see unpack_apk
+        :param sources: disassemble the dex files, see unpack_apk
+        """
+        patches = patches or []
+        apk_version_folder = os.path.dirname(apk.file_path)
+        unpack_folder_paths = [apk.unpack_folder_path]
+        if splits:
+            unpack_folder_paths.extend(split.unpack_folder_path for split in apk.splits)
+        pack_file_paths = [pack_file_path for pack_file_path, _ in apk.pack_file_paths.values()]
+        signed_file_paths = [signed_file_path for _, signed_file_path in apk.pack_file_paths.values()]
+
+        pipeline = Pipeline(
+            os.path.join(apk_version_folder, f'{apk.info.package_name}.pipeline.json'),
+            # apktool writes its build files into the decoded folder
+            [os.path.join(unpack_folder_path, 'build') for unpack_folder_path in unpack_folder_paths]
+        )
+
+        def recorded(action: Callable[[], None]) -> Callable[[], List[Dict[str, Any]]]:
+            """
+            Recipe entries added by a stage are stored with it, so a skipped stage still adds them
+            """
+            def run():
+                start = len(apk.recipe)
+                action()
+                return apk.recipe[start:]
+            return run
+
+        def decode():
+            self.unpack_apk(apk, clean=True, splits=splits, resources=resources, sources=sources)
+            for patch, config in patches:
+                self.apply_patch(apk, patch, config)
+
+        def pack():
+            self.pack_apk(apk, debuggable)
+            if optimize:
+                self.optimize_apk(apk)
+            if align:
+                self.align_apk(apk)
+
+        pipeline.add(PipelineStage(
+            'decode',
+            recorded(decode),
+            inputs=[apk.file_path] + ([split.file_path for split in apk.splits] if splits else []) + sorted({
+                inspect.getsourcefile(patch) for patch, _ in patches if inspect.getsourcefile(patch) is not None
+            } | {
+                path for patch, _ in patches for path in patch.input_paths()
+            }),
+            outputs=unpack_folder_paths,
+            params={
+                'apktool': self.apktool.version,
+                'resources': resources,
+                'sources': sources,
+                'patches': [[f'{patch.__module__}.{patch.__qualname__}', config or {}] for patch, config in patches]
+            },
+            restore=apk.recipe.extend
+        ))
+        pipeline.add(PipelineStage(
+            'pack',
+            recorded(pack),
+            inputs=unpack_folder_paths + [split.file_path for split in apk.splits if not splits],
+            outputs=pack_file_paths,
+            params={
+                'apktool': self.apktool.version,
+                'debuggable': debuggable,
+                'optimize': optimize,
+                'align': align,
+                'abi': apk.info.available_abi
+            },
+            restore=apk.recipe.extend
+        ))
+        pipeline.add(PipelineStage(
+            'sign',
+            recorded(functools.partial(self.sign_apk, apk, use_apksigner)),
+            inputs=pack_file_paths + [self.SIGN_KEY, self.SIGN_CERT],
+            outputs=signed_file_paths,
+            params={
+                'apksigner': self.apksigner.version if use_apksigner else None,
+                'min_sdk_version': self.min_sdk_version(apk.file_path)
+            },
+            restore=apk.recipe.extend
+        ))
+        if len(apk.splits) > 0:
+            pipeline.add(PipelineStage(
+                'bundle',
+                functools.partial(self.bundle_apk, apk),
+                inputs=signed_file_paths,
+                outputs=[apk.apk_set_file_path]
+            ))
+
+        plans = pipeline.run(dry_run)
+        if not dry_run:
+            skipped = [plan.stage.name for plan in plans if not plan.run]
+            if len(skipped) > 0:
+                print(f'Up to date: {", ".join(skipped)}')
+            self.touch_apk(apk.info.package_name, os.path.basename(apk_version_folder))
+            self.workspace.update(apk.info.package_name, os.path.basename(apk_version_folder))
+        return plans
@@ -0,0 +1,6 @@
+import sys
+
+from apk_patcher.benchmark.runner import main
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+import base64
+import json
+import os
+import re
+import threading
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+from urllib.parse import urlparse
+
+from apk_patcher.lib.util import hash_file
+
+
+@dataclass
+class MockFile:
+    file_path: str
+    # Served base64 encoded, like the googlesource downloads
+    encode_base64: bool = False
+
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+    """
+    Offline stand-in for the provider and tool download hosts:
+
+    GET  /files/<name>                  a registered file, optionally base64 encoded
+    POST /v6/users                      QooApp token
+    GET  /v10/apps/<package name>       QooApp app info
+    GET  /v6/apps/<package name>/download
+    """
+    RE_FILE = re.compile(r'^/files/([\w\-.]+)$')
+    RE_QOOAPP_INFO = re.compile(r'^/v10/apps/([\w.]+)$')
+    RE_QOOAPP_DOWNLOAD = re.compile(r'^/v6/apps/([\w.]+)/download$')
+    BUFFER_SIZE = 1024 * 1024  # 1mB
+    # A multiple of 3, so every encoded chunk is complete without padding
+    BASE64_CHUNK_SIZE = 3 * 256 * 1024
+
+    mock: 'MockServer'
+
+    def send_json(self, data: Any, status: int = 200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, file: MockFile):
+        size = os.path.getsize(file.file_path)
+        if file.encode_base64:
+            size = 4 * ((size + 2) // 3)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        with open(file.file_path, 'rb') as f:
+            chunk_size = self.BASE64_CHUNK_SIZE if file.encode_base64 else self.BUFFER_SIZE
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                self.wfile.write(base64.b64encode(chunk) if file.encode_base64 else chunk)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if urlparse(self.path).path == '/v6/users':
+            self.send_json({'token': 'benchmark'})
+            return
+        self.send_error(404)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        match = self.RE_FILE.match(path)
+        if match is not None and match.group(1) in self.mock.files:
+            self.send_file(self.mock.files[match.group(1)])
+            return
+        match = self.RE_QOOAPP_INFO.match(path)
+        if match is not None and match.group(1) in self.mock.apps:
+            self.send_json({'data': self.mock.apps[match.group(1)]})
+            return
+        match = self.RE_QOOAPP_DOWNLOAD.match(path)
+        if match is not None and match.group(1) in self.mock.apps:
+            self.send_file(self.mock.files[f'{match.group(1)}.apk'])
+            return
+        self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockServer:
+    """
+    Local HTTP server for benchmarks, runs in a background thread while used as a context manager
+    """
+    files: Dict[str, MockFile]
+    apps: Dict[str, Dict[str, Any]]
+    server: ThreadingHTTPServer
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.files = {}
+        self.apps = {}
+        handler = type('BoundMockAPIHandler', (MockAPIHandler,), {'mock': self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.__thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def add_file(self, name: str, file_path: str, encode_base64: bool = False) -> str:
+        """
+        :return: download url
+        """
+        self.files[name] = MockFile(os.path.abspath(file_path), encode_base64)
+        return f'{self.url}/files/{name}'
+
+    def add_app(self, package_name: str, apk_file_path: str, version_name: str, version_code: int):
+        """
+        Serves apk_file_path as the QooApp download of package_name
+        """
+        self.add_file(f'{package_name}.apk', apk_file_path)
+        self.apps[package_name] = {
+            'is_apk_ready': True,
+            'apk': {
+                'version_name': version_name,
+                'version_code': version_code,
+                'base_apk_md5': hash_file(apk_file_path, 'md5').hex(),
+                'dl_compatibility': None,
+                'data_pack_needed': False,
+                'obb': None
+            }
+        }
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def __enter__(self) -> 'MockServer':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,420 @@
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+from dataclasses import asdict, dataclass, field, replace
+from typing import Any, Callable, Dict, List, Optional
+
+from apk_patcher.benchmark.mock_server import MockServer
+from apk_patcher.benchmark.synthetic import SyntheticAPK, write_apk, write_decoded_tree
+from apk_patcher.lib.apk_inspector import inspect_apk
+from apk_patcher.lib.apk_optimizer import optimize_apk
+from apk_patcher.lib.archive import Archive
+from apk_patcher.lib.arsc import ResourceTable
+from apk_patcher.lib.certificate import Certificate
+from apk_patcher.lib.downloader import Downloader
+from apk_patcher.lib.signer import sign_apk
+from apk_patcher.lib.smali_patch import SmaliPatch
+from apk_patcher.lib.stream_download import DownloadMiddleware, stream_decode_response_base64, \
+    stream_download_progress
+from apk_patcher.lib.util import hash_file
+from apk_patcher.lib.zip_align import zip_align
+from apk_patcher.patches.change_package_name import ChangePackageName
+from apk_patcher.patches.network_security import AllowAllSSLCerts
+from apk_patcher.tools.apktool import APKTool
+from apk_patcher.tools.java import JDK, JRE, Java
+from apk_patcher.tools.qooapp import QooApp
+
+PRESETS: Dict[str, SyntheticAPK] = {
+    'small': SyntheticAPK(dex_count=1, dex_size=256 * 1024, smali_file_count=100, resource_count=200,
+                          native_lib_count=1, native_lib_size=128 * 1024),
+    'medium': SyntheticAPK(dex_count=2, dex_size=2 * 1024 * 1024, smali_file_count=1000, resource_count=2000,
+                           native_lib_count=2, native_lib_size=1024 * 1024),
+    'large': SyntheticAPK(dex_count=4, dex_size=8 * 1024 * 1024, smali_file_count=5000, resource_count=10000,
+                          native_lib_count=4, native_lib_size=4 * 1024 * 1024)
+}
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    times: List[float] = field(default_factory=list)
+    # Bytes processed by one run, for throughput
+    size: Optional[int] = None
+    skipped: Optional[str] = None
+    error: Optional[str] = None
+
+    @property
+    def median(self) -> float:
+        return statistics.median(self.times)
+
+    @property
+    def min(self) -> float:
+        return min(self.times)
+
+
+@dataclass
+class BenchmarkCase:
+    name: str
+    # Timed, called with an empty folder for every run
+    run: Callable[[str], Optional[int]]
+    # Untimed, called with the same folder before each run
+    prepare: Optional[Callable[[str], None]] = None
+    skipped: Optional[str] = None
+
+
+class BenchmarkJRE(JRE):
+    """
+    The java found on PATH, without looking up releases
+    """
+    @property
+    def metadata(self) -> Downloader.Metadata:
+        return Downloader.Metadata('java', 'system', '', None, None, None)
+
+
+class BenchmarkJDK(JDK):
+    @property
+    def metadata(self) -> Downloader.Metadata:
+        return Downloader.Metadata('javac', 'system', '', None, None, None)
+
+
+class BenchmarkJava(Java):
+    def __init__(self, working_dir: str):
+        self.runtime = BenchmarkJRE(working_dir, 'system')
+        self.dev = BenchmarkJDK(working_dir, 'system')
+
+
+class BenchmarkAPKTool(APKTool):
+    """
+    APKTool downloading from the mock server, or using an existing jar when url is None
+    """
+    def __init__(self, java: Java, working_dir: str, jar_file_path: str, url: Optional[str] = None):
+        self.jar_file_path = jar_file_path
+        self.url = url
+        super().__init__(java, working_dir, 'benchmark')
+        if url is None:
+            self.file_path = jar_file_path
+
+    @property
+    def metadata(self) -> Downloader.Metadata:
+        return Downloader.Metadata(os.path.basename(self.jar_file_path), 'benchmark', self.url,
+                                   'application/x-java-archive', os.path.getsize(self.jar_file_path), None)
+
+    def test_download(self):
+        if self.url is not None:
+            # Only the download is measured, the served jar doesn't have to run
+            return
+        super().test_download()
+
+
+class BenchmarkSmaliPatch(SmaliPatch):
+    target_file = ''
+    line_start = '.method public method0('
+    line_end = '.end method'
+
+    def config(self, **kwargs):
+        pass
+
+    def replace(self, original: str) -> str:
+        return original.replace('return-object v0', 'const/4 v1, 0x0\n\n    return-object v0')
+
+
+class BenchmarkSuite:
+    """
+    Offline benchmarks of every stage, against a synthetic APK and a decoded tree served from a local mock server
+    """
+    spec: SyntheticAPK
+    work_folder: str
+    mock: MockServer
+    apktool_jar: Optional[str]
+    apk_file_path: str
+    tree_folder_path: str
+
+    def __init__(self, spec: SyntheticAPK, work_folder: str, mock: MockServer, apktool_jar: Optional[str] = None,
+                 apk_file_path: Optional[str] = None):
+        self.spec = spec
+        self.work_folder = os.path.abspath(work_folder)
+        self.mock = mock
+        self.apktool_jar = apktool_jar
+        self.input_folder = os.path.join(self.work_folder, 'input')
+        self.apk_file_path = apk_file_path or os.path.join(self.input_folder, f'{spec.package_name}.apk')
+        self.tree_folder_path = os.path.join(self.input_folder, 'decoded')
+        self.key_path = os.path.join(self.input_folder, 'key.pk8')
+        self.cert_path = os.path.join(self.input_folder, 'cert.pem')
+
+    def generate(self):
+        print('Generating synthetic apk...', end='')
+        os.makedirs(self.input_folder, 0o755, exist_ok=True)
+        if not os.path.exists(self.apk_file_path):
+            write_apk(self.spec, self.apk_file_path)
+        write_decoded_tree(self.spec, self.tree_folder_path)
+        Certificate(2048).save(self.key_path, self.cert_path)
+        self.mock.add_file('app.apk', self.apk_file_path)
+        self.mock.add_file('app.apk.b64', self.apk_file_path, encode_base64=True)
+        self.mock.add_app(self.spec.package_name, self.apk_file_path, self.spec.version_name, self.spec.version_code)
+        print('done')
+
+    def copy_apk(self, run_folder: str):
+        shutil.copy2(self.apk_file_path, os.path.join(run_folder, 'in.apk'))
+
+    def copy_tree(self, run_folder: str):
+        shutil.copytree(self.tree_folder_path, os.path.join(run_folder, 'decoded'))
+
+    def download(self, run_folder: str, name: str, middleware: Optional[DownloadMiddleware] = None) -> int:
+        output_file_path = os.path.join(run_folder, 'out.apk')
+        stream_download_progress(f'{self.mock.url}/files/{name}', output_file_path, Downloader.BUFFER_SIZE, None,
+                                 middleware, None, None)
+        return os.path.getsize(output_file_path)
+
+    def qooapp(self) -> QooApp:
+        qooapp = QooApp()
+        qooapp.API_URL = self.mock.url
+        qooapp.setup(None, None)
+        return qooapp
+
+    def qooapp_info(self, run_folder: str) -> None:
+        self.qooapp().get_apk_info(self.spec.package_name, self.spec.min_sdk_version, self.spec.abis)
+
+    def qooapp_download(self, run_folder: str) -> int:
+        qooapp = self.qooapp()
+        apk_info = qooapp.get_apk_info(self.spec.package_name, self.spec.min_sdk_version, self.spec.abis)
+        output_file_path = os.path.join(run_folder, 'out.apk')
+        qooapp.download_apk(apk_info, output_file_path, None, None)
+        return os.path.getsize(output_file_path)
+
+    def tool_download(self, run_folder: str) -> int:
+        # The apk stands in for the apktool jar, only its size matters
+        url = self.mock.add_file('apktool_benchmark.jar', self.apk_file_path)
+        apktool = BenchmarkAPKTool(BenchmarkJava(run_folder), run_folder, self.apk_file_path, url)
+        apktool.download(None, None)
+        return os.path.getsize(apktool.file_path)
+
+    def extract(self, run_folder: str) -> int:
+        Archive(self.apk_file_path).extract_all(os.path.join(run_folder, 'extracted'), None, None)
+        return os.path.getsize(self.apk_file_path)
+
+    def smali_patch(self, run_folder: str) -> int:
+        tree_folder_path = os.path.join(run_folder, 'decoded')
+        smali_files = []
+        for dir_path, _, file_names in os.walk(tree_folder_path):
+            smali_files.extend(os.path.relpath(os.path.join(dir_path, name), tree_folder_path)
+                               for name in file_names if name.endswith('.smali'))
+        for smali_file in smali_files:
+            patch = type('BoundSmaliPatch', (BenchmarkSmaliPatch,), {'target_file': smali_file})()
+            patch.apply(tree_folder_path)
+        return len(smali_files)
+
+    def network_patch(self, run_folder: str):
+        AllowAllSSLCerts().apply(os.path.join(run_folder, 'decoded'))
+
+    def package_rename(self, run_folder: str):
+        patch = ChangePackageName()
+        patch.config(f'{self.spec.package_name}.renamed', rename_classes=True)
+        patch.apply(os.path.join(run_folder, 'decoded'))
+
+    def resource_lookup(self, _: str):
+        """
+        Indexes resources.arsc and reads the value of every drawable
+        """
+        with ResourceTable.open(self.apk_file_path) as resources:
+            names = resources.names('drawable')
+            for name in names:
+                resources.value('drawable', name)
+
+    def optimize(self, run_folder: str) -> int:
+        optimize_apk(os.path.join(run_folder, 'in.apk'), self.spec.abis[:1], zlib.Z_BEST_COMPRESSION)
+        return os.path.getsize(self.apk_file_path)
+
+    def align(self, run_folder: str) -> int:
+        zip_align(os.path.join(run_folder, 'in.apk'))
+        return os.path.getsize(self.apk_file_path)
+
+    def sign(self, run_folder: str) -> int:
+        sign_apk(os.path.join(run_folder, 'in.apk'), os.path.join(run_folder, 'signed.apk'), self.key_path,
+                 self.cert_path, self.spec.min_sdk_version)
+        return os.path.getsize(self.apk_file_path)
+
+    def apktool(self) -> APKTool:
+        return BenchmarkAPKTool(BenchmarkJava(self.work_folder), self.work_folder, self.apktool_jar)
+
+    def apktool_unpack(self, run_folder: str) -> int:
+        self.apktool().unpack_apk(self.apk_file_path, os.path.join(run_folder, 'unpacked')).check()
+        return os.path.getsize(self.apk_file_path)
+
+    def prepare_apktool_pack(self, run_folder: str):
+        self.apktool().unpack_apk(self.apk_file_path, os.path.join(run_folder, 'unpacked')).check()
+
+    def apktool_pack(self, run_folder: str):
+        self.apktool().pack_apk(os.path.join(run_folder, 'unpacked'), os.path.join(run_folder, 'packed.apk')).check()
+
+    def cases(self) -> List[BenchmarkCase]:
+        apktool_skipped = None
+        if self.apktool_jar is None:
+            apktool_skipped = 'no --apktool-jar given'
+        elif shutil.which('java') is None:
+            apktool_skipped = 'java not found on PATH'
+        return [
+            BenchmarkCase('hash_file', lambda _: len(hash_file(self.apk_file_path, 'sha256')) and
+                          os.path.getsize(self.apk_file_path)),
+            BenchmarkCase('stream_download_progress', lambda folder: self.download(folder, 'app.apk')),
+            BenchmarkCase('stream_download_progress_base64',
+                          lambda folder: self.download(folder, 'app.apk.b64', stream_decode_response_base64)),
+            BenchmarkCase('qooapp_get_apk_info', self.qooapp_info),
+            BenchmarkCase('qooapp_download_apk', self.qooapp_download),
+            BenchmarkCase('downloader_download', self.tool_download),
+            BenchmarkCase('archive_extract_all', self.extract),
+            BenchmarkCase('inspect_apk', lambda _: inspect_apk(self.apk_file_path) and
+                          os.path.getsize(self.apk_file_path)),
+            BenchmarkCase('resource_table_lookup', self.resource_lookup),
+            BenchmarkCase('smali_patch_apply', self.smali_patch, self.copy_tree),
+            BenchmarkCase('allow_all_ssl_certs_apply', self.network_patch, self.copy_tree),
+            BenchmarkCase('change_package_name_apply', self.package_rename, self.copy_tree),
+            BenchmarkCase('optimize_apk', self.optimize, self.copy_apk),
+            BenchmarkCase('zip_align', self.align, self.copy_apk),
+            BenchmarkCase('sign_apk', self.sign, self.copy_apk),
+            BenchmarkCase('apktool_unpack', self.apktool_unpack, skipped=apktool_skipped),
+            BenchmarkCase('apktool_pack', self.apktool_pack, self.prepare_apktool_pack, skipped=apktool_skipped)
+        ]
+
+    def run_case(self, case: BenchmarkCase, repeat: int) -> BenchmarkResult:
+        result = BenchmarkResult(case.name, skipped=case.skipped)
+        if case.skipped is not None:
+            return result
+        for i in range(repeat):
+            run_folder = os.path.join(self.work_folder, 'runs', case.name, str(i))
+            shutil.rmtree(run_folder, ignore_errors=True)
+            os.makedirs(run_folder, 0o755)
+            try:
+                if case.prepare is not None:
+                    case.prepare(run_folder)
+                start = time.perf_counter()
+                size = case.run(run_folder)
+                result.times.append(time.perf_counter() - start)
+                if isinstance(size, int) and not isinstance(size, bool):
+                    result.size = size
+            except Exception as e:
+                result.error = f'{type(e).__name__}: {e}'
+                return result
+            finally:
+                shutil.rmtree(run_folder, ignore_errors=True)
+        return result
+
+    def run(self, repeat: int, names: Optional[List[str]] = None) -> List[BenchmarkResult]:
+        results = []
+        for case in self.cases():
+            if names is not None and not any(name in case.name for name in names):
+                continue
+            print(f'Benchmarking {case.name}...', end='', flush=True)
+            result = self.run_case(case, repeat)
+            results.append(result)
+            print(result.skipped and f'skipped ({result.skipped})' or result.error and 'failed' or 'done')
+        return results
+
+
+def format_results(results: List[BenchmarkResult], baseline: Optional[Dict[str, Any]] = None) -> str:
+    lines = [f'{"case":<34}{"median":>10}{"min":>10}{"MB/s":>9}{"baseline":>10}{"change":>9}']
+    baseline_results = (baseline or {}).get('results', {})
+    for result in results:
+        if result.skipped is not None or result.error is not None:
+            lines.append(f'{result.name:<34}{result.skipped or result.error}')
+            continue
+        throughput = ''
+        if result.size is not None and result.size > 1024 and result.median > 0:
+            throughput = f'{result.size / result.median / 1024 / 1024:.1f}'
+        line = f'{result.name:<34}{result.median * 1000:>8.1f}ms{result.min * 1000:>8.1f}ms{throughput:>9}'
+        if result.name in baseline_results:
+            baseline_median = baseline_results[result.name]['median']
+            change = (result.median - baseline_median) / baseline_median * 100 if baseline_median > 0 else 0
+            line += f'{baseline_median * 1000:>8.1f}ms{change:>+8.1f}%'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def regressions(results: List[BenchmarkResult], baseline: Dict[str, Any], threshold: float,
+                min_delta: float = 0.005) -> List[str]:
+    """
+    Cases whose median got slower than the baseline by more than threshold, ignoring differences under min_delta
+    seconds which are timer noise
+    """
+    slower = []
+    for result in results:
+        previous = baseline.get('results', {}).get(result.name)
+        if previous is None or len(result.times) == 0:
+            continue
+        if result.median > previous['median'] * (1 + threshold) and result.median - previous['median'] > min_delta:
+            slower.append(result.name)
+    return slower
+
+
+def save_baseline(results: List[BenchmarkResult], spec: SyntheticAPK, file_path: str):
+    data = {
+        'spec': asdict(spec),
+        'python': sys.version.split()[0],
+        'results': {
+            result.name: {'median': result.median, 'min': result.min, 'size': result.size}
+            for result in results if len(result.times) > 0
+        }
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), 0o755, exist_ok=True)
+    tmp_file_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(tmp_file_path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp_file_path, file_path)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m apk_patcher.benchmark',
+                                     description='Times every build stage offline against a synthetic APK')
+    parser.add_argument('--size', choices=sorted(PRESETS), default='small', help='synthetic apk preset')
+    parser.add_argument('--dex-count', type=int)
+    parser.add_argument('--dex-size', type=int, help='bytes per dex file')
+    parser.add_argument('--smali-files', type=int)
+    parser.add_argument('--resources', type=int)
+    parser.add_argument('--native-libs', type=int, help='libraries per abi')
+    parser.add_argument('--native-lib-size', type=int, help='bytes per library')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--case', action='append', dest='cases', help='only run cases containing this, repeatable')
+    parser.add_argument('--apk', help='benchmark this apk instead of a synthetic one, e.g. for the apktool cases')
+    parser.add_argument('--apktool-jar', help='enables the apktool cases, java must be on PATH')
+    parser.add_argument('--work-folder', help='kept after the run, a temporary folder by default')
+    parser.add_argument('--baseline', help='compare against this baseline file')
+    parser.add_argument('--save-baseline', help='write the results as a baseline file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='fail when a median is this much slower than the baseline, default 0.2 (20%%)')
+    args = parser.parse_args(argv)
+
+    spec = replace(PRESETS[args.size])
+    for option, spec_field in [('dex_count', 'dex_count'), ('dex_size', 'dex_size'),
+                               ('smali_files', 'smali_file_count'), ('resources', 'resource_count'),
+                               ('native_libs', 'native_lib_count'), ('native_lib_size', 'native_lib_size')]:
+        if getattr(args, option) is not None:
+            setattr(spec, spec_field, getattr(args, option))
+
+    work_folder = args.work_folder or tempfile.mkdtemp(prefix='apk_patcher_benchmark_')
+    try:
+        with MockServer() as mock:
+            suite = BenchmarkSuite(spec, work_folder, mock, args.apktool_jar, args.apk)
+            suite.generate()
+            results = suite.run(args.repeat, args.cases)
+    finally:
+        if args.work_folder is None:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    print(format_results(results, baseline))
+    if args.save_baseline is not None:
+        save_baseline(results, spec, args.save_baseline)
+
+    failed = [result.name for result in results if result.error is not None]
+    slower = regressions(results, baseline, args.threshold) if baseline is not None else []
+    if len(slower) > 0:
+        print(f'Slower than baseline: {", ".join(slower)}')
+    return 1 if len(failed) > 0 or len(slower) > 0 else 0
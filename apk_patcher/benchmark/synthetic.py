@@ -0,0 +1,316 @@
+import os
+import random
+import struct
+import textwrap
+import zipfile
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple, Union
+
+from apk_patcher.lib.axml import ResChunk, ResValue
+
+ANDROID_NS = 'http://schemas.android.com/apk/res/android'
+
+# (namespace, name, resource id, value type, value)
+XMLAttribute = Tuple[Optional[str], str, Optional[int], int, Union[str, int]]
+
+
+@dataclass
+class SyntheticAPK:
+    """
+    Shape of a generated APK, sizes are chosen to resemble real apps rather than to be valid ones
+    """
+    package_name: str = 'com.benchmark.app'
+    version_code: int = 1
+    version_name: str = '1.0'
+    min_sdk_version: int = 21
+    dex_count: int = 1
+    dex_size: int = 512 * 1024
+    smali_file_count: int = 200
+    smali_methods_per_file: int = 10
+    resource_count: int = 500
+    native_lib_count: int = 2
+    native_lib_size: int = 256 * 1024
+    abis: List[str] = field(default_factory=lambda: ['armeabi-v7a', 'arm64-v8a', 'x86'])
+    split_name: Optional[str] = None
+    seed: int = 0
+
+    @property
+    def package_path(self) -> str:
+        return self.package_name.replace('.', '/')
+
+
+def random_bytes(rand: random.Random, size: int) -> bytes:
+    # Random.randbytes is 3.9+
+    return rand.getrandbits(size * 8).to_bytes(size, 'little') if size > 0 else b''
+
+
+class StringPoolBuilder:
+    def __init__(self):
+        self.strings: List[str] = []
+
+    def index(self, value: Optional[str]) -> int:
+        if value is None:
+            return ResChunk.NO_ENTRY
+        if value not in self.strings:
+            self.strings.append(value)
+        return self.strings.index(value)
+
+    def build(self) -> bytes:
+        """
+        UTF-16 string pool chunk
+        """
+        offsets = []
+        data = bytearray()
+        for value in self.strings:
+            offsets.append(len(data))
+            data += struct.pack('<H', len(value)) + value.encode('utf-16-le') + b'\0\0'
+        while len(data) % 4 != 0:
+            data += b'\0'
+        header_size = 28
+        body = struct.pack(f'<{len(offsets)}I', *offsets) + bytes(data)
+        return struct.pack('<HHIIIIII', ResChunk.STRING_POOL_TYPE, header_size, header_size + len(body),
+                           len(self.strings), 0, 0, header_size + 4 * len(offsets), 0) + body
+
+
+def write_axml(elements: List[Tuple[str, List[XMLAttribute], List]]) -> bytes:
+    """
+    Compiles a tree of (name, attributes, children) into binary XML, as aapt does for AndroidManifest.xml
+    """
+    strings = StringPoolBuilder()
+    resource_ids: List[int] = []
+
+    def collect(nodes):
+        # Attribute names with a resource id come first in the string pool, matching the resource map
+        for name, attributes, children in nodes:
+            for _, attribute_name, resource_id, _, _ in attributes:
+                if resource_id is not None and attribute_name not in strings.strings:
+                    strings.index(attribute_name)
+                    resource_ids.append(resource_id)
+            collect(children)
+
+    def compile_nodes(nodes) -> bytes:
+        chunks = bytearray()
+        for name, attributes, children in nodes:
+            attribute_data = bytearray()
+            for namespace, attribute_name, _, value_type, value in attributes:
+                if value_type == ResValue.TYPE_STRING:
+                    raw_value = data = strings.index(value)
+                else:
+                    raw_value, data = ResChunk.NO_ENTRY, value
+                attribute_data += struct.pack('<IIIHBBI', strings.index(namespace), strings.index(attribute_name),
+                                              raw_value, 8, 0, value_type, data)
+            body = struct.pack('<II', 1, ResChunk.NO_ENTRY) + struct.pack(
+                '<IIHHHHHH', ResChunk.NO_ENTRY, strings.index(name), 20, 20, len(attributes), 0, 0, 0
+            ) + attribute_data
+            chunks += struct.pack('<HHI', ResChunk.XML_START_ELEMENT_TYPE, 16, 8 + len(body)) + body
+            chunks += compile_nodes(children)
+            body = struct.pack('<IIII', 1, ResChunk.NO_ENTRY, ResChunk.NO_ENTRY, strings.index(name))
+            chunks += struct.pack('<HHI', ResChunk.XML_END_ELEMENT_TYPE, 16, 8 + len(body)) + body
+        return bytes(chunks)
+
+    collect(elements)
+    nodes = compile_nodes(elements)
+    resource_map = struct.pack('<HHI', ResChunk.XML_RESOURCE_MAP_TYPE, 8, 8 + 4 * len(resource_ids)) + \
+        struct.pack(f'<{len(resource_ids)}I', *resource_ids)
+    content = strings.build() + resource_map + nodes
+    return struct.pack('<HHI', ResChunk.XML_TYPE, 8, 8 + len(content)) + content
+
+
+def write_manifest(spec: SyntheticAPK) -> bytes:
+    attributes: List[XMLAttribute] = [
+        (ANDROID_NS, 'versionCode', 0x0101021b, ResValue.TYPE_INT_DEC, spec.version_code),
+        (ANDROID_NS, 'versionName', 0x0101021c, ResValue.TYPE_STRING, spec.version_name),
+        (None, 'package', None, ResValue.TYPE_STRING, spec.package_name)
+    ]
+    if spec.split_name is not None:
+        attributes.append((None, 'split', None, ResValue.TYPE_STRING, spec.split_name))
+    return write_axml([('manifest', attributes, [
+        ('uses-sdk', [(ANDROID_NS, 'minSdkVersion', 0x0101020c, ResValue.TYPE_INT_DEC, spec.min_sdk_version)], []),
+        ('application', [], [])
+    ])])
+
+
+def write_resource_type(type_id: int, config: bytes, values: List[Optional[Tuple[int, int, int]]]) -> bytes:
+    """
+    Type chunk of simple entries, values are (key index, value type, value data) or None for a missing entry
+    """
+    header_size = 20 + len(config)
+    offsets = []
+    entries = bytearray()
+    for value in values:
+        if value is None:
+            offsets.append(ResChunk.NO_ENTRY)
+            continue
+        key, value_type, value_data = value
+        offsets.append(len(entries))
+        entries += struct.pack('<HHI', 8, 0, key) + ResValue.STRUCT.pack(8, 0, value_type, value_data)
+    entries_start = header_size + 4 * len(offsets)
+    return struct.pack('<HHIBBHII', ResChunk.TABLE_TYPE_TYPE, header_size, entries_start + len(entries),
+                       type_id, 0, 0, len(values), entries_start) + config + \
+        struct.pack(f'<{len(offsets)}I', *offsets) + bytes(entries)
+
+
+def write_resource_config(language: str = '') -> bytes:
+    """
+    ResTable_config, default except for the language
+    """
+    config = bytearray(64)
+    struct.pack_into('<I', config, 0, len(config))
+    config[8:8 + len(language)] = language.encode('ascii')
+    return bytes(config)
+
+
+def write_resource_table(spec: SyntheticAPK) -> bytes:
+    """
+    Resource table of one package with the images as drawables and the app name, in English and German
+    """
+    strings = StringPoolBuilder()
+    for i in range(spec.resource_count):
+        strings.index(f'res/drawable/image_{i}.png')
+    app_name = strings.index('Benchmark')
+    app_name_de = strings.index('Benchmark (de)')
+    type_strings = StringPoolBuilder()
+    key_strings = StringPoolBuilder()
+    drawables = [(key_strings.index(f'image_{i}'), ResValue.TYPE_STRING, i) for i in range(spec.resource_count)]
+    app_name_key = key_strings.index('app_name')
+    type_strings.index('drawable')
+    type_strings.index('string')
+    chunks = type_strings.build() + key_strings.build()
+    chunks += struct.pack('<HHIBBHI', ResChunk.TABLE_TYPE_SPEC_TYPE, 16, 16 + 4 * len(drawables), 1, 0, 0,
+                          len(drawables)) + bytes(4 * len(drawables))
+    chunks += write_resource_type(1, write_resource_config(), drawables)
+    chunks += struct.pack('<HHIBBHII', ResChunk.TABLE_TYPE_SPEC_TYPE, 16, 20, 2, 0, 0, 1, 0)
+    chunks += write_resource_type(2, write_resource_config(), [(app_name_key, ResValue.TYPE_STRING, app_name)])
+    chunks += write_resource_type(2, write_resource_config('de'), [(app_name_key, ResValue.TYPE_STRING, app_name_de)])
+    package_header_size = 288
+    name = spec.package_name.encode('utf-16-le')[:254].ljust(256, b'\0')
+    type_strings_size = len(type_strings.build())
+    package = struct.pack('<HHII256sIIIII', ResChunk.TABLE_PACKAGE_TYPE, package_header_size,
+                          package_header_size + len(chunks), 0x7f, name, package_header_size, 0,
+                          package_header_size + type_strings_size, 0, 0) + chunks
+    pool = strings.build()
+    return struct.pack('<HHII', ResChunk.TABLE_TYPE, 12, 12 + len(pool) + len(package), 1) + pool + package
+
+
+def write_apk(spec: SyntheticAPK, output_file_path: str):
+    """
+    Writes an APK with the manifest, dex files, resources and native libraries described by spec
+    """
+    rand = random.Random(spec.seed)
+    os.makedirs(os.path.dirname(os.path.abspath(output_file_path)), 0o755, exist_ok=True)
+    with zipfile.ZipFile(output_file_path, 'w', zipfile.ZIP_DEFLATED) as apk:
+        apk.writestr('AndroidManifest.xml', write_manifest(spec))
+        if spec.split_name is None:
+            for i in range(spec.dex_count):
+                name = 'classes.dex' if i == 0 else f'classes{i + 1}.dex'
+                # Dex files compress about 2:1, half random half repeated bytes is close enough
+                half = spec.dex_size // 2
+                apk.writestr(name, b'dex\n035\0' + random_bytes(rand, half) + bytes(spec.dex_size - half - 8))
+            apk.writestr('resources.arsc', write_resource_table(spec), zipfile.ZIP_STORED)
+            for i in range(spec.resource_count):
+                # Already compressed images
+                image = b'\x89PNG\r\n\x1a\n' + random_bytes(rand, rand.randint(200, 4000))
+                apk.writestr(f'res/drawable/image_{i}.png', image, zipfile.ZIP_STORED)
+        for abi in spec.abis:
+            for i in range(spec.native_lib_count):
+                apk.writestr(f'lib/{abi}/libnative{i}.so', b'\x7fELF' + random_bytes(rand, spec.native_lib_size - 4))
+
+
+def write_smali_class(spec: SyntheticAPK, class_name: str) -> str:
+    methods = []
+    for i in range(spec.smali_methods_per_file):
+        methods.append(textwrap.dedent(f'''\
+            .method public method{i}(Ljava/lang/String;I)Ljava/lang/String;
+                .registers 5
+
+                new-instance v0, Ljava/lang/StringBuilder;
+
+                invoke-direct {{v0}}, Ljava/lang/StringBuilder;-><init>()V
+
+                invoke-virtual {{v0, p1}}, Ljava/lang/StringBuilder;->append(Ljava/lang/String;)Ljava/lang/StringBuilder;
+
+                const-string v1, "{class_name}.method{i}"
+
+                invoke-virtual {{v0, v1}}, Ljava/lang/StringBuilder;->append(Ljava/lang/String;)Ljava/lang/StringBuilder;
+
+                invoke-virtual {{v0}}, Ljava/lang/StringBuilder;->toString()Ljava/lang/String;
+
+                move-result-object v0
+
+                return-object v0
+            .end method
+        '''))
+    return textwrap.dedent(f'''\
+        .class public L{spec.package_path}/{class_name};
+        .super Ljava/lang/Object;
+        .source "{class_name}.java"
+
+
+        # direct methods
+        .method public constructor <init>()V
+            .registers 1
+
+            invoke-direct {{p0}}, Ljava/lang/Object;-><init>()V
+
+            return-void
+        .end method
+
+
+        # virtual methods
+    ''') + '\n'.join(methods)
+
+
+def write_decoded_tree(spec: SyntheticAPK, output_folder_path: str):
+    """
+    Writes a folder shaped like the output of apktool d, for benchmarking patches without apktool
+    """
+    rand = random.Random(spec.seed)
+    os.makedirs(output_folder_path, 0o755, exist_ok=True)
+    with open(os.path.join(output_folder_path, 'AndroidManifest.xml'), 'w') as f:
+        f.write(textwrap.dedent(f'''\
+            <?xml version="1.0" encoding="utf-8" standalone="no"?>
+            <manifest xmlns:android="{ANDROID_NS}" package="{spec.package_name}">
+                <application android:label="@string/app_name">
+                    <activity android:name="{spec.package_name}.Class0"/>
+                </application>
+            </manifest>
+        '''))
+    with open(os.path.join(output_folder_path, 'apktool.yml'), 'w') as f:
+        f.write(textwrap.dedent(f'''\
+            version: 2.5.0
+            apkFileName: {spec.package_name}.apk
+            sdkInfo:
+              minSdkVersion: '{spec.min_sdk_version}'
+            versionInfo:
+              versionCode: '{spec.version_code}'
+              versionName: {spec.version_name}
+        '''))
+
+    for i in range(spec.smali_file_count):
+        dex_index = i % spec.dex_count
+        smali_folder = 'smali' if dex_index == 0 else f'smali_classes{dex_index + 1}'
+        class_file_path = os.path.join(output_folder_path, smali_folder, *spec.package_path.split('/'),
+                                       f'Class{i}.smali')
+        os.makedirs(os.path.dirname(class_file_path), 0o755, exist_ok=True)
+        with open(class_file_path, 'w') as f:
+            f.write(write_smali_class(spec, f'Class{i}'))
+
+    values_folder = os.path.join(output_folder_path, 'res', 'values')
+    drawable_folder = os.path.join(output_folder_path, 'res', 'drawable')
+    os.makedirs(values_folder, 0o755, exist_ok=True)
+    os.makedirs(drawable_folder, 0o755, exist_ok=True)
+    with open(os.path.join(values_folder, 'strings.xml'), 'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<resources>\n    <string name="app_name">Benchmark</string>\n')
+        for i in range(spec.resource_count):
+            f.write(f'    <string name="string_{i}">Value {i}</string>\n')
+        f.write('</resources>\n')
+    for i in range(spec.resource_count):
+        with open(os.path.join(drawable_folder, f'image_{i}.png'), 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n' + random_bytes(rand, rand.randint(200, 4000)))
+
+    for abi in spec.abis:
+        lib_folder = os.path.join(output_folder_path, 'lib', abi)
+        os.makedirs(lib_folder, 0o755, exist_ok=True)
+        for i in range(spec.native_lib_count):
+            with open(os.path.join(lib_folder, f'libnative{i}.so'), 'wb') as f:
+                f.write(b'\x7fELF' + random_bytes(rand, spec.native_lib_size - 4))
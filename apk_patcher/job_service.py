@@ -0,0 +1,221 @@
+import argparse
+import importlib
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from contextlib import ExitStack, nullcontext
+from dataclasses import dataclass, field, fields
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from apk_patcher.apk_patcher import APKPatcher
+from apk_patcher.lib.apk_provider import APKProvider
+from apk_patcher.lib.job_queue import HTTPJobQueue, Job, JobLeaseLost, JobQueue, SQLiteJobQueue
+from apk_patcher.lib.job_server import create_job_server
+from apk_patcher.lib.patch import Patch
+
+
+@dataclass
+class JobSpec:
+    package_name: str
+    # Provider class names, e.g. ['QooApp'], all registered providers when empty
+    providers: List[str] = field(default_factory=list)
+    min_sdk_version: int = APKProvider.COMMON_MIN_SDK
+    available_abi: List[str] = field(default_factory=lambda: list(APKProvider.COMMON_ABI))
+    # [patch class path, config] pairs, e.g. [['apk_patcher.patches.network_security.AllowAllSSLCerts', {}]]
+    patches: List[Tuple[str, Optional[Dict[str, Any]]]] = field(default_factory=list)
+    splits: bool = False
+    debuggable: bool = False
+    optimize: bool = False
+    align: bool = True
+    use_apksigner: bool = False
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> 'JobSpec':
+        known = set(f.name for f in fields(cls))
+        unknown = set(data.keys()) - known
+        if len(unknown) > 0:
+            raise Exception(f'unknown job options: {", ".join(sorted(unknown))}')
+        return cls(**data)
+
+    @staticmethod
+    def load_patch(path: str) -> Type[Patch]:
+        module_name, _, class_name = path.rpartition('.')
+        patch = getattr(importlib.import_module(module_name), class_name, None)
+        if not isinstance(patch, type) or not issubclass(patch, Patch):
+            raise Exception(f'{path} is not a Patch class')
+        return patch
+
+
+def open_job_queue() -> JobQueue:
+    """
+    The queue server given by JOB_QUEUE_URL, otherwise the local SQLite queue in DIST_FOLDER
+    """
+    if APKPatcher.JOB_QUEUE_URL is not None:
+        return HTTPJobQueue(APKPatcher.JOB_QUEUE_URL, token=APKPatcher.JOB_QUEUE_TOKEN)
+    return SQLiteJobQueue(APKPatcher.JOB_QUEUE_FILE, APKPatcher.JOB_ARTIFACT_FOLDER, APKPatcher.JOB_LEASE_TIMEOUT)
+
+
+class JobWorker:
+    """
+    Runs queued jobs one after another with the same APKPatcher, so tools are set up and the provider
+    and artifact caches are loaded once per worker instead of once per job
+    """
+    POLL_INTERVAL = 2
+
+    patcher: APKPatcher
+    queue: JobQueue
+    name: str
+
+    def __init__(self, patcher: APKPatcher, queue: JobQueue, name: Optional[str] = None):
+        """
+        :param name: unique among the workers of the queue, leases belong to it
+        """
+        self.patcher = patcher
+        self.queue = queue
+        self.name = name or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+    def run_job(self, job: Job) -> Dict[str, Any]:
+        spec = JobSpec.from_json(job.spec)
+        providers = None
+        if len(spec.providers) > 0:
+            by_name = {tool.__name__: tool for tool in self.patcher.tools if issubclass(tool, APKProvider)}
+            for name in spec.providers:
+                if name not in by_name:
+                    raise Exception(f'APK provider {name} not registered')
+            providers = [by_name[name] for name in spec.providers]
+        patches = [(spec.load_patch(path), config) for path, config in spec.patches]
+
+        # Reports of every job go to their own folder
+        profile_folder = None
+        if APKPatcher.PROFILE_FOLDER is not None:
+            profile_folder = os.path.abspath(os.path.join(APKPatcher.PROFILE_FOLDER, job.id))
+        # Other workers evicting from the APK store leave the version folder alone until it is uploaded
+        with ExitStack() as pins:
+            with self.patcher.profiling(profile_folder) if profile_folder is not None else nullcontext():
+                apk_info = self.patcher.resolve_apk_info(spec.package_name, spec.min_sdk_version,
+                                                         spec.available_abi, providers)
+                pins.enter_context(self.patcher.pin_apk(apk_info))
+                apk = self.patcher.get_apk(apk_info)
+                plans = self.patcher.build(apk, patches, spec.splits, spec.debuggable, spec.optimize, spec.align,
+                                           spec.use_apksigner)
+
+            artifact_paths = [signed_file_path for _, signed_file_path in apk.pack_file_paths.values()]
+            if len(apk.splits) > 0:
+                artifact_paths.append(apk.apk_set_file_path)
+            for artifact_path in artifact_paths:
+                self.queue.put_artifact(job.id, os.path.basename(artifact_path), artifact_path)
+        return {
+            'package_name': apk.info.package_name,
+            'version_name': apk.info.version_name,
+            'version_code': apk.info.version_code,
+            'provider': apk.info.provider.__name__,
+            'stages': {plan.stage.name: plan.reason if plan.run else 'skipped' for plan in plans},
+            'artifacts': [os.path.basename(artifact_path) for artifact_path in artifact_paths],
+            'profile_folder': profile_folder
+        }
+
+    def heartbeat(self, job: Job, done: threading.Event):
+        while not done.wait(APKPatcher.JOB_LEASE_TIMEOUT / 3):
+            try:
+                self.queue.heartbeat(job.id, self.name)
+            except JobLeaseLost as e:
+                print(f'\t{e}')
+                # Another worker has the job now, stop its downloads and tools
+                self.patcher.cancel()
+                return
+            except Exception as e:
+                # The queue server may be restarting, the next heartbeat can still keep the lease
+                print(f'\tjob heartbeat failed: {e}')
+
+    def run_once(self) -> bool:
+        """
+        :return: False if the queue was empty
+        """
+        job = self.queue.claim(self.name)
+        if job is None:
+            return False
+        print(f'Running job {job.id} ({job.spec.get("package_name")})...')
+        self.patcher.progress.reset()
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(job, done), daemon=True)
+        heartbeat.start()
+        try:
+            result = self.run_job(job)
+        except Exception:
+            done.set()
+            error = traceback.format_exc()
+            print(error)
+            try:
+                self.queue.fail(job.id, self.name, error)
+            except JobLeaseLost as e:
+                print(f'\t{e}')
+            print(f'Running job {job.id}...failed')
+            return True
+        done.set()
+        try:
+            self.queue.complete(job.id, self.name, result)
+        except JobLeaseLost as e:
+            print(f'\t{e}')
+        print(f'Running job {job.id}...done')
+        return True
+
+    def run_forever(self, stop: Optional[threading.Event] = None):
+        while stop is None or not stop.is_set():
+            if not self.run_once():
+                time.sleep(self.POLL_INTERVAL)
+
+
+def worker_main(name: str):
+    JobWorker(APKPatcher(), open_job_queue(), name).run_forever()
+
+
+def run_workers(count: int, serve: bool = False, host: str = '127.0.0.1', port: int = 8751):
+    """
+    Starts count worker processes and, with serve, the HTTP API in this process. Blocks until interrupted.
+    """
+    server = None
+    if serve:
+        if APKPatcher.JOB_QUEUE_TOKEN is None:
+            print('JOB_QUEUE_TOKEN is not set, the job API is read only')
+        server = create_job_server(open_job_queue(), host, port, APKPatcher.JOB_QUEUE_TOKEN)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f'Job API listening on {host}:{server.server_address[1]}')
+    # Unique across service instances, also on the same host
+    instance = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+    processes = [
+        multiprocessing.Process(target=worker_main, args=(f'{instance}-{i}',), daemon=True)
+        for i in range(count)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+        if server is not None and count == 0:
+            threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        if server is not None:
+            server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m apk_patcher.job_service',
+                                     description='Runs queued APK build jobs in worker processes')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--serve', action='store_true', help='also serve the HTTP job API')
+    parser.add_argument('--host', default='127.0.0.1', help='0.0.0.0 to serve other hosts')
+    parser.add_argument('--port', type=int, default=8751)
+    args = parser.parse_args()
+    run_workers(args.workers, args.serve, args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+import os
+import re
+import struct
+import zlib
+from dataclasses import dataclass
+from functools import cached_property
+from typing import TYPE_CHECKING, Dict, List, Optional, Type, Union
+
+from apk_patcher.lib.apk_provider import APKInfo, APKProvider
+from apk_patcher.lib.axml import AXMLElement, AXMLParser
+from apk_patcher.lib.raw_zip import RawZip, RawZipEntry, RawZipReader
+from apk_patcher.lib.util import worker_pool
+
+if TYPE_CHECKING:
+    from cryptography.hazmat.primitives.hashes import HashAlgorithm
+
+
+class InvalidAPK(Exception):
+    def __init__(self, file_path: str, error: str):
+        super().__init__(f'{os.path.basename(file_path)}: {error}')
+
+
+@dataclass
+class DexHeader:
+    name: str
+    version: str
+    file_size: int
+    string_ids_size: int
+    type_ids_size: int
+    proto_ids_size: int
+    field_ids_size: int
+    method_ids_size: int
+    class_defs_size: int
+
+
+@dataclass
+class APKMetadata:
+    package_name: str
+    version_name: Optional[str]
+    version_code: int
+    min_sdk_version: Optional[int]
+    target_sdk_version: Optional[int]
+    available_abi: List[str]
+    dex_files: List[str]
+    file_size: int
+    split_name: Optional[str] = None
+
+    @property
+    def dex_count(self) -> int:
+        return len(self.dex_files)
+
+    def to_apk_info(self, provider: Type[APKProvider], file_hash: Optional[bytes] = None,
+                    file_hash_type: Optional[Type['HashAlgorithm']] = None) -> APKInfo:
+        return APKInfo(
+            provider,
+            self.package_name,
+            self.version_name or str(self.version_code),
+            self.version_code,
+            self.min_sdk_version or APKProvider.COMMON_MIN_SDK,
+            self.available_abi,
+            file_hash=file_hash,
+            file_hash_type=file_hash_type,
+            file_size=self.file_size
+        )
+
+
+class APKInspector:
+    """
+    Reads APK metadata from the zip central directory, the binary AndroidManifest.xml and dex headers,
+    without decoding the APK with apktool
+    """
+    MANIFEST_PATH = 'AndroidManifest.xml'
+    RE_DEX_FILE = re.compile(r'^classes(\d*)\.dex$')
+    NATIVE_LIB_FOLDER = 'lib'
+
+    # See: https://source.android.com/devices/tech/dalvik/dex-format#header-item
+    DEX_MAGIC = b'dex\n'
+    DEX_HEADER_SIZE = 0x70
+    DEX_HEADER = struct.Struct('<8s4x20sII16xIIIIIIIIIIII8x')
+
+    # See: https://developer.android.com/reference/android/R.attr
+    ATTR_VERSION_CODE = 0x0101021b
+    ATTR_VERSION_NAME = 0x0101021c
+    ATTR_MIN_SDK_VERSION = 0x0101020c
+    ATTR_TARGET_SDK_VERSION = 0x01010270
+
+    file_path: str
+    reader: RawZipReader
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.reader = RawZipReader(file_path)
+
+    def __enter__(self) -> 'APKInspector':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.reader.close()
+
+    @cached_property
+    def entries(self) -> Dict[str, RawZipEntry]:
+        return self.reader.entries_by_name()
+
+    def read_entry(self, entry: RawZipEntry, max_length: Optional[int] = None) -> bytes:
+        """
+        Stored entries are sliced straight from the mmap, deflated entries only decompress up to max_length
+        """
+        if max_length is None:
+            return self.reader.read(entry)
+        self.reader.read_local_header(entry)
+        start = entry.data_offset
+        if entry.compress_type == RawZip.STORED:
+            return self.reader.data[start:start + min(max_length, entry.compress_size)]
+        if entry.compress_type == RawZip.DEFLATED:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return decompressor.decompress(self.reader.data[start:start + entry.compress_size], max_length)
+        return self.reader.read(entry)[:max_length]
+
+    @cached_property
+    def manifest_elements(self) -> Dict[str, AXMLElement]:
+        """
+        First <manifest>, <uses-sdk> and <application> elements of the binary manifest
+        """
+        entry = self.entries.get(self.MANIFEST_PATH)
+        if entry is None:
+            raise InvalidAPK(self.file_path, f'missing {self.MANIFEST_PATH}')
+        elements = {}
+        for element in AXMLParser(self.read_entry(entry)).iter_elements():
+            if element.depth == 0 and element.name != 'manifest':
+                raise InvalidAPK(self.file_path, f'unexpected root element {element.name}')
+            if element.depth <= 1 and element.name not in elements:
+                elements[element.name] = element
+            if element.name == 'application':
+                break
+        return elements
+
+    def manifest_value(self, element_name: str, name: str, resource_id: Optional[int] = None) -> Union[str, int, bool, None]:
+        element = self.manifest_elements.get(element_name)
+        if element is None:
+            return None
+        attribute = element.get(name, resource_id)
+        return attribute.value if attribute is not None else None
+
+    @staticmethod
+    def sdk_version(value: Union[str, int, bool, None]) -> Optional[int]:
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.isdigit():
+            return int(value)
+        return None
+
+    @cached_property
+    def available_abi(self) -> List[str]:
+        abis = set()
+        for name in self.entries:
+            parts = name.split('/')
+            if len(parts) >= 3 and parts[0] == self.NATIVE_LIB_FOLDER and parts[2] != '':
+                abis.add(parts[1])
+        return sorted(abis)
+
+    @cached_property
+    def dex_files(self) -> List[str]:
+        dex_files = [name for name in self.entries if self.RE_DEX_FILE.match(name) is not None]
+        return sorted(dex_files, key=lambda name: int(self.RE_DEX_FILE.match(name).group(1) or 1))
+
+    @property
+    def split_name(self) -> Optional[str]:
+        """
+        Name of a split APK, None for the base APK
+        """
+        split_name = self.manifest_value('manifest', 'split')
+        return split_name if isinstance(split_name, str) and split_name != '' else None
+
+    def dex_header(self, name: str) -> DexHeader:
+        data = self.read_entry(self.entries[name], self.DEX_HEADER_SIZE)
+        if len(data) < self.DEX_HEADER_SIZE or not data.startswith(self.DEX_MAGIC):
+            raise InvalidAPK(self.file_path, f'{name} is not a dex file')
+        (magic, _, file_size, _, string_ids_size, _, type_ids_size, _, proto_ids_size, _, field_ids_size, _,
+         method_ids_size, _, class_defs_size, _) = self.DEX_HEADER.unpack_from(data)
+        return DexHeader(
+            name,
+            magic[4:7].decode(),
+            file_size,
+            string_ids_size,
+            type_ids_size,
+            proto_ids_size,
+            field_ids_size,
+            method_ids_size,
+            class_defs_size
+        )
+
+    def dex_headers(self) -> List[DexHeader]:
+        return [self.dex_header(name) for name in self.dex_files]
+
+    def metadata(self) -> APKMetadata:
+        package_name = self.manifest_value('manifest', 'package')
+        if not isinstance(package_name, str) or package_name == '':
+            raise InvalidAPK(self.file_path, 'manifest is missing the package name')
+        version_code = self.manifest_value('manifest', 'versionCode', self.ATTR_VERSION_CODE)
+        version_name = self.manifest_value('manifest', 'versionName', self.ATTR_VERSION_NAME)
+        return APKMetadata(
+            package_name,
+            str(version_name) if version_name is not None else None,
+            version_code if isinstance(version_code, int) else 0,
+            self.sdk_version(self.manifest_value('uses-sdk', 'minSdkVersion', self.ATTR_MIN_SDK_VERSION)),
+            self.sdk_version(self.manifest_value('uses-sdk', 'targetSdkVersion', self.ATTR_TARGET_SDK_VERSION)),
+            self.available_abi,
+            self.dex_files,
+            os.path.getsize(self.file_path),
+            self.split_name
+        )
+
+
+def inspect_apk(file_path: str) -> APKMetadata:
+    with APKInspector(file_path) as inspector:
+        return inspector.metadata()
+
+
+def inspect_apks(file_paths: List[str], max_workers: Optional[int] = None) -> Dict[str, Union[APKMetadata, Exception]]:
+    """
+    Inspects many APK's in worker processes, or threads where processes can't be started (see worker_pool),
+    failures are returned in place of the metadata
+    """
+    with worker_pool(max_workers) as executor:
+        results = executor.map(_inspect_apk_safe, file_paths, chunksize=32)
+        return dict(zip(file_paths, results))
+
+
+def _inspect_apk_safe(file_path: str) -> Union[APKMetadata, Exception]:
+    try:
+        return inspect_apk(file_path)
+    except Exception as e:
+        # Exceptions with custom __init__ arguments can't be unpickled in the parent process
+        return Exception(str(e))
@@ -0,0 +1,128 @@
+import dataclasses
+import os
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Deque, List, Optional, Tuple
+
+from apk_patcher.lib.raw_zip import RawZip, RawZipEntry, RawZipReader, RawZipWriter, entry_alignment
+
+
+@dataclass
+class OptimizeResult:
+    original_size: int
+    optimized_size: int
+    removed_entries: List[str] = field(default_factory=list)
+    recompressed_entries: int = 0
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_size - self.optimized_size
+
+    @staticmethod
+    def total(results: List['OptimizeResult']) -> 'OptimizeResult':
+        return OptimizeResult(
+            sum(result.original_size for result in results),
+            sum(result.optimized_size for result in results),
+            [name for result in results for name in result.removed_entries],
+            sum(result.recompressed_entries for result in results)
+        )
+
+
+class APKOptimizer:
+    NATIVE_LIB_FOLDER = 'lib'
+
+    target_abi: Optional[List[str]]
+    compress_level: int
+    max_workers: int
+
+    def __init__(self, target_abi: Optional[List[str]] = None, compress_level: int = zlib.Z_BEST_COMPRESSION,
+                 max_workers: Optional[int] = None):
+        """
+        :param target_abi: ABIs to keep native libraries for, None keeps every ABI
+        :param compress_level: zlib level deflated entries are recompressed with, -1 skips recompression
+        """
+        self.target_abi = target_abi
+        self.compress_level = compress_level
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+
+    @classmethod
+    def entry_abi(cls, entry: RawZipEntry) -> Optional[str]:
+        parts = entry.name.split('/')
+        if len(parts) < 3 or parts[0] != cls.NATIVE_LIB_FOLDER:
+            return None
+        return parts[1]
+
+    def stripped_abi(self, entries: List[RawZipEntry]) -> List[str]:
+        if self.target_abi is None:
+            return []
+        apk_abi = {abi for abi in map(self.entry_abi, entries) if abi is not None}
+        if len(apk_abi.intersection(self.target_abi)) == 0:
+            # Removing every ABI would leave the app without its native code
+            return []
+        return sorted(apk_abi.difference(self.target_abi))
+
+    def recompress(self, reader: RawZipReader, entry: RawZipEntry) -> Optional[bytes]:
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = bytearray()
+        for chunk in reader.iter_content(entry):
+            compressed.extend(compressor.compress(chunk))
+        compressed.extend(compressor.flush())
+        if len(compressed) >= entry.compress_size:
+            return None
+        return bytes(compressed)
+
+    def optimize(self, in_apk_file_path: str, out_apk_file_path: str) -> OptimizeResult:
+        result = OptimizeResult(os.path.getsize(in_apk_file_path), 0)
+
+        with RawZipReader(in_apk_file_path) as reader, \
+                ThreadPoolExecutor(self.max_workers) as executor, \
+                open(out_apk_file_path, 'wb') as f:
+            stripped_abi = self.stripped_abi(reader.entries)
+            entries = []
+            for entry in reader.entries:
+                if self.entry_abi(entry) in stripped_abi:
+                    result.removed_entries.append(entry.name)
+                    continue
+                reader.read_local_header(entry)
+                entries.append(entry)
+
+            writer = RawZipWriter(f, comment=reader.comment)
+            # Bound the number of recompressed entries held in memory while keeping the entry order
+            pending: Deque[Tuple[RawZipEntry, Optional[Future]]] = deque()
+
+            def write_next():
+                pending_entry, future = pending.popleft()
+                recompressed = future.result() if future is not None else None
+                if recompressed is None:
+                    with reader.read_raw(pending_entry) as data:
+                        writer.write_raw(pending_entry, data, entry_alignment(pending_entry))
+                    return
+                result.recompressed_entries += 1
+                writer.write_raw(dataclasses.replace(pending_entry, compress_size=len(recompressed)), recompressed)
+
+            for entry in entries:
+                future = None
+                if self.compress_level >= 0 and entry.compress_type == RawZip.DEFLATED:
+                    future = executor.submit(self.recompress, reader, entry)
+                pending.append((entry, future))
+                if len(pending) > self.max_workers * 2:
+                    write_next()
+            while len(pending) > 0:
+                write_next()
+            writer.close()
+            result.optimized_size = writer.offset
+
+        return result
+
+
+def optimize_apk(apk_file_path: str, target_abi: Optional[List[str]], compress_level: int) -> OptimizeResult:
+    tmp_file_path = f'{apk_file_path}.tmp'
+    try:
+        result = APKOptimizer(target_abi, compress_level).optimize(apk_file_path, tmp_file_path)
+        os.replace(tmp_file_path, apk_file_path)
+        return result
+    finally:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
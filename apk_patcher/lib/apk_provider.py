@@ -1,14 +1,35 @@
 import os
 from abc import ABCMeta, abstractmethod
-from dataclasses import dataclass
-from typing import Any, List, Optional, Type
-
-from cryptography.hazmat.primitives.hashes import HashAlgorithm
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, TYPE_CHECKING, Type, Union
 
 from apk_patcher.lib.progress import ProgressCallback
 from apk_patcher.lib.tool import Tool
 from apk_patcher.lib.util import hash_file
 
+if TYPE_CHECKING:
+    from cryptography.hazmat.primitives.hashes import HashAlgorithm
+    from apk_patcher.lib.provider_cache import ProviderInfoCache
+
+
+@dataclass
+class APKSplitInfo:
+    # Split name from the split's manifest, e.g. config.arm64_v8a or config.xxhdpi
+    name: str
+    file_hash: Optional[bytes]
+    file_hash_type: Optional[Type['HashAlgorithm']]
+    file_size: Optional[int]
+
+    ABI_SPLITS = {
+        f'config.{abi.replace("-", "_")}': abi
+        for abi in ('armeabi', 'armeabi-v7a', 'arm64-v8a', 'x86', 'x86_64', 'mips', 'mips64')
+    }
+
+    @property
+    def abi(self) -> Optional[str]:
+        return self.ABI_SPLITS.get(self.name)
+
 
 @dataclass
 class APKInfo:
@@ -19,25 +40,68 @@ class APKInfo:
     sdk_version: int
     available_abi: List[str]
     file_hash: Optional[bytes]
-    file_hash_type: Optional[Type[HashAlgorithm]]
+    file_hash_type: Optional[Type['HashAlgorithm']]
     file_size: Optional[int]
+    # Split APK's installed together with the base APK described above
+    splits: List[APKSplitInfo] = field(default_factory=list)
+    # Other providers offering the same file, tried in order when downloading from provider fails
+    mirrors: List['APKInfo'] = field(default_factory=list)
 
 
 class APKProvider(Tool, metaclass=ABCMeta):
     COMMON_ABI = ['armeabi-v7a']
     COMMON_MIN_SDK = 21
+    BATCH_MAX_WORKERS = 8
+
+    info_cache: Optional['ProviderInfoCache'] = None
 
     @abstractmethod
     def get_apk_info(self, package_name: str, sdk_version: int, available_abi: List[str]) -> APKInfo:
         raise NotImplementedError()
 
+    def get_cached_apk_info(self, package_name: str, sdk_version: int, available_abi: List[str]) -> APKInfo:
+        if self.info_cache is not None:
+            apk_info = self.info_cache.get(type(self), package_name, sdk_version, available_abi)
+            if apk_info is not None:
+                return apk_info
+
+        apk_info = self.get_apk_info(package_name, sdk_version, available_abi)
+
+        if self.info_cache is not None:
+            self.info_cache.put(apk_info, sdk_version, available_abi)
+        return apk_info
+
+    def get_apk_infos(self, package_names: List[str], sdk_version: int, available_abi: List[str],
+                      max_workers: Optional[int] = None) -> Dict[str, Union[APKInfo, Exception]]:
+        """
+        Resolves many packages concurrently, failed lookups are returned in place of the APKInfo
+        """
+        results = {}
+        with ThreadPoolExecutor(max_workers or self.BATCH_MAX_WORKERS) as executor:
+            futures = {
+                package_name: executor.submit(self.get_cached_apk_info, package_name, sdk_version, available_abi)
+                for package_name in package_names
+            }
+            for package_name, future in futures.items():
+                try:
+                    results[package_name] = future.result()
+                except Exception as e:
+                    results[package_name] = e
+        if self.info_cache is not None:
+            self.info_cache.save()
+        return results
+
     @abstractmethod
     def download_apk(self, apk_info: APKInfo, output_file_path: str, on_progress: Optional[ProgressCallback],
                      progress_user_var: Optional[Any]):
         raise NotImplementedError()
 
+    def download_split(self, apk_info: APKInfo, split: APKSplitInfo, output_file_path: str,
+                       on_progress: Optional[ProgressCallback], progress_user_var: Optional[Any]):
+        raise Exception(f'{type(self).__name__} does not provide split apks')
+
     @staticmethod
-    def is_download_valid(download_path: str, apk_info: APKInfo) -> bool:
+    def is_download_valid(download_path: str, apk_info: Union[APKInfo, APKSplitInfo]) -> bool:
         if apk_info.file_hash is not None and apk_info.file_hash_type is not None:
             return hash_file(download_path, apk_info.file_hash_type) == apk_info.file_hash
 
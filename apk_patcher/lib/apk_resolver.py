@@ -0,0 +1,149 @@
+import binascii
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Type
+
+from apk_patcher.lib.apk_provider import APKInfo, APKProvider
+from apk_patcher.lib.util import hash_file
+
+if TYPE_CHECKING:
+    from cryptography.hazmat.primitives.hashes import HashAlgorithm
+
+
+class ResolveError(Exception):
+    def __init__(self, package_name: str, errors: Dict[str, str]):
+        details = ', '.join(f'{provider}: {error}' for provider, error in errors.items())
+        super().__init__(f'unable to resolve {package_name} from any provider ({details})')
+
+
+class ChecksumMismatch(Exception):
+    def __init__(self, error: str):
+        super().__init__(f'checksum mismatch: {error}')
+
+
+@dataclass
+class ProviderResult:
+    provider: APKProvider
+    apk_info: APKInfo
+    latency: float
+
+
+class APKResolver:
+    """
+    Queries several APK providers concurrently. The newest compatible version wins and the providers
+    offering it are ordered by how fast they responded, the first is the source and the rest are fallbacks.
+    """
+    providers: List[APKProvider]
+    timeout: Optional[float]
+    # (seconds, succeeded) of every provider lookup that finished, by provider name
+    lookup_times: Dict[str, Tuple[float, bool]]
+
+    def __init__(self, providers: List[APKProvider], timeout: Optional[float] = None):
+        """
+        :param timeout: seconds to wait for the slowest provider, providers that didn't respond are ignored
+        """
+        if len(providers) == 0:
+            raise Exception('no APK providers to resolve with')
+        self.providers = providers
+        self.timeout = timeout
+        self.lookup_times = {}
+
+    def __lookup(self, provider: APKProvider, package_name: str, sdk_version: int,
+                 available_abi: List[str]) -> ProviderResult:
+        start = time.monotonic()
+        succeeded = False
+        try:
+            apk_info = provider.get_cached_apk_info(package_name, sdk_version, available_abi)
+            succeeded = True
+        finally:
+            self.lookup_times[type(provider).__name__] = (time.monotonic() - start, succeeded)
+        return ProviderResult(provider, apk_info, self.lookup_times[type(provider).__name__][0])
+
+    def query(self, package_name: str, sdk_version: int,
+              available_abi: List[str]) -> Tuple[List[ProviderResult], Dict[str, str]]:
+        """
+        :return: successful lookups and the errors of failed or timed out providers by provider name
+        """
+        executor = ThreadPoolExecutor(len(self.providers))
+        try:
+            futures = {
+                executor.submit(self.__lookup, provider, package_name, sdk_version, available_abi): provider
+                for provider in self.providers
+            }
+            _, not_done = wait(futures.keys(), self.timeout)
+        finally:
+            # Don't wait for providers that timed out, their results are dropped
+            executor.shutdown(wait=False)
+
+        results = []
+        errors = {}
+        for future, provider in futures.items():
+            name = type(provider).__name__
+            if future in not_done:
+                errors[name] = f'timed out after {self.timeout}s'
+            elif future.exception() is not None:
+                errors[name] = str(future.exception())
+            else:
+                results.append(future.result())
+        return results, errors
+
+    @staticmethod
+    def cross_check(apk_infos: List[APKInfo]):
+        """
+        :raises ChecksumMismatch: if providers advertise different files for the same version
+        """
+        seen: Dict[str, Tuple[Type[APKProvider], bytes]] = {}
+        sizes: Dict[int, Type[APKProvider]] = {}
+        for apk_info in apk_infos:
+            if apk_info.file_hash is not None and apk_info.file_hash_type is not None:
+                other = seen.setdefault(apk_info.file_hash_type.name, (apk_info.provider, apk_info.file_hash))
+                if other[1] != apk_info.file_hash:
+                    raise ChecksumMismatch(
+                        f'{apk_info.package_name} v{apk_info.version_code} {apk_info.file_hash_type.name} '
+                        f'{binascii.hexlify(other[1]).decode()} from {other[0].__name__} != '
+                        f'{binascii.hexlify(apk_info.file_hash).decode()} from {apk_info.provider.__name__}'
+                    )
+            if apk_info.file_size is not None:
+                sizes.setdefault(apk_info.file_size, apk_info.provider)
+        if len(sizes) > 1:
+            details = ', '.join(f'{size} bytes from {provider.__name__}' for size, provider in sizes.items())
+            raise ChecksumMismatch(f'{apk_infos[0].package_name} v{apk_infos[0].version_code} sizes differ ({details})')
+
+    def resolve(self, package_name: str, sdk_version: int, available_abi: List[str]) -> APKInfo:
+        """
+        :return: APKInfo of the fastest provider with the newest version, the other providers of that
+                 version are in APKInfo.mirrors
+        :raises ResolveError: if no provider has the package
+        :raises ChecksumMismatch: if providers disagree on the file of the newest version
+        """
+        results, errors = self.query(package_name, sdk_version, available_abi)
+        if len(results) == 0:
+            raise ResolveError(package_name, errors)
+
+        newest_version = max(int(result.apk_info.version_code) for result in results)
+        sources = sorted((result for result in results if int(result.apk_info.version_code) == newest_version),
+                         key=lambda result: result.latency)
+        apk_infos = [result.apk_info for result in sources]
+        self.cross_check(apk_infos)
+
+        apk_info = apk_infos[0]
+        apk_info.mirrors = apk_infos[1:]
+        return apk_info
+
+
+def verify_download(download_path: str, apk_infos: List[APKInfo]):
+    """
+    Checks a download against every hash advertised for it, each hash type is only computed once
+
+    :raises ChecksumMismatch: if any advertised hash doesn't match the file
+    """
+    digests: Dict[Type['HashAlgorithm'], bytes] = {}
+    for apk_info in apk_infos:
+        if apk_info.file_hash is None or apk_info.file_hash_type is None:
+            continue
+        if apk_info.file_hash_type not in digests:
+            digests[apk_info.file_hash_type] = hash_file(download_path, apk_info.file_hash_type)
+        if digests[apk_info.file_hash_type] != apk_info.file_hash:
+            raise ChecksumMismatch(f'download does not match the {apk_info.file_hash_type.name} '
+                                   f'advertised by {apk_info.provider.__name__}')
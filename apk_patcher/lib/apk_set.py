@@ -0,0 +1,20 @@
+import os
+import zipfile
+from typing import Dict
+
+
+def write_apk_set(output_file_path: str, base_file_path: str, split_file_paths: Dict[str, str]):
+    """
+    Writes an .apks archive with base.apk and split_<name>.apk entries, installable with SAI or
+    unpacked for adb install-multiple. APK's are already compressed, so they are stored.
+    """
+    tmp_file_path = f'{output_file_path}.tmp'
+    try:
+        with zipfile.ZipFile(tmp_file_path, 'w', zipfile.ZIP_STORED) as zf:
+            zf.write(base_file_path, 'base.apk')
+            for split_name, split_file_path in split_file_paths.items():
+                zf.write(split_file_path, f'split_{split_name}.apk')
+        os.replace(tmp_file_path, output_file_path)
+    finally:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
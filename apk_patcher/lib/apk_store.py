@@ -0,0 +1,245 @@
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+from apk_patcher.lib.file_lock import FileLock, LockTimeout, SharedFileLock, atomic_output
+
+
+@dataclass
+class StoreEntry:
+    # Bytes of the files only this entry uses, files shared through hardlinks are counted once as objects
+    size: int
+    last_used: float
+
+
+@dataclass
+class StoreIndex:
+    entries: Dict[str, StoreEntry] = field(default_factory=dict)
+    # Size of every deduplicated file, by SHA-256
+    objects: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def size(self) -> int:
+        return sum(entry.size for entry in self.entries.values()) + sum(self.objects.values())
+
+
+class APKStore:
+    """
+    Keeps the version folders of APK_FOLDER (<package name>/<version name>, an entry) under a size cap.
+
+    Identical downloads are stored once, as hardlinks to a file in the objects folder named by its digest.
+    Entry sizes and use times are kept in an index, so eviction doesn't have to walk the folders. The least
+    recently used entries are evicted first, but never an entry that is pinned by a running job or whose
+    version folder lock is held.
+    """
+    INDEX_FILE_NAME = 'apk_store.json'
+    OBJECTS_FOLDER_NAME = '.objects'
+
+    root_folder: str
+    max_size: Optional[int]
+
+    def __init__(self, root_folder: str, max_size: Optional[int] = None):
+        """
+        :param max_size: bytes, None to never evict
+        """
+        self.root_folder = os.path.abspath(root_folder)
+        self.max_size = max_size
+
+    @property
+    def index_file_path(self) -> str:
+        return os.path.join(self.root_folder, self.INDEX_FILE_NAME)
+
+    @property
+    def objects_folder(self) -> str:
+        return os.path.join(self.root_folder, self.OBJECTS_FOLDER_NAME)
+
+    @staticmethod
+    def entry_name(package_name: str, version_name: str) -> str:
+        return f'{package_name}/{version_name}'
+
+    def entry_folder(self, name: str) -> str:
+        return os.path.join(self.root_folder, *name.split('/'))
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_folder, digest[:2], digest)
+
+    def index_lock(self) -> FileLock:
+        return FileLock(f'{self.index_file_path}.lock')
+
+    def pin_lock(self, name: str) -> SharedFileLock:
+        return SharedFileLock(f'{self.entry_folder(name)}.pin')
+
+    @contextmanager
+    def pinned(self, package_name: str, version_name: str) -> Iterator[str]:
+        """
+        Keeps the entry from being evicted while the block runs, a pin ends with the process holding it
+
+        :return: version folder
+        """
+        name = self.entry_name(package_name, version_name)
+        with self.pin_lock(name):
+            yield self.entry_folder(name)
+
+    @contextmanager
+    def unused(self, name: str) -> Iterator[bool]:
+        """
+        Yields False if the entry is pinned or its version folder lock is held, otherwise True with both held
+        until the block ends, so the entry can be deleted
+        """
+        pin_lock = self.pin_lock(name)
+        if not pin_lock.try_acquire_exclusive():
+            yield False
+            return
+        try:
+            # Held while downloading or building, a worker may be between pinning and locking
+            version_lock = FileLock(f'{self.entry_folder(name)}.lock', timeout=0)
+            try:
+                version_lock.acquire()
+            except LockTimeout:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                version_lock.release()
+        finally:
+            pin_lock.release()
+
+    @staticmethod
+    def folder_size(folder_path: str) -> int:
+        """
+        Files with more than one link are shared, with other entries or with the objects folder
+        """
+        size = 0
+        for dir_path, _, file_names in os.walk(folder_path):
+            for file_name in file_names:
+                try:
+                    stat = os.lstat(os.path.join(dir_path, file_name))
+                except OSError:
+                    continue
+                if stat.st_nlink <= 1:
+                    size += stat.st_size
+        return size
+
+    def load_index(self) -> StoreIndex:
+        if not os.path.exists(self.index_file_path):
+            return self.scan()
+        try:
+            with open(self.index_file_path, 'r') as f:
+                data = json.load(f)
+            return StoreIndex(
+                {name: StoreEntry(**entry) for name, entry in data['entries'].items()},
+                data['objects']
+            )
+        except (OSError, ValueError, KeyError, TypeError):
+            return self.scan()
+
+    def save_index(self, index: StoreIndex):
+        os.makedirs(self.root_folder, 0o755, exist_ok=True)
+        with atomic_output(self.index_file_path) as tmp_file_path:
+            with open(tmp_file_path, 'w') as f:
+                json.dump(asdict(index), f)
+
+    def scan(self) -> StoreIndex:
+        """
+        Builds the index from the folders, once for a store made before the index existed
+        """
+        index = StoreIndex()
+        if not os.path.isdir(self.root_folder):
+            return index
+        for package_name in os.listdir(self.root_folder):
+            package_folder = os.path.join(self.root_folder, package_name)
+            if package_name == self.OBJECTS_FOLDER_NAME or not os.path.isdir(package_folder):
+                continue
+            for version_name in os.listdir(package_folder):
+                version_folder = os.path.join(package_folder, version_name)
+                if os.path.isdir(version_folder):
+                    index.entries[self.entry_name(package_name, version_name)] = StoreEntry(
+                        self.folder_size(version_folder), os.path.getmtime(version_folder)
+                    )
+        for dir_path, _, file_names in os.walk(self.objects_folder):
+            for digest in file_names:
+                index.objects[digest] = os.path.getsize(os.path.join(dir_path, digest))
+        return index
+
+    def deduplicate(self, file_path: str, digest: str):
+        """
+        Replaces file_path with a hardlink to the stored file of the same digest, or stores it if it is the first.
+        Nothing changes where hardlinks aren't supported.
+        """
+        object_path = self.object_path(digest)
+        with self.index_lock():
+            index = self.load_index()
+            try:
+                if os.path.exists(object_path):
+                    if os.path.samefile(object_path, file_path):
+                        return
+                    with atomic_output(file_path) as tmp_file_path:
+                        os.link(object_path, tmp_file_path)
+                elif os.stat(file_path).st_nlink > 1:
+                    # Already a link to a file outside the store, e.g. in a LocalFolder
+                    return
+                else:
+                    os.makedirs(os.path.dirname(object_path), 0o755, exist_ok=True)
+                    os.link(file_path, object_path)
+            except OSError:
+                return
+            index.objects[digest] = os.path.getsize(object_path)
+            self.save_index(index)
+
+    def touch(self, package_name: str, version_name: str) -> List[str]:
+        """
+        Records the entry as just used with its current size, then evicts others if the store is over its cap
+
+        :return: evicted entries
+        """
+        name = self.entry_name(package_name, version_name)
+        size = self.folder_size(self.entry_folder(name))
+        with self.index_lock():
+            index = self.load_index()
+            index.entries[name] = StoreEntry(size, time.time())
+            evicted = self.evict(index, name)
+            self.save_index(index)
+        return evicted
+
+    def evict(self, index: StoreIndex, keep: Optional[str] = None) -> List[str]:
+        """
+        Removes least recently used entries from disk and index until the store fits max_size, the index lock
+        must be held
+
+        :param keep: entry that stays, the caller's own
+        """
+        evicted = []
+        if self.max_size is None or index.size <= self.max_size:
+            return evicted
+        for name in sorted(index.entries, key=lambda n: index.entries[n].last_used):
+            if index.size <= self.max_size:
+                break
+            if name == keep:
+                continue
+            with self.unused(name) as unused:
+                if not unused:
+                    continue
+                shutil.rmtree(self.entry_folder(name), ignore_errors=True)
+            del index.entries[name]
+            evicted.append(name)
+            self.collect_objects(index)
+        return evicted
+
+    def collect_objects(self, index: StoreIndex):
+        """
+        Removes stored files no entry links to anymore
+        """
+        for digest in list(index.objects):
+            object_path = self.object_path(digest)
+            try:
+                if os.stat(object_path).st_nlink > 1:
+                    continue
+                os.remove(object_path)
+            except FileNotFoundError:
+                pass
+            del index.objects[digest]
@@ -0,0 +1,347 @@
+import struct
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from apk_patcher.lib.axml import InvalidResourceChunk, ResChunk, ResStringPool, ResValue
+from apk_patcher.lib.raw_zip import RawZip, RawZipReader
+
+
+@dataclass
+class ResourceValue:
+    type: int
+    data: int
+    # Global string pool entry of a string value
+    string: Optional[str] = None
+
+    @property
+    def value(self) -> Union[str, int, float, bool, None]:
+        if self.type == ResValue.TYPE_STRING:
+            return self.string
+        if self.type in (ResValue.TYPE_INT_DEC, ResValue.TYPE_INT_HEX):
+            return struct.unpack('<i', struct.pack('<I', self.data))[0]
+        if self.type == ResValue.TYPE_INT_BOOLEAN:
+            return self.data != 0
+        if self.type == ResValue.TYPE_FLOAT:
+            return struct.unpack('<f', struct.pack('<I', self.data))[0]
+        if ResValue.TYPE_FIRST_COLOR_INT <= self.type <= ResValue.TYPE_LAST_COLOR_INT:
+            return f'#{self.data:08x}'
+        if self.type == ResValue.TYPE_REFERENCE:
+            return f'@0x{self.data:08x}'
+        if self.type == ResValue.TYPE_ATTRIBUTE:
+            return f'?0x{self.data:08x}'
+        if self.type == ResValue.TYPE_NULL:
+            return None
+        return self.data
+
+
+@dataclass
+class ResourceEntry:
+    resource_id: int
+    type_name: str
+    name: str
+    # aapt qualifiers, e.g. en-rUS-xhdpi-v21, empty for the default configuration
+    config: str
+    # Simple values, None for bags (styles, arrays, plurals, ...)
+    value: Optional[ResourceValue] = None
+    parent: Optional[int] = None
+    # Bag items by attribute or index resource ID
+    bag: Dict[int, ResourceValue] = field(default_factory=dict)
+
+
+class ResourceConfig:
+    """
+    Formats a ResTable_config as aapt qualifiers, the common ones only
+    """
+    DENSITIES = {
+        120: 'ldpi', 160: 'mdpi', 213: 'tvdpi', 240: 'hdpi', 320: 'xhdpi', 480: 'xxhdpi', 640: 'xxxhdpi',
+        0xfffe: 'anydpi', 0xffff: 'nodpi'
+    }
+    ORIENTATIONS = {1: 'port', 2: 'land', 3: 'square'}
+    UI_MODE_NIGHT = {0x10: 'notnight', 0x20: 'night'}
+    LAYOUT_DIRECTIONS = {0x40: 'ldltr', 0x80: 'ldrtl'}
+
+    @staticmethod
+    def unpack_locale(data: bytes, base: str) -> str:
+        """
+        Two letters, or three packed into two bytes when the high bit is set
+        """
+        if data[0] == 0:
+            return ''
+        if data[0] & 0x80 == 0:
+            return data.decode('ascii', errors='replace')
+        first, second = data[0], data[1]
+        return ''.join(chr(ord(base) + value) for value in (
+            second & 0x1f, ((second & 0xe0) >> 5) | ((first & 0x03) << 3), (first & 0x7c) >> 2
+        ))
+
+    @classmethod
+    def qualifiers(cls, data: Union[bytes, memoryview], offset: int) -> str:
+        size, = struct.unpack_from('<I', data, offset)
+        # Fields past the stored size are zero
+        config = bytes(data[offset:offset + size]).ljust(48, b'\0')
+        mcc, mnc = struct.unpack_from('<HH', config, 4)
+        orientation, density = config[12], struct.unpack_from('<H', config, 14)[0]
+        sdk_version, = struct.unpack_from('<H', config, 24)
+        screen_layout, ui_mode, smallest_width = config[28], config[29], struct.unpack_from('<H', config, 30)[0]
+        width, height = struct.unpack_from('<HH', config, 32)
+        parts = []
+        if mcc != 0:
+            parts.append(f'mcc{mcc}')
+        if mnc != 0:
+            parts.append(f'mnc{mnc}')
+        language = cls.unpack_locale(config[8:10], 'a')
+        if language != '':
+            parts.append(language)
+            region = cls.unpack_locale(config[10:12], '0')
+            if region != '':
+                parts.append(f'r{region}')
+        if screen_layout & 0xc0 in cls.LAYOUT_DIRECTIONS:
+            parts.append(cls.LAYOUT_DIRECTIONS[screen_layout & 0xc0])
+        if smallest_width != 0:
+            parts.append(f'sw{smallest_width}dp')
+        if width != 0:
+            parts.append(f'w{width}dp')
+        if height != 0:
+            parts.append(f'h{height}dp')
+        if orientation in cls.ORIENTATIONS:
+            parts.append(cls.ORIENTATIONS[orientation])
+        if ui_mode & 0x30 in cls.UI_MODE_NIGHT:
+            parts.append(cls.UI_MODE_NIGHT[ui_mode & 0x30])
+        if density != 0:
+            parts.append(cls.DENSITIES.get(density, f'{density}dpi'))
+        if sdk_version != 0:
+            parts.append(f'v{sdk_version}')
+        return '-'.join(parts)
+
+
+class ResourceTable:
+    """
+    Reads a compiled resource table (resources.arsc) in place, e.g. straight from an APK's mmap, so resource
+    IDs, names and values can be looked up without decoding the resources with apktool.
+
+    The index of type/name/config to entry offsets is built on the first lookup, values are read when asked for.
+    """
+    # See: https://android.googlesource.com/platform/frameworks/base/+/refs/heads/master/libs/androidfw/include/androidfw/ResourceTypes.h
+    PACKAGE_HEADER = struct.Struct('<I256sIIII')
+    TYPE_HEADER = struct.Struct('<BBHII')
+    ENTRY = struct.Struct('<HHI')
+    MAP_ENTRY = struct.Struct('<II')
+    MAP = struct.Struct('<I')
+    # From the start of a type chunk
+    TYPE_CONFIG_OFFSET = 20
+
+    TYPE_FLAG_SPARSE = 0x01
+    TYPE_FLAG_OFFSET16 = 0x02
+    ENTRY_FLAG_COMPLEX = 0x0001
+    ENTRY_FLAG_COMPACT = 0x0008
+    NO_ENTRY16 = 0xffff
+
+    ARSC_PATH = 'resources.arsc'
+
+    data: Union[bytes, memoryview]
+    reader: Optional[RawZipReader]
+
+    def __init__(self, data: Union[bytes, memoryview], reader: Optional[RawZipReader] = None):
+        """
+        :param reader: closed with the table, data may be a view of its mmap
+        """
+        self.data = data
+        self.reader = reader
+        if len(data) < ResChunk.HEADER.size:
+            raise InvalidResourceChunk('resource table is empty')
+        chunk_type, header_size, size = ResChunk.HEADER.unpack_from(data, 0)
+        if chunk_type != ResChunk.TABLE_TYPE:
+            raise InvalidResourceChunk(f'unexpected resource table chunk type 0x{chunk_type:04x}')
+        self.__start = header_size
+        self.__end = min(size, len(data))
+        self.strings: Optional[ResStringPool] = None
+        # Package names by package ID
+        self.packages: Dict[int, str] = {}
+        self.__ids: Dict[Tuple[str, str], int] = {}
+        self.__names: Dict[int, Tuple[str, str]] = {}
+        # Entry offsets and whether they are compact, by resource ID and config
+        self.__entries: Dict[int, Dict[str, Tuple[int, bool]]] = {}
+        self.__indexed = False
+
+    @classmethod
+    def open(cls, apk_file_path: str) -> 'ResourceTable':
+        """
+        resources.arsc of an APK, a stored table is read from the mmap without copying it
+        """
+        reader = RawZipReader(apk_file_path)
+        data = None
+        try:
+            entry = reader.entries_by_name().get(cls.ARSC_PATH)
+            if entry is None:
+                raise InvalidResourceChunk(f'{apk_file_path} has no {cls.ARSC_PATH}')
+            data = reader.read_raw(entry) if entry.compress_type == RawZip.STORED else reader.read(entry)
+            return cls(data, reader)
+        except Exception:
+            if isinstance(data, memoryview):
+                data.release()
+            reader.close()
+            raise
+
+    def __enter__(self) -> 'ResourceTable':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if isinstance(self.data, memoryview):
+            self.data.release()
+        if self.reader is not None:
+            self.reader.close()
+
+    def index(self):
+        """
+        Walks the packages and their type chunks once, before the first lookup
+        """
+        if self.__indexed:
+            return
+        self.__indexed = True
+        for chunk_type, header_size, size, pos in ResChunk.iter_chunks(self.data, self.__start, self.__end):
+            if chunk_type == ResChunk.STRING_POOL_TYPE and self.strings is None:
+                self.strings = ResStringPool(self.data, pos, header_size)
+            elif chunk_type == ResChunk.TABLE_PACKAGE_TYPE:
+                self.__index_package(pos, header_size, size)
+
+    def __index_package(self, pos: int, header_size: int, size: int):
+        (package_id, name, type_strings_offset, _, key_strings_offset,
+         _) = self.PACKAGE_HEADER.unpack_from(self.data, pos + ResChunk.HEADER.size)
+        type_id_offset = 0
+        if header_size >= ResChunk.HEADER.size + self.PACKAGE_HEADER.size + 4:
+            type_id_offset, = struct.unpack_from('<I', self.data, pos + ResChunk.HEADER.size + self.PACKAGE_HEADER.size)
+        self.packages[package_id] = name.decode('utf-16-le', errors='replace').split('\0', 1)[0]
+        type_strings = key_strings = None
+        chunks = ResChunk.iter_chunks(self.data, pos + header_size, pos + size)
+        for chunk_type, chunk_header_size, _, chunk_pos in chunks:
+            if chunk_type == ResChunk.STRING_POOL_TYPE:
+                if chunk_pos == pos + type_strings_offset:
+                    type_strings = ResStringPool(self.data, chunk_pos, chunk_header_size)
+                elif chunk_pos == pos + key_strings_offset:
+                    key_strings = ResStringPool(self.data, chunk_pos, chunk_header_size)
+            elif chunk_type == ResChunk.TABLE_TYPE_TYPE:
+                if type_strings is None or key_strings is None:
+                    raise InvalidResourceChunk('resource type before the package string pools')
+                type_id, _, _, _, _ = self.TYPE_HEADER.unpack_from(self.data, chunk_pos + ResChunk.HEADER.size)
+                type_name = type_strings.get(type_id - 1 - type_id_offset) or f'type{type_id}'
+                self.__index_type(chunk_pos, chunk_header_size, (package_id << 24) | (type_id << 16),
+                                  type_name, key_strings)
+
+    def __iter_offsets(self, pos: int, header_size: int, flags: int, count: int) -> Iterator[Tuple[int, int]]:
+        """
+        :return: (entry index, offset from the entries start) of the entries present in a type chunk
+        """
+        offsets_pos = pos + header_size
+        if flags & self.TYPE_FLAG_SPARSE:
+            for index, offset in struct.iter_unpack('<HH', self.data[offsets_pos:offsets_pos + count * 4]):
+                yield index, offset * 4
+        elif flags & self.TYPE_FLAG_OFFSET16:
+            for index, (offset,) in enumerate(struct.iter_unpack('<H', self.data[offsets_pos:offsets_pos + count * 2])):
+                if offset != self.NO_ENTRY16:
+                    yield index, offset * 4
+        else:
+            for index, (offset,) in enumerate(struct.iter_unpack('<I', self.data[offsets_pos:offsets_pos + count * 4])):
+                if offset != ResChunk.NO_ENTRY:
+                    yield index, offset
+
+    def __index_type(self, pos: int, header_size: int, type_resource_id: int, type_name: str,
+                     key_strings: ResStringPool):
+        _, flags, _, count, entries_start = self.TYPE_HEADER.unpack_from(self.data, pos + ResChunk.HEADER.size)
+        config = ResourceConfig.qualifiers(self.data, pos + self.TYPE_CONFIG_OFFSET)
+        for index, offset in self.__iter_offsets(pos, header_size, flags, count):
+            entry_pos = pos + entries_start + offset
+            size, entry_flags, key = self.ENTRY.unpack_from(self.data, entry_pos)
+            compact = bool(entry_flags & self.ENTRY_FLAG_COMPACT)
+            resource_id = type_resource_id | index
+            if resource_id not in self.__names:
+                # The key of a compact entry is in its size field
+                name = key_strings.get(size if compact else key) or f'0x{resource_id:08x}'
+                self.__names[resource_id] = (type_name, name)
+                self.__ids.setdefault((type_name, name), resource_id)
+            self.__entries.setdefault(resource_id, {})[config] = (entry_pos, compact)
+
+    def __value(self, pos: int) -> ResourceValue:
+        _, _, value_type, data = ResValue.STRUCT.unpack_from(self.data, pos)
+        return ResourceValue(value_type, data, self.strings.get(data) if value_type == ResValue.TYPE_STRING else None)
+
+    def resource_id(self, type_name: str, name: str) -> Optional[int]:
+        """
+        ID of e.g. string/app_name, the first package's if several define it
+        """
+        self.index()
+        return self.__ids.get((type_name, name))
+
+    def resource_name(self, resource_id: int) -> Optional[str]:
+        """
+        :return: type/name, e.g. string/app_name
+        """
+        self.index()
+        names = self.__names.get(resource_id)
+        return f'{names[0]}/{names[1]}' if names is not None else None
+
+    def configs(self, resource_id: int) -> List[str]:
+        self.index()
+        return list(self.__entries.get(resource_id, {}))
+
+    def names(self, type_name: str) -> Dict[str, int]:
+        """
+        Resource IDs of every resource of a type, by name
+        """
+        self.index()
+        return {name: resource_id for (t, name), resource_id in self.__ids.items() if t == type_name}
+
+    def entry(self, resource_id: int, config: str = '') -> Optional[ResourceEntry]:
+        self.index()
+        located = self.__entries.get(resource_id, {}).get(config)
+        if located is None:
+            return None
+        pos, compact = located
+        type_name, name = self.__names[resource_id]
+        entry = ResourceEntry(resource_id, type_name, name, config)
+        size, flags, key = self.ENTRY.unpack_from(self.data, pos)
+        if compact:
+            value_type = flags >> 8
+            entry.value = ResourceValue(value_type, key,
+                                        self.strings.get(key) if value_type == ResValue.TYPE_STRING else None)
+        elif flags & self.ENTRY_FLAG_COMPLEX:
+            parent, count = self.MAP_ENTRY.unpack_from(self.data, pos + self.ENTRY.size)
+            entry.parent = parent if parent != 0 else None
+            map_pos = pos + size
+            for _ in range(count):
+                attribute, = self.MAP.unpack_from(self.data, map_pos)
+                entry.bag[attribute] = self.__value(map_pos + self.MAP.size)
+                map_pos += self.MAP.size + ResValue.STRUCT.size
+        else:
+            entry.value = self.__value(pos + size)
+        return entry
+
+    def entries(self, type_name: str, name: str) -> List[ResourceEntry]:
+        """
+        Entry of the resource in every config it is defined for
+        """
+        resource_id = self.resource_id(type_name, name)
+        if resource_id is None:
+            return []
+        return [self.entry(resource_id, config) for config in self.configs(resource_id)]
+
+    def value(self, type_name: str, name: str, config: str = '',
+              resolve: bool = True) -> Union[str, int, float, bool, None]:
+        """
+        Simple value of e.g. string/app_name, None if it isn't defined for config or is a bag
+
+        :param resolve: follow references to other resources in the same config, e.g. @string/other
+        """
+        resource_id = self.resource_id(type_name, name)
+        seen = set()
+        while resource_id is not None and resource_id not in seen:
+            seen.add(resource_id)
+            entry = self.entry(resource_id, config)
+            if entry is None or entry.value is None:
+                return None
+            if not resolve or entry.value.type != ResValue.TYPE_REFERENCE:
+                return entry.value.value
+            resource_id = entry.value.data
+        return None
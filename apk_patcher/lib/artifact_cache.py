@@ -0,0 +1,282 @@
+import binascii
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+from abc import ABCMeta, abstractmethod
+from typing import TYPE_CHECKING, Any, List, Optional
+
+from apk_patcher.lib.file_lock import atomic_output
+from apk_patcher.lib.util import hash_file
+
+if TYPE_CHECKING:
+    import requests
+
+
+class ArtifactBackend(metaclass=ABCMeta):
+    """
+    Flat object store, object names are either blobs/<sha256> of the content or refs/<sha256> of a recipe
+    """
+
+    @abstractmethod
+    def has(self, name: str) -> bool:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get(self, name: str, output_file_path: str) -> bool:
+        """
+        :return: False if the object doesn't exist
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def put(self, name: str, file_path: str):
+        raise NotImplementedError()
+
+
+class DirectoryBackend(ArtifactBackend):
+    """
+    Store in a local or shared (NFS, SMB) folder. Objects are written to a temporary file in the same
+    folder first, so other nodes never see a partial object.
+    """
+    root_folder: str
+
+    def __init__(self, root_folder: str):
+        self.root_folder = os.path.abspath(root_folder)
+
+    def object_path(self, name: str) -> str:
+        kind, digest = name.split('/', 1)
+        return os.path.join(self.root_folder, kind, digest[:2], digest)
+
+    def has(self, name: str) -> bool:
+        return os.path.exists(self.object_path(name))
+
+    def get(self, name: str, output_file_path: str) -> bool:
+        object_path = self.object_path(name)
+        if not os.path.exists(object_path):
+            return False
+        shutil.copyfile(object_path, output_file_path)
+        return True
+
+    def put(self, name: str, file_path: str):
+        object_path = self.object_path(name)
+        if os.path.exists(object_path):
+            return
+        os.makedirs(os.path.dirname(object_path), 0o755, exist_ok=True)
+        # Temporary file per thread, artifact_server handles uploads of the same object in parallel
+        with atomic_output(object_path) as tmp_file_path:
+            shutil.copyfile(file_path, tmp_file_path)
+
+
+class HTTPBackend(ArtifactBackend):
+    """
+    Store behind an HTTP server that answers GET/HEAD/PUT on <base_url>/<name>, see artifact_server.py
+    """
+    BUFFER_SIZE = 1024 * 1024  # 1mB
+
+    base_url: str
+    session: 'requests.Session'
+
+    def __init__(self, base_url: str, timeout: float = 30, token: Optional[str] = None):
+        """
+        :param token: sent as a bearer token, the server only accepts a PUT with its token
+        """
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        if token is not None:
+            self.session.headers['Authorization'] = f'Bearer {token}'
+
+    def object_url(self, name: str) -> str:
+        return f'{self.base_url}/{name}'
+
+    def has(self, name: str) -> bool:
+        resp = self.session.head(self.object_url(name), timeout=self.timeout)
+        return resp.status_code == 200
+
+    def get(self, name: str, output_file_path: str) -> bool:
+        with self.session.get(self.object_url(name), stream=True, timeout=self.timeout) as resp:
+            if resp.status_code == 404:
+                return False
+            if resp.status_code >= 400:
+                raise Exception(f'artifact store GET {name} failed: {resp.status_code}')
+            with open(output_file_path, 'wb') as f:
+                for chunk in resp.iter_content(chunk_size=self.BUFFER_SIZE):
+                    f.write(chunk)
+        return True
+
+    def put(self, name: str, file_path: str):
+        with open(file_path, 'rb') as f:
+            resp = self.session.put(self.object_url(name), data=f, timeout=self.timeout)
+        if resp.status_code >= 400:
+            raise Exception(f'artifact store PUT {name} failed: {resp.status_code}')
+
+
+class ArtifactCache:
+    """
+    Content addressed cache shared between build nodes. Files are stored once as blobs named by their SHA-256,
+    recipes (what a file was built from) are hashed into refs that point at a blob. Backends are tried in order
+    and a hit in a later backend is copied to the earlier ones, e.g. a local folder in front of a shared store.
+    """
+    backends: List[ArtifactBackend]
+
+    def __init__(self, backends: List[ArtifactBackend]):
+        self.backends = backends
+
+    @property
+    def enabled(self) -> bool:
+        return len(self.backends) > 0
+
+    @staticmethod
+    def recipe_key(kind: str, **inputs: Any) -> str:
+        """
+        Stable digest of everything an artifact was built from, values must be JSON serializable
+        """
+        recipe = json.dumps({'kind': kind, **inputs}, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(recipe.encode()).hexdigest()
+
+    @staticmethod
+    def blob_name(digest: str) -> str:
+        return f'blobs/{digest}'
+
+    @staticmethod
+    def ref_name(key: str) -> str:
+        return f'refs/{key}'
+
+    def __get(self, name: str, output_file_path: str) -> bool:
+        for i, backend in enumerate(self.backends):
+            try:
+                if not backend.get(name, output_file_path):
+                    continue
+            except Exception as e:
+                print(f'\tartifact cache {type(backend).__name__}: {e}')
+                continue
+            for earlier in self.backends[:i]:
+                self.__put(earlier, name, output_file_path)
+            return True
+        return False
+
+    @staticmethod
+    def __put(backend: ArtifactBackend, name: str, file_path: str):
+        try:
+            if not backend.has(name):
+                backend.put(name, file_path)
+        except Exception as e:
+            # A cache that can't be written to must not fail the build
+            print(f'\tartifact cache {type(backend).__name__}: {e}')
+
+    def resolve(self, key: str) -> Optional[str]:
+        """
+        :return: blob digest the recipe key points to
+        """
+        fd, tmp_file_path = tempfile.mkstemp(suffix='.ref')
+        os.close(fd)
+        try:
+            if not self.__get(self.ref_name(key), tmp_file_path):
+                return None
+            with open(tmp_file_path, 'r') as f:
+                return f.read().strip()
+        finally:
+            os.remove(tmp_file_path)
+
+    def fetch_file(self, key: str, output_file_path: str) -> bool:
+        """
+        :return: False on a cache miss, output_file_path is only replaced on a hit
+        """
+        if not self.enabled:
+            return False
+        digest = self.resolve(key)
+        if digest is None:
+            return False
+        os.makedirs(os.path.dirname(os.path.abspath(output_file_path)), 0o755, exist_ok=True)
+        tmp_file_path = f'{output_file_path}.cache.tmp'
+        try:
+            if not self.__get(self.blob_name(digest), tmp_file_path):
+                return False
+            if binascii.hexlify(hash_file(tmp_file_path, 'sha256')).decode() != digest:
+                print(f'\tartifact cache blob {digest} is corrupt, ignoring it')
+                return False
+            os.replace(tmp_file_path, output_file_path)
+            return True
+        finally:
+            if os.path.exists(tmp_file_path):
+                os.remove(tmp_file_path)
+
+    def store_file(self, key: str, file_path: str):
+        if not self.enabled:
+            return
+        digest = binascii.hexlify(hash_file(file_path, 'sha256')).decode()
+        fd, ref_file_path = tempfile.mkstemp(suffix='.ref')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(digest)
+            for backend in self.backends:
+                # Blob first, a ref must never point to a missing blob
+                self.__put(backend, self.blob_name(digest), file_path)
+                self.__put(backend, self.ref_name(key), ref_file_path)
+        finally:
+            os.remove(ref_file_path)
+
+    def fetch_tree(self, key: str, output_folder_path: str) -> bool:
+        """
+        Restores a folder stored with store_tree, e.g. an apktool decode tree
+        """
+        if not self.enabled:
+            return False
+        fd, tar_file_path = tempfile.mkstemp(suffix='.tar.gz')
+        os.close(fd)
+        try:
+            if not self.fetch_file(key, tar_file_path):
+                return False
+            tmp_folder_path = f'{output_folder_path}.cache.tmp'
+            if os.path.exists(tmp_folder_path):
+                shutil.rmtree(tmp_folder_path)
+            with tarfile.open(tar_file_path, 'r:gz') as tar:
+                for member in tar.getmembers():
+                    if member.name.startswith('/') or '..' in member.name.split('/'):
+                        raise Exception(f'artifact cache tree {key} has unsafe path {member.name}')
+                    # store_tree only adds these, a link could point outside of the folder
+                    if not member.isfile() and not member.isdir():
+                        raise Exception(f'artifact cache tree {key} has unsafe member {member.name}')
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extractall(tmp_folder_path, filter='data')
+                else:
+                    tar.extractall(tmp_folder_path)
+            if os.path.exists(output_folder_path):
+                shutil.rmtree(output_folder_path)
+            os.replace(tmp_folder_path, output_folder_path)
+            return True
+        finally:
+            os.remove(tar_file_path)
+
+    def store_tree(self, key: str, folder_path: str):
+        if not self.enabled:
+            return
+        fd, tar_file_path = tempfile.mkstemp(suffix='.tar.gz')
+        os.close(fd)
+        try:
+            # Sorted and without timestamps or the random temporary file name gzip would record, so the same tree
+            # always gives the same blob
+            with open(tar_file_path, 'wb') as f, \
+                    gzip.GzipFile(filename='', fileobj=f, mode='wb', compresslevel=1, mtime=0) as gz, \
+                    tarfile.open(fileobj=gz, mode='w') as tar:
+                for root, dirs, files in os.walk(folder_path):
+                    dirs.sort()
+                    for name in dirs + sorted(files):
+                        path = os.path.join(root, name)
+                        info = tar.gettarinfo(path, os.path.relpath(path, folder_path).replace(os.sep, '/'))
+                        info.mtime = 0
+                        info.uid = info.gid = 0
+                        info.uname = info.gname = ''
+                        if info.isfile():
+                            with open(path, 'rb') as member:
+                                tar.addfile(info, member)
+                        elif info.isdir():
+                            tar.addfile(info)
+            self.store_file(key, tar_file_path)
+        finally:
+            os.remove(tar_file_path)
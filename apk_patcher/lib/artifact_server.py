@@ -0,0 +1,100 @@
+import hmac
+import os
+import re
+import shutil
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from apk_patcher.lib.artifact_cache import DirectoryBackend
+
+
+class ArtifactStoreHandler(BaseHTTPRequestHandler):
+    """
+    Minimal GET/HEAD/PUT object store for HTTPBackend, objects are kept in a DirectoryBackend. A PUT needs the
+    bearer token, without one the store is read only.
+    """
+    RE_OBJECT_NAME = re.compile(r'^/(blobs|refs)/([0-9a-f]{64})$')
+    BUFFER_SIZE = 1024 * 1024  # 1mB
+
+    backend: DirectoryBackend
+    token: Optional[str]
+
+    def object_name(self):
+        match = self.RE_OBJECT_NAME.match(self.path)
+        if match is None:
+            self.send_error(400, 'invalid object name')
+            return None
+        return f'{match.group(1)}/{match.group(2)}'
+
+    def do_HEAD(self):
+        self.send_object(False)
+
+    def do_GET(self):
+        self.send_object(True)
+
+    def send_object(self, with_body: bool):
+        name = self.object_name()
+        if name is None:
+            return
+        object_path = self.backend.object_path(name)
+        if not os.path.exists(object_path):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(object_path)))
+        self.end_headers()
+        if with_body:
+            with open(object_path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile, self.BUFFER_SIZE)
+
+    def authorized(self) -> bool:
+        if self.token is None:
+            return False
+        return hmac.compare_digest(self.headers.get('Authorization', ''), f'Bearer {self.token}')
+
+    def do_PUT(self):
+        if not self.authorized():
+            self.send_error(401 if self.token is not None else 403)
+            return
+        name = self.object_name()
+        if name is None:
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        fd, tmp_file_path = tempfile.mkstemp(suffix='.upload')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while length > 0:
+                    chunk = self.rfile.read(min(length, self.BUFFER_SIZE))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    length -= len(chunk)
+            if length > 0:
+                self.send_error(400, 'incomplete upload')
+                return
+            self.backend.put(name, tmp_file_path)
+        finally:
+            os.remove(tmp_file_path)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_artifact_server(root_folder: str, host: str = '127.0.0.1', port: int = 8750,
+                           token: Optional[str] = None) -> ThreadingHTTPServer:
+    """
+    Call serve_forever() on the result to share root_folder with other build nodes
+
+    :param host: 0.0.0.0 to serve other hosts
+    :param token: required for a PUT, None serves read only
+    """
+    handler = type('BoundArtifactStoreHandler', (ArtifactStoreHandler,), {
+        'backend': DirectoryBackend(root_folder),
+        'token': token
+    })
+    return ThreadingHTTPServer((host, port), handler)
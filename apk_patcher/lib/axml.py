@@ -0,0 +1,221 @@
+import struct
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Union
+
+
+class InvalidResourceChunk(Exception):
+    def __init__(self, error: str):
+        super().__init__(f'invalid binary resource: {error}')
+
+
+class ResChunk:
+    # See: https://android.googlesource.com/platform/frameworks/base/+/refs/heads/master/libs/androidfw/include/androidfw/ResourceTypes.h
+    HEADER = struct.Struct('<HHI')
+
+    NULL_TYPE = 0x0000
+    STRING_POOL_TYPE = 0x0001
+    TABLE_TYPE = 0x0002
+    XML_TYPE = 0x0003
+    XML_START_NAMESPACE_TYPE = 0x0100
+    XML_END_NAMESPACE_TYPE = 0x0101
+    XML_START_ELEMENT_TYPE = 0x0102
+    XML_END_ELEMENT_TYPE = 0x0103
+    XML_RESOURCE_MAP_TYPE = 0x0180
+    TABLE_PACKAGE_TYPE = 0x0200
+    TABLE_TYPE_TYPE = 0x0201
+    TABLE_TYPE_SPEC_TYPE = 0x0202
+    TABLE_LIBRARY_TYPE = 0x0203
+
+    NO_ENTRY = 0xffffffff
+
+    @staticmethod
+    def iter_chunks(data: Union[bytes, memoryview], start: int, end: int) -> Iterator[tuple]:
+        """
+        :return: (chunk type, header size, chunk size, chunk offset) for each chunk in [start, end)
+        """
+        pos = start
+        while pos + ResChunk.HEADER.size <= end:
+            chunk_type, header_size, size = ResChunk.HEADER.unpack_from(data, pos)
+            if size < ResChunk.HEADER.size or pos + size > end:
+                raise InvalidResourceChunk(f'bad chunk size {size} at offset {pos}')
+            yield chunk_type, header_size, size, pos
+            pos += size
+
+
+class ResValue:
+    TYPE_NULL = 0x00
+    TYPE_REFERENCE = 0x01
+    TYPE_ATTRIBUTE = 0x02
+    TYPE_STRING = 0x03
+    TYPE_FLOAT = 0x04
+    TYPE_DIMENSION = 0x05
+    TYPE_FRACTION = 0x06
+    TYPE_INT_DEC = 0x10
+    TYPE_INT_HEX = 0x11
+    TYPE_INT_BOOLEAN = 0x12
+    TYPE_FIRST_COLOR_INT = 0x1c
+    TYPE_LAST_COLOR_INT = 0x1f
+
+    STRUCT = struct.Struct('<HBBI')
+
+
+class ResStringPool:
+    HEADER = struct.Struct('<IIIII')
+    SORTED_FLAG = 1 << 0
+    UTF8_FLAG = 1 << 8
+
+    data: Union[bytes, memoryview]
+    count: int
+    is_utf8: bool
+
+    def __init__(self, data: Union[bytes, memoryview], offset: int, header_size: int):
+        self.data = data
+        (self.count, _, flags, strings_start,
+         _) = self.HEADER.unpack_from(data, offset + ResChunk.HEADER.size)
+        self.is_utf8 = bool(flags & self.UTF8_FLAG)
+        self.__offsets_start = offset + header_size
+        self.__strings_start = offset + strings_start
+        self.__cache = {}
+
+    def __len__(self) -> int:
+        return self.count
+
+    @staticmethod
+    def __utf8_length(data, pos: int) -> tuple:
+        length = data[pos]
+        if length & 0x80:
+            return ((length & 0x7f) << 8) | data[pos + 1], pos + 2
+        return length, pos + 1
+
+    @staticmethod
+    def __utf16_length(data, pos: int) -> tuple:
+        length, = struct.unpack_from('<H', data, pos)
+        if length & 0x8000:
+            low, = struct.unpack_from('<H', data, pos + 2)
+            return ((length & 0x7fff) << 16) | low, pos + 4
+        return length, pos + 2
+
+    def get(self, index: int) -> Optional[str]:
+        if index == ResChunk.NO_ENTRY or index >= self.count:
+            return None
+        value = self.__cache.get(index)
+        if value is not None:
+            return value
+        offset, = struct.unpack_from('<I', self.data, self.__offsets_start + index * 4)
+        pos = self.__strings_start + offset
+        if self.is_utf8:
+            _, pos = self.__utf8_length(self.data, pos)
+            length, pos = self.__utf8_length(self.data, pos)
+            value = bytes(self.data[pos:pos + length]).decode('utf-8', errors='replace')
+        else:
+            length, pos = self.__utf16_length(self.data, pos)
+            value = bytes(self.data[pos:pos + length * 2]).decode('utf-16-le', errors='replace')
+        self.__cache[index] = value
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        for index in range(self.count):
+            yield self.get(index)
+
+
+@dataclass
+class AXMLAttribute:
+    namespace: Optional[str]
+    name: str
+    resource_id: Optional[int]
+    raw_value: Optional[str]
+    value_type: int
+    value_data: int
+
+    @property
+    def value(self) -> Union[str, int, bool, None]:
+        if self.value_type == ResValue.TYPE_STRING:
+            return self.raw_value
+        if self.value_type in (ResValue.TYPE_INT_DEC, ResValue.TYPE_INT_HEX):
+            return struct.unpack('<i', struct.pack('<I', self.value_data))[0]
+        if self.value_type == ResValue.TYPE_INT_BOOLEAN:
+            return self.value_data != 0
+        if self.value_type == ResValue.TYPE_REFERENCE:
+            return f'@0x{self.value_data:08x}'
+        if self.raw_value is not None:
+            return self.raw_value
+        return None
+
+
+@dataclass
+class AXMLElement:
+    depth: int
+    namespace: Optional[str]
+    name: str
+    attributes: List[AXMLAttribute]
+
+    def get(self, name: str, resource_id: Optional[int] = None) -> Optional[AXMLAttribute]:
+        for attribute in self.attributes:
+            if resource_id is not None and attribute.resource_id == resource_id:
+                return attribute
+            if attribute.name == name:
+                return attribute
+        return None
+
+
+class AXMLParser:
+    """
+    Streams the elements of a compiled (binary) Android XML file, e.g. AndroidManifest.xml inside an APK
+    """
+    ATTRIBUTE_EXT = struct.Struct('<IIHHHHHH')
+    ATTRIBUTE = struct.Struct('<IIIHBBI')
+    NODE_HEADER_SIZE = 16
+
+    data: Union[bytes, memoryview]
+    strings: Optional[ResStringPool]
+    resource_ids: List[int]
+
+    def __init__(self, data: Union[bytes, memoryview]):
+        self.data = data
+        self.strings = None
+        self.resource_ids = []
+        if len(data) < ResChunk.HEADER.size:
+            raise InvalidResourceChunk('xml is empty')
+        chunk_type, header_size, size = ResChunk.HEADER.unpack_from(data, 0)
+        if chunk_type != ResChunk.XML_TYPE:
+            raise InvalidResourceChunk(f'unexpected xml chunk type 0x{chunk_type:04x}')
+        self.__start = header_size
+        self.__end = min(size, len(data))
+
+    def iter_elements(self) -> Iterator[AXMLElement]:
+        depth = 0
+        for chunk_type, header_size, size, pos in ResChunk.iter_chunks(self.data, self.__start, self.__end):
+            if chunk_type == ResChunk.STRING_POOL_TYPE:
+                self.strings = ResStringPool(self.data, pos, header_size)
+            elif chunk_type == ResChunk.XML_RESOURCE_MAP_TYPE:
+                count = (size - header_size) // 4
+                self.resource_ids = list(struct.unpack_from(f'<{count}I', self.data, pos + header_size))
+            elif chunk_type == ResChunk.XML_START_ELEMENT_TYPE:
+                yield self.__parse_element(pos + self.NODE_HEADER_SIZE, depth)
+                depth += 1
+            elif chunk_type == ResChunk.XML_END_ELEMENT_TYPE:
+                depth -= 1
+
+    def __string(self, index: int) -> Optional[str]:
+        if self.strings is None:
+            raise InvalidResourceChunk('xml element before string pool')
+        return self.strings.get(index)
+
+    def __parse_element(self, pos: int, depth: int) -> AXMLElement:
+        (namespace, name, attribute_start, attribute_size, attribute_count,
+         _, _, _) = self.ATTRIBUTE_EXT.unpack_from(self.data, pos)
+        attributes = []
+        attribute_pos = pos + attribute_start
+        for _ in range(attribute_count):
+            (attr_namespace, attr_name, raw_value, _, _, value_type,
+             value_data) = self.ATTRIBUTE.unpack_from(self.data, attribute_pos)
+            attribute_pos += attribute_size
+            attributes.append(AXMLAttribute(
+                self.__string(attr_namespace),
+                self.__string(attr_name) or '',
+                self.resource_ids[attr_name] if attr_name < len(self.resource_ids) else None,
+                self.__string(raw_value),
+                value_type,
+                value_data
+            ))
+        return AXMLElement(depth, self.__string(namespace), self.__string(name) or '', attributes)
@@ -5,6 +5,8 @@ from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
 
+from apk_patcher.lib.file_lock import atomic_output
+
 
 class Certificate:
     __private_key: RSAPrivateKey
@@ -30,12 +32,12 @@ class Certificate:
         return builder.sign(self.__private_key, hashes.SHA256())
 
     def save(self, key_path: str, cert_path: str):
-        with open(key_path, 'wb+') as f:
+        with atomic_output(key_path) as tmp_key_path, open(tmp_key_path, 'wb+') as f:
             f.write(self.__private_key.private_bytes(
                 encoding=serialization.Encoding.DER,
                 format=serialization.PrivateFormat.PKCS8,
                 encryption_algorithm=serialization.NoEncryption()
             ))
 
-        with open(cert_path, 'wb+') as f:
+        with atomic_output(cert_path) as tmp_cert_path, open(tmp_cert_path, 'wb+') as f:
             f.write(self.cert.public_bytes(serialization.Encoding.PEM))
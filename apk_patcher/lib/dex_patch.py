@@ -0,0 +1,239 @@
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+from abc import ABCMeta
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from apk_patcher.lib.patch import IncompletePatch, Patch
+from apk_patcher.tools.android_jar import AndroidJar
+from apk_patcher.tools.baksmali import Baksmali
+from apk_patcher.tools.dx import DX
+from apk_patcher.tools.java import Java
+
+DEX_MAGIC = b'dex\n'
+# Offsets of the header fields, see: https://source.android.com/docs/core/runtime/dex-format#header-item
+DEX_STRING_IDS_OFF = 0x3c
+DEX_TYPE_IDS_OFF = 0x44
+DEX_CLASS_DEFS = 0x60
+DEX_CLASS_DEF_SIZE = 32
+
+
+def read_uleb128(data: Any, pos: int) -> int:
+    """
+    :return: position after the value, it is skipped
+    """
+    while data[pos] & 0x80:
+        pos += 1
+    return pos + 1
+
+
+def dex_defines_class(dex_file_path: str, descriptor: str) -> bool:
+    """
+    Whether the dex file has a class_def for descriptor, e.g. Lcom/company/MainActivity;. Other dex files only
+    reference it.
+    """
+    needle = descriptor.encode()
+    with open(dex_file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data[:4] != DEX_MAGIC or data.find(needle) < 0:
+            return False
+        string_ids_off, = struct.unpack_from('<I', data, DEX_STRING_IDS_OFF)
+        type_ids_off, = struct.unpack_from('<I', data, DEX_TYPE_IDS_OFF)
+        class_defs_size, class_defs_off = struct.unpack_from('<II', data, DEX_CLASS_DEFS)
+        for i in range(class_defs_size):
+            class_idx, = struct.unpack_from('<I', data, class_defs_off + i * DEX_CLASS_DEF_SIZE)
+            descriptor_idx, = struct.unpack_from('<I', data, type_ids_off + class_idx * 4)
+            string_data_off, = struct.unpack_from('<I', data, string_ids_off + descriptor_idx * 4)
+            start = read_uleb128(data, string_data_off)
+            if data[start:start + len(needle) + 1] == needle + b'\0':
+                return True
+    return False
+
+
+@dataclass
+class SmaliHook:
+    """
+    Smali inserted at the start of a method, after its .locals or .registers line, e.g. a call into injected code:
+
+    SmaliHook('com/company/MainActivity.smali', 'onCreate(Landroid/os/Bundle;)V',
+              'invoke-static {p0}, Lcom/company/hook/Hook;->init(Landroid/app/Activity;)V')
+    """
+    # Path of the smali file below the smali folders, found in whichever one has it
+    class_file: str
+    # Partial match of the .method line
+    method: str
+    code: str
+
+
+class DexPatch(Patch, metaclass=ABCMeta):
+    """
+    Compiles the Java sources in source_folder with javac against android.jar, converts them with DX to a new
+    classesN.dex in the decoded APK and adds the hooks. apktool copies the new dex file into the APK as it is.
+
+    apktool assembles every smali folder again. Decode with sources=False to keep the app's dex files as they are
+    instead, then a hook disassembles only the dex file defining its class with baksmali, and only that one is
+    assembled again.
+
+    The injected code can only use the Android API, not classes of the app. Apps with a minSdkVersion below 21
+    load the extra dex file only if they use the multidex support library.
+    """
+    RE_DEX_FILE = re.compile(r'^classes(\d*)\.dex$')
+    RE_SMALI_FOLDER = re.compile(r'^smali(?:_classes(\d+))?$')
+    RE_REGISTERS = re.compile(r'^\s*\.(?:locals|registers)\s')
+    # dx converts every class file of this version
+    JAVA_LEVEL = '1.7'
+
+    # Folder of .java files, in folders matching their packages
+    source_folder: str
+    hooks: List[SmaliHook] = []
+
+    java: Java
+    android_jar: AndroidJar
+    dx: DX
+    baksmali: Baksmali
+
+    def __init__(self, java: Java, android_jar: AndroidJar, dx: DX, baksmali: Baksmali):
+        self.java = java
+        self.android_jar = android_jar
+        self.dx = dx
+        self.baksmali = baksmali
+
+    @classmethod
+    def input_paths(cls) -> List[str]:
+        return [cls.source_folder]
+
+    def marker_file_path(self, root_folder_path: str) -> str:
+        """
+        Holds the name of the dex file this patch added and of the dex files it disassembled
+        """
+        return os.path.join(root_folder_path, f'{type(self).__name__}.dexpatch')
+
+    def load_marker(self, root_folder_path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.marker_file_path(root_folder_path), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_marker(self, root_folder_path: str, marker: Dict[str, Any]):
+        with open(self.marker_file_path(root_folder_path), 'w') as f:
+            json.dump(marker, f)
+
+    @staticmethod
+    def smali_folder_name(dex_file_name: str) -> str:
+        """
+        apktool's name for the smali of a dex file
+        """
+        number = DexPatch.RE_DEX_FILE.match(dex_file_name).group(1)
+        return f'smali_classes{number}' if number else 'smali'
+
+    def next_dex_file_name(self, root_folder_path: str) -> str:
+        """
+        Android loads classes.dex, classes2.dex, ... until one is missing, the new one is the next number
+        """
+        numbers = {1}
+        for name in os.listdir(root_folder_path):
+            match = self.RE_DEX_FILE.match(name) or self.RE_SMALI_FOLDER.match(name)
+            if match is not None:
+                numbers.add(int(match.group(1) or 1))
+        return f'classes{max(numbers) + 1}.dex'
+
+    def compile(self, out_dex_file_path: str):
+        sources = [
+            os.path.join(dir_path, file_name)
+            for dir_path, _, file_names in os.walk(self.source_folder)
+            for file_name in sorted(file_names) if file_name.endswith('.java')
+        ]
+        if len(sources) == 0:
+            raise IncompletePatch(type(self).__name__, f'no java sources in {self.source_folder}')
+        with tempfile.TemporaryDirectory() as classes_folder:
+            self.java.dev.exec('javac', [
+                '-source', self.JAVA_LEVEL, '-target', self.JAVA_LEVEL,
+                '-encoding', 'UTF-8', '-nowarn',
+                '-bootclasspath', self.android_jar.file_path,
+                '-d', classes_folder,
+                *sources
+            ]).check()
+            self.dx.dex_file(classes_folder, out_dex_file_path).check()
+
+    def find_class_file(self, root_folder_path: str, class_file: str) -> str:
+        for name in sorted(os.listdir(root_folder_path)):
+            file_path = os.path.join(root_folder_path, name, class_file)
+            if self.RE_SMALI_FOLDER.match(name) is not None and os.path.exists(file_path):
+                return file_path
+        raise IncompletePatch(type(self).__name__, f'unable to find {class_file}')
+
+    def disassemble_class_file(self, root_folder_path: str, class_file: str, marker: Dict[str, Any]) -> str:
+        """
+        Disassembles the dex file defining the class of class_file into its smali folder, if it was decoded
+        with sources=False. The dex file is kept as a backup, apktool would otherwise copy it too.
+        """
+        descriptor = 'L' + os.path.splitext(class_file)[0].replace(os.sep, '/') + ';'
+        for name in sorted(os.listdir(root_folder_path)):
+            dex_file_path = os.path.join(root_folder_path, name)
+            if name == marker['dex_file'] or self.RE_DEX_FILE.match(name) is None or \
+                    not dex_defines_class(dex_file_path, descriptor):
+                continue
+            smali_folder_path = os.path.join(root_folder_path, self.smali_folder_name(name))
+            self.baksmali.disassemble(dex_file_path, smali_folder_path).check()
+            self.backup_file(dex_file_path)
+            os.remove(dex_file_path)
+            marker['disassembled'].append(name)
+            self.save_marker(root_folder_path, marker)
+            return self.find_class_file(root_folder_path, class_file)
+        raise IncompletePatch(type(self).__name__, f'unable to find {class_file}')
+
+    def add_hook(self, root_folder_path: str, hook: SmaliHook, marker: Dict[str, Any]):
+        try:
+            target_file_path = self.find_class_file(root_folder_path, hook.class_file)
+        except IncompletePatch:
+            target_file_path = self.disassemble_class_file(root_folder_path, hook.class_file, marker)
+        self.restore_file(target_file_path)
+        self.backup_file(target_file_path)
+        with open(target_file_path, 'r') as f:
+            lines = f.readlines()
+        insert_at: Optional[int] = None
+        in_method = False
+        for i, line in enumerate(lines):
+            if line.lstrip().startswith('.method') and hook.method in line:
+                in_method = True
+            elif in_method and self.RE_REGISTERS.match(line) is not None:
+                insert_at = i + 1
+                break
+            elif in_method and line.lstrip().startswith('.end method'):
+                break
+        if insert_at is None:
+            raise IncompletePatch(type(self).__name__, f'unable to locate `{hook.method}` in {hook.class_file}')
+        code = ''.join(f'    {line.strip()}\n' for line in hook.code.strip().splitlines())
+        lines.insert(insert_at, f'\n{code}')
+        with open(target_file_path, 'w') as f:
+            f.writelines(lines)
+
+    def apply(self, root_folder_path: str):
+        self.unapply(root_folder_path)
+        marker = {'dex_file': self.next_dex_file_name(root_folder_path), 'disassembled': []}
+        self.compile(os.path.join(root_folder_path, marker['dex_file']))
+        self.save_marker(root_folder_path, marker)
+        for hook in self.hooks:
+            self.add_hook(root_folder_path, hook, marker)
+
+    def unapply(self, root_folder_path: str):
+        marker = self.load_marker(root_folder_path)
+        for name in marker['disassembled'] if marker is not None else []:
+            shutil.rmtree(os.path.join(root_folder_path, self.smali_folder_name(name)), ignore_errors=True)
+            self.restore_file(os.path.join(root_folder_path, name))
+        for hook in self.hooks:
+            try:
+                self.restore_file(self.find_class_file(root_folder_path, hook.class_file))
+            except IncompletePatch:
+                pass
+        if marker is None:
+            return
+        dex_file_path = os.path.join(root_folder_path, marker['dex_file'])
+        if os.path.exists(dex_file_path):
+            os.remove(dex_file_path)
+        os.remove(self.marker_file_path(root_folder_path))
@@ -1,14 +1,17 @@
 import os
 from abc import ABCMeta, abstractmethod
 from dataclasses import dataclass
-from typing import Any, Optional, TypeVar
-
-import requests
+from typing import TYPE_CHECKING, Any, Optional, TypeVar
 
+from apk_patcher.lib.artifact_cache import ArtifactCache
+from apk_patcher.lib.file_lock import FileLock
 from apk_patcher.lib.progress import ProgressCallback
 from apk_patcher.lib.tool import Tool
 from apk_patcher.lib.stream_download import DownloadMiddleware, stream_download_progress
 
+if TYPE_CHECKING:
+    import requests
+
 
 class Downloader(Tool, metaclass=ABCMeta):
     @dataclass
@@ -26,6 +29,7 @@ class Downloader(Tool, metaclass=ABCMeta):
     version_folder: str
     file_path: str
     working_dir: str
+    artifact_cache: Optional[ArtifactCache] = None
 
     def __init__(self, working_dir: str, version: str = 'latest'):
         self.working_dir = working_dir
@@ -77,32 +81,60 @@ class Downloader(Tool, metaclass=ABCMeta):
     def setup(self, on_progress: Optional[ProgressCallback], progress_user_var: Optional[Any]):
         self.download(on_progress, progress_user_var)
 
-    def check_response(self, resp: requests.Response):
+    def set_artifact_cache(self, artifact_cache: ArtifactCache):
+        self.artifact_cache = artifact_cache
+
+    @property
+    def artifact_key(self) -> str:
+        return ArtifactCache.recipe_key('tool', tool=type(self).__name__, version=self.version,
+                                        file=self.target_file_name)
+
+    def check_response(self, resp: 'requests.Response'):
         if resp.status_code >= 400:
             raise Exception(f'HTTP request failed for {self.target_file_name}: {resp.status_code}\n{resp.request.url}')
 
+    @property
+    def lock_file_path(self) -> str:
+        return f'{self.file_path}.lock'
+
     def download(self, on_progress: Optional[ProgressCallback], progress_user_var: Optional[Any]):
         """
+        Single-flight download, workers sharing the folder wait for the one downloading and then reuse its file
+
         :raises Exception: unknown errors
-        :raises AlreadyDownloaded: file is already downloaded
         :raises DownloadCancelled: progress callback returns False
         """
+        with FileLock(self.lock_file_path):
+            if self.is_ready():
+                return
+            self.download_file(on_progress, progress_user_var)
+
+    def download_file(self, on_progress: Optional[ProgressCallback], progress_user_var: Optional[Any]):
+        """
+        Downloads and installs the tool, only called while holding the download lock
+        """
         os.makedirs(self.version_folder, 0o755, exist_ok=True)
 
-        stream_download_progress(
-            self.download_url,
-            self.file_path,
-            self.BUFFER_SIZE,
-            self.download_size,
-            self.download_middleware,
-            on_progress,
-            progress_user_var
-        )
+        cached = self.artifact_cache is not None and self.artifact_cache.fetch_file(self.artifact_key, self.file_path)
+        if not cached:
+            stream_download_progress(
+                self.download_url,
+                self.file_path,
+                self.BUFFER_SIZE,
+                self.download_size,
+                self.download_middleware,
+                on_progress,
+                progress_user_var
+            )
 
         if not self.is_download_valid():
-            os.remove(self.file_path)
+            if os.path.exists(self.file_path):
+                os.remove(self.file_path)
             raise Exception(f'\tIncomplete or corrupt download of {self.target_file_name} v{self.version}')
 
+        if not cached and self.artifact_cache is not None:
+            self.artifact_cache.store_file(self.artifact_key, self.file_path)
+
     @abstractmethod
     def test_download(self):
         raise NotImplementedError()
@@ -0,0 +1,213 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, Optional
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+
+class LockTimeout(Exception):
+    def __init__(self, lock_file_path: str, timeout: float):
+        super().__init__(f'unable to lock {lock_file_path} within {timeout}s')
+
+
+@dataclass
+class _HeldLock:
+    thread_lock: threading.RLock = field(default_factory=threading.RLock)
+    depth: int = 0
+    fd: Optional[int] = None
+
+
+class FileLock:
+    """
+    Exclusive lock shared between processes through a lock file. Re-entrant within a thread, also across
+    FileLock instances of the same file, so a stage holding a lock can call another stage taking the same lock.
+    """
+    POLL_INTERVAL = 0.1
+
+    # OS file locks belong to the process, threads are kept apart by a lock per file
+    __registry_lock = threading.Lock()
+    __held: Dict[str, _HeldLock] = {}
+
+    lock_file_path: str
+    timeout: Optional[float]
+
+    def __init__(self, lock_file_path: str, timeout: Optional[float] = None):
+        """
+        :param timeout: seconds to wait for the lock, None waits forever
+        """
+        self.lock_file_path = os.path.abspath(lock_file_path)
+        self.timeout = timeout
+        with FileLock.__registry_lock:
+            self.__state = FileLock.__held.setdefault(self.lock_file_path, _HeldLock())
+
+    def __enter__(self) -> 'FileLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def acquire(self):
+        """
+        :raises LockTimeout: lock is held by another process or thread for longer than timeout
+        """
+        state = self.__state
+        if not state.thread_lock.acquire(timeout=-1 if self.timeout is None else self.timeout):
+            raise LockTimeout(self.lock_file_path, self.timeout)
+        try:
+            if state.depth == 0:
+                state.fd = self.__lock_file()
+            state.depth += 1
+        except BaseException:
+            state.thread_lock.release()
+            raise
+
+    def release(self):
+        state = self.__state
+        state.depth -= 1
+        if state.depth == 0:
+            fd, state.fd = state.fd, None
+            self.__unlock_file(fd)
+        state.thread_lock.release()
+
+    def __lock_file(self) -> int:
+        os.makedirs(os.path.dirname(self.lock_file_path), 0o755, exist_ok=True)
+        fd = os.open(self.lock_file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        try:
+            while True:
+                try:
+                    if os.name == 'nt':
+                        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                    elif deadline is None:
+                        fcntl.flock(fd, fcntl.LOCK_EX)
+                    else:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except OSError:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise LockTimeout(self.lock_file_path, self.timeout)
+                    time.sleep(self.POLL_INTERVAL)
+        except BaseException:
+            os.close(fd)
+            raise
+
+    @staticmethod
+    def __unlock_file(fd: int):
+        try:
+            if os.name == 'nt':
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+
+class SharedFileLock:
+    """
+    Lock file any number of processes hold at once, e.g. to mark something in use, while another process can
+    take it exclusively only when nobody holds it. Not re-entrant, every holder uses its own instance.
+
+    Windows has no shared locks, there every holder locks one byte of the file and an exclusive holder all of them.
+    """
+    POLL_INTERVAL = 0.1
+    SLOTS = 1024
+
+    lock_file_path: str
+
+    def __init__(self, lock_file_path: str):
+        self.lock_file_path = os.path.abspath(lock_file_path)
+        self.__fd: Optional[int] = None
+        # Locked bytes on Windows, (offset, length)
+        self.__region = (0, 0)
+
+    def __enter__(self) -> 'SharedFileLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __open(self) -> int:
+        os.makedirs(os.path.dirname(self.lock_file_path), 0o755, exist_ok=True)
+        return os.open(self.lock_file_path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def acquire(self):
+        """
+        Takes the lock shared, waits while it is held exclusively
+        """
+        fd = self.__open()
+        try:
+            if os.name != 'nt':
+                fcntl.flock(fd, fcntl.LOCK_SH)
+            else:
+                while not self.__lock_slot(fd):
+                    time.sleep(self.POLL_INTERVAL)
+        except BaseException:
+            os.close(fd)
+            raise
+        self.__fd = fd
+
+    def __lock_slot(self, fd: int) -> bool:
+        first = os.getpid() % self.SLOTS
+        for i in range(self.SLOTS):
+            offset = 1 + (first + i) % self.SLOTS
+            try:
+                os.lseek(fd, offset, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                self.__region = (offset, 1)
+                return True
+            except OSError:
+                continue
+        return False
+
+    def try_acquire_exclusive(self) -> bool:
+        """
+        :return: False right away if anyone holds the lock
+        """
+        fd = self.__open()
+        try:
+            if os.name != 'nt':
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                os.lseek(fd, 1, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, self.SLOTS)
+                self.__region = (1, self.SLOTS)
+        except OSError:
+            os.close(fd)
+            return False
+        self.__fd = fd
+        return True
+
+    def release(self):
+        fd, self.__fd = self.__fd, None
+        try:
+            if os.name == 'nt':
+                offset, length = self.__region
+                os.lseek(fd, offset, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, length)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+
+@contextmanager
+def atomic_output(file_path: str) -> Iterator[str]:
+    """
+    Yields a temporary path next to file_path, which replaces file_path if the block succeeds
+    """
+    tmp_file_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        yield tmp_file_path
+        os.replace(tmp_file_path, file_path)
+    finally:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
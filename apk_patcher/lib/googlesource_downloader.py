@@ -5,8 +5,6 @@ import re
 from abc import ABCMeta
 from typing import Any, Optional
 
-import requests
-
 from apk_patcher.lib.downloader import Downloader
 from apk_patcher.lib.stream_download import DownloadMiddleware, stream_decode_response_base64
 from apk_patcher.lib.util import change_url_query_param, git_hash_file
@@ -23,6 +21,7 @@ class GoogleSourceDownloader(Downloader, metaclass=ABCMeta):
 
     @property
     def download_size(self) -> Optional[int]:
+        import requests
         page_url = change_url_query_param(self.download_url, 'format', '')
         resp = requests.get(page_url)
         self.check_response(resp)
@@ -36,6 +35,7 @@ class GoogleSourceDownloader(Downloader, metaclass=ABCMeta):
         return stream_decode_response_base64
 
     def is_download_valid(self) -> bool:
+        import requests
         if not os.path.exists(self.file_path):
             return False
         metadata_url = change_url_query_param(self.download_url, 'format', 'JSON')
@@ -0,0 +1,357 @@
+import json
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from enum import Enum
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional
+
+from apk_patcher.lib.file_lock import atomic_output
+
+if TYPE_CHECKING:
+    import requests
+
+
+class JobStatus(Enum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class JobNotFound(Exception):
+    def __init__(self, job_id: str):
+        super().__init__(f'job {job_id} does not exist')
+
+
+class JobLeaseLost(Exception):
+    def __init__(self, job_id: str):
+        super().__init__(f'job {job_id} is no longer leased to this worker')
+
+
+@dataclass
+class Job:
+    id: str
+    # What to build, see job_service.JobSpec
+    spec: Dict[str, Any]
+    status: JobStatus
+    created_at: float
+    attempts: int = 0
+    worker: Optional[str] = None
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    heartbeat_at: Optional[float] = None
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    artifacts: List[str] = field(default_factory=list)
+
+    def to_json(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data['status'] = self.status.value
+        return data
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> 'Job':
+        return cls(**{**data, 'status': JobStatus(data['status'])})
+
+
+class JobQueue(metaclass=ABCMeta):
+    """
+    Persistent queue of build jobs. A job is leased to one worker at a time, the worker sends heartbeats
+    while it runs and a job whose lease expired (the worker died) is handed to the next worker.
+    """
+
+    @abstractmethod
+    def submit(self, spec: Dict[str, Any]) -> Job:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get(self, job_id: str) -> Job:
+        """
+        :raises JobNotFound: unknown job id
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def list(self, status: Optional[JobStatus] = None, limit: int = 100) -> List[Job]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def claim(self, worker: str) -> Optional[Job]:
+        """
+        :return: the oldest queued job, now leased to worker, or None if the queue is empty
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def heartbeat(self, job_id: str, worker: str):
+        """
+        :raises JobLeaseLost: the lease expired and the job was given to another worker
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def complete(self, job_id: str, worker: str, result: Dict[str, Any]):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def fail(self, job_id: str, worker: str, error: str):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def put_artifact(self, job_id: str, name: str, file_path: str):
+        """
+        Stores an output file of the job, workers on other nodes upload it to the queue server
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_artifact(self, job_id: str, name: str, output_file_path: str):
+        raise NotImplementedError()
+
+
+class SQLiteJobQueue(JobQueue):
+    """
+    Queue in a SQLite database, shared by the worker processes of one machine. Other nodes reach it
+    through the HTTP API of job_server.py, SQLite locking is unreliable on network file systems.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            spec TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            started_at REAL,
+            finished_at REAL,
+            heartbeat_at REAL,
+            result TEXT,
+            error TEXT,
+            artifacts TEXT NOT NULL DEFAULT '[]'
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+    '''
+
+    db_file_path: str
+    artifact_folder: str
+    lease_timeout: float
+    max_attempts: int
+
+    def __init__(self, db_file_path: str, artifact_folder: str, lease_timeout: float = 600, max_attempts: int = 3):
+        """
+        :param lease_timeout: seconds without a heartbeat after which a running job is given to another worker
+        :param max_attempts: times a job is started before a worker dying on it fails the job
+        """
+        self.db_file_path = os.path.abspath(db_file_path)
+        self.artifact_folder = os.path.abspath(artifact_folder)
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(self.db_file_path), 0o755, exist_ok=True)
+        with self.connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(self.SCHEMA)
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        """
+        A connection per call, so the queue can be used from several threads and processes
+        """
+        db = sqlite3.connect(self.db_file_path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with self.connect() as db:
+            # Takes the write lock up front, two workers can't claim the same job
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    @staticmethod
+    def row_to_job(row: sqlite3.Row) -> Job:
+        return Job(
+            id=row['id'],
+            spec=json.loads(row['spec']),
+            status=JobStatus(row['status']),
+            created_at=row['created_at'],
+            attempts=row['attempts'],
+            worker=row['worker'],
+            started_at=row['started_at'],
+            finished_at=row['finished_at'],
+            heartbeat_at=row['heartbeat_at'],
+            result=json.loads(row['result']) if row['result'] is not None else None,
+            error=row['error'],
+            artifacts=json.loads(row['artifacts'])
+        )
+
+    def submit(self, spec: Dict[str, Any]) -> Job:
+        job = Job(uuid.uuid4().hex, spec, JobStatus.QUEUED, time.time())
+        with self.connect() as db:
+            db.execute('INSERT INTO jobs (id, spec, status, created_at) VALUES (?, ?, ?, ?)',
+                       (job.id, json.dumps(spec), job.status.value, job.created_at))
+        return job
+
+    def get(self, job_id: str) -> Job:
+        with self.connect() as db:
+            row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            raise JobNotFound(job_id)
+        return self.row_to_job(row)
+
+    def list(self, status: Optional[JobStatus] = None, limit: int = 100) -> List[Job]:
+        with self.connect() as db:
+            if status is None:
+                rows = db.execute('SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?', (limit,)).fetchall()
+            else:
+                rows = db.execute('SELECT * FROM jobs WHERE status = ? ORDER BY created_at DESC LIMIT ?',
+                                  (status.value, limit)).fetchall()
+        return [self.row_to_job(row) for row in rows]
+
+    def expire_leases(self, db: sqlite3.Connection, now: float):
+        """
+        Requeues running jobs whose worker stopped sending heartbeats
+        """
+        expired = now - self.lease_timeout
+        db.execute('UPDATE jobs SET status = ?, finished_at = ?, error = ? '
+                   'WHERE status = ? AND heartbeat_at < ? AND attempts >= ?',
+                   (JobStatus.FAILED.value, now, 'worker stopped responding', JobStatus.RUNNING.value, expired,
+                    self.max_attempts))
+        db.execute('UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND heartbeat_at < ?',
+                   (JobStatus.QUEUED.value, JobStatus.RUNNING.value, expired))
+
+    def claim(self, worker: str) -> Optional[Job]:
+        now = time.time()
+        with self.transaction() as db:
+            self.expire_leases(db, now)
+            row = db.execute('SELECT id FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1',
+                             (JobStatus.QUEUED.value,)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE jobs SET status = ?, worker = ?, started_at = ?, heartbeat_at = ?, '
+                       'attempts = attempts + 1 WHERE id = ?',
+                       (JobStatus.RUNNING.value, worker, now, now, row['id']))
+            return self.row_to_job(db.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone())
+
+    def __update_leased(self, job_id: str, worker: str, sql: str, params: tuple):
+        with self.transaction() as db:
+            cursor = db.execute(f'UPDATE jobs SET {sql} WHERE id = ? AND worker = ? AND status = ?',
+                                (*params, job_id, worker, JobStatus.RUNNING.value))
+            if cursor.rowcount == 0:
+                raise JobLeaseLost(job_id)
+
+    def heartbeat(self, job_id: str, worker: str):
+        self.__update_leased(job_id, worker, 'heartbeat_at = ?', (time.time(),))
+
+    def complete(self, job_id: str, worker: str, result: Dict[str, Any]):
+        self.__update_leased(job_id, worker, 'status = ?, finished_at = ?, result = ?',
+                             (JobStatus.DONE.value, time.time(), json.dumps(result)))
+
+    def fail(self, job_id: str, worker: str, error: str):
+        self.__update_leased(job_id, worker, 'status = ?, finished_at = ?, error = ?',
+                             (JobStatus.FAILED.value, time.time(), error))
+
+    def artifact_path(self, job_id: str, name: str) -> str:
+        if os.path.basename(name) != name or name.startswith('.'):
+            raise Exception(f'invalid artifact name {name}')
+        return os.path.join(self.artifact_folder, job_id, name)
+
+    def put_artifact(self, job_id: str, name: str, file_path: str):
+        artifact_path = self.artifact_path(job_id, name)
+        os.makedirs(os.path.dirname(artifact_path), 0o755, exist_ok=True)
+        # Temporary file per thread, job_server handles uploads of the same artifact in parallel
+        with atomic_output(artifact_path) as tmp_file_path:
+            shutil.copyfile(file_path, tmp_file_path)
+        with self.transaction() as db:
+            row = db.execute('SELECT artifacts FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                raise JobNotFound(job_id)
+            artifacts = json.loads(row['artifacts'])
+            if name not in artifacts:
+                db.execute('UPDATE jobs SET artifacts = ? WHERE id = ?', (json.dumps(artifacts + [name]), job_id))
+
+    def get_artifact(self, job_id: str, name: str, output_file_path: str):
+        artifact_path = self.artifact_path(job_id, name)
+        if not os.path.exists(artifact_path):
+            raise Exception(f'job {job_id} has no artifact {name}')
+        shutil.copyfile(artifact_path, output_file_path)
+
+
+class HTTPJobQueue(JobQueue):
+    """
+    Queue behind the HTTP API of job_server.py, lets workers on other nodes pull jobs
+    """
+    BUFFER_SIZE = 1024 * 1024  # 1mB
+
+    base_url: str
+    session: 'requests.Session'
+
+    def __init__(self, base_url: str, timeout: float = 30, token: Optional[str] = None):
+        """
+        :param token: sent as a bearer token, the server only accepts a POST or PUT with its token
+        """
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        if token is not None:
+            self.session.headers['Authorization'] = f'Bearer {token}'
+
+    def request(self, method: str, path: str, **kwargs) -> 'requests.Response':
+        resp = self.session.request(method, f'{self.base_url}{path}', timeout=self.timeout, **kwargs)
+        if resp.status_code == 404:
+            raise JobNotFound(path.split('/')[2])
+        if resp.status_code == 409:
+            raise JobLeaseLost(path.split('/')[2])
+        if resp.status_code >= 400:
+            raise Exception(f'job queue {method} {path} failed: {resp.status_code} {resp.text}')
+        return resp
+
+    def submit(self, spec: Dict[str, Any]) -> Job:
+        return Job.from_json(self.request('POST', '/jobs', json=spec).json())
+
+    def get(self, job_id: str) -> Job:
+        return Job.from_json(self.request('GET', f'/jobs/{job_id}').json())
+
+    def list(self, status: Optional[JobStatus] = None, limit: int = 100) -> List[Job]:
+        params = {'limit': limit}
+        if status is not None:
+            params['status'] = status.value
+        return [Job.from_json(data) for data in self.request('GET', '/jobs', params=params).json()]
+
+    def claim(self, worker: str) -> Optional[Job]:
+        resp = self.request('POST', '/jobs/claim', json={'worker': worker})
+        if resp.status_code == 204:
+            return None
+        return Job.from_json(resp.json())
+
+    def heartbeat(self, job_id: str, worker: str):
+        self.request('POST', f'/jobs/{job_id}/heartbeat', json={'worker': worker})
+
+    def complete(self, job_id: str, worker: str, result: Dict[str, Any]):
+        self.request('POST', f'/jobs/{job_id}/complete', json={'worker': worker, 'result': result})
+
+    def fail(self, job_id: str, worker: str, error: str):
+        self.request('POST', f'/jobs/{job_id}/fail', json={'worker': worker, 'error': error})
+
+    def put_artifact(self, job_id: str, name: str, file_path: str):
+        with open(file_path, 'rb') as f:
+            self.request('PUT', f'/jobs/{job_id}/artifacts/{name}', data=f)
+
+    def get_artifact(self, job_id: str, name: str, output_file_path: str):
+        with self.request('GET', f'/jobs/{job_id}/artifacts/{name}', stream=True) as resp:
+            with open(output_file_path, 'wb') as f:
+                for chunk in resp.iter_content(chunk_size=self.BUFFER_SIZE):
+                    f.write(chunk)
@@ -0,0 +1,186 @@
+import hmac
+import json
+import os
+import re
+import shutil
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+from urllib.parse import parse_qs, urlparse
+
+from apk_patcher.lib.job_queue import JobLeaseLost, JobNotFound, JobQueue, JobStatus, SQLiteJobQueue
+
+
+class JobQueueHandler(BaseHTTPRequestHandler):
+    """
+    JSON API over a SQLiteJobQueue:
+
+    POST /jobs                          submit a job spec
+    GET  /jobs?status=&limit=           list jobs, newest first
+    GET  /jobs/<id>                     job status and result
+    GET  /jobs/<id>/artifacts/<name>    download an output file
+    POST /jobs/claim                    lease the oldest queued job to a worker, 204 when the queue is empty
+    POST /jobs/<id>/heartbeat|complete|fail
+    PUT  /jobs/<id>/artifacts/<name>    upload an output file
+
+    A POST or PUT needs the bearer token, without one the API is read only.
+    """
+    RE_JOB = re.compile(r'^/jobs/([0-9a-f]{32})$')
+    RE_JOB_ACTION = re.compile(r'^/jobs/([0-9a-f]{32})/(heartbeat|complete|fail)$')
+    RE_ARTIFACT = re.compile(r'^/jobs/([0-9a-f]{32})/artifacts/([\w\-.]+)$')
+    BUFFER_SIZE = 1024 * 1024  # 1mB
+
+    queue: SQLiteJobQueue
+    token: Optional[str]
+
+    def send_json(self, data: Any, status: int = 200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status: int):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def read_json(self) -> Optional[Any]:
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            return json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.send_error(400, 'invalid json')
+            return None
+
+    def handle_errors(self, fn):
+        try:
+            fn()
+        except JobNotFound as e:
+            self.send_error(404, str(e))
+        except JobLeaseLost as e:
+            self.send_error(409, str(e))
+        except Exception as e:
+            self.send_error(500, str(e))
+
+    def do_GET(self):
+        self.handle_errors(self.get)
+
+    def authorized(self) -> bool:
+        if self.token is None:
+            return False
+        return hmac.compare_digest(self.headers.get('Authorization', ''), f'Bearer {self.token}')
+
+    def do_POST(self):
+        if not self.authorized():
+            self.send_error(401 if self.token is not None else 403)
+            return
+        self.handle_errors(self.post)
+
+    def do_PUT(self):
+        if not self.authorized():
+            self.send_error(401 if self.token is not None else 403)
+            return
+        self.handle_errors(self.put)
+
+    def get(self):
+        url = urlparse(self.path)
+        if url.path == '/jobs':
+            query = parse_qs(url.query)
+            status = JobStatus(query['status'][0]) if 'status' in query else None
+            limit = int(query.get('limit', ['100'])[0])
+            self.send_json([job.to_json() for job in self.queue.list(status, limit)])
+            return
+        match = self.RE_JOB.match(url.path)
+        if match is not None:
+            self.send_json(self.queue.get(match.group(1)).to_json())
+            return
+        match = self.RE_ARTIFACT.match(url.path)
+        if match is None:
+            self.send_error(404)
+            return
+        artifact_path = self.queue.artifact_path(match.group(1), match.group(2))
+        if not os.path.exists(artifact_path):
+            self.send_error(404, 'no such artifact')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.android.package-archive')
+        self.send_header('Content-Length', str(os.path.getsize(artifact_path)))
+        self.send_header('Content-Disposition', f'attachment; filename="{match.group(2)}"')
+        self.end_headers()
+        with open(artifact_path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile, self.BUFFER_SIZE)
+
+    def post(self):
+        data = self.read_json()
+        if data is None:
+            return
+        if self.path == '/jobs':
+            if not isinstance(data, dict) or 'package_name' not in data:
+                self.send_error(400, 'job spec needs a package_name')
+                return
+            self.send_json(self.queue.submit(data).to_json(), 201)
+            return
+        if self.path == '/jobs/claim':
+            job = self.queue.claim(data['worker'])
+            if job is None:
+                self.send_empty(204)
+            else:
+                self.send_json(job.to_json())
+            return
+        match = self.RE_JOB_ACTION.match(self.path)
+        if match is None:
+            self.send_error(404)
+            return
+        job_id, action = match.groups()
+        if action == 'heartbeat':
+            self.queue.heartbeat(job_id, data['worker'])
+        elif action == 'complete':
+            self.queue.complete(job_id, data['worker'], data['result'])
+        else:
+            self.queue.fail(job_id, data['worker'], data['error'])
+        self.send_empty(204)
+
+    def put(self):
+        match = self.RE_ARTIFACT.match(self.path)
+        if match is None:
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        fd, tmp_file_path = tempfile.mkstemp(suffix='.upload')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while length > 0:
+                    chunk = self.rfile.read(min(length, self.BUFFER_SIZE))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    length -= len(chunk)
+            if length > 0:
+                self.send_error(400, 'incomplete upload')
+                return
+            self.queue.put_artifact(match.group(1), match.group(2), tmp_file_path)
+        finally:
+            os.remove(tmp_file_path)
+        self.send_empty(201)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_job_server(queue: JobQueue, host: str = '127.0.0.1', port: int = 8751,
+                      token: Optional[str] = None) -> ThreadingHTTPServer:
+    """
+    Call serve_forever() on the result to accept jobs and let workers on other nodes pull them
+
+    :param host: 0.0.0.0 to serve other hosts
+    :param token: required to submit jobs, for worker requests and uploads, None serves read only
+    """
+    if not isinstance(queue, SQLiteJobQueue):
+        raise Exception('the job server needs a local queue')
+    handler = type('BoundJobQueueHandler', (JobQueueHandler,), {
+        'queue': queue,
+        'token': token
+    })
+    return ThreadingHTTPServer((host, port), handler)
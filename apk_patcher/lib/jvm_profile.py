@@ -0,0 +1,123 @@
+import os
+import re
+import subprocess
+import uuid
+from dataclasses import dataclass, field, fields
+from typing import List, Optional, Tuple
+
+
+class InvalidJVMProfile(Exception):
+    def __init__(self, profile: str, error: str):
+        super().__init__(f'invalid JVM profile `{profile}`: {error}')
+
+
+@dataclass
+class JVMProfile:
+    """
+    Launch options of a java tool. Written in .env as comma separated key=value pairs, e.g.
+
+    heap_min=128m,heap_max=1g,gc=parallel,tiered_stop_at_level=1,cds=true,options=-Xss4m -Dfile.encoding=UTF-8
+    """
+    GC_OPTIONS = {
+        'serial': '-XX:+UseSerialGC',
+        'parallel': '-XX:+UseParallelGC',
+        'g1': '-XX:+UseG1GC',
+        'shenandoah': '-XX:+UseShenandoahGC',
+        'z': '-XX:+UseZGC'
+    }
+    RE_SIZE = re.compile(r'^\d+[kKmMgG]?$')
+    # Dynamic class data sharing archives, -XX:ArchiveClassesAtExit, came with java 13
+    CDS_MIN_VERSION = 13
+
+    heap_min: Optional[str] = None
+    heap_max: Optional[str] = None
+    gc: Optional[str] = None
+    # 1 compiles with C1 only, faster for short runs like apksigner
+    tiered_stop_at_level: Optional[int] = None
+    # Class data sharing archive per tool command, where the runtime supports it
+    cds: bool = False
+    options: List[str] = field(default_factory=list)
+
+    @classmethod
+    def parse(cls, value: Optional[str]) -> 'JVMProfile':
+        profile = cls()
+        known = {f.name for f in fields(cls)}
+        for item in (value or '').split(','):
+            if item.strip() == '':
+                continue
+            key, sep, option = item.partition('=')
+            key, option = key.strip(), option.strip()
+            if sep == '' or key not in known:
+                raise InvalidJVMProfile(value, f'unknown option {item.strip()}')
+            if key in ('heap_min', 'heap_max'):
+                if cls.RE_SIZE.match(option) is None:
+                    raise InvalidJVMProfile(value, f'{key} must be a size like 512m')
+                setattr(profile, key, option)
+            elif key == 'gc':
+                if option not in cls.GC_OPTIONS:
+                    raise InvalidJVMProfile(value, f'gc must be one of {", ".join(cls.GC_OPTIONS)}')
+                profile.gc = option
+            elif key == 'tiered_stop_at_level':
+                if option not in ('0', '1', '2', '3', '4'):
+                    raise InvalidJVMProfile(value, 'tiered_stop_at_level must be 0 to 4')
+                profile.tiered_stop_at_level = int(option)
+            elif key == 'cds':
+                profile.cds = option.lower() in ('1', 'true', 'yes')
+            else:
+                profile.options = option.split()
+        return profile
+
+    def jvm_options(self) -> List[str]:
+        options = []
+        if self.heap_min is not None:
+            options.append(f'-Xms{self.heap_min}')
+        if self.heap_max is not None:
+            options.append(f'-Xmx{self.heap_max}')
+        if self.gc is not None:
+            options.append(self.GC_OPTIONS[self.gc])
+        if self.tiered_stop_at_level is not None:
+            options.append(f'-XX:TieredStopAtLevel={self.tiered_stop_at_level}')
+        return options + self.options
+
+    @staticmethod
+    def cds_archive_path(jar_file_path: str, name: str, java_version: int) -> str:
+        """
+        Archives only work with the runtime that made them, the java version is part of the name
+        """
+        return os.path.join(os.path.dirname(jar_file_path), 'cds', f'{name}.java{java_version}.jsa')
+
+    def cds_options(self, archive_path: str, java_version: Optional[int]) -> Tuple[List[str], Optional[str]]:
+        """
+        :return: options, and the temporary path the archive is written to when the process exits, to be moved
+                 to archive_path if it succeeded
+        """
+        if not self.cds or java_version is None or java_version < self.CDS_MIN_VERSION:
+            return [], None
+        if os.path.exists(archive_path):
+            return [f'-XX:SharedArchiveFile={archive_path}'], None
+        # Concurrent first runs each dump their own archive, the last one to finish replaces the others
+        os.makedirs(os.path.dirname(archive_path), 0o755, exist_ok=True)
+        tmp_archive_path = f'{archive_path}.{uuid.uuid4().hex}.tmp'
+        return [f'-XX:ArchiveClassesAtExit={tmp_archive_path}'], tmp_archive_path
+
+
+RE_JAVA_VERSION = re.compile(r'version "(\d+)(?:\.(\d+))?')
+
+
+def java_feature_version(java_binary: str) -> Optional[int]:
+    """
+    8 for 1.8.0_292, 17 for 17.0.2, None if the binary can't run
+    """
+    try:
+        proc = subprocess.run([java_binary, '-version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    match = RE_JAVA_VERSION.search(proc.stdout.decode(errors='replace'))
+    if match is None:
+        return None
+    major = int(match.group(1))
+    if major == 1 and match.group(2) is not None:
+        return int(match.group(2))
+    return major
+
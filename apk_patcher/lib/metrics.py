@@ -0,0 +1,201 @@
+import json
+import math
+import os
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+LabelSet = Tuple[Tuple[str, str], ...]
+
+
+@dataclass
+class MetricEvent:
+    """
+    One measured operation, e.g. a build stage or a tool run
+    """
+    name: str
+    labels: Dict[str, str]
+    started_at: float
+    duration: float = 0
+    result: str = 'ok'
+    # Extra measurements, e.g. bytes
+    values: Dict[str, float] = field(default_factory=dict)
+
+
+@dataclass
+class Histogram:
+    buckets: List[float]
+    counts: List[int]
+    count: int = 0
+    sum: float = 0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class MetricsSink(metaclass=ABCMeta):
+    @abstractmethod
+    def emit(self, event: MetricEvent):
+        """
+        Called for every event as it finishes
+        """
+        raise NotImplementedError()
+
+    def flush(self, metrics: 'Metrics'):
+        """
+        Called after every build stage, sinks exporting the aggregated metrics write them here
+        """
+        pass
+
+
+class JSONLinesSink(MetricsSink):
+    """
+    Appends every event as a line of JSON, for analysis of individual runs
+    """
+    file_path: str
+
+    def __init__(self, file_path: str):
+        self.file_path = os.path.abspath(file_path)
+        self.__lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.file_path), 0o755, exist_ok=True)
+
+    def emit(self, event: MetricEvent):
+        line = json.dumps(asdict(event), sort_keys=True) + '\n'
+        with self.__lock:
+            # One write call per line, lines from several processes appending to the file don't interleave
+            with open(self.file_path, 'a') as f:
+                f.write(line)
+
+
+class OpenMetricsFileSink(MetricsSink):
+    """
+    Rewrites an OpenMetrics text file with the aggregated metrics, e.g. for the node_exporter textfile collector
+    """
+    file_path: str
+
+    def __init__(self, file_path: str):
+        self.file_path = os.path.abspath(file_path)
+        os.makedirs(os.path.dirname(self.file_path), 0o755, exist_ok=True)
+
+    def emit(self, event: MetricEvent):
+        pass
+
+    def flush(self, metrics: 'Metrics'):
+        tmp_file_path = f'{self.file_path}.{os.getpid()}.tmp'
+        with open(tmp_file_path, 'w') as f:
+            f.write(metrics.openmetrics())
+        os.replace(tmp_file_path, self.file_path)
+
+
+class Metrics:
+    """
+    Durations, counts and bytes of build stages, tool runs, provider lookups and downloads. Every finished
+    event goes to the sinks and is aggregated into OpenMetrics counters and histograms:
+
+    <prefix>_<name>_seconds      histogram of durations
+    <prefix>_<name>_total        counter of runs by result
+    <prefix>_<name>_<value>      counter of each extra value, e.g. <prefix>_download_bytes
+    """
+    DURATION_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+    prefix: str
+    sinks: List[MetricsSink]
+
+    def __init__(self, sinks: Optional[List[MetricsSink]] = None, prefix: str = 'apk_patcher'):
+        self.prefix = prefix
+        self.sinks = sinks or []
+        self.__lock = threading.Lock()
+        self.__histograms: Dict[str, Dict[LabelSet, Histogram]] = {}
+        self.__counters: Dict[str, Dict[LabelSet, float]] = {}
+
+    @staticmethod
+    def label_set(labels: Dict[str, Any]) -> LabelSet:
+        return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+    @contextmanager
+    def measure(self, name: str, **labels: Any) -> Iterator[MetricEvent]:
+        """
+        Times the block, set values on the yielded event to record more than the duration. None labels are left out.
+        """
+        event = MetricEvent(name, dict(self.label_set(labels)), time.time())
+        start = time.perf_counter()
+        try:
+            yield event
+        except BaseException:
+            event.result = 'error'
+            raise
+        finally:
+            event.duration = time.perf_counter() - start
+            self.record(event)
+
+    def record(self, event: MetricEvent):
+        labels = self.label_set(event.labels)
+        with self.__lock:
+            histograms = self.__histograms.setdefault(f'{self.prefix}_{event.name}_seconds', {})
+            if labels not in histograms:
+                histograms[labels] = Histogram(self.DURATION_BUCKETS, [0] * len(self.DURATION_BUCKETS))
+            histograms[labels].observe(event.duration)
+            self.__add(f'{self.prefix}_{event.name}', labels + (('result', event.result),), 1)
+            for key, value in event.values.items():
+                self.__add(f'{self.prefix}_{event.name}_{key}', labels, value)
+        for sink in self.sinks:
+            try:
+                sink.emit(event)
+            except Exception as e:
+                # Metrics must not fail the build
+                print(f'\tmetrics {type(sink).__name__}: {e}')
+
+    def __add(self, name: str, labels: LabelSet, value: float):
+        counters = self.__counters.setdefault(name, {})
+        counters[labels] = counters.get(labels, 0) + value
+
+    def flush(self):
+        for sink in self.sinks:
+            try:
+                sink.flush(self)
+            except Exception as e:
+                print(f'\tmetrics {type(sink).__name__}: {e}')
+
+    @staticmethod
+    def format_labels(labels: LabelSet) -> str:
+        if len(labels) == 0:
+            return ''
+        escaped = (
+            (key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels
+        )
+        return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+    @staticmethod
+    def format_number(value: float) -> str:
+        if math.isinf(value):
+            return '+Inf'
+        return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+    def openmetrics(self) -> str:
+        """
+        Aggregated metrics in the OpenMetrics text format
+        """
+        lines = []
+        with self.__lock:
+            for name in sorted(self.__histograms):
+                lines.append(f'# TYPE {name} histogram')
+                lines.append(f'# UNIT {name} seconds')
+                for labels, histogram in sorted(self.__histograms[name].items()):
+                    for bound, count in zip(histogram.buckets + [math.inf], histogram.counts + [histogram.count]):
+                        bucket_labels = self.format_labels(labels + (('le', self.format_number(bound)),))
+                        lines.append(f'{name}_bucket{bucket_labels} {count}')
+                    lines.append(f'{name}_count{self.format_labels(labels)} {histogram.count}')
+                    lines.append(f'{name}_sum{self.format_labels(labels)} {self.format_number(histogram.sum)}')
+            for name in sorted(self.__counters):
+                lines.append(f'# TYPE {name} counter')
+                for labels, value in sorted(self.__counters[name].items()):
+                    lines.append(f'{name}_total{self.format_labels(labels)} {self.format_number(value)}')
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
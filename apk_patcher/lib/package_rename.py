@@ -0,0 +1,225 @@
+import os
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from lxml import etree
+
+from apk_patcher.lib.util import worker_pool
+
+ANDROID_NS = 'http://schemas.android.com/apk/res/android'
+
+# (regex, replacement) pairs, plain strings so they can be sent to worker processes. A None replacement renames
+# the matched name, which starts with the old package.
+Rules = Tuple[Tuple[str, Optional[str]], ...]
+
+
+@dataclass
+class ManifestEdit:
+    element: etree._Element
+    attribute: str
+    old: str
+    new: str
+
+
+@dataclass
+class RenameIndex:
+    """
+    Every reference to the package in a decoded APK
+    """
+    manifest: List[ManifestEdit] = field(default_factory=list)
+    # Names of the app's identity besides the package: authorities, permissions, actions, ...
+    names: List[str] = field(default_factory=list)
+    # Lines with a reference, by file path relative to the decoded APK
+    lines: Dict[str, List[int]] = field(default_factory=dict)
+
+    @property
+    def reference_count(self) -> int:
+        return len(self.manifest) + sum(len(lines) for lines in self.lines.values())
+
+
+class PackageRenamer:
+    """
+    Renames the package of a decoded APK in two passes. The index pass finds every reference: manifest attributes
+    through lxml, then smali and resource XML lines in workers. The rewrite pass only edits the indexed lines,
+    again in workers.
+
+    Names are only matched as a whole, bounded by characters that can't be part of one, so com.example doesn't
+    match com.example2 or com.example.Foo. Authorities, permissions and other names of the app that start with the
+    package are renamed wherever they appear, e.g. a provider authority in a smali string constant.
+
+    Class names under the package stay unless rename_classes is set, then Lcom/old/...; descriptors and dotted
+    class names in strings, the manifest and layouts are renamed too. That breaks native methods registered by
+    their JNI names. Without it, relative component names in the manifest are made absolute, they would
+    otherwise resolve against the new package.
+    """
+    MANIFEST_PATH = 'AndroidManifest.xml'
+    SMALI_FOLDER_PREFIX = 'smali'
+    RES_FOLDER = 'res'
+    # Attributes naming a class, by element
+    CLASS_ATTRIBUTES = {
+        'application': ('name', 'backupAgent', 'manageSpaceActivity'),
+        'activity': ('name', 'parentActivityName'),
+        'activity-alias': ('name', 'targetActivity'),
+        'service': ('name',),
+        'receiver': ('name',),
+        'provider': ('name',),
+        'instrumentation': ('name',),
+    }
+    MAX_WORKERS = None
+    CHUNK_SIZE = 64
+
+    root_folder_path: str
+    old_package_name: str
+    new_package_name: str
+    rename_classes: bool
+
+    def __init__(self, root_folder_path: str, new_package_name: str, rename_classes: bool = False,
+                 max_workers: Optional[int] = MAX_WORKERS):
+        self.root_folder_path = root_folder_path
+        self.new_package_name = new_package_name
+        self.rename_classes = rename_classes
+        self.max_workers = max_workers
+        self.manifest = etree.parse(os.path.join(root_folder_path, self.MANIFEST_PATH))
+        self.old_package_name = self.manifest.getroot().attrib['package']
+
+    def renamed(self, name: str) -> str:
+        """
+        com.old, com.old.x or com.old:x with the new package
+        """
+        return self.new_package_name + name[len(self.old_package_name):]
+
+    def is_own_name(self, name: str) -> bool:
+        return name == self.old_package_name or name.startswith((f'{self.old_package_name}.',
+                                                                  f'{self.old_package_name}:'))
+
+    def index_manifest(self, index: RenameIndex):
+        root = self.manifest.getroot()
+        index.manifest.append(ManifestEdit(root, 'package', self.old_package_name, self.new_package_name))
+        for element in root.iter(tag=etree.Element):
+            class_attributes = self.CLASS_ATTRIBUTES.get(element.tag, ())
+            for attribute, value in element.attrib.items():
+                if attribute == 'package' or not attribute.startswith(f'{{{ANDROID_NS}}}'):
+                    continue
+                name = attribute[len(ANDROID_NS) + 2:]
+                if element.tag == 'meta-data':
+                    # Often a class name, e.g. an androidx.startup initializer, never relative
+                    if self.rename_classes and self.is_own_name(value):
+                        index.manifest.append(ManifestEdit(element, attribute, value, self.renamed(value)))
+                    continue
+                if name in class_attributes:
+                    class_name = f'{self.old_package_name}{value}' if value.startswith('.') else value
+                    if '.' not in class_name:
+                        class_name = f'{self.old_package_name}.{class_name}'
+                    if self.rename_classes and self.is_own_name(class_name):
+                        index.manifest.append(ManifestEdit(element, attribute, value, self.renamed(class_name)))
+                    elif not self.rename_classes and class_name != value:
+                        index.manifest.append(ManifestEdit(element, attribute, value, class_name))
+                    continue
+                # Authorities are ; separated
+                names = value.split(';')
+                if any(self.is_own_name(n) for n in names):
+                    new_value = ';'.join(self.renamed(n) if self.is_own_name(n) else n for n in names)
+                    index.manifest.append(ManifestEdit(element, attribute, value, new_value))
+                    index.names.extend(n for n in names if self.is_own_name(n) and n != self.old_package_name)
+
+    def needles(self) -> Tuple[str, ...]:
+        """
+        Every rule matches one of these, lines without them are skipped without a regex
+        """
+        if self.rename_classes:
+            return self.old_package_name, f'L{self.old_package_name.replace(".", "/")}/'
+        return self.old_package_name,
+
+    def rules(self, index: RenameIndex) -> Rules:
+        names = sorted({self.old_package_name, *index.names}, key=len, reverse=True)
+        rules: List[Tuple[str, Optional[str]]] = [
+            (r'(?<![\w.$])(' + '|'.join(re.escape(name) for name in names) + r')(?![\w.$])', None)
+        ]
+        if self.rename_classes:
+            old_path = self.old_package_name.replace('.', '/')
+            new_path = self.new_package_name.replace('.', '/')
+            rules.append((rf'(?<![\w.$]){re.escape(self.old_package_name)}\.(?=[\w$])', f'{self.new_package_name}.'))
+            rules.append((rf'(?<![\w/$])L{re.escape(old_path)}/(?=[\w$])', f'L{new_path}/'))
+        return tuple(rules)
+
+    def files(self) -> List[str]:
+        files = []
+        for name in sorted(os.listdir(self.root_folder_path)):
+            folder_path = os.path.join(self.root_folder_path, name)
+            if not os.path.isdir(folder_path):
+                continue
+            if name.startswith(self.SMALI_FOLDER_PREFIX):
+                extension = '.smali'
+            elif name == self.RES_FOLDER:
+                extension = '.xml'
+            else:
+                continue
+            for dir_path, _, file_names in os.walk(folder_path):
+                files.extend(os.path.join(dir_path, file_name) for file_name in file_names
+                             if file_name.endswith(extension))
+        return files
+
+    def index(self) -> RenameIndex:
+        index = RenameIndex()
+        self.index_manifest(index)
+        rules = self.rules(index)
+        files = self.files()
+        with worker_pool(self.max_workers) as executor:
+            results = executor.map(_index_file, files, [rules] * len(files), [self.needles()] * len(files),
+                                   chunksize=self.CHUNK_SIZE)
+            for file_path, lines in zip(files, results):
+                if len(lines) > 0:
+                    index.lines[os.path.relpath(file_path, self.root_folder_path)] = lines
+        return index
+
+    def rewrite(self, index: RenameIndex):
+        for edit in index.manifest:
+            edit.element.attrib[edit.attribute] = edit.new
+        self.manifest.write(
+            os.path.join(self.root_folder_path, self.MANIFEST_PATH),
+            xml_declaration=True,
+            encoding='utf-8',
+            standalone=False
+        )
+        rules = self.rules(index)
+        files = [os.path.join(self.root_folder_path, path) for path in index.lines]
+        with worker_pool(self.max_workers) as executor:
+            list(executor.map(_rewrite_file, files, [index.lines[path] for path in index.lines],
+                              [rules] * len(files), [(self.old_package_name, self.new_package_name)] * len(files),
+                              chunksize=self.CHUNK_SIZE))
+
+
+@lru_cache(maxsize=8)
+def _compile(rules: Rules) -> List[Tuple[re.Pattern, Optional[str]]]:
+    return [(re.compile(pattern), replacement) for pattern, replacement in rules]
+
+
+def _index_file(file_path: str, rules: Rules, needles: Tuple[str, ...]) -> List[int]:
+    patterns = _compile(rules)
+    with open(file_path, 'r', encoding='utf-8', errors='surrogateescape', newline='') as f:
+        content = f.read()
+    if not any(needle in content for needle in needles):
+        return []
+    return [
+        i for i, line in enumerate(content.splitlines(True))
+        if any(needle in line for needle in needles) and any(pattern.search(line) for pattern, _ in patterns)
+    ]
+
+
+def _rewrite_file(file_path: str, lines: List[int], rules: Rules, rename: Tuple[str, str]):
+    old_package_name, new_package_name = rename
+
+    def renamed(match: re.Match) -> str:
+        return new_package_name + match.group(1)[len(old_package_name):]
+
+    patterns = _compile(rules)
+    with open(file_path, 'r', encoding='utf-8', errors='surrogateescape', newline='') as f:
+        # Split like _index_file, the line numbers must match
+        content = f.read().splitlines(True)
+    for i in lines:
+        for pattern, replacement in patterns:
+            content[i] = pattern.sub(renamed if replacement is None else replacement, content[i])
+    with open(file_path, 'w', encoding='utf-8', errors='surrogateescape', newline='') as f:
+        f.writelines(content)
@@ -1,6 +1,7 @@
 import os
 import shutil
 from abc import ABCMeta, abstractmethod
+from typing import List
 
 
 class IncompletePatch(Exception):
@@ -9,6 +10,17 @@ class IncompletePatch(Exception):
 
 
 class Patch(metaclass=ABCMeta):
+    # Results are recorded and replayed by APKPatcher's patch cache, False for patches that change anything
+    # besides the decoded APK or don't always do the same to the same input
+    cacheable: bool = True
+
+    @classmethod
+    def input_paths(cls) -> List[str]:
+        """
+        Files and folders the patch reads besides its code and the decoded APK
+        """
+        return []
+
     @abstractmethod
     def config(self, **kwargs):
         raise NotImplementedError()
@@ -0,0 +1,377 @@
+import binascii
+import difflib
+import hashlib
+import inspect
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterator, List, Optional, Tuple, Type
+
+from apk_patcher.lib.file_lock import FileLock, atomic_output
+from apk_patcher.lib.patch import Patch
+from apk_patcher.lib.util import hash_file
+
+
+@dataclass
+class FileEdit:
+    # SHA-256 of the file before and after the patch, None if it didn't exist
+    before: Optional[str]
+    after: Optional[str]
+    # Blob of the line diff from before to after of a text file, there is no blob of after then
+    diff: Optional[str] = None
+    # Recorded file whose content from before the patch this one gets, e.g. a backup, no blob either
+    source: Optional[str] = None
+
+
+# (start, end, lines): lines start to end of the file before are replaced with lines
+LineDiff = List[Tuple[int, int, List[str]]]
+
+
+class PatchCache:
+    """
+    Records what a patch did to a decoded APK as the files it added, changed or removed. Changed text files are
+    stored as line diffs, other contents once as blobs named by their SHA-256. Entries are keyed by everything
+    the result depends on: the patch's code, its config and the recipe of the APK so far (its digests and
+    earlier stages).
+
+    A replay first checks that every recorded file still has its digest from before the patch, then writes the
+    recorded contents. If anything differs, or a blob is missing, nothing is changed and the patch runs instead.
+
+    Digests of a decoded APK's files are kept with their size and modification time, so only files that changed
+    since are hashed again, also by later processes. Above max_size, the least recently used entries and the
+    blobs only they use are deleted.
+    """
+    ENTRIES_FOLDER_NAME = 'entries'
+    BLOBS_FOLDER_NAME = 'blobs'
+    DIGESTS_FOLDER_NAME = 'digests'
+    LOCK_FILE_NAME = 'patch_cache.lock'
+    # apktool's scratch folder inside a decoded APK
+    IGNORED_FOLDERS = ('build',)
+    TEXT_EXTENSIONS = ('.smali', '.xml', '.yml', '.json', '.txt', '.properties')
+
+    root_folder: str
+    max_size: Optional[int]
+
+    def __init__(self, root_folder: str, max_size: Optional[int] = None):
+        """
+        :param max_size: bytes, None keeps every entry
+        """
+        self.root_folder = os.path.abspath(root_folder)
+        self.max_size = max_size
+        # Digests of files seen before, by path, valid while size and modification time are the same
+        self.__digests: Dict[str, Tuple[int, int, str]] = {}
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.root_folder, self.ENTRIES_FOLDER_NAME, key[:2], f'{key}.json')
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root_folder, self.BLOBS_FOLDER_NAME, digest[:2], digest)
+
+    def digests_file_path(self, root_folder_path: str) -> str:
+        name = hashlib.sha256(os.path.abspath(root_folder_path).encode()).hexdigest()
+        return os.path.join(self.root_folder, self.DIGESTS_FOLDER_NAME, f'{name}.json')
+
+    def lock(self) -> FileLock:
+        os.makedirs(self.root_folder, 0o755, exist_ok=True)
+        return FileLock(os.path.join(self.root_folder, self.LOCK_FILE_NAME))
+
+    @staticmethod
+    def code_digest(patch: Type[Patch]) -> str:
+        """
+        Digest of the source files of the patch and its base classes, and of its input_paths
+        """
+        paths = set()
+        for cls in patch.__mro__:
+            try:
+                paths.add(inspect.getsourcefile(cls))
+            except TypeError:
+                # Built-in class
+                continue
+        for path in patch.input_paths():
+            if os.path.isdir(path):
+                paths.update(
+                    os.path.join(dir_path, file_name)
+                    for dir_path, _, file_names in os.walk(path) for file_name in file_names
+                )
+            else:
+                paths.add(path)
+        # Contents only, the same patch installed elsewhere gives the same digest
+        digests = sorted(
+            binascii.hexlify(hash_file(path, 'sha256')).decode()
+            for path in paths if path is not None and os.path.isfile(path)
+        )
+        return hashlib.sha256(json.dumps(digests).encode()).hexdigest()
+
+    def snapshot(self, root_folder_path: str) -> Dict[str, Tuple[int, int]]:
+        """
+        Size and modification time of every file, by path relative to root_folder_path
+        """
+        files = {}
+        for dir_path, dirs, file_names in os.walk(root_folder_path):
+            if dir_path == root_folder_path:
+                dirs[:] = [name for name in dirs if name not in self.IGNORED_FOLDERS]
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                stat = os.stat(file_path)
+                files[os.path.relpath(file_path, root_folder_path).replace(os.sep, '/')] = \
+                    (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def digest(self, file_path: str) -> Optional[str]:
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        known = self.__digests.get(file_path)
+        if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+            return known[2]
+        digest = binascii.hexlify(hash_file(file_path, 'sha256')).decode()
+        self.__digests[file_path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def load_digests(self, root_folder_path: str):
+        """
+        Adds the digests another process saved for root_folder_path
+        """
+        try:
+            with open(self.digests_file_path(root_folder_path), 'r') as f:
+                files = json.load(f)['files']
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        for path, (size, mtime_ns, digest) in files.items():
+            self.__digests.setdefault(os.path.join(root_folder_path, *path.split('/')), (size, mtime_ns, digest))
+
+    def save_digests(self, root_folder_path: str, files: Dict[str, Tuple[int, int]]):
+        """
+        :param files: snapshot of root_folder_path
+        """
+        known = {}
+        for path, stat in files.items():
+            digest = self.__digests.get(os.path.join(root_folder_path, *path.split('/')))
+            if digest is not None and digest[:2] == stat:
+                known[path] = digest
+        digests_file_path = self.digests_file_path(root_folder_path)
+        os.makedirs(os.path.dirname(digests_file_path), 0o755, exist_ok=True)
+        with atomic_output(digests_file_path) as tmp_file_path:
+            with open(tmp_file_path, 'w') as f:
+                json.dump({'root': os.path.abspath(root_folder_path), 'files': known}, f)
+
+    def load(self, key: str) -> Optional[Dict[str, FileEdit]]:
+        try:
+            with open(self.entry_path(key), 'r') as f:
+                return {path: FileEdit(**edit) for path, edit in json.load(f).items()}
+        except (OSError, ValueError, TypeError, AttributeError):
+            return None
+
+    def is_text(self, path: str) -> bool:
+        return path.endswith(self.TEXT_EXTENSIONS)
+
+    @staticmethod
+    def read_lines(file_path: str) -> List[str]:
+        with open(file_path, 'r', encoding='utf-8', errors='surrogateescape', newline='') as f:
+            return f.read().splitlines(True)
+
+    @staticmethod
+    def line_diff(before: List[str], after: List[str]) -> LineDiff:
+        return [
+            (i1, i2, after[j1:j2])
+            for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, before, after).get_opcodes()
+            if tag != 'equal'
+        ]
+
+    @staticmethod
+    def apply_line_diff(before: List[str], diff: LineDiff) -> bytes:
+        lines = []
+        pos = 0
+        for start, end, new_lines in diff:
+            lines.extend(before[pos:start])
+            lines.extend(new_lines)
+            pos = end
+        lines.extend(before[pos:])
+        return ''.join(lines).encode('utf-8', 'surrogateescape')
+
+    def replay(self, key: str, root_folder_path: str) -> bool:
+        """
+        :return: False if there is no usable entry, root_folder_path is unchanged then
+        """
+        self.load_digests(root_folder_path)
+        with self.lock():
+            edits = self.load(key)
+            if edits is None:
+                return False
+            # Contents of diffed files, made before anything is written
+            patched: Dict[str, bytes] = {}
+            for path, edit in edits.items():
+                file_path = os.path.join(root_folder_path, *path.split('/'))
+                blob = edit.diff if edit.diff is not None else edit.after
+                if edit.source is None and blob is not None and not os.path.exists(self.blob_path(blob)):
+                    return False
+                if self.digest(file_path) != edit.before:
+                    return False
+                if edit.source is not None:
+                    source = edits.get(edit.source)
+                    if source is None or source.before != edit.after:
+                        return False
+                    with open(os.path.join(root_folder_path, *edit.source.split('/')), 'rb') as f:
+                        patched[path] = f.read()
+                elif edit.diff is not None:
+                    with open(self.blob_path(edit.diff), 'r') as f:
+                        patched[path] = self.apply_line_diff(self.read_lines(file_path), json.load(f))
+                    if hashlib.sha256(patched[path]).hexdigest() != edit.after:
+                        return False
+            for path, edit in edits.items():
+                file_path = os.path.join(root_folder_path, *path.split('/'))
+                if edit.after is None:
+                    os.remove(file_path)
+                    continue
+                os.makedirs(os.path.dirname(file_path), 0o755, exist_ok=True)
+                with atomic_output(file_path) as tmp_file_path:
+                    if path in patched:
+                        with open(tmp_file_path, 'wb') as f:
+                            f.write(patched[path])
+                    else:
+                        shutil.copyfile(self.blob_path(edit.after), tmp_file_path)
+                stat = os.stat(file_path)
+                self.__digests[file_path] = (stat.st_size, stat.st_mtime_ns, edit.after)
+            # Least recently used goes first on eviction
+            os.utime(self.entry_path(key))
+        self.save_digests(root_folder_path, self.snapshot(root_folder_path))
+        return True
+
+    @contextmanager
+    def record(self, key: str, root_folder_path: str) -> Iterator[None]:
+        """
+        Stores the changes the block makes to root_folder_path as the entry of key, if it succeeds
+        """
+        self.load_digests(root_folder_path)
+        before = self.snapshot(root_folder_path)
+        # Only files not seen before with this size and modification time are hashed
+        digests = {path: self.digest(os.path.join(root_folder_path, *path.split('/'))) for path in before}
+        yield
+        after = self.snapshot(root_folder_path)
+        edits = {}
+        for path in sorted(set(before) | set(after)):
+            if before.get(path) == after.get(path):
+                continue
+            file_path = os.path.join(root_folder_path, *path.split('/'))
+            edit = FileEdit(digests.get(path), self.digest(file_path) if path in after else None)
+            if edit.before != edit.after:
+                edits[path] = edit
+        # Contents from before the patch by digest, e.g. a backup the patch made
+        originals = {edit.after: path for path, edit in edits.items() if edit.after is not None}
+        sources = {edit.before: path for path, edit in edits.items()
+                   if edit.before is not None and edit.after != edit.before}
+        with self.lock():
+            for path, edit in edits.items():
+                if edit.after is None:
+                    continue
+                if edit.before is None and edit.after in sources:
+                    edit.source = sources[edit.after]
+                    continue
+                file_path = os.path.join(root_folder_path, *path.split('/'))
+                if edit.before is not None and self.is_text(path):
+                    original_path = originals.get(edit.before)
+                    if original_path is not None:
+                        original_path = os.path.join(root_folder_path, *original_path.split('/'))
+                    elif os.path.exists(self.blob_path(edit.before)):
+                        original_path = self.blob_path(edit.before)
+                    if original_path is not None:
+                        edit.diff = self.store_diff(original_path, file_path)
+                        if edit.diff is not None:
+                            continue
+                self.store_blob(file_path, edit.after)
+            entry_path = self.entry_path(key)
+            os.makedirs(os.path.dirname(entry_path), 0o755, exist_ok=True)
+            with atomic_output(entry_path) as tmp_file_path:
+                with open(tmp_file_path, 'w') as f:
+                    json.dump({path: asdict(edit) for path, edit in edits.items()}, f)
+            self.evict()
+        self.save_digests(root_folder_path, after)
+
+    def store_blob(self, file_path: str, digest: str):
+        blob_path = self.blob_path(digest)
+        if os.path.exists(blob_path):
+            return
+        os.makedirs(os.path.dirname(blob_path), 0o755, exist_ok=True)
+        with atomic_output(blob_path) as tmp_file_path:
+            shutil.copyfile(file_path, tmp_file_path)
+
+    def store_diff(self, original_file_path: str, file_path: str) -> Optional[str]:
+        """
+        :return: digest of the diff blob, None if it isn't smaller than the file
+        """
+        diff = json.dumps(self.line_diff(self.read_lines(original_file_path), self.read_lines(file_path)),
+                          separators=(',', ':')).encode()
+        if len(diff) >= os.path.getsize(file_path):
+            return None
+        digest = hashlib.sha256(diff).hexdigest()
+        blob_path = self.blob_path(digest)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), 0o755, exist_ok=True)
+            with atomic_output(blob_path) as tmp_file_path:
+                with open(tmp_file_path, 'wb') as f:
+                    f.write(diff)
+        return digest
+
+    def files(self, folder_name: str) -> List[Tuple[str, os.stat_result]]:
+        files = []
+        for dir_path, _, file_names in os.walk(os.path.join(self.root_folder, folder_name)):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                try:
+                    files.append((file_path, os.stat(file_path)))
+                except FileNotFoundError:
+                    continue
+        return files
+
+    def evict(self):
+        """
+        Deletes least recently used entries until the cache fits max_size, then the blobs no entry uses and the
+        digests of decoded APK's that are gone, the lock must be held
+        """
+        for file_path, _ in self.files(self.DIGESTS_FOLDER_NAME):
+            try:
+                with open(file_path, 'r') as f:
+                    root_folder_path = json.load(f)['root']
+            except (OSError, ValueError, KeyError, TypeError):
+                root_folder_path = None
+            if root_folder_path is None or not os.path.isdir(root_folder_path):
+                os.remove(file_path)
+        if self.max_size is None:
+            return
+        entries = self.files(self.ENTRIES_FOLDER_NAME)
+        blobs = {os.path.basename(file_path): (file_path, stat.st_size)
+                 for file_path, stat in self.files(self.BLOBS_FOLDER_NAME)}
+        size = sum(stat.st_size for _, stat in entries) + sum(blob_size for _, blob_size in blobs.values())
+        if size <= self.max_size:
+            return
+        # Blobs of each entry and the number of entries using a blob, a blob is deleted with its last entry
+        uses: Dict[str, List[str]] = {}
+        users: Dict[str, int] = {}
+        for file_path, _ in entries:
+            try:
+                with open(file_path, 'r') as f:
+                    uses[file_path] = [digest for edit in json.load(f).values()
+                                       for digest in (edit.get('after'), edit.get('diff')) if digest is not None]
+            except (OSError, ValueError, AttributeError):
+                uses[file_path] = []
+            for digest in uses[file_path]:
+                users[digest] = users.get(digest, 0) + 1
+        # Left by a process that stopped while recording
+        for digest in [digest for digest in blobs if digest not in users]:
+            blob_path, blob_size = blobs.pop(digest)
+            os.remove(blob_path)
+            size -= blob_size
+        for file_path, stat in sorted(entries, key=lambda entry: entry[1].st_mtime):
+            if size <= self.max_size:
+                break
+            os.remove(file_path)
+            size -= stat.st_size
+            for digest in uses[file_path]:
+                users[digest] -= 1
+                if users[digest] == 0 and digest in blobs:
+                    blob_path, blob_size = blobs.pop(digest)
+                    os.remove(blob_path)
+                    size -= blob_size
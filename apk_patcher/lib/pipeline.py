@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Set
+
+
+@dataclass
+class PipelineStage:
+    name: str
+    # Runs the stage, the (JSON serializable) return value is stored and passed to restore when the stage is skipped
+    action: Callable[[], Any]
+    inputs: List[str] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+    # Tool versions, options and configs the outputs depend on
+    params: Dict[str, Any] = field(default_factory=dict)
+    restore: Optional[Callable[[Any], None]] = None
+
+
+@dataclass
+class StagePlan:
+    stage: PipelineStage
+    run: bool
+    reason: str
+
+
+class Pipeline:
+    """
+    Make-style list of stages. A stage runs when its params or input files changed since it last ran,
+    one of its outputs is missing or was modified, or a stage producing one of its inputs runs.
+    Fingerprints of the last run are stored in a JSON state file.
+    """
+    STATE_VERSION = 1
+
+    state_file_path: str
+    ignored_paths: Set[str]
+    stages: List[PipelineStage]
+    state: Dict[str, Dict[str, Any]]
+
+    def __init__(self, state_file_path: str, ignored_paths: Optional[List[str]] = None):
+        """
+        :param ignored_paths: folders left out of fingerprints, e.g. scratch folders tools write into their inputs
+        """
+        self.state_file_path = os.path.abspath(state_file_path)
+        self.ignored_paths = set(os.path.abspath(path) for path in ignored_paths or [])
+        self.stages = []
+        self.state = {}
+        self.load_state()
+
+    def add(self, stage: PipelineStage) -> PipelineStage:
+        if any(other.name == stage.name for other in self.stages):
+            raise Exception(f'duplicate pipeline stage {stage.name}')
+        self.stages.append(stage)
+        return stage
+
+    def load_state(self):
+        if not os.path.exists(self.state_file_path):
+            return
+        try:
+            with open(self.state_file_path, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            return
+        if data.get('version') == self.STATE_VERSION:
+            self.state = data['stages']
+
+    def save_state(self):
+        os.makedirs(os.path.dirname(self.state_file_path), 0o755, exist_ok=True)
+        tmp_file_path = f'{self.state_file_path}.{os.getpid()}.tmp'
+        with open(tmp_file_path, 'w') as f:
+            json.dump({'version': self.STATE_VERSION, 'stages': self.state}, f, indent=2)
+        os.replace(tmp_file_path, self.state_file_path)
+
+    def fingerprint_path(self, path: str) -> List[Any]:
+        """
+        Size and modification time of a file, or of every file in a folder, like make
+        """
+        if not os.path.exists(path):
+            return [path, None]
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            return [path, stat.st_size, stat.st_mtime_ns]
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs[:] = sorted(name for name in dirs if os.path.abspath(os.path.join(root, name)) not in self.ignored_paths)
+            for name in sorted(names):
+                file_path = os.path.join(root, name)
+                stat = os.stat(file_path)
+                files.append([os.path.relpath(file_path, path), stat.st_size, stat.st_mtime_ns])
+        return [path, files]
+
+    @classmethod
+    def fingerprint(cls, value: Any) -> str:
+        return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+    def fingerprint_files(self, paths: List[str]) -> str:
+        return self.fingerprint([self.fingerprint_path(path) for path in paths])
+
+    def producers(self, stage: PipelineStage) -> List[PipelineStage]:
+        inputs = set(stage.inputs)
+        return [
+            other for other in self.stages[:self.stages.index(stage)]
+            if len(inputs.intersection(other.outputs)) > 0
+        ]
+
+    def plan(self) -> List[StagePlan]:
+        plans: Dict[str, StagePlan] = {}
+        for stage in self.stages:
+            reason = self.__reason(stage, plans)
+            plans[stage.name] = StagePlan(stage, reason is not None, reason or 'up to date')
+        return list(plans.values())
+
+    def __reason(self, stage: PipelineStage, plans: Dict[str, StagePlan]) -> Optional[str]:
+        running = [producer.name for producer in self.producers(stage) if plans[producer.name].run]
+        if len(running) > 0:
+            return f'{", ".join(running)} will run'
+        state = self.state.get(stage.name)
+        if state is None:
+            return 'never ran'
+        if state['params'] != self.fingerprint(stage.params):
+            return 'params changed'
+        if state['inputs'] != self.fingerprint_files(stage.inputs):
+            return 'inputs changed'
+        for path in stage.outputs:
+            if not os.path.exists(path):
+                return f'{os.path.basename(path)} is missing'
+        if state['outputs'] != self.fingerprint_files(stage.outputs):
+            return 'outputs were modified'
+        return None
+
+    @staticmethod
+    def print_plan(plans: List[StagePlan]):
+        print('Pipeline plan:')
+        for plan in plans:
+            print(f'\t{plan.stage.name}: {"run" if plan.run else "skip"} ({plan.reason})')
+
+    def run(self, dry_run: bool = False) -> List[StagePlan]:
+        """
+        :param dry_run: only print which stages would run and why
+        """
+        plans = self.plan()
+        if dry_run:
+            self.print_plan(plans)
+            return plans
+        for plan in plans:
+            stage = plan.stage
+            if not plan.run:
+                if stage.restore is not None:
+                    stage.restore(self.state[stage.name].get('data'))
+                continue
+            # Forget the old fingerprints first, a failed stage must run again
+            self.state.pop(stage.name, None)
+            self.save_state()
+            inputs = self.fingerprint_files(stage.inputs)
+            data = stage.action()
+            self.state[stage.name] = {
+                'params': self.fingerprint(stage.params),
+                'inputs': inputs,
+                'outputs': self.fingerprint_files(stage.outputs),
+                'data': data
+            }
+            self.save_state()
+        return plans
@@ -0,0 +1,377 @@
+import atexit
+import collections
+import os
+import selectors
+import signal
+import subprocess
+import threading
+import time
+from subprocess import PIPE, Popen, STDOUT
+from typing import Callable, Deque, Dict, Iterator, List, Optional
+
+
+class ProcessFailed(Exception):
+    name: str
+    returncode: Optional[int]
+    tail: List[str]
+
+    def __init__(self, name: str, returncode: Optional[int], tail: List[str], reason: Optional[str] = None):
+        self.name = name
+        self.returncode = returncode
+        self.tail = tail
+        message = reason or f'exited with {returncode}'
+        output = '\n'.join(f'\t{line}' for line in tail)
+        super().__init__(f'{name} {message}' + (f', last output:\n{output}' if len(tail) > 0 else ''))
+
+
+class ProcessKilled(ProcessFailed):
+    """
+    Killed by the supervisor, see reason: timed out, over the memory limit or cancelled
+    """
+    pass
+
+
+class SupervisedProcess:
+    """
+    A tool process started by ProcessSupervisor. stdout and stderr are merged and kept in a ring buffer of the
+    last output lines.
+    """
+    name: str
+    proc: Popen
+    timeout: Optional[float]
+    memory_limit: Optional[int]
+    started: float
+    returncode: Optional[int] = None
+    kill_reason: Optional[str] = None
+
+    def __init__(self, name: str, proc: Popen, ring_size: int, timeout: Optional[float], memory_limit: Optional[int]):
+        self.name = name
+        self.proc = proc
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.started = time.monotonic()
+        self.lines: Deque[str] = collections.deque(maxlen=ring_size)
+        # Lines received so far, including those the ring buffer dropped
+        self.line_count = 0
+        self.partial = bytearray()
+        self.kill_deadline: Optional[float] = None
+        self.changed = threading.Condition()
+        self.finished = threading.Event()
+        self.done_callbacks: List[Callable[['SupervisedProcess'], None]] = []
+
+    @property
+    def pid(self) -> int:
+        return self.proc.pid
+
+    @property
+    def tail(self) -> List[str]:
+        with self.changed:
+            return list(self.lines)
+
+    def add_output(self, data: bytes, final: bool = False):
+        self.partial += data
+        *complete, rest = self.partial.split(b'\n')
+        if final and len(rest) > 0:
+            complete.append(rest)
+            rest = b''
+        elif len(rest) > ProcessSupervisor.MAX_LINE_LENGTH:
+            complete.append(rest)
+            rest = b''
+        self.partial = bytearray(rest)
+        if len(complete) == 0:
+            return
+        with self.changed:
+            for line in complete:
+                self.lines.append(line.decode(errors='replace').rstrip('\r'))
+            self.line_count += len(complete)
+            self.changed.notify_all()
+
+    def finish(self, returncode: int):
+        with self.changed:
+            self.returncode = returncode
+            callbacks = self.done_callbacks
+            self.done_callbacks = []
+        for callback in callbacks:
+            self.run_callback(callback)
+        with self.changed:
+            self.finished.set()
+            self.changed.notify_all()
+
+    def add_done_callback(self, callback: Callable[['SupervisedProcess'], None]):
+        """
+        Calls callback with the process once it exited, before waiters return. Right away if it already did.
+        """
+        with self.changed:
+            if self.returncode is None:
+                self.done_callbacks.append(callback)
+                return
+        self.run_callback(callback)
+
+    def run_callback(self, callback: Callable[['SupervisedProcess'], None]):
+        try:
+            callback(self)
+        except Exception as e:
+            # Runs on the supervisor thread, which must keep going
+            print(f'\t{self.name} done callback: {e}')
+
+    def follow(self) -> Iterator[str]:
+        """
+        Yields output lines as they arrive until the process ends, lines the ring buffer dropped before they were
+        read are skipped
+        """
+        seen = 0
+        while True:
+            with self.changed:
+                while self.line_count == seen and not self.finished.is_set():
+                    self.changed.wait()
+                available = min(self.line_count - seen, len(self.lines))
+                lines = list(self.lines)[len(self.lines) - available:]
+                seen = self.line_count
+                done = self.finished.is_set()
+            yield from lines
+            if done:
+                return
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[int]:
+        """
+        :return: exit code like Popen.wait, None if timeout passed first
+        """
+        self.finished.wait(timeout)
+        return self.returncode
+
+    def check(self):
+        """
+        Waits for the process
+
+        :raises ProcessKilled: killed by the supervisor
+        :raises ProcessFailed: non-zero exit code
+        """
+        self.wait()
+        if self.kill_reason is not None:
+            raise ProcessKilled(self.name, self.returncode, self.tail, self.kill_reason)
+        if self.returncode != 0:
+            raise ProcessFailed(self.name, self.returncode, self.tail)
+
+
+class ProcessSupervisor:
+    """
+    Runs tool processes with a single thread multiplexing their output, instead of a blocking reader per process.
+    Every process gets its own process group (a job tree on Windows), so timeouts, memory limits and cancel()
+    kill the tool together with everything it started.
+
+    Memory is the resident size of the tool process, read from /proc, the limit is ignored where that is missing.
+    Windows pipes can't be selected, there every process gets a reader thread instead.
+    """
+    RING_SIZE = 200
+    MAX_LINE_LENGTH = 64 * 1024
+    READ_SIZE = 64 * 1024
+    CHECK_INTERVAL = 0.5
+    EXIT_POLL_INTERVAL = 0.01
+    # Seconds between SIGTERM and SIGKILL
+    KILL_GRACE = 5
+
+    timeout: Optional[float]
+    memory_limit: Optional[int]
+    ring_size: int
+
+    def __init__(self, timeout: Optional[float] = None, memory_limit: Optional[int] = None,
+                 ring_size: int = RING_SIZE):
+        """
+        :param timeout: default wall clock limit in seconds
+        :param memory_limit: default resident memory limit in bytes
+        """
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.ring_size = ring_size
+        self.__lock = threading.Lock()
+        self.__processes: Dict[int, SupervisedProcess] = {}
+        self.__selector: Optional[selectors.BaseSelector] = None
+        self.__thread: Optional[threading.Thread] = None
+        self.__wakeup: Optional[List[int]] = None
+        atexit.register(self.shutdown)
+
+    def start(self, args: List[str], name: Optional[str] = None, timeout: Optional[float] = None,
+              memory_limit: Optional[int] = None, **kwargs) -> SupervisedProcess:
+        """
+        Starts args with stdout and stderr captured, other Popen arguments are passed on
+
+        :param timeout: overrides the default wall clock limit
+        :param memory_limit: overrides the default memory limit
+        """
+        kwargs.update(stdout=PIPE, stderr=STDOUT)
+        if os.name == 'nt':
+            kwargs['creationflags'] = kwargs.get('creationflags', 0) | subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            kwargs['start_new_session'] = True
+        proc = Popen(args=args, **kwargs)
+        process = SupervisedProcess(name or os.path.basename(args[0]), proc, self.ring_size,
+                                    timeout if timeout is not None else self.timeout,
+                                    memory_limit if memory_limit is not None else self.memory_limit)
+        with self.__lock:
+            self.__processes[proc.pid] = process
+            self.ensure_thread()
+            if self.__selector is None:
+                threading.Thread(target=self.read_blocking, args=(process,), daemon=True).start()
+            else:
+                os.set_blocking(proc.stdout.fileno(), False)
+                self.__selector.register(proc.stdout, selectors.EVENT_READ, process)
+                os.write(self.__wakeup[1], b'\0')
+        return process
+
+    def ensure_thread(self):
+        if self.__thread is not None:
+            return
+        if os.name != 'nt':
+            self.__selector = selectors.DefaultSelector()
+            self.__wakeup = list(os.pipe())
+            os.set_blocking(self.__wakeup[0], False)
+            self.__selector.register(self.__wakeup[0], selectors.EVENT_READ, None)
+        self.__thread = threading.Thread(target=self.run, name='process-supervisor', daemon=True)
+        self.__thread.start()
+
+    def run(self):
+        last_check = 0.0
+        while True:
+            if self.__selector is None:
+                time.sleep(self.CHECK_INTERVAL)
+                self.check_processes()
+                continue
+            # A process that closed its output is about to exit, poll it closely so waiters return promptly
+            exiting = any(process.proc.stdout.closed for process in self.running())
+            for key, _ in self.__selector.select(self.EXIT_POLL_INTERVAL if exiting else self.CHECK_INTERVAL):
+                if key.data is None:
+                    try:
+                        os.read(self.__wakeup[0], 4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                if self.read_available(key.data):
+                    exiting = True
+            if exiting or time.monotonic() - last_check >= self.CHECK_INTERVAL:
+                last_check = time.monotonic()
+                self.check_processes()
+
+    def read_available(self, process: SupervisedProcess) -> bool:
+        """
+        :return: True at end of output
+        """
+        stdout = process.proc.stdout
+        while True:
+            try:
+                data = os.read(stdout.fileno(), self.READ_SIZE)
+            except BlockingIOError:
+                return False
+            except OSError:
+                data = b''
+            if data == b'':
+                with self.__lock:
+                    self.__selector.unregister(stdout)
+                stdout.close()
+                process.add_output(b'', True)
+                return True
+            process.add_output(data)
+
+    def read_blocking(self, process: SupervisedProcess):
+        for data in iter(lambda: process.proc.stdout.read1(self.READ_SIZE), b''):
+            process.add_output(data)
+        process.add_output(b'', True)
+        process.proc.stdout.close()
+
+    def check_processes(self):
+        with self.__lock:
+            processes = list(self.__processes.values())
+        now = time.monotonic()
+        for process in processes:
+            returncode = process.proc.poll()
+            if returncode is not None:
+                if self.__selector is None:
+                    # The reader thread closes stdout at the end of output
+                    if not process.proc.stdout.closed:
+                        continue
+                elif not process.proc.stdout.closed and not self.read_available(process):
+                    # Output still buffered in the pipe belongs to the process, a grandchild holding the pipe
+                    # open must not keep it running
+                    with self.__lock:
+                        self.__selector.unregister(process.proc.stdout)
+                    process.proc.stdout.close()
+                    process.add_output(b'', True)
+                with self.__lock:
+                    del self.__processes[process.pid]
+                process.finish(returncode)
+                continue
+            if process.kill_deadline is not None:
+                if now >= process.kill_deadline:
+                    self.signal_tree(process, True)
+                continue
+            if process.timeout is not None and now - process.started > process.timeout:
+                self.kill(process, f'timed out after {process.timeout:g}s')
+                continue
+            if process.memory_limit is not None:
+                resident = self.resident_memory(process.pid)
+                if resident is not None and resident > process.memory_limit:
+                    self.kill(process, f'used {resident // 1024 // 1024}MB, over the '
+                                       f'{process.memory_limit // 1024 // 1024}MB memory limit')
+
+    @staticmethod
+    def resident_memory(pid: int) -> Optional[int]:
+        try:
+            with open(f'/proc/{pid}/statm', 'r') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError, AttributeError):
+            return None
+
+    @staticmethod
+    def signal_tree(process: SupervisedProcess, force: bool):
+        try:
+            if os.name == 'nt':
+                subprocess.run(['taskkill', '/T', '/PID', str(process.pid)] + (['/F'] if force else []),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                os.killpg(process.pid, signal.SIGKILL if force else signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def kill(self, process: SupervisedProcess, reason: str):
+        """
+        Terminates the process tree, killed for good after KILL_GRACE seconds
+        """
+        if process.finished.is_set() or process.kill_reason is not None:
+            return
+        process.kill_reason = reason
+        process.kill_deadline = time.monotonic() + self.KILL_GRACE
+        self.signal_tree(process, False)
+
+    def cancel(self, process: Optional[SupervisedProcess] = None):
+        """
+        Kills process, or every running process when None
+        """
+        with self.__lock:
+            processes = [process] if process is not None else list(self.__processes.values())
+        for p in processes:
+            self.kill(p, 'cancelled')
+
+    def running(self) -> List[SupervisedProcess]:
+        with self.__lock:
+            return list(self.__processes.values())
+
+    def shutdown(self):
+        """
+        Process groups don't get the interpreter's Ctrl+C, kill what is left when exiting
+        """
+        for process in self.running():
+            self.signal_tree(process, True)
+
+
+_shared: Optional[ProcessSupervisor] = None
+_shared_lock = threading.Lock()
+
+
+def shared_supervisor() -> ProcessSupervisor:
+    """
+    Supervisor without limits for tools not given one
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = ProcessSupervisor()
+        return _shared
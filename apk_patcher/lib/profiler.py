@@ -0,0 +1,121 @@
+import cProfile
+import io
+import itertools
+import os
+import pstats
+import re
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+
+class Profiler:
+    """
+    Opt-in profiling of build stages. Python regions are captured with cProfile (<n>-<name>.prof, load with
+    pstats or snakeviz) and tracemalloc, with a readable summary of both in <n>-<name>.txt. JVM tool runs get
+    Flight Recorder (<n>-<name>.jfr) and GC logging (<n>-<name>.gc.log) options. Every report of one build or
+    job is written to the same folder, numbered in the order the regions started.
+    """
+    STATS_LIMIT = 30
+    MEMORY_LIMIT = 25
+    RE_UNSAFE_NAME = re.compile(r'[^\w\-.]+')
+
+    output_folder: str
+    python: bool
+    memory: bool
+    jvm: bool
+
+    def __init__(self, output_folder: str, python: bool = True, memory: bool = True, jvm: bool = True):
+        self.output_folder = os.path.abspath(output_folder)
+        self.python = python
+        self.memory = memory
+        self.jvm = jvm
+        self.__counter = itertools.count(1)
+        self.__lock = threading.Lock()
+        self.__active = threading.local()
+        os.makedirs(self.output_folder, 0o755, exist_ok=True)
+
+    def report_path(self, name: str) -> str:
+        """
+        :return: numbered path without extension
+        """
+        with self.__lock:
+            number = next(self.__counter)
+        return os.path.join(self.output_folder, f'{number:03d}-{self.RE_UNSAFE_NAME.sub("_", name)}')
+
+    @contextmanager
+    def profile(self, name: str) -> Iterator[None]:
+        """
+        Profiles the block in the current thread. A region inside another region is part of the outer report,
+        cProfile can't run nested.
+        """
+        if getattr(self.__active, 'name', None) is not None or not (self.python or self.memory):
+            yield
+            return
+        self.__active.name = name
+        report_path = self.report_path(name)
+        profile = cProfile.Profile() if self.python else None
+        started_tracing = False
+        snapshot = None
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            elif hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            snapshot = tracemalloc.take_snapshot()
+        try:
+            if profile is not None:
+                profile.enable()
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            self.__active.name = None
+            try:
+                memory = None
+                if snapshot is not None:
+                    # Before writing the report, which allocates too
+                    memory = (snapshot, tracemalloc.take_snapshot(), *tracemalloc.get_traced_memory())
+                self.write_report(name, report_path, profile, memory)
+            finally:
+                if started_tracing:
+                    tracemalloc.stop()
+
+    def write_report(self, name: str, report_path: str, profile: Optional[cProfile.Profile],
+                     memory: Optional[Tuple[tracemalloc.Snapshot, tracemalloc.Snapshot, int, int]]):
+        """
+        :param memory: tracemalloc snapshots at the start and end of the region, current and peak traced bytes
+        """
+        summary = io.StringIO()
+        summary.write(f'{name}\n\n')
+        if profile is not None:
+            profile.dump_stats(f'{report_path}.prof')
+            stats = pstats.Stats(profile, stream=summary)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.STATS_LIMIT)
+        if memory is not None:
+            start, end, current, peak = memory
+            summary.write(f'Memory: {current} bytes allocated, {peak} bytes peak\n')
+            summary.write(f'Top {self.MEMORY_LIMIT} allocation sites by growth:\n')
+            ignored = [tracemalloc.Filter(False, tracemalloc.__file__)]
+            stats = end.filter_traces(ignored).compare_to(start.filter_traces(ignored), 'lineno')
+            for stat in stats[:self.MEMORY_LIMIT]:
+                summary.write(f'\t{stat}\n')
+        with open(f'{report_path}.txt', 'w') as f:
+            f.write(summary.getvalue())
+
+    def jvm_options(self, name: str) -> List[str]:
+        """
+        Options placed before -jar. Unknown options are ignored, so older JVMs without Flight Recorder still run.
+        """
+        if not self.jvm:
+            return []
+        report_path = self.report_path(name)
+        return [
+            '-XX:+IgnoreUnrecognizedVMOptions',
+            f'-XX:StartFlightRecording=dumponexit=true,settings=profile,filename={report_path}.jfr',
+            f'-Xloggc:{report_path}.gc.log',
+            '-XX:+PrintGCDetails',
+            '-XX:+PrintGCDateStamps'
+        ]
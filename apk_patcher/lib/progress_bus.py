@@ -0,0 +1,244 @@
+import json
+import sys
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from dataclasses import replace
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, TextIO
+
+from apk_patcher.lib.metrics import MetricEvent, Metrics
+from apk_patcher.lib.progress import ProgressData, ProgressStage, ProgressType
+
+if TYPE_CHECKING:
+    from tqdm import tqdm
+
+
+class ProgressSubscriber(metaclass=ABCMeta):
+    @abstractmethod
+    def on_event(self, progress: ProgressData) -> bool:
+        """
+        Called from the bus thread with coalesced events, PROGRESS deltas are summed since the last call
+
+        :return: False to cancel the producer
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class ProgressBus:
+    """
+    Decouples progress producers from rendering. publish() only copies the event under a lock, a background
+    thread delivers events to the subscribers every INTERVAL seconds. PROGRESS events of the same task
+    (description) are coalesced into one, START, STOP and RESET are always delivered in order.
+
+    A subscriber returning False, or cancel(), makes the next publish() return False, so producers keep
+    raising ProgressCancelled as with a plain ProgressCallback.
+    """
+    INTERVAL = 0.1
+
+    subscribers: List[ProgressSubscriber]
+    interval: float
+
+    def __init__(self, subscribers: Optional[List[ProgressSubscriber]] = None, interval: float = INTERVAL):
+        self.subscribers = subscribers or []
+        self.interval = interval
+        self.__lock = threading.Lock()
+        # Held while delivering, so flush() and the bus thread don't reorder events
+        self.__dispatch_lock = threading.Lock()
+        self.__pending: List[ProgressData] = []
+        # Last pending PROGRESS event of each task, later events are added to it
+        self.__coalesced: Dict[str, ProgressData] = {}
+        self.__cancelled = threading.Event()
+        self.__closed = threading.Event()
+        self.__thread: Optional[threading.Thread] = None
+
+    def subscribe(self, subscriber: ProgressSubscriber):
+        self.subscribers.append(subscriber)
+
+    def cancel(self):
+        self.__cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.__cancelled.is_set()
+
+    def reset(self):
+        """
+        Clears a cancellation, for the next operation
+        """
+        self.__cancelled.clear()
+
+    @staticmethod
+    def callback(bus: 'ProgressBus', progress: ProgressData) -> bool:
+        """
+        ProgressCallback publishing to the bus given as user var
+        """
+        return bus.publish(progress)
+
+    def publish(self, progress: ProgressData) -> bool:
+        """
+        Never blocks on subscribers, producers may keep mutating progress after the call
+
+        :return: False when cancelled
+        """
+        if len(self.subscribers) == 0:
+            return not self.__cancelled.is_set()
+        with self.__lock:
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.run, name='progress-bus', daemon=True)
+                self.__thread.start()
+            coalesced = self.__coalesced.get(progress.description)
+            if progress.stage == ProgressStage.PROGRESS and coalesced is not None:
+                coalesced.current = progress.current
+                coalesced.total = progress.total
+                coalesced.delta += progress.delta
+            else:
+                event = replace(progress)
+                self.__pending.append(event)
+                if progress.stage == ProgressStage.PROGRESS:
+                    self.__coalesced[progress.description] = event
+                else:
+                    self.__coalesced.pop(progress.description, None)
+        return not self.__cancelled.is_set()
+
+    def dispatch(self):
+        with self.__dispatch_lock:
+            with self.__lock:
+                pending = self.__pending
+                self.__pending = []
+                self.__coalesced.clear()
+            for event in pending:
+                for subscriber in self.subscribers:
+                    try:
+                        if subscriber.on_event(event) is False:
+                            self.__cancelled.set()
+                    except Exception as e:
+                        # Rendering must not fail the build
+                        print(f'\tprogress {type(subscriber).__name__}: {e}')
+
+    def run(self):
+        while not self.__closed.wait(self.interval):
+            self.dispatch()
+
+    def flush(self):
+        """
+        Delivers pending events now, e.g. before printing so bars and output don't interleave
+        """
+        self.dispatch()
+
+    def close(self):
+        """
+        Stops the bus thread after delivering pending events, a later publish() starts it again
+        """
+        with self.__lock:
+            thread = self.__thread
+            self.__thread = None
+            self.__closed.set()
+        if thread is not None:
+            thread.join()
+        self.__closed.clear()
+        self.dispatch()
+        for subscriber in self.subscribers:
+            subscriber.close()
+
+    def __enter__(self) -> 'ProgressBus':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TqdmSubscriber(ProgressSubscriber):
+    """
+    A tqdm bar per task, for interactive terminals
+    """
+    bars: Dict[str, 'tqdm']
+
+    def __init__(self):
+        self.bars = {}
+
+    def on_event(self, progress: ProgressData) -> bool:
+        bar = self.bars.get(progress.description)
+        if progress.stage == ProgressStage.START or progress.stage == ProgressStage.RESET:
+            from tqdm import tqdm
+            if bar is not None:
+                bar.close()
+            config: Dict[str, Any] = {
+                'desc': progress.description,
+                'total': progress.total
+            }
+            if progress.type == ProgressType.FILE:
+                config['unit'] = 'B'
+                config['unit_scale'] = True
+            self.bars[progress.description] = bar = tqdm(**config)
+            bar.update(progress.current)
+        elif bar is None:
+            return True
+        elif progress.stage == ProgressStage.PROGRESS:
+            bar.total = progress.total
+            bar.update(progress.delta)
+        elif progress.stage == ProgressStage.STOP:
+            bar.total = progress.total
+            bar.update(progress.current - bar.n)
+            bar.close()
+            del self.bars[progress.description]
+        return True
+
+    def close(self):
+        for bar in self.bars.values():
+            bar.close()
+        self.bars.clear()
+
+
+class LogSubscriber(ProgressSubscriber):
+    """
+    JSON lines for headless workers, at most one PROGRESS line per task every interval seconds
+    """
+    stream: TextIO
+    interval: float
+
+    def __init__(self, stream: Optional[TextIO] = None, interval: float = 5):
+        self.stream = stream or sys.stdout
+        self.interval = interval
+        self.last_logged: Dict[str, float] = {}
+
+    def on_event(self, progress: ProgressData) -> bool:
+        now = time.monotonic()
+        if progress.stage == ProgressStage.PROGRESS:
+            if now - self.last_logged.get(progress.description, 0) < self.interval:
+                return True
+        self.last_logged[progress.description] = now
+        if progress.stage == ProgressStage.STOP:
+            del self.last_logged[progress.description]
+        self.stream.write(json.dumps({
+            'progress': progress.description,
+            'stage': progress.stage.name.lower(),
+            'current': progress.current,
+            'total': progress.total
+        }) + '\n')
+        self.stream.flush()
+        return True
+
+
+class MetricsSubscriber(ProgressSubscriber):
+    """
+    Records the duration and amount of every finished task as a progress event, see Metrics
+    """
+    metrics: Metrics
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self.started: Dict[str, float] = {}
+
+    def on_event(self, progress: ProgressData) -> bool:
+        if progress.stage == ProgressStage.START or progress.stage == ProgressStage.RESET:
+            self.started[progress.description] = time.time()
+        elif progress.stage == ProgressStage.STOP and progress.description in self.started:
+            started_at = self.started.pop(progress.description)
+            unit = 'bytes' if progress.type == ProgressType.FILE else 'items'
+            # Descriptions contain file names, the type keeps the label set small
+            self.metrics.record(MetricEvent('progress', {'type': progress.type.name.lower()}, started_at,
+                                            time.time() - started_at, values={unit: progress.current}))
+        return True
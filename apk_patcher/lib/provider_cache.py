@@ -0,0 +1,166 @@
+import binascii
+import json
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Type
+
+from apk_patcher.lib.apk_provider import APKInfo, APKProvider, APKSplitInfo
+from apk_patcher.lib.file_lock import FileLock, atomic_output
+
+if TYPE_CHECKING:
+    from cryptography.hazmat.primitives.hashes import HashAlgorithm
+
+
+class ProviderInfoCache:
+    """
+    Time limited cache of APKInfo results keyed by (provider, package, sdk version, abis), persisted as JSON.
+    Processes sharing the file merge their changes into it, the entry that expires last wins.
+    """
+    file_path: Optional[str]
+    ttl: float
+
+    def __init__(self, file_path: Optional[str], ttl: float):
+        self.file_path = os.path.abspath(file_path) if file_path is not None else None
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        self.__entries: Dict[str, dict] = {}
+        # Keys put or invalidated since the last save, None for invalidated
+        self.__changes: Dict[str, Optional[dict]] = {}
+        self.load()
+
+    @staticmethod
+    def hash_type(name: Optional[str]) -> Optional[Type['HashAlgorithm']]:
+        """
+        Hash class of a stored name, cryptography is only imported once an entry is read
+        """
+        from cryptography.hazmat.primitives import hashes
+        algorithms = (hashes.MD5, hashes.SHA1, hashes.SHA256, hashes.SHA384, hashes.SHA512)
+        return {algorithm.name: algorithm for algorithm in algorithms}.get(name)
+
+    @staticmethod
+    def key(provider: Type[APKProvider], package_name: str, sdk_version: int, available_abi: List[str]) -> str:
+        return '|'.join([provider.__name__, package_name, str(sdk_version), ','.join(sorted(available_abi))])
+
+    def read(self) -> Dict[str, dict]:
+        """
+        Entries of the file that haven't expired
+        """
+        if self.file_path is None or not os.path.exists(self.file_path):
+            return {}
+        try:
+            with open(self.file_path, 'r') as f:
+                entries = json.load(f)
+        except ValueError:
+            return {}
+        now = time.time()
+        return {key: entry for key, entry in entries.items() if entry['expires_at'] > now}
+
+    def load(self):
+        entries = self.read()
+        with self.__lock:
+            self.__entries = entries
+
+    def save(self):
+        """
+        Merges the changes of this instance into the entries other processes saved in the meantime
+        """
+        if self.file_path is None:
+            return
+        with self.__lock:
+            if len(self.__changes) == 0:
+                return
+            changes = dict(self.__changes)
+            self.__changes.clear()
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        with FileLock(f'{self.file_path}.lock'):
+            entries = self.read()
+            for key, entry in changes.items():
+                if entry is None:
+                    entries.pop(key, None)
+                elif key not in entries or entries[key]['expires_at'] < entry['expires_at']:
+                    entries[key] = entry
+            with atomic_output(self.file_path) as tmp_file_path:
+                with open(tmp_file_path, 'w') as f:
+                    json.dump(entries, f)
+        with self.__lock:
+            # Changes made while saving stay for the next save
+            entries.update({key: entry for key, entry in self.__changes.items() if entry is not None})
+            for key in [key for key, entry in self.__changes.items() if entry is None]:
+                entries.pop(key, None)
+            self.__entries = entries
+
+    def get(self, provider: Type[APKProvider], package_name: str, sdk_version: int,
+            available_abi: List[str]) -> Optional[APKInfo]:
+        key = self.key(provider, package_name, sdk_version, available_abi)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            if entry['expires_at'] <= time.time():
+                # Dropped from the file by the next save
+                del self.__entries[key]
+                return None
+        info = entry['info']
+        return APKInfo(
+            provider,
+            info['package_name'],
+            info['version_name'],
+            info['version_code'],
+            info['sdk_version'],
+            info['available_abi'],
+            file_hash=self.__load_hash(info['file_hash']),
+            file_hash_type=self.hash_type(info['file_hash_type']),
+            file_size=info['file_size'],
+            splits=[
+                APKSplitInfo(
+                    split['name'],
+                    file_hash=self.__load_hash(split['file_hash']),
+                    file_hash_type=self.hash_type(split['file_hash_type']),
+                    file_size=split['file_size']
+                )
+                for split in info.get('splits', [])
+            ]
+        )
+
+    @staticmethod
+    def __load_hash(file_hash: Optional[str]) -> Optional[bytes]:
+        return binascii.unhexlify(file_hash) if file_hash is not None else None
+
+    @staticmethod
+    def __dump_hash(file_hash: Optional[bytes]) -> Optional[str]:
+        return binascii.hexlify(file_hash).decode() if file_hash is not None else None
+
+    def put(self, apk_info: APKInfo, sdk_version: int, available_abi: List[str]):
+        key = self.key(apk_info.provider, apk_info.package_name, sdk_version, available_abi)
+        entry = {
+            'expires_at': time.time() + self.ttl,
+            'info': {
+                'package_name': apk_info.package_name,
+                'version_name': apk_info.version_name,
+                'version_code': apk_info.version_code,
+                'sdk_version': apk_info.sdk_version,
+                'available_abi': apk_info.available_abi,
+                'file_hash': self.__dump_hash(apk_info.file_hash),
+                'file_hash_type': apk_info.file_hash_type.name if apk_info.file_hash_type is not None else None,
+                'file_size': apk_info.file_size,
+                'splits': [
+                    {
+                        'name': split.name,
+                        'file_hash': self.__dump_hash(split.file_hash),
+                        'file_hash_type': split.file_hash_type.name if split.file_hash_type is not None else None,
+                        'file_size': split.file_size
+                    }
+                    for split in apk_info.splits
+                ]
+            }
+        }
+        with self.__lock:
+            self.__entries[key] = entry
+            self.__changes[key] = entry
+
+    def invalidate(self, provider: Type[APKProvider], package_name: str, sdk_version: int, available_abi: List[str]):
+        key = self.key(provider, package_name, sdk_version, available_abi)
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__changes[key] = None
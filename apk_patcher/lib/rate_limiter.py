@@ -0,0 +1,50 @@
+import threading
+import time
+from typing import Dict
+from urllib.parse import urlparse
+
+
+class RateLimiter:
+    """
+    Token bucket shared between threads, acquire() blocks until a request may be sent
+    """
+    rate: float
+    burst: int
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.__tokens = float(burst)
+        self.__updated_at = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(float(self.burst), self.__tokens + (now - self.__updated_at) * self.rate)
+            self.__updated_at = now
+            # Reserve a token even if it isn't available yet, later callers queue up behind this one
+            self.__tokens -= 1
+            wait = -self.__tokens / self.rate if self.__tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HostRateLimiter:
+    rate: float
+    burst: int
+    limiters: Dict[str, RateLimiter]
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.limiters = {}
+        self.__lock = threading.Lock()
+
+    def acquire(self, url: str):
+        host = urlparse(url).netloc
+        with self.__lock:
+            limiter = self.limiters.get(host)
+            if limiter is None:
+                limiter = self.limiters[host] = RateLimiter(self.rate, self.burst)
+        limiter.acquire()
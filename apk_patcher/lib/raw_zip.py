@@ -0,0 +1,334 @@
+import mmap
+import struct
+import zlib
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+
+class UnsupportedZip(Exception):
+    def __init__(self, error: str):
+        super().__init__(f'unsupported zip: {error}')
+
+
+@dataclass
+class RawZipEntry:
+    name: str
+    version_made_by: int
+    version_needed: int
+    flags: int
+    compress_type: int
+    mod_time: int
+    mod_date: int
+    crc32: int
+    compress_size: int
+    file_size: int
+    internal_attr: int
+    external_attr: int
+    header_offset: int
+    extra: bytes
+    comment: bytes
+    data_offset: Optional[int] = None
+    local_extra: Optional[bytes] = None
+
+    def is_dir(self) -> bool:
+        return self.name.endswith('/')
+
+    @property
+    def name_bytes(self) -> bytes:
+        return self.name.encode('utf-8' if self.flags & RawZip.FLAG_UTF8 else 'cp437')
+
+
+class RawZip:
+    STORED = 0
+    DEFLATED = 8
+
+    FLAG_DATA_DESCRIPTOR = 0x08
+    FLAG_UTF8 = 0x800
+
+    # 1980-01-01 00:00:00, keeps generated entries reproducible
+    DEFAULT_DOS_DATE = (1 << 5) | 1
+    DEFAULT_DOS_TIME = 0
+
+    # See: https://developer.android.com/studio/command-line/zipalign
+    ALIGNMENT_EXTRA_ID = 0xd935
+    ALIGNMENT_EXTRA_MIN_SIZE = 6
+
+    LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+    LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+    CENTRAL_HEADER = struct.Struct('<4sHHHHHHIIIHHHHHII')
+    CENTRAL_HEADER_SIGNATURE = b'PK\x01\x02'
+    END_RECORD = struct.Struct('<4sHHHHIIH')
+    END_RECORD_SIGNATURE = b'PK\x05\x06'
+    END_RECORD_CD_OFFSET_POS = 16
+    ZIP64_LOCATOR_SIGNATURE = b'PK\x06\x07'
+    ZIP64_LOCATOR_SIZE = 20
+    MAX_COMMENT_SIZE = 0xffff
+
+    @staticmethod
+    def strip_extra_field(extra: bytes, header_id: int) -> bytes:
+        out = bytearray()
+        pos = 0
+        while pos + 4 <= len(extra):
+            field_id, field_size = struct.unpack_from('<HH', extra, pos)
+            field_end = pos + 4 + field_size
+            if field_end > len(extra):
+                # Malformed or zero padded (old zipalign), drop the remainder
+                break
+            if field_id != header_id:
+                out.extend(extra[pos:field_end])
+            pos = field_end
+        return bytes(out)
+
+    @staticmethod
+    def get_alignment_extra(extra: bytes) -> Optional[int]:
+        pos = 0
+        while pos + 4 <= len(extra):
+            field_id, field_size = struct.unpack_from('<HH', extra, pos)
+            if field_id == RawZip.ALIGNMENT_EXTRA_ID and field_size >= 2 and pos + 6 <= len(extra):
+                return struct.unpack_from('<H', extra, pos + 4)[0]
+            pos += 4 + field_size
+        return None
+
+    @staticmethod
+    def end_record_with_cd_offset(end_record: bytes, cd_offset: int) -> bytes:
+        pos = RawZip.END_RECORD_CD_OFFSET_POS
+        return end_record[:pos] + struct.pack('<I', cd_offset) + end_record[pos + 4:]
+
+
+class RawZipReader:
+    """
+    Reads zip entries without decompressing them, used to copy, digest or rewrite APKs
+    while keeping the original compressed data.
+    """
+    file_path: str
+    entries: List[RawZipEntry]
+    cd_offset: int
+    cd_size: int
+    end_record_offset: int
+    comment: bytes
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.__file = open(file_path, 'rb')
+        try:
+            self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.__file.close()
+            raise UnsupportedZip(f'{file_path} is empty')
+        self.__read_central_directory()
+
+    def __enter__(self) -> 'RawZipReader':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.__map.close()
+        self.__file.close()
+
+    @property
+    def data(self) -> mmap.mmap:
+        return self.__map
+
+    def __read_central_directory(self):
+        data = self.__map
+        search_start = max(0, len(data) - RawZip.END_RECORD.size - RawZip.MAX_COMMENT_SIZE)
+        end_record_offset = data.rfind(RawZip.END_RECORD_SIGNATURE, search_start)
+        if end_record_offset < 0:
+            raise UnsupportedZip(f'{self.file_path} is missing the end of central directory record')
+
+        locator_offset = end_record_offset - RawZip.ZIP64_LOCATOR_SIZE
+        if locator_offset >= 0 and data[locator_offset:locator_offset + 4] == RawZip.ZIP64_LOCATOR_SIGNATURE:
+            raise UnsupportedZip('zip64 archives are not supported')
+
+        (_, disk, cd_disk, disk_entries, total_entries, cd_size, cd_offset,
+         comment_size) = RawZip.END_RECORD.unpack_from(data, end_record_offset)
+        if disk != 0 or cd_disk != 0 or disk_entries != total_entries:
+            raise UnsupportedZip('multi-disk archives are not supported')
+
+        comment_offset = end_record_offset + RawZip.END_RECORD.size
+        self.comment = bytes(data[comment_offset:comment_offset + comment_size])
+        self.cd_offset = cd_offset
+        self.cd_size = cd_size
+        self.end_record_offset = end_record_offset
+        self.entries = []
+
+        pos = cd_offset
+        for _ in range(total_entries):
+            (signature, version_made_by, version_needed, flags, compress_type, mod_time, mod_date, crc32,
+             compress_size, file_size, name_size, extra_size, comment_size, _, internal_attr, external_attr,
+             header_offset) = RawZip.CENTRAL_HEADER.unpack_from(data, pos)
+            if signature != RawZip.CENTRAL_HEADER_SIGNATURE:
+                raise UnsupportedZip(f'bad central directory header at offset {pos}')
+            if 0xffffffff in (compress_size, file_size, header_offset):
+                raise UnsupportedZip('zip64 entries are not supported')
+            pos += RawZip.CENTRAL_HEADER.size
+            name = bytes(data[pos:pos + name_size]).decode('utf-8' if flags & RawZip.FLAG_UTF8 else 'cp437')
+            pos += name_size
+            extra = bytes(data[pos:pos + extra_size])
+            pos += extra_size
+            comment = bytes(data[pos:pos + comment_size])
+            pos += comment_size
+            self.entries.append(RawZipEntry(
+                name, version_made_by, version_needed, flags, compress_type, mod_time, mod_date, crc32,
+                compress_size, file_size, internal_attr, external_attr, header_offset, extra, comment
+            ))
+
+    def entries_by_name(self) -> Dict[str, RawZipEntry]:
+        return {entry.name: entry for entry in self.entries}
+
+    def read_local_header(self, entry: RawZipEntry):
+        if entry.data_offset is not None:
+            return
+        (signature, _, _, _, _, _, _, _, _, name_size,
+         extra_size) = RawZip.LOCAL_HEADER.unpack_from(self.__map, entry.header_offset)
+        if signature != RawZip.LOCAL_HEADER_SIGNATURE:
+            raise UnsupportedZip(f'bad local header for {entry.name}')
+        extra_offset = entry.header_offset + RawZip.LOCAL_HEADER.size + name_size
+        entry.local_extra = bytes(self.__map[extra_offset:extra_offset + extra_size])
+        entry.data_offset = extra_offset + extra_size
+
+    def read_raw(self, entry: RawZipEntry) -> memoryview:
+        """
+        Zero-copy view of the entry's (possibly compressed) data, release it before closing the reader
+        """
+        self.read_local_header(entry)
+        return memoryview(self.__map)[entry.data_offset:entry.data_offset + entry.compress_size]
+
+    def iter_content(self, entry: RawZipEntry, buffer_size: int = 1024 * 1024) -> Iterator[bytes]:
+        self.read_local_header(entry)
+        start = entry.data_offset
+        end = entry.data_offset + entry.compress_size
+        if entry.compress_type == RawZip.STORED:
+            for pos in range(start, end, buffer_size):
+                yield self.__map[pos:min(pos + buffer_size, end)]
+        elif entry.compress_type == RawZip.DEFLATED:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            for pos in range(start, end, buffer_size):
+                chunk = decompressor.decompress(self.__map[pos:min(pos + buffer_size, end)])
+                if chunk:
+                    yield chunk
+            chunk = decompressor.flush()
+            if chunk:
+                yield chunk
+        else:
+            raise UnsupportedZip(f'compression method {entry.compress_type} of {entry.name}')
+
+    def read(self, entry: RawZipEntry) -> bytes:
+        return b''.join(self.iter_content(entry))
+
+
+class RawZipWriter:
+    """
+    Writes zip entries from already compressed data, optionally aligning the start of the entry data
+    """
+    file: BinaryIO
+    offset: int
+    entries: List[RawZipEntry]
+    comment: bytes
+
+    def __init__(self, file: BinaryIO, offset: int = 0, comment: bytes = b''):
+        self.file = file
+        self.offset = offset
+        self.entries = []
+        self.comment = comment
+
+    def __write(self, data: bytes):
+        self.file.write(data)
+        self.offset += len(data)
+
+    def __local_extra(self, entry: RawZipEntry, name_size: int, alignment: int) -> bytes:
+        extra = RawZip.strip_extra_field(entry.local_extra or b'', RawZip.ALIGNMENT_EXTRA_ID)
+        if alignment <= 1 or entry.compress_type != RawZip.STORED:
+            return extra
+        data_offset = self.offset + RawZip.LOCAL_HEADER.size + name_size + len(extra) + RawZip.ALIGNMENT_EXTRA_MIN_SIZE
+        padding = (alignment - data_offset % alignment) % alignment
+        return extra + struct.pack('<HHH', RawZip.ALIGNMENT_EXTRA_ID, 2 + padding, alignment) + bytes(padding)
+
+    def write_raw(self, entry: RawZipEntry, data: bytes, alignment: int = 1) -> RawZipEntry:
+        name = entry.name_bytes
+        local_extra = self.__local_extra(entry, len(name), alignment)
+        flags = entry.flags & ~RawZip.FLAG_DATA_DESCRIPTOR
+        out_entry = RawZipEntry(
+            entry.name, entry.version_made_by, entry.version_needed, flags, entry.compress_type, entry.mod_time,
+            entry.mod_date, entry.crc32, len(data), entry.file_size, entry.internal_attr, entry.external_attr,
+            self.offset, entry.extra, entry.comment,
+            data_offset=self.offset + RawZip.LOCAL_HEADER.size + len(name) + len(local_extra),
+            local_extra=local_extra
+        )
+        self.__write(RawZip.LOCAL_HEADER.pack(
+            RawZip.LOCAL_HEADER_SIGNATURE, out_entry.version_needed, out_entry.flags, out_entry.compress_type,
+            out_entry.mod_time, out_entry.mod_date, out_entry.crc32, out_entry.compress_size, out_entry.file_size,
+            len(name), len(local_extra)
+        ))
+        self.__write(name)
+        self.__write(local_extra)
+        self.__write(data)
+        self.entries.append(out_entry)
+        return out_entry
+
+    def write(self, name: str, data: bytes, compress_type: int = RawZip.DEFLATED, level: int = zlib.Z_BEST_COMPRESSION,
+              alignment: int = 1) -> RawZipEntry:
+        crc32 = zlib.crc32(data)
+        if compress_type == RawZip.DEFLATED:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            compressed = compressor.compress(data) + compressor.flush()
+        elif compress_type == RawZip.STORED:
+            compressed = data
+        else:
+            raise UnsupportedZip(f'compression method {compress_type}')
+        entry = RawZipEntry(
+            name, 20, 20 if compress_type == RawZip.DEFLATED else 10, RawZip.FLAG_UTF8 if not name.isascii() else 0,
+            compress_type, RawZip.DEFAULT_DOS_TIME, RawZip.DEFAULT_DOS_DATE, crc32, len(compressed), len(data),
+            0, 0, 0, b'', b''
+        )
+        return self.write_raw(entry, compressed, alignment)
+
+    def end_records(self) -> Tuple[bytes, bytes]:
+        """
+        :return: central directory and end of central directory record for the entries written so far
+        """
+        cd = bytearray()
+        for entry in self.entries:
+            name = entry.name_bytes
+            cd.extend(RawZip.CENTRAL_HEADER.pack(
+                RawZip.CENTRAL_HEADER_SIGNATURE, entry.version_made_by, entry.version_needed, entry.flags,
+                entry.compress_type, entry.mod_time, entry.mod_date, entry.crc32, entry.compress_size,
+                entry.file_size, len(name), len(entry.extra), len(entry.comment), 0, entry.internal_attr,
+                entry.external_attr, entry.header_offset
+            ))
+            cd.extend(name)
+            cd.extend(entry.extra)
+            cd.extend(entry.comment)
+        if len(self.entries) > 0xffff or self.offset > 0xffffffff:
+            raise UnsupportedZip('zip64 archives are not supported')
+        end_record = RawZip.END_RECORD.pack(
+            RawZip.END_RECORD_SIGNATURE, 0, 0, len(self.entries), len(self.entries), len(cd), self.offset,
+            len(self.comment)
+        ) + self.comment
+        return bytes(cd), end_record
+
+    def close(self):
+        cd, end_record = self.end_records()
+        self.__write(cd)
+        self.__write(end_record)
+
+
+def copy_entry(reader: RawZipReader, writer: RawZipWriter, entry: RawZipEntry, alignment: int = 1) -> RawZipEntry:
+    with reader.read_raw(entry) as data:
+        return writer.write_raw(entry, data, alignment)
+
+
+def entry_alignment(entry: RawZipEntry, page_size: int = 4096) -> int:
+    """
+    Alignment to keep when copying a stored entry, page aligned entries stay page aligned
+    """
+    if entry.compress_type != RawZip.STORED:
+        return 1
+    alignment = RawZip.get_alignment_extra(entry.local_extra or b'')
+    if alignment is not None:
+        return alignment
+    if entry.data_offset is not None and entry.data_offset % page_size == 0:
+        return page_size
+    return 4
@@ -0,0 +1,70 @@
+import os
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional
+
+import dotenv
+
+from apk_patcher.lib.file_lock import FileLock
+
+
+def find_dotenv_file() -> str:
+    """
+    The .env found from this package's folder up, otherwise the one in the current directory
+    """
+    dotenv_file = dotenv.find_dotenv()
+    return dotenv_file if dotenv_file != '' else os.path.abspath('.env')
+
+
+class Settings:
+    """
+    Configuration read in a single pass, environment variables override the .env file, which overrides the
+    defaults. Empty values in the .env are treated as missing.
+
+    The .env is read once when created and values don't change after that. Defaults of keys missing from the
+    .env are only written by save_defaults(), in one locked write for all of them.
+    """
+    dotenv_file: str
+    values: Mapping[str, Optional[str]]
+
+    def __init__(self, dotenv_file: Optional[str] = None):
+        self.dotenv_file = dotenv_file or find_dotenv_file()
+        self.values = MappingProxyType(self.read())
+        self.__defaults: Dict[str, Optional[str]] = {}
+
+    def read(self) -> Dict[str, Optional[str]]:
+        if not os.path.exists(self.dotenv_file):
+            return {}
+        return dict(dotenv.dotenv_values(self.dotenv_file))
+
+    def get(self, key: str, default: Optional[str]) -> Optional[str]:
+        # If env has key, use that value first, it overrides .env
+        value = os.getenv(key, None)
+        if value is not None:
+            return value
+        if key not in self.values:
+            self.__defaults[key] = default
+        value = self.values.get(key)
+        return value if value is not None and value != '' else default
+
+    def save_defaults(self):
+        """
+        Adds the keys missing from the .env with their default values, creates the .env if there is none
+        """
+        if len(self.__defaults) == 0:
+            return
+        # Workers sharing a .env must not interleave their read and write
+        with FileLock(f'{self.dotenv_file}.lock'):
+            # Another worker may have added some of them since this one read the .env
+            present = self.read()
+            missing = {key: default for key, default in self.__defaults.items() if key not in present}
+            if len(missing) > 0:
+                with open(self.dotenv_file, 'a+b') as f:
+                    f.seek(0, os.SEEK_END)
+                    if f.tell() > 0:
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b'\n':
+                            f.write(b'\n')
+                    for key, default in missing.items():
+                        print(f'\tSetting default value for {key} to {default}')
+                        f.write(f'{key}={default or ""}\n'.encode())
+        self.__defaults.clear()
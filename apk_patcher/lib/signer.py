@@ -0,0 +1,352 @@
+import base64
+import hashlib
+import os
+import re
+import struct
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+from cryptography.hazmat.primitives.serialization import pkcs7
+
+from apk_patcher.lib.raw_zip import RawZip, RawZipEntry, RawZipReader, RawZipWriter, entry_alignment
+
+SigningPrivateKey = Union[rsa.RSAPrivateKey, ec.EllipticCurvePrivateKey]
+
+
+class UnsupportedSigning(Exception):
+    def __init__(self, error: str):
+        super().__init__(f'unable to sign in-process: {error}')
+
+
+@dataclass
+class SigningKey:
+    private_key: SigningPrivateKey
+    certificate: x509.Certificate
+
+    @staticmethod
+    def load(key_path: str, cert_path: str) -> 'SigningKey':
+        with open(key_path, 'rb') as f:
+            key_data = f.read()
+        with open(cert_path, 'rb') as f:
+            cert_data = f.read()
+
+        if key_data.lstrip().startswith(b'-----'):
+            private_key = serialization.load_pem_private_key(key_data, None)
+        else:
+            private_key = serialization.load_der_private_key(key_data, None)
+        if not isinstance(private_key, (rsa.RSAPrivateKey, ec.EllipticCurvePrivateKey)):
+            raise UnsupportedSigning(f'{type(private_key).__name__} keys are not supported')
+
+        if cert_data.lstrip().startswith(b'-----'):
+            certificate = x509.load_pem_x509_certificate(cert_data)
+        else:
+            certificate = x509.load_der_x509_certificate(cert_data)
+
+        return SigningKey(private_key, certificate)
+
+
+class ChunkDigester:
+    """
+    Computes the APK Signature Scheme v2/v3 chunked SHA-256 digest of a byte stream,
+    hashing each 1 MB chunk on the executor as soon as it is complete.
+    See: https://source.android.com/security/apksigning/v2#integrity-protected-contents
+    """
+    CHUNK_SIZE = 1024 * 1024
+
+    executor: Executor
+    chunks: List[Future]
+
+    def __init__(self, executor: Executor):
+        self.executor = executor
+        self.chunks = []
+        self.__buffer = bytearray()
+
+    @staticmethod
+    def chunk_digest(chunk: bytes) -> bytes:
+        digest = hashlib.sha256(b'\xa5' + struct.pack('<I', len(chunk)))
+        digest.update(chunk)
+        return digest.digest()
+
+    def __submit(self, chunk: bytes):
+        self.chunks.append(self.executor.submit(self.chunk_digest, chunk))
+
+    def update(self, data: bytes):
+        view = memoryview(data)
+        if len(self.__buffer) > 0:
+            needed = self.CHUNK_SIZE - len(self.__buffer)
+            self.__buffer.extend(view[:needed])
+            view = view[needed:]
+            if len(self.__buffer) < self.CHUNK_SIZE:
+                return
+            self.__submit(bytes(self.__buffer))
+            self.__buffer.clear()
+        while len(view) >= self.CHUNK_SIZE:
+            self.__submit(bytes(view[:self.CHUNK_SIZE]))
+            view = view[self.CHUNK_SIZE:]
+        self.__buffer.extend(view)
+
+    def end_section(self):
+        """
+        Sections are chunked independently, the last chunk of a section may be short
+        """
+        if len(self.__buffer) > 0:
+            self.__submit(bytes(self.__buffer))
+            self.__buffer.clear()
+
+    def digest(self) -> bytes:
+        self.end_section()
+        digest = hashlib.sha256(b'\x5a' + struct.pack('<I', len(self.chunks)))
+        for chunk in self.chunks:
+            digest.update(chunk.result())
+        return digest.digest()
+
+
+class DigestingWriter:
+    file: BinaryIO
+    digester: ChunkDigester
+
+    def __init__(self, file: BinaryIO, digester: ChunkDigester):
+        self.file = file
+        self.digester = digester
+
+    def write(self, data: bytes) -> int:
+        self.digester.update(data)
+        return self.file.write(data)
+
+
+class Signer:
+    """
+    In-process APK signer producing JAR (v1), APK Signature Scheme v2 and v3 signatures
+    """
+    # See: https://source.android.com/security/apksigning/v2#apk-signing-block-format
+    SIGNING_BLOCK_MAGIC = b'APK Sig Block 42'
+    V2_BLOCK_ID = 0x7109871a
+    V3_BLOCK_ID = 0xf05368c0
+    V2_STRIPPING_PROTECTION_ATTR_ID = 0xbeeff00d
+    SIG_RSA_PKCS1_V1_5_WITH_SHA256 = 0x0103
+    SIG_ECDSA_WITH_SHA256 = 0x0201
+    V3_MIN_SDK = 28
+    MAX_SDK = 0x7fffffff
+
+    # See: https://docs.oracle.com/javase/8/docs/technotes/guides/jar/jar.html#Signed_JAR_File
+    V1_MIN_SHA256_SDK = 18
+    V1_SIGNER_NAME = 'CERT'
+    MANIFEST_PATH = 'META-INF/MANIFEST.MF'
+    MANIFEST_LINE_LENGTH = 72
+    CREATED_BY = '1.0 (APKPatcher)'
+    RE_V1_SIGNATURE_FILE = re.compile(r'^META-INF/([^/]+\.(SF|RSA|DSA|EC)|SIG-[^/]+|MANIFEST\.MF)$', re.IGNORECASE)
+
+    signing_key: SigningKey
+    min_sdk_version: int
+    v1_enabled: bool
+    v2_enabled: bool
+    v3_enabled: bool
+    max_workers: Optional[int]
+
+    def __init__(self, signing_key: SigningKey, min_sdk_version: int, v1_enabled: bool = True,
+                 v2_enabled: bool = True, v3_enabled: bool = True, max_workers: Optional[int] = None):
+        self.signing_key = signing_key
+        self.min_sdk_version = min_sdk_version
+        self.v1_enabled = v1_enabled
+        self.v2_enabled = v2_enabled
+        self.v3_enabled = v3_enabled
+        self.max_workers = max_workers
+
+    @property
+    def signature_algorithm(self) -> int:
+        if isinstance(self.signing_key.private_key, rsa.RSAPrivateKey):
+            return self.SIG_RSA_PKCS1_V1_5_WITH_SHA256
+        return self.SIG_ECDSA_WITH_SHA256
+
+    def sign_data(self, data: bytes) -> bytes:
+        private_key = self.signing_key.private_key
+        if isinstance(private_key, rsa.RSAPrivateKey):
+            return private_key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+        return private_key.sign(data, ec.ECDSA(hashes.SHA256()))
+
+    @classmethod
+    def is_v1_signature_file(cls, name: str) -> bool:
+        return cls.RE_V1_SIGNATURE_FILE.match(name) is not None
+
+    @classmethod
+    def manifest_attribute(cls, key: str, value: str) -> bytes:
+        line = f'{key}: {value}'.encode()
+        out = [line[:cls.MANIFEST_LINE_LENGTH]]
+        for pos in range(cls.MANIFEST_LINE_LENGTH, len(line), cls.MANIFEST_LINE_LENGTH - 1):
+            out.append(b' ' + line[pos:pos + cls.MANIFEST_LINE_LENGTH - 1])
+        return b'\r\n'.join(out) + b'\r\n'
+
+    def __entry_digest(self, reader: RawZipReader, entry: RawZipEntry) -> str:
+        digest = hashlib.sha256()
+        for chunk in reader.iter_content(entry):
+            digest.update(chunk)
+        return base64.b64encode(digest.digest()).decode()
+
+    def build_v1_files(self, reader: RawZipReader, entries: List[RawZipEntry], executor: Executor) -> Dict[str, bytes]:
+        entry_digests = executor.map(lambda e: self.__entry_digest(reader, e), entries)
+
+        manifest = bytearray(
+            self.manifest_attribute('Manifest-Version', '1.0') +
+            self.manifest_attribute('Created-By', self.CREATED_BY) +
+            b'\r\n'
+        )
+        sections = []
+        for entry, entry_digest in zip(entries, entry_digests):
+            section = (self.manifest_attribute('Name', entry.name) +
+                       self.manifest_attribute('SHA-256-Digest', entry_digest) +
+                       b'\r\n')
+            sections.append((entry.name, section))
+            manifest.extend(section)
+
+        def b64_digest(data: bytes) -> str:
+            return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+        signed_schemes = [str(scheme) for scheme, enabled in ((2, self.v2_enabled), (3, self.v3_enabled)) if enabled]
+        signature_file = bytearray(
+            self.manifest_attribute('Signature-Version', '1.0') +
+            self.manifest_attribute('Created-By', self.CREATED_BY) +
+            self.manifest_attribute('SHA-256-Digest-Manifest', b64_digest(manifest))
+        )
+        if len(signed_schemes) > 0:
+            # Lets Android detect v2/v3 signatures being stripped to downgrade to v1
+            signature_file.extend(self.manifest_attribute('X-Android-APK-Signed', ', '.join(signed_schemes)))
+        signature_file.extend(b'\r\n')
+        for name, section in sections:
+            signature_file.extend(self.manifest_attribute('Name', name))
+            signature_file.extend(self.manifest_attribute('SHA-256-Digest', b64_digest(section)))
+            signature_file.extend(b'\r\n')
+
+        block = (pkcs7.PKCS7SignatureBuilder()
+                 .set_data(bytes(signature_file))
+                 .add_signer(self.signing_key.certificate, self.signing_key.private_key,
+                             hashes.SHA256())
+                 .sign(serialization.Encoding.DER, [pkcs7.PKCS7Options.DetachedSignature,
+                                                    pkcs7.PKCS7Options.NoAttributes]))
+        block_ext = 'RSA' if isinstance(self.signing_key.private_key, rsa.RSAPrivateKey) else 'EC'
+
+        return {
+            self.MANIFEST_PATH: bytes(manifest),
+            f'META-INF/{self.V1_SIGNER_NAME}.SF': bytes(signature_file),
+            f'META-INF/{self.V1_SIGNER_NAME}.{block_ext}': block
+        }
+
+    @staticmethod
+    def length_prefixed(data: bytes) -> bytes:
+        return struct.pack('<I', len(data)) + data
+
+    @classmethod
+    def length_prefixed_sequence(cls, items: List[bytes]) -> bytes:
+        return cls.length_prefixed(b''.join(cls.length_prefixed(item) for item in items))
+
+    def __signer_fields(self, content_digest: bytes, extra_signed: bytes, attributes: List[bytes]) -> Tuple[bytes, bytes, bytes]:
+        algorithm = self.signature_algorithm
+        certificate = self.signing_key.certificate.public_bytes(serialization.Encoding.DER)
+        public_key = self.signing_key.private_key.public_key().public_bytes(
+            serialization.Encoding.DER,
+            serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        signed_data = (
+            self.length_prefixed_sequence([struct.pack('<I', algorithm) + self.length_prefixed(content_digest)]) +
+            self.length_prefixed_sequence([certificate]) +
+            extra_signed +
+            self.length_prefixed_sequence(attributes)
+        )
+        signatures = self.length_prefixed_sequence([
+            struct.pack('<I', algorithm) + self.length_prefixed(self.sign_data(signed_data))
+        ])
+        return signed_data, signatures, self.length_prefixed(public_key)
+
+    def build_v2_block(self, content_digest: bytes) -> bytes:
+        attributes = []
+        if self.v3_enabled:
+            attributes.append(struct.pack('<II', self.V2_STRIPPING_PROTECTION_ATTR_ID, 3))
+        signed_data, signatures, public_key = self.__signer_fields(content_digest, b'', attributes)
+        signer = self.length_prefixed(signed_data) + signatures + public_key
+        return self.length_prefixed_sequence([signer])
+
+    def build_v3_block(self, content_digest: bytes) -> bytes:
+        sdk_range = struct.pack('<II', self.V3_MIN_SDK, self.MAX_SDK)
+        signed_data, signatures, public_key = self.__signer_fields(content_digest, sdk_range, [])
+        signer = self.length_prefixed(signed_data) + sdk_range + signatures + public_key
+        return self.length_prefixed_sequence([signer])
+
+    def build_signing_block(self, content_digest: bytes) -> bytes:
+        pairs = bytearray()
+        if self.v2_enabled:
+            value = self.build_v2_block(content_digest)
+            pairs.extend(struct.pack('<QI', 4 + len(value), self.V2_BLOCK_ID) + value)
+        if self.v3_enabled:
+            value = self.build_v3_block(content_digest)
+            pairs.extend(struct.pack('<QI', 4 + len(value), self.V3_BLOCK_ID) + value)
+        block_size = len(pairs) + 8 + len(self.SIGNING_BLOCK_MAGIC)
+        return struct.pack('<Q', block_size) + pairs + struct.pack('<Q', block_size) + self.SIGNING_BLOCK_MAGIC
+
+    def sign(self, in_apk_file_path: str, out_apk_file_path: str):
+        """
+        Copies the zip entries without recompressing them, entry data is hashed for v2/v3 while it is written
+        and the APK Signing Block is placed in front of the central directory, so the output is written once.
+
+        :raises UnsupportedZip: input is not a zip that can be signed in-process (zip64, unknown compression)
+        :raises UnsupportedSigning: v1 signature would need SHA-1, which is not supported in-process
+        """
+        if self.v1_enabled and self.min_sdk_version < self.V1_MIN_SHA256_SDK:
+            raise UnsupportedSigning(f'v1 signatures for min sdk {self.min_sdk_version} require SHA-1')
+
+        block_enabled = self.v2_enabled or self.v3_enabled
+        with RawZipReader(in_apk_file_path) as reader, \
+                ThreadPoolExecutor(self.max_workers) as executor, \
+                open(out_apk_file_path, 'wb') as f:
+            entries = [
+                entry for entry in reader.entries
+                if not (self.v1_enabled and self.is_v1_signature_file(entry.name))
+            ]
+            names = set()
+            for entry in entries:
+                if entry.name in names:
+                    raise Exception(f'duplicate zip entry {entry.name}')
+                names.add(entry.name)
+                reader.read_local_header(entry)
+
+            v1_files = {}
+            if self.v1_enabled:
+                v1_files = self.build_v1_files(reader, [entry for entry in entries if not entry.is_dir()], executor)
+
+            digester = ChunkDigester(executor)
+            writer = RawZipWriter(DigestingWriter(f, digester) if block_enabled else f, comment=reader.comment)
+            for entry in entries:
+                with reader.read_raw(entry) as data:
+                    writer.write_raw(entry, data, entry_alignment(entry))
+            for name, data in v1_files.items():
+                writer.write(name, data)
+
+            cd, end_record = writer.end_records()
+            if not block_enabled:
+                f.write(cd)
+                f.write(end_record)
+                return
+
+            digester.end_section()
+            digester.update(cd)
+            digester.end_section()
+            # The end record is digested with the central directory offset pointing at the signing block,
+            # which is the offset of the central directory before the block is inserted
+            digester.update(end_record)
+            signing_block = self.build_signing_block(digester.digest())
+
+            f.write(signing_block)
+            f.write(cd)
+            f.write(RawZip.end_record_with_cd_offset(end_record, writer.offset + len(signing_block)))
+
+
+def sign_apk(in_apk_file_path: str, out_apk_file_path: str, key_path: str, cert_path: str, min_sdk_version: int):
+    tmp_file_path = f'{out_apk_file_path}.tmp'
+    try:
+        Signer(SigningKey.load(key_path, cert_path), min_sdk_version).sign(in_apk_file_path, tmp_file_path)
+        os.replace(tmp_file_path, out_apk_file_path)
+    finally:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
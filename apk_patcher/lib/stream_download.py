@@ -2,8 +2,7 @@ import binascii
 import os
 from typing import Any, Callable, Generator, Iterator, NewType, Optional
 
-import requests
-
+from apk_patcher.lib.file_lock import atomic_output
 from apk_patcher.lib.progress import ProgressCallback, ProgressCancelled, ProgressData, ProgressStage, ProgressType
 
 DownloadMiddleware = NewType('DownloadMiddleware', Callable[[Iterator], Generator[bytes, None, None]])
@@ -12,6 +11,7 @@ DownloadMiddleware = NewType('DownloadMiddleware', Callable[[Iterator], Generato
 def stream_download_progress(url: str, output_file_path: str, buffer_size: int, output_file_size: Optional[int],
                              middleware: Optional[DownloadMiddleware], on_progress: Optional[ProgressCallback],
                              progress_user_var: Optional[Any], **kwargs):
+    import requests
     dl_resp = requests.get(url, stream=True, allow_redirects=True, **kwargs)
     if dl_resp.status_code >= 400:
         raise Exception(dl_resp)
@@ -28,7 +28,8 @@ def stream_download_progress(url: str, output_file_path: str, buffer_size: int,
 
     os.makedirs(os.path.dirname(output_file_path), 0o755, exist_ok=True)
 
-    with open(output_file_path, 'wb') as f:
+    # Readers never see a partially downloaded file
+    with atomic_output(output_file_path) as tmp_file_path, open(tmp_file_path, 'wb') as f:
         chunker = dl_resp.iter_content(chunk_size=buffer_size)
         if middleware is not None:
             chunker = middleware(chunker)
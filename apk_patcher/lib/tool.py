@@ -1,8 +1,11 @@
 from abc import ABCMeta, abstractmethod
-from typing import Any, Optional, TypeVar
+from typing import Any, Optional, TYPE_CHECKING, TypeVar
 
 from apk_patcher.lib.progress import ProgressCallback
 
+if TYPE_CHECKING:
+    from apk_patcher.lib.artifact_cache import ArtifactCache
+
 
 class Tool(metaclass=ABCMeta):
 
@@ -14,5 +17,8 @@ class Tool(metaclass=ABCMeta):
     def setup(self, on_progress: Optional[ProgressCallback], progress_user_var: Optional[Any]):
         raise NotImplementedError()
 
+    def set_artifact_cache(self, artifact_cache: 'ArtifactCache'):
+        pass
+
 
 ToolType = TypeVar('ToolType', bound=Tool)
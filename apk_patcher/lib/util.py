@@ -1,19 +1,17 @@
 import functools
+import hashlib
+import multiprocessing
 import os
-from subprocess import Popen
-from typing import Optional, Type
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional, Type, Union
 from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
 
 import dotenv
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.hashes import HashAlgorithm, SHA1
 
+from apk_patcher.lib.file_lock import FileLock
 
-def print_subprocess_output(proc: Popen, prefix: str = '\t'):
-    for line in iter(proc.stdout.readline, b''):
-        line = line.decode().strip()
-        print(f'{prefix}{line}')
-    proc.wait()
+if TYPE_CHECKING:
+    from cryptography.hazmat.primitives.hashes import HashAlgorithm
 
 
 def change_url_query_param(url: str, key: str, value: str, single_value: bool = True) -> str:
@@ -34,25 +32,39 @@ def change_url_query_param(url: str, key: str, value: str, single_value: bool =
     ))
 
 
-def hash_file(file_path: str, hasher: Type[HashAlgorithm], buffer_size: int = 1024 * 1024) -> bytes:
+def worker_pool(max_workers: Optional[int] = None) -> Executor:
+    """
+    Worker processes where they can be started without the caller's help: not from a daemon process like a
+    job service worker, and only with fork, spawn would need an if __name__ == '__main__' guard. Threads
+    otherwise.
+    """
+    if not multiprocessing.current_process().daemon and multiprocessing.get_start_method() == 'fork':
+        return ProcessPoolExecutor(max_workers)
+    return ThreadPoolExecutor(max_workers)
+
+
+def hash_file(file_path: str, hasher: Union[str, Type['HashAlgorithm']], buffer_size: int = 1024 * 1024) -> bytes:
+    """
+    :param hasher: hashlib name, e.g. 'sha256', or a cryptography hash class, only its name is used
+    """
     with open(file_path, 'rb') as f:
-        digest = hashes.Hash(hasher())
-        chunker = functools.partial(f.read, buffer_size - (buffer_size % digest.algorithm.block_size))
+        digest = hashlib.new(hasher if isinstance(hasher, str) else hasher.name)
+        chunker = functools.partial(f.read, buffer_size - (buffer_size % digest.block_size))
         for chunk in iter(chunker, b''):
             digest.update(chunk)
-        return digest.finalize()
+        return digest.digest()
 
 
 def git_hash_file(file_path: str, buffer_size: int = 1024 * 1024) -> bytes:
     file_size = os.path.getsize(file_path)
     with open(file_path, 'rb') as f:
-        digest = hashes.Hash(hashes.SHA1())
+        digest = hashlib.sha1()
         # See: https://git-scm.com/book/en/v2/Git-Internals-Git-Objects#_object_storage
         digest.update(b'blob %d\0' % file_size)
-        chunker = functools.partial(f.read, buffer_size - (buffer_size % SHA1.block_size))
+        chunker = functools.partial(f.read, buffer_size - (buffer_size % digest.block_size))
         for chunk in iter(chunker, b''):
             digest.update(chunk)
-        return digest.finalize()
+        return digest.digest()
 
 
 def dotenv_get_set(key: str, default: Optional[str]) -> Optional[str]:
@@ -64,20 +76,23 @@ def dotenv_get_set(key: str, default: Optional[str]) -> Optional[str]:
     # find dot env file, make one in cwd if one doesn't exist
     dotenv_file = dotenv.find_dotenv()
     if dotenv_file == '':
-        open('.env', 'w').close()
-        dotenv_file = dotenv.find_dotenv()
-
-    # Get the value from the .env, will be None if it doesn't exist
-    value = dotenv.get_key(dotenv_file, key)
-
-    # Treat empty values in .env as None
-    if value == '':
-        value = None
-
-    # If value is not in .env set the default, will not use sys env
-    if value is None:
-        print(f'\tSetting default value for {key} to {default}')
-        dotenv.set_key(dotenv_file, key, default or '', quote_mode='never')
-        return default
+        # Append mode, another worker may have just created it
+        open('.env', 'a').close()
+        dotenv_file = os.path.abspath('.env')
+
+    # Workers sharing a .env must not interleave their read and write
+    with FileLock(f'{dotenv_file}.lock'):
+        # Get the value from the .env, will be None if it doesn't exist
+        value = dotenv.get_key(dotenv_file, key)
+
+        # Treat empty values in .env as None
+        if value == '':
+            value = None
+
+        # If value is not in .env set the default, will not use sys env
+        if value is None:
+            print(f'\tSetting default value for {key} to {default}')
+            dotenv.set_key(dotenv_file, key, default or '', quote_mode='never')
+            return default
 
     return value
@@ -0,0 +1,140 @@
+import json
+import os
+import shutil
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional
+
+from apk_patcher.lib.apk_store import APKStore
+from apk_patcher.lib.file_lock import FileLock, atomic_output
+
+
+@dataclass
+class WorkspaceEntry:
+    size: int
+    last_used: float
+
+
+class Workspace:
+    """
+    Places the decode trees of APK versions (entries of the APK store) on a RAM backed filesystem, e.g. /dev/shm,
+    within a memory budget. Packed and signed APK's stay in the APK store.
+
+    A version gets a RAM folder if it fits the budget and the free space of the filesystem, after deleting the
+    least recently used RAM folders of versions not in use. Otherwise it spills to its folder in the APK store,
+    and keeps using that one. The size of a version is estimated from its APK's until a build measured it.
+    """
+    INDEX_FILE_NAME = 'workspaces.json'
+    # Decoded trees take about this many times the size of the APK's
+    EXPANSION = 4
+
+    store: APKStore
+    root_folder: Optional[str]
+    max_size: Optional[int]
+
+    def __init__(self, store: APKStore, root_folder: Optional[str] = None, max_size: Optional[int] = None):
+        """
+        :param root_folder: folder on a RAM backed filesystem, None keeps every decode tree in the APK store
+        :param max_size: bytes, None is only limited by the free space of the filesystem
+        """
+        self.store = store
+        self.root_folder = os.path.abspath(root_folder) if root_folder is not None else None
+        self.max_size = max_size
+
+    @property
+    def index_file_path(self) -> str:
+        return os.path.join(self.root_folder, self.INDEX_FILE_NAME)
+
+    def entry_folder(self, name: str) -> str:
+        return os.path.join(self.root_folder, *name.split('/'))
+
+    def index_lock(self) -> FileLock:
+        return FileLock(f'{self.index_file_path}.lock')
+
+    def load_index(self) -> Dict[str, WorkspaceEntry]:
+        try:
+            with open(self.index_file_path, 'r') as f:
+                data = json.load(f)
+            index = {name: WorkspaceEntry(**entry) for name, entry in data.items()}
+        except (OSError, ValueError, TypeError):
+            return {}
+        # Folders are gone after a reboot
+        return {name: entry for name, entry in index.items() if os.path.isdir(self.entry_folder(name))}
+
+    def save_index(self, index: Dict[str, WorkspaceEntry]):
+        with atomic_output(self.index_file_path) as tmp_file_path:
+            with open(tmp_file_path, 'w') as f:
+                json.dump({name: asdict(entry) for name, entry in index.items()}, f)
+
+    def fits(self, index: Dict[str, WorkspaceEntry], size: int) -> bool:
+        if self.max_size is not None and sum(entry.size for entry in index.values()) + size > self.max_size:
+            return False
+        return shutil.disk_usage(self.root_folder).free >= size
+
+    def allocate(self, package_name: str, version_name: str, input_size: int) -> Optional[str]:
+        """
+        :param input_size: bytes of the APK's to decode
+        :return: RAM folder of the version, None to use its folder in the APK store
+        """
+        if self.root_folder is None:
+            return None
+        name = self.store.entry_name(package_name, version_name)
+        folder = self.entry_folder(name)
+        os.makedirs(self.root_folder, 0o755, exist_ok=True)
+        with self.index_lock():
+            index = self.load_index()
+            entry = index.get(name)
+            if entry is None:
+                entry = WorkspaceEntry(input_size * self.EXPANSION, time.time())
+                # Deleting other versions would not make room for it
+                if self.max_size is not None and entry.size > self.max_size:
+                    return None
+                self.evict(index, entry.size)
+                if not self.fits(index, entry.size):
+                    self.save_index(index)
+                    return None
+                os.makedirs(folder, 0o755, exist_ok=True)
+                index[name] = entry
+            entry.last_used = time.time()
+            self.save_index(index)
+        return folder
+
+    def update(self, package_name: str, version_name: str):
+        """
+        Records the measured size of the version's RAM folder after a build
+        """
+        if self.root_folder is None:
+            return
+        name = self.store.entry_name(package_name, version_name)
+        with self.index_lock():
+            index = self.load_index()
+            if name in index:
+                index[name] = WorkspaceEntry(self.store.folder_size(self.entry_folder(name)), time.time())
+                self.save_index(index)
+
+    def evict(self, index: Dict[str, WorkspaceEntry], size: int):
+        """
+        Deletes least recently used RAM folders of versions not in use until size fits, the index lock must be held
+        """
+        for name in sorted(index, key=lambda n: index[n].last_used):
+            if self.fits(index, size):
+                return
+            with self.store.unused(name) as unused:
+                if not unused:
+                    continue
+                shutil.rmtree(self.entry_folder(name), ignore_errors=True)
+            del index[name]
+
+    def remove(self, package_name: str, version_name: str):
+        """
+        Deletes the version's RAM folder, e.g. after the APK store evicted the version
+        """
+        if self.root_folder is None:
+            return
+        name = self.store.entry_name(package_name, version_name)
+        with self.index_lock():
+            index = self.load_index()
+            shutil.rmtree(self.entry_folder(name), ignore_errors=True)
+            if name in index:
+                del index[name]
+                self.save_index(index)
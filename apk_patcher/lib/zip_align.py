@@ -0,0 +1,73 @@
+import dataclasses
+import fnmatch
+import os
+
+from apk_patcher.lib.raw_zip import RawZip, RawZipEntry, RawZipReader, RawZipWriter
+
+
+class ZipAlign:
+    """
+    Rewrites an APK so stored entries start on a 4 byte boundary and native libraries on a page boundary,
+    which lets Android mmap them straight from the APK instead of extracting them at install time.
+    See: https://developer.android.com/studio/command-line/zipalign
+    """
+    DEFAULT_ALIGNMENT = 4
+    PAGE_ALIGNMENT = 4096
+    NATIVE_LIB_PATTERN = 'lib/*.so'
+    RESOURCE_TABLE = 'resources.arsc'
+
+    uncompress_native_libs: bool
+    uncompress_resources: bool
+    page_alignment: int
+
+    def __init__(self, uncompress_native_libs: bool = False, uncompress_resources: bool = False,
+                 page_alignment: int = PAGE_ALIGNMENT):
+        self.uncompress_native_libs = uncompress_native_libs
+        self.uncompress_resources = uncompress_resources
+        self.page_alignment = page_alignment
+
+    @classmethod
+    def is_native_lib(cls, name: str) -> bool:
+        return fnmatch.fnmatchcase(name, cls.NATIVE_LIB_PATTERN)
+
+    def should_uncompress(self, entry: RawZipEntry) -> bool:
+        if entry.compress_type == RawZip.STORED:
+            return False
+        if self.uncompress_native_libs and self.is_native_lib(entry.name):
+            return True
+        return self.uncompress_resources and entry.name == self.RESOURCE_TABLE
+
+    def alignment(self, entry: RawZipEntry) -> int:
+        if entry.compress_type != RawZip.STORED:
+            return 1
+        if self.is_native_lib(entry.name):
+            return self.page_alignment
+        return self.DEFAULT_ALIGNMENT
+
+    def align(self, in_apk_file_path: str, out_apk_file_path: str):
+        """
+        Any existing APK signature is dropped along with the zip layout, align before signing
+        """
+        with RawZipReader(in_apk_file_path) as reader, open(out_apk_file_path, 'wb') as f:
+            writer = RawZipWriter(f, comment=reader.comment)
+            for entry in reader.entries:
+                if self.should_uncompress(entry):
+                    reader.read_local_header(entry)
+                    data = reader.read(entry)
+                    entry = dataclasses.replace(entry, compress_type=RawZip.STORED, compress_size=len(data),
+                                                version_needed=10)
+                    writer.write_raw(entry, data, self.alignment(entry))
+                    continue
+                with reader.read_raw(entry) as data:
+                    writer.write_raw(entry, data, self.alignment(entry))
+            writer.close()
+
+
+def zip_align(apk_file_path: str, uncompress_native_libs: bool = False, uncompress_resources: bool = False):
+    tmp_file_path = f'{apk_file_path}.tmp'
+    try:
+        ZipAlign(uncompress_native_libs, uncompress_resources).align(apk_file_path, tmp_file_path)
+        os.replace(tmp_file_path, apk_file_path)
+    finally:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
@@ -1,33 +1,50 @@
 import os
-from io import SEEK_SET
-
-from lxml import etree
+import shutil
 
+from apk_patcher.lib.package_rename import PackageRenamer
 from apk_patcher.lib.patch import Patch
 
 
 class ChangePackageName(Patch):
+    """
+    Renames the package, and the authorities, permissions and other names of the app that start with it, in the
+    manifest, resource XML and smali. See PackageRenamer, rename_classes also moves the classes under the package.
+    """
     new_package_name: str
+    rename_classes: bool
 
-    def config(self, new_package_name: str):
+    def config(self, new_package_name: str, rename_classes: bool = False):
         self.new_package_name = new_package_name
+        self.rename_classes = rename_classes
 
-    def apply(self, root_folder_path: str):
-        manifest_file_path = os.path.join(root_folder_path, 'AndroidManifest.xml')
+    def backup_folder_path(self, root_folder_path: str) -> str:
+        """
+        Originals of the rewritten smali and resource files, outside of the folders apktool builds
+        """
+        return os.path.join(root_folder_path, f'{type(self).__name__}.backup')
 
-        self.restore_file(manifest_file_path)
+    def apply(self, root_folder_path: str):
+        self.unapply(root_folder_path)
+        manifest_file_path = os.path.join(root_folder_path, PackageRenamer.MANIFEST_PATH)
         self.backup_file(manifest_file_path)
 
-        xml = etree.parse(manifest_file_path)
-        xml_root = xml.getroot()
-        manifest_node = xml_root.xpath('.', namespaces=xml_root.nsmap)[0]
-        old_package_name = manifest_node.attrib['package']
-
-        with open(manifest_file_path, 'r+') as f:
-            xml_data = f.read()
-            f.seek(0, SEEK_SET)
-            f.write(xml_data.replace(old_package_name, self.new_package_name))
-            f.truncate()
+        renamer = PackageRenamer(root_folder_path, self.new_package_name, self.rename_classes)
+        index = renamer.index()
+        backup_folder_path = self.backup_folder_path(root_folder_path)
+        for path in index.lines:
+            backup_file_path = os.path.join(backup_folder_path, path)
+            os.makedirs(os.path.dirname(backup_file_path), 0o755, exist_ok=True)
+            shutil.copy2(os.path.join(root_folder_path, path), backup_file_path)
+        renamer.rewrite(index)
 
     def unapply(self, root_folder_path: str):
-        self.restore_file(os.path.join(root_folder_path, 'AndroidManifest.xml'))
+        self.restore_file(os.path.join(root_folder_path, PackageRenamer.MANIFEST_PATH))
+        backup_folder_path = self.backup_folder_path(root_folder_path)
+        if not os.path.isdir(backup_folder_path):
+            return
+        for dir_path, _, file_names in os.walk(backup_folder_path):
+            for file_name in file_names:
+                backup_file_path = os.path.join(dir_path, file_name)
+                path = os.path.relpath(backup_file_path, backup_folder_path)
+                shutil.copy2(backup_file_path, os.path.join(root_folder_path, path))
+        shutil.rmtree(backup_folder_path)
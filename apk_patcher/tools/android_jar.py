@@ -1,5 +1,3 @@
-import requests
-
 from apk_patcher.lib.googlesource_downloader import GoogleSourceDownloader
 
 
@@ -10,6 +8,7 @@ class AndroidJar(GoogleSourceDownloader):
 
     @property
     def latest_version(self) -> str:
+        import requests
         resp = requests.get('https://android.googlesource.com/platform/prebuilts/fullsdk/platforms/?format=JSON')
         self.check_response(resp)
         versions = GoogleSourceDownloader.gs_json_loads(resp.text)
@@ -1,9 +1,7 @@
-from distutils.version import StrictVersion
-from subprocess import DEVNULL, PIPE, Popen, STDOUT
-
-import requests
+from subprocess import DEVNULL, PIPE, STDOUT
 
 from apk_patcher.lib.googlesource_downloader import GoogleSourceDownloader
+from apk_patcher.lib.process_supervisor import SupervisedProcess
 from apk_patcher.tools.java import Java
 
 
@@ -16,6 +14,8 @@ class APKSigner(GoogleSourceDownloader):
 
     @property
     def latest_version(self) -> str:
+        from distutils.version import StrictVersion
+        import requests
         resp = requests.get('https://android.googlesource.com/platform/prebuilts/fullsdk-linux/build-tools/?format=JSON')
         self.check_response(resp)
         versions = GoogleSourceDownloader.gs_json_loads(resp.text)
@@ -35,7 +35,7 @@ class APKSigner(GoogleSourceDownloader):
     def target_file_name(self) -> str:
         return 'apksigner.jar'
 
-    def sign_apk(self, in_apk_file_path: str, out_apk_file_path: str, key_path: str, cert_path: str) -> Popen:
+    def sign_apk(self, in_apk_file_path: str, out_apk_file_path: str, key_path: str, cert_path: str) -> SupervisedProcess:
         return self.java.runtime.exec('java', [
             '-jar', self.file_path,
             'sign', '--key', key_path, '--cert', cert_path,
@@ -1,11 +1,10 @@
 import os
 from functools import cached_property
-from subprocess import DEVNULL, PIPE, Popen, STDOUT
+from subprocess import DEVNULL, PIPE, STDOUT
 from typing import List, Optional
 
-import requests
-
 from apk_patcher.lib.downloader import Downloader
+from apk_patcher.lib.process_supervisor import SupervisedProcess
 from apk_patcher.lib.tool import Tool
 from apk_patcher.lib.stream_download import DownloadMiddleware
 from apk_patcher.tools.java import Java
@@ -20,6 +19,7 @@ class APKTool(Downloader, Tool):
 
     @cached_property
     def metadata(self) -> Downloader.Metadata:
+        import requests
         if self.version == 'latest':
             url = f'https://api.github.com/repos/iBotPeaches/Apktool/releases/latest'
         else:
@@ -67,7 +67,7 @@ class APKTool(Downloader, Tool):
         if proc.wait() != 0:
             raise Exception(f'Error testing {self.target_file_name}: {proc.returncode}')
 
-    def unpack_apk(self, apk_file_path: str, output_folder_path: str, options: Optional[List[str]] = None) -> Popen:
+    def unpack_apk(self, apk_file_path: str, output_folder_path: str, options: Optional[List[str]] = None) -> SupervisedProcess:
         cmd_line = [
             '-jar', self.file_path,
             'd', '--output', output_folder_path,
@@ -78,7 +78,7 @@ class APKTool(Downloader, Tool):
         cmd_line.append(apk_file_path)
         return self.java.runtime.exec('java', cmd_line, stdout=PIPE, stderr=STDOUT)
 
-    def pack_apk(self, input_folder_path: str, output_apk_path: str, rebuild: bool = False, options: Optional[List[str]] = None) -> Popen:
+    def pack_apk(self, input_folder_path: str, output_apk_path: str, rebuild: bool = False, options: Optional[List[str]] = None) -> SupervisedProcess:
         cmd_line = [
             '-jar', self.file_path,
             'b', '--output', output_apk_path,
@@ -1,12 +1,11 @@
 import os
 import re
 from functools import cached_property
-from subprocess import DEVNULL, PIPE, Popen, STDOUT
+from subprocess import DEVNULL, PIPE, STDOUT
 from typing import List, Optional
 
-import requests
-
 from apk_patcher.lib.downloader import Downloader
+from apk_patcher.lib.process_supervisor import SupervisedProcess
 from apk_patcher.lib.stream_download import DownloadMiddleware
 from apk_patcher.tools.java import Java
 
@@ -49,6 +48,7 @@ class Baksmali(Downloader):
 
     @cached_property
     def metadata(self) -> Downloader.Metadata:
+        import requests
         resp = requests.get('https://api.bitbucket.org/2.0/repositories/JesusFreke/smali/downloads/')
         self.check_response(resp)
         data = resp.json()
@@ -93,7 +93,7 @@ class Baksmali(Downloader):
         if proc.wait() != 0:
             raise Exception(f'Error testing {self.target_file_name}: {proc.returncode}')
 
-    def disassemble(self, dex_file_path: str, output_folder_path: str, options: Optional[List[str]] = None) -> Popen:
+    def disassemble(self, dex_file_path: str, output_folder_path: str, options: Optional[List[str]] = None) -> SupervisedProcess:
         cmd_line = [
             '-jar', self.file_path,
             'disassemble', '--output', output_folder_path
@@ -1,9 +1,7 @@
-from distutils.version import StrictVersion
-from subprocess import DEVNULL, PIPE, Popen, STDOUT
-
-import requests
+from subprocess import DEVNULL, PIPE, STDOUT
 
 from apk_patcher.lib.googlesource_downloader import GoogleSourceDownloader
+from apk_patcher.lib.process_supervisor import SupervisedProcess
 from apk_patcher.tools.java import Java
 
 
@@ -20,6 +18,8 @@ class DX(GoogleSourceDownloader):
 
     @property
     def latest_version(self) -> str:
+        from distutils.version import StrictVersion
+        import requests
         resp = requests.get('https://android.googlesource.com/platform/prebuilts/fullsdk-linux/build-tools/?format=JSON')
         if resp.status_code >= 400:
             raise Exception(f'Unable to get version list for apksigner: {resp}')
@@ -36,7 +36,7 @@ class DX(GoogleSourceDownloader):
         if proc.wait() != 0:
             raise Exception(f'Error testing {self.target_file_name}: {proc.returncode}')
 
-    def dex_file(self, class_file_path: str, out_dex_file_path: str) -> Popen:
+    def dex_file(self, class_file_path: str, out_dex_file_path: str) -> SupervisedProcess:
         return self.java.runtime.exec('java', [
             '-jar', self.file_path,
             '--dex', '--output', out_dex_file_path,
@@ -3,13 +3,15 @@ import platform
 import sys
 from abc import ABCMeta, abstractmethod
 from functools import cached_property
-from subprocess import DEVNULL, Popen
-from typing import Any, List, Optional
-
-import requests
+from subprocess import DEVNULL
+from typing import Any, Dict, List, Optional
 
 from apk_patcher.lib.archive import Archive
+from apk_patcher.lib.artifact_cache import ArtifactCache
 from apk_patcher.lib.downloader import Downloader
+from apk_patcher.lib.jvm_profile import JVMProfile, java_feature_version
+from apk_patcher.lib.process_supervisor import ProcessSupervisor, SupervisedProcess, shared_supervisor
+from apk_patcher.lib.profiler import Profiler
 from apk_patcher.lib.progress import ProgressCallback
 from apk_patcher.lib.tool import Tool
 from apk_patcher.lib.stream_download import DownloadMiddleware
@@ -43,6 +45,12 @@ class JavaBase(Downloader, metaclass=ABCMeta):
         'text/plain'
     ]  # .msi, .pkg, .json, .txt
 
+    profiler: Optional[Profiler] = None
+    supervisor: Optional[ProcessSupervisor] = None
+    # By absolute jar path, set through Java.set_jvm_profile
+    jvm_profiles: Dict[str, JVMProfile] = {}
+    default_jvm_profile: Optional[JVMProfile] = None
+
     @property
     @abstractmethod
     def env(self) -> str:
@@ -50,6 +58,7 @@ class JavaBase(Downloader, metaclass=ABCMeta):
 
     @cached_property
     def metadata(self) -> Downloader.Metadata:
+        import requests
         if self.version == 'latest':
             url = f'https://api.github.com/repos/AdoptOpenJDK/openjdk8-binaries/releases/latest'
         else:
@@ -94,16 +103,73 @@ class JavaBase(Downloader, metaclass=ABCMeta):
             return True
         return os.path.exists(self.file_path) and os.path.getsize(self.file_path) == self.download_size
 
-    def download(self, on_progress: Optional[ProgressCallback], progress_user_var: Optional[Any]):
-        super(JavaBase, self).download(on_progress, progress_user_var)
+    def download_file(self, on_progress: Optional[ProgressCallback], progress_user_var: Optional[Any]):
+        super(JavaBase, self).download_file(on_progress, progress_user_var)
         Archive(self.file_path).extract_all(self.version_folder, on_progress, progress_user_var)
 
-    def exec(self, binary: str, args: Optional[List[str]] = None, **kwargs) -> Popen:
+    @staticmethod
+    def profile_name(args: List[str]) -> str:
+        """
+        Jar name and the first argument after it, e.g. apktool_2.5.0-d
+        """
+        if '-jar' in args and args.index('-jar') + 1 < len(args):
+            i = args.index('-jar') + 1
+            name = os.path.splitext(os.path.basename(args[i]))[0]
+            return f'{name}-{args[i + 1]}' if i + 1 < len(args) else name
+        return 'java'
+
+    def binary_path(self, binary: str) -> str:
         if self.version != 'system':
             binary = os.path.join(self.version_folder, 'bin', binary)
         if platform.system() == 'Windows':
             binary = f'{binary}.exe'
-        return Popen(args=[binary, *args], **kwargs)
+        return binary
+
+    @cached_property
+    def java_version(self) -> Optional[int]:
+        return java_feature_version(self.binary_path('java'))
+
+    def jvm_profile(self, args: List[str]) -> Optional[JVMProfile]:
+        if '-jar' in args and args.index('-jar') + 1 < len(args):
+            jar_file_path = os.path.abspath(args[args.index('-jar') + 1])
+            return self.jvm_profiles.get(jar_file_path, self.default_jvm_profile)
+        return self.default_jvm_profile
+
+    def exec(self, binary: str, args: Optional[List[str]] = None, **kwargs) -> SupervisedProcess:
+        """
+        Runs binary under the supervisor, output is always captured, stdout and stderr arguments are ignored
+        """
+        args = args or []
+        name = self.profile_name(args)
+        tmp_archive_path = None
+        if binary == 'java':
+            profile = self.jvm_profile(args)
+            if profile is not None:
+                options = profile.jvm_options()
+                if profile.cds and '-jar' in args and self.java_version is not None:
+                    archive_path = profile.cds_archive_path(args[args.index('-jar') + 1], name, self.java_version)
+                    cds_options, tmp_archive_path = profile.cds_options(archive_path, self.java_version)
+                    options += cds_options
+                args = [*options, *args]
+            if self.profiler is not None:
+                args = [*self.profiler.jvm_options(name), *args]
+        kwargs.pop('stdout', None)
+        kwargs.pop('stderr', None)
+        supervisor = self.supervisor or shared_supervisor()
+        process = supervisor.start([self.binary_path(binary), *args], name, **kwargs)
+        if tmp_archive_path is not None:
+            process.add_done_callback(lambda p: self.store_cds_archive(p, tmp_archive_path, archive_path))
+        return process
+
+    @staticmethod
+    def store_cds_archive(process: SupervisedProcess, tmp_archive_path: str, archive_path: str):
+        """
+        Keeps the archive dumped at exit of a successful run, a failed run may not have loaded every class
+        """
+        if process.returncode == 0 and process.kill_reason is None and os.path.exists(tmp_archive_path):
+            os.replace(tmp_archive_path, archive_path)
+        elif os.path.exists(tmp_archive_path):
+            os.remove(tmp_archive_path)
 
 
 class JRE(JavaBase):
@@ -137,6 +203,43 @@ class Java(Tool):
     def is_ready(self) -> bool:
         return self.runtime.is_ready() and self.dev.is_ready()
 
+    def set_artifact_cache(self, artifact_cache: ArtifactCache):
+        self.runtime.set_artifact_cache(artifact_cache)
+        self.dev.set_artifact_cache(artifact_cache)
+
+    def set_profiler(self, profiler: Optional[Profiler]):
+        """
+        Adds Flight Recorder and GC logging options to every java process until set to None
+        """
+        self.runtime.profiler = profiler
+        self.dev.profiler = profiler
+
+    def set_supervisor(self, supervisor: Optional[ProcessSupervisor]):
+        """
+        Runs every java process under supervisor, the shared supervisor without limits when None
+        """
+        self.runtime.supervisor = supervisor
+        self.dev.supervisor = supervisor
+
+    def set_jvm_profile(self, jar_file_path: str, profile: Optional[JVMProfile]):
+        """
+        Launch options for java processes running jar_file_path, the default profile when None
+        """
+        for java in (self.runtime, self.dev):
+            profiles = dict(java.jvm_profiles)
+            if profile is None:
+                profiles.pop(os.path.abspath(jar_file_path), None)
+            else:
+                profiles[os.path.abspath(jar_file_path)] = profile
+            java.jvm_profiles = profiles
+
+    def set_default_jvm_profile(self, profile: Optional[JVMProfile]):
+        """
+        Launch options for java processes without a profile of their own
+        """
+        self.runtime.default_jvm_profile = profile
+        self.dev.default_jvm_profile = profile
+
     def setup(self, on_progress: Optional[ProgressCallback], progress_user_var: Optional[Any]):
         self.runtime.download(on_progress, progress_user_var)
         self.dev.download(on_progress, progress_user_var)
@@ -0,0 +1,240 @@
+import binascii
+import json
+import os
+import shutil
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Iterator, List, Optional
+
+from apk_patcher.lib.apk_inspector import inspect_apk
+from apk_patcher.lib.apk_provider import APKInfo, APKProvider, APKSplitInfo
+from apk_patcher.lib.progress import ProgressCallback, ProgressCancelled, ProgressData, ProgressStage, ProgressType
+from apk_patcher.lib.util import hash_file, worker_pool
+
+
+@dataclass
+class LocalIndexEntry:
+    path: str
+    size: int
+    mtime_ns: int
+    package_name: str
+    version_name: str
+    version_code: int
+    min_sdk_version: Optional[int]
+    available_abi: List[str]
+    sha256: str
+    split_name: Optional[str] = None
+
+
+class LocalFolder(APKProvider):
+    """
+    Provides APK's from a local or shared folder tree. Package, version and digest of every APK are kept
+    in an index file and only APK's with a changed size or modification time are read again.
+    """
+    INDEX_VERSION = 2
+    APK_EXTENSION = '.apk'
+
+    root_folder: str
+    index_file_path: str
+    index: Dict[str, LocalIndexEntry]
+    max_workers: Optional[int]
+
+    def __init__(self, root_folder: str, index_file_path: Optional[str] = None, max_workers: Optional[int] = None):
+        self.root_folder = os.path.abspath(root_folder)
+        self.index_file_path = os.path.abspath(index_file_path or os.path.join(self.root_folder, '.apk_index.json'))
+        self.max_workers = max_workers
+        self.index = {}
+        self.__refreshed = False
+        self.load_index()
+
+    def is_ready(self) -> bool:
+        return self.__refreshed
+
+    def setup(self, on_progress: Optional[ProgressCallback], progress_user_var: Optional[Any]):
+        self.refresh(on_progress, progress_user_var)
+
+    def load_index(self):
+        if not os.path.exists(self.index_file_path):
+            return
+        with open(self.index_file_path, 'r') as f:
+            data = json.load(f)
+        if data.get('version') != self.INDEX_VERSION:
+            return
+        self.index = {entry['path']: LocalIndexEntry(**entry) for entry in data['entries']}
+
+    def save_index(self):
+        os.makedirs(os.path.dirname(self.index_file_path), exist_ok=True)
+        tmp_file_path = f'{self.index_file_path}.{os.getpid()}.tmp'
+        with open(tmp_file_path, 'w') as f:
+            json.dump({
+                'version': self.INDEX_VERSION,
+                'entries': [asdict(entry) for entry in self.index.values()]
+            }, f)
+        os.replace(tmp_file_path, self.index_file_path)
+
+    def iter_apk_files(self, folder_path: Optional[str] = None) -> Iterator[os.DirEntry]:
+        with os.scandir(folder_path or self.root_folder) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self.iter_apk_files(entry.path)
+                elif entry.is_file() and entry.name.lower().endswith(self.APK_EXTENSION):
+                    yield entry
+
+    def refresh(self, on_progress: Optional[ProgressCallback] = None, progress_user_var: Optional[Any] = None):
+        """
+        Rescans the folder tree, only new or changed APK's are inspected and hashed
+        """
+        found = {}
+        changed = []
+        for dir_entry in self.iter_apk_files():
+            stat = dir_entry.stat()
+            path = os.path.relpath(dir_entry.path, self.root_folder)
+            found[path] = stat
+            indexed = self.index.get(path)
+            if indexed is None or indexed.size != stat.st_size or indexed.mtime_ns != stat.st_mtime_ns:
+                changed.append(path)
+
+        removed = set(self.index.keys()).difference(found.keys())
+        for path in removed:
+            del self.index[path]
+
+        if on_progress is not None and len(changed) > 0:
+            progress = ProgressData(ProgressStage.START, ProgressType.DEFAULT, f'indexing {self.root_folder}',
+                                    0, len(changed), 0)
+            if not on_progress(progress_user_var, progress):
+                raise ProgressCancelled()
+
+        if len(changed) > 0:
+            file_paths = [os.path.join(self.root_folder, path) for path in changed]
+            with worker_pool(self.max_workers) as executor:
+                for path, result in zip(changed, executor.map(_index_apk, file_paths, chunksize=8)):
+                    stat = found[path]
+                    # Unreadable APK's are indexed without a package name, so they are skipped until they change
+                    self.index[path] = LocalIndexEntry(path=path, size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                                                       **(result or _INVALID_APK))
+                    if on_progress is not None:
+                        # noinspection PyUnboundLocalVariable
+                        progress.delta = 1
+                        progress.current += 1
+                        progress.stage = ProgressStage.PROGRESS
+                        if not on_progress(progress_user_var, progress):
+                            raise ProgressCancelled()
+
+            if on_progress is not None:
+                progress.stage = ProgressStage.STOP
+                on_progress(progress_user_var, progress)
+
+        if len(changed) > 0 or len(removed) > 0:
+            self.save_index()
+        self.__refreshed = True
+
+    def find(self, package_name: str, sdk_version: int, available_abi: List[str]) -> Optional[LocalIndexEntry]:
+        candidates = [
+            entry for entry in self.index.values()
+            if entry.package_name == package_name and entry.split_name is None and
+            (entry.min_sdk_version is None or entry.min_sdk_version <= sdk_version) and
+            (len(entry.available_abi) == 0 or len(set(entry.available_abi).intersection(available_abi)) > 0)
+        ]
+        if len(candidates) == 0:
+            return None
+        return max(candidates, key=lambda entry: (entry.version_code, entry.mtime_ns))
+
+    def find_splits(self, base: LocalIndexEntry, available_abi: List[str]) -> List[LocalIndexEntry]:
+        """
+        Splits of the same package and version as the base APK, ABI splits are only kept for available_abi
+        """
+        splits: Dict[str, LocalIndexEntry] = {}
+        for entry in self.index.values():
+            if entry.package_name != base.package_name or entry.version_code != base.version_code or \
+                    entry.split_name is None:
+                continue
+            abi = APKSplitInfo(entry.split_name, None, None, None).abi
+            if abi is not None and abi not in available_abi:
+                continue
+            other = splits.get(entry.split_name)
+            if other is None or other.mtime_ns < entry.mtime_ns:
+                splits[entry.split_name] = entry
+        return sorted(splits.values(), key=lambda entry: entry.split_name)
+
+    def get_apk_info(self, package_name: str, sdk_version: int, available_abi: List[str]) -> APKInfo:
+        from cryptography.hazmat.primitives.hashes import SHA256
+        entry = self.find(package_name, sdk_version, available_abi)
+        if entry is None:
+            raise Exception(f'Unable to find a compatible apk for {package_name} in {self.root_folder}')
+        return APKInfo(
+            type(self),
+            entry.package_name,
+            entry.version_name,
+            entry.version_code,
+            sdk_version,
+            available_abi,
+            file_hash=binascii.unhexlify(entry.sha256),
+            file_hash_type=SHA256,
+            file_size=entry.size,
+            splits=[
+                APKSplitInfo(
+                    split.split_name,
+                    file_hash=binascii.unhexlify(split.sha256),
+                    file_hash_type=SHA256,
+                    file_size=split.size
+                )
+                for split in self.find_splits(entry, available_abi)
+            ]
+        )
+
+    def download_apk(self, apk_info: APKInfo, output_file_path: str, on_progress: Optional[ProgressCallback],
+                     progress_user_var: Optional[Any]):
+        """
+        The output is a hardlink to the indexed APK when possible, it must not be modified in place
+        """
+        self.link_file(self.indexed_file_path(apk_info, None, apk_info.file_hash), output_file_path)
+
+    def download_split(self, apk_info: APKInfo, split: APKSplitInfo, output_file_path: str,
+                       on_progress: Optional[ProgressCallback], progress_user_var: Optional[Any]):
+        self.link_file(self.indexed_file_path(apk_info, split.name, split.file_hash), output_file_path)
+
+    def indexed_file_path(self, apk_info: APKInfo, split_name: Optional[str], file_hash: Optional[bytes]) -> str:
+        sha256 = binascii.hexlify(file_hash).decode() if file_hash is not None else None
+        for entry in self.index.values():
+            if entry.package_name == apk_info.package_name and entry.version_code == apk_info.version_code and \
+                    entry.split_name == split_name and (sha256 is None or entry.sha256 == sha256):
+                return os.path.join(self.root_folder, entry.path)
+        name = apk_info.package_name if split_name is None else f'{apk_info.package_name} split {split_name}'
+        raise Exception(f'{name} v{apk_info.version_name} is no longer in {self.root_folder}')
+
+    @staticmethod
+    def link_file(source_file_path: str, output_file_path: str):
+        os.makedirs(os.path.dirname(output_file_path), 0o755, exist_ok=True)
+        if os.path.exists(output_file_path):
+            os.remove(output_file_path)
+        try:
+            os.link(source_file_path, output_file_path)
+        except OSError:
+            # Different file system or links not supported
+            shutil.copyfile(source_file_path, output_file_path)
+
+
+_INVALID_APK = {
+    'package_name': '',
+    'version_name': '',
+    'version_code': 0,
+    'min_sdk_version': None,
+    'available_abi': [],
+    'sha256': '',
+    'split_name': None
+}
+
+
+def _index_apk(file_path: str) -> Optional[Dict[str, Any]]:
+    try:
+        metadata = inspect_apk(file_path)
+    except Exception:
+        return None
+    return {
+        'package_name': metadata.package_name,
+        'version_name': metadata.version_name or str(metadata.version_code),
+        'version_code': metadata.version_code,
+        'min_sdk_version': metadata.min_sdk_version,
+        'available_abi': metadata.available_abi,
+        'sha256': binascii.hexlify(hash_file(file_path, 'sha256')).decode(),
+        'split_name': metadata.split_name
+    }
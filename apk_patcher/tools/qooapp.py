@@ -1,26 +1,39 @@
 import binascii
 import os
-from typing import Any, Dict, List, Optional
-
-import requests
-from cryptography.hazmat.primitives.hashes import MD5
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
 
 from apk_patcher.lib.apk_provider import APKInfo, APKProvider
 from apk_patcher.lib.progress import ProgressCallback
+from apk_patcher.lib.rate_limiter import HostRateLimiter
 from apk_patcher.lib.stream_download import stream_download_progress
 
+if TYPE_CHECKING:
+    import requests
+
 
 class QooApp(APKProvider):
     VERSION_STR = '8.1.6'
     VERSION_CODE = 316
     BUFFER_SIZE = 1024 * 1024  # 1mB
+    REQUESTS_PER_SECOND = 5
+    # Overridden by the benchmarks to point at a local mock server
+    API_URL = 'https://api.qoo-app.com'
 
     device_id: Optional[str]
     token: Optional[str]
+    session: 'requests.Session'
+    rate_limiter: HostRateLimiter
 
-    def __init__(self, device_id: Optional[str] = None, token: Optional[str] = None):
+    def __init__(self, device_id: Optional[str] = None, token: Optional[str] = None,
+                 requests_per_second: float = REQUESTS_PER_SECOND):
+        import requests
+        from requests.adapters import HTTPAdapter
         self.device_id = device_id
         self.token = token
+        # Keep-alive connections for batches of info requests, one per worker thread
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=self.BATCH_MAX_WORKERS))
+        self.rate_limiter = HostRateLimiter(requests_per_second, max(1, int(requests_per_second)))
 
     def is_ready(self) -> bool:
         return self.device_id is not None and self.token is not None
@@ -42,7 +55,7 @@ class QooApp(APKProvider):
         }
 
     def generate_token(self) -> str:
-        url = 'https://api.qoo-app.com/v6/users'
+        url = f'{self.API_URL}/v6/users'
         query_params = {
             'version_code': self.VERSION_CODE,
         }
@@ -53,14 +66,15 @@ class QooApp(APKProvider):
             'email': 'null',
             'version_code': self.VERSION_CODE
         }
-        token_resp = requests.post(url, params=query_params, data=data_params, headers=self.build_headers())
+        self.rate_limiter.acquire(url)
+        token_resp = self.session.post(url, params=query_params, data=data_params, headers=self.build_headers())
         if token_resp.status_code >= 400:
             raise Exception(f'Unable to generate QooApp token: {token_resp}')
 
         return token_resp.json()['token']
 
     def get_apk_info(self, package_name: str, sdk_version: int, available_abi: List[str]) -> APKInfo:
-        url = f'https://api.qoo-app.com/v10/apps/{package_name}'
+        url = f'{self.API_URL}/v10/apps/{package_name}'
         query_params = {
             'supported_abis': ','.join(available_abi),
             'sdk_version': sdk_version,
@@ -70,7 +84,8 @@ class QooApp(APKProvider):
             'X-User-Token': self.token,
             **self.build_headers()
         }
-        info_resp = requests.get(url, params=query_params, headers=headers)
+        self.rate_limiter.acquire(url)
+        info_resp = self.session.get(url, params=query_params, headers=headers)
         if info_resp.status_code >= 400:
             raise Exception(f'Unable to get info for {package_name}: {info_resp}')
 
@@ -88,6 +103,7 @@ class QooApp(APKProvider):
         if data['apk']['data_pack_needed'] or data['apk']['obb'] is not None:
             raise Exception('split apks are not supported')
 
+        from cryptography.hazmat.primitives.hashes import MD5
         return APKInfo(
             type(self),
             package_name,
@@ -102,7 +118,7 @@ class QooApp(APKProvider):
 
     def download_apk(self, apk_info: APKInfo, output_file_path: str,
                      on_progress: Optional[ProgressCallback], progress_user_var: Optional[Any]):
-        url = f'https://api.qoo-app.com/v6/apps/{apk_info.package_name}/download'
+        url = f'{self.API_URL}/v6/apps/{apk_info.package_name}/download'
         query_params = {
             'supported_abis': ','.join(apk_info.available_abi),
             'sdk_version': apk_info.sdk_version,
@@ -0,0 +1,106 @@
+import importlib
+import os
+import sys
+import tempfile
+import textwrap
+import unittest
+from datetime import datetime
+
+from apk_patcher.apk_patcher import APK, APKPatcher
+from apk_patcher.benchmark.synthetic import SyntheticAPK, write_apk
+from apk_patcher.lib.apk_provider import APKInfo
+from apk_patcher.lib.metrics import Metrics
+from apk_patcher.lib.patch_cache import PatchCache
+from apk_patcher.tools.local_folder import LocalFolder
+
+PATCH_SOURCE = '''\
+import os
+
+from apk_patcher.lib.patch import Patch
+
+HOOK_FILE_PATH = os.path.join(os.path.dirname(__file__), 'hook.smali')
+
+
+class AddAsset(Patch):
+    @classmethod
+    def input_paths(cls):
+        return [HOOK_FILE_PATH]
+
+    def config(self, **kwargs):
+        pass
+
+    def apply(self, root_folder_path: str):
+        with open(os.path.join(root_folder_path, 'asset.txt'), 'w') as f:
+            f.write({text!r})
+
+    def unapply(self, root_folder_path: str):
+        pass
+'''
+
+
+class PatchRecipeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+        self.patch_folder = os.path.join(self.folder, 'patches')
+        os.makedirs(self.patch_folder)
+        self.write_patch('a')
+        self.write_hook('.class public LHook;')
+        sys.path.insert(0, self.patch_folder)
+
+        # Only what apply_patch needs, the constructor sets up the tools
+        self.patcher = object.__new__(APKPatcher)
+        self.patcher.tools = {}
+        self.patcher.metrics = Metrics()
+        self.patcher.profiler = None
+        self.patcher.patch_cache = PatchCache(os.path.join(self.folder, 'patch_cache'))
+
+    def tearDown(self):
+        sys.path.remove(self.patch_folder)
+        sys.modules.pop('recipe_patch', None)
+        self.tmp.cleanup()
+
+    def write_patch(self, text: str):
+        with open(os.path.join(self.patch_folder, 'recipe_patch.py'), 'w') as f:
+            f.write(PATCH_SOURCE.format(text=text))
+
+    def write_hook(self, content: str):
+        with open(os.path.join(self.patch_folder, 'hook.smali'), 'w') as f:
+            f.write(content)
+
+    def pack_key(self) -> str:
+        """
+        Pack artifact key after applying the current recipe_patch to a fresh decode
+        """
+        module = importlib.reload(importlib.import_module('recipe_patch'))
+        version_folder = os.path.join(self.folder, 'apks', 'com.example', '1.0')
+        file_path = os.path.join(version_folder, 'base.apk')
+        if not os.path.exists(file_path):
+            write_apk(SyntheticAPK(package_name='com.example', dex_size=16, resource_count=1, native_lib_count=0),
+                      file_path)
+        unpack_folder_path = os.path.join(version_folder, 'base')
+        os.makedirs(unpack_folder_path, exist_ok=True)
+        info = APKInfo(LocalFolder, 'com.example', '1.0', 1, 21, ['arm64-v8a'], file_hash=None, file_hash_type=None,
+                       file_size=None)
+        apk = APK(info, file_path, datetime.now(),
+                  unpack_folder_path, os.path.join(version_folder, 'pack.apk'),
+                  os.path.join(version_folder, 'signed.apk'), os.path.join(version_folder, 'out.apks'),
+                  recipe=[{'stage': 'apk'}, {'stage': 'unpack'}])
+        self.patcher.apply_patch(apk, module.AddAsset)
+        return APKPatcher.build_artifact_key(apk, 'pack', 'base')
+
+    def test_pack_key_follows_the_patch_code(self):
+        key = self.pack_key()
+        self.assertEqual(self.pack_key(), key)
+
+        self.write_patch('b')
+        changed_source = self.pack_key()
+        self.assertNotEqual(changed_source, key)
+
+        self.write_hook('.class public LHook;\n.super Ljava/lang/Object;')
+        changed_input = self.pack_key()
+        self.assertNotIn(changed_input, (key, changed_source))
+
+
+if __name__ == '__main__':
+    unittest.main()
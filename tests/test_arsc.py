@@ -0,0 +1,171 @@
+import os
+import struct
+import tempfile
+import unittest
+import zipfile
+
+from apk_patcher.benchmark.synthetic import StringPoolBuilder, SyntheticAPK, write_apk, write_resource_table
+from apk_patcher.lib.arsc import ResourceTable
+from apk_patcher.lib.axml import InvalidResourceChunk, ResChunk, ResValue
+
+APP_NAME = 0x7f010000
+GREETING = 0x7f010001
+LOOP = 0x7f010002
+COUNT = 0x7f020002
+APP_THEME = 0x7f030000
+
+
+def config(language: str = '', region: str = '', density: int = 0, sdk_version: int = 0) -> bytes:
+    data = bytearray(64)
+    struct.pack_into('<I', data, 0, len(data))
+    data[8:8 + len(language)] = language.encode()
+    data[10:10 + len(region)] = region.encode()
+    struct.pack_into('<H', data, 14, density)
+    struct.pack_into('<H', data, 24, sdk_version)
+    return bytes(data)
+
+
+def simple_entry(key: int, value_type: int, data: int) -> bytes:
+    return struct.pack('<HHI', 8, 0, key) + ResValue.STRUCT.pack(8, 0, value_type, data)
+
+
+def bag_entry(key: int, parent: int, items) -> bytes:
+    data = struct.pack('<HHIII', 16, ResourceTable.ENTRY_FLAG_COMPLEX, key, parent, len(items))
+    for name, value_type, value in items:
+        data += struct.pack('<I', name) + ResValue.STRUCT.pack(8, 0, value_type, value)
+    return data
+
+
+def type_chunk(type_id: int, config_data: bytes, entries, sparse: bool = False) -> bytes:
+    """
+    entries are the raw entries by index, None where the config has no value
+    """
+    header_size = 20 + len(config_data)
+    offsets = bytearray()
+    data = bytearray()
+    for index, entry in enumerate(entries):
+        if entry is not None and sparse:
+            offsets += struct.pack('<HH', index, len(data) // 4)
+        elif not sparse:
+            offsets += struct.pack('<I', len(data) if entry is not None else ResChunk.NO_ENTRY)
+        data += entry or b''
+    count = len(offsets) // 4
+    flags = ResourceTable.TYPE_FLAG_SPARSE if sparse else 0
+    return struct.pack('<HHIBBHII', ResChunk.TABLE_TYPE_TYPE, header_size, header_size + len(offsets) + len(data),
+                       type_id, flags, 0, count if sparse else len(entries), header_size + len(offsets)) + \
+        config_data + bytes(offsets) + bytes(data)
+
+
+def resource_table() -> bytes:
+    strings = StringPoolBuilder()
+    keys = StringPoolBuilder()
+    types = StringPoolBuilder()
+    for type_name in ('string', 'integer', 'style'):
+        types.index(type_name)
+    chunks = type_chunk(1, config(), [
+        simple_entry(keys.index('app_name'), ResValue.TYPE_STRING, strings.index('Hello')),
+        simple_entry(keys.index('greeting'), ResValue.TYPE_REFERENCE, APP_NAME),
+        simple_entry(keys.index('loop'), ResValue.TYPE_REFERENCE, LOOP)
+    ])
+    chunks += type_chunk(1, config('de'), [
+        simple_entry(keys.index('app_name'), ResValue.TYPE_STRING, strings.index('Hallo'))
+    ])
+    chunks += type_chunk(1, config('de', 'AT', 320, 21), [
+        None,
+        simple_entry(keys.index('greeting'), ResValue.TYPE_STRING, strings.index('Servus'))
+    ])
+    chunks += type_chunk(2, config(), [
+        None,
+        None,
+        simple_entry(keys.index('count'), ResValue.TYPE_INT_DEC, 0xfffffffb)
+    ], sparse=True)
+    chunks += type_chunk(3, config(), [bag_entry(keys.index('AppTheme'), 0x01030005, [
+        (0x01010036, ResValue.TYPE_FIRST_COLOR_INT, 0xff00ff00),
+        (0x01010098, ResValue.TYPE_INT_BOOLEAN, 1)
+    ])])
+
+    type_pool = types.build()
+    header_size = 288
+    package = struct.pack('<HHII256sIIIII', ResChunk.TABLE_PACKAGE_TYPE, header_size, 0, 0x7f,
+                          'com.example'.encode('utf-16-le').ljust(256, b'\0'), header_size, 0,
+                          header_size + len(type_pool), 0, 0) + type_pool + keys.build() + chunks
+    package = package[:4] + struct.pack('<I', len(package)) + package[8:]
+    pool = strings.build()
+    return struct.pack('<HHII', ResChunk.TABLE_TYPE, 12, 12 + len(pool) + len(package), 1) + pool + package
+
+
+class ResourceTableTest(unittest.TestCase):
+    def setUp(self):
+        self.table = ResourceTable(resource_table())
+
+    def test_names_and_ids(self):
+        self.assertEqual(self.table.resource_id('string', 'app_name'), APP_NAME)
+        self.assertEqual(self.table.packages, {0x7f: 'com.example'})
+        self.assertEqual(self.table.resource_name(COUNT), 'integer/count')
+        self.assertEqual(self.table.names('string'), {'app_name': APP_NAME, 'greeting': GREETING, 'loop': LOOP})
+        self.assertIsNone(self.table.resource_id('string', 'missing'))
+        self.assertIsNone(self.table.resource_name(0x7f090000))
+
+    def test_configs(self):
+        self.assertEqual(self.table.configs(APP_NAME), ['', 'de'])
+        self.assertEqual(self.table.configs(GREETING), ['', 'de-rAT-xhdpi-v21'])
+        self.assertEqual(self.table.value('string', 'app_name'), 'Hello')
+        self.assertEqual(self.table.value('string', 'app_name', 'de'), 'Hallo')
+        self.assertEqual(self.table.value('string', 'greeting', 'de-rAT-xhdpi-v21'), 'Servus')
+        self.assertIsNone(self.table.value('string', 'greeting', 'fr'))
+        self.assertEqual([entry.value.value for entry in self.table.entries('string', 'app_name')], ['Hello', 'Hallo'])
+
+    def test_references(self):
+        self.assertEqual(self.table.value('string', 'greeting'), 'Hello')
+        self.assertEqual(self.table.value('string', 'greeting', resolve=False), f'@0x{APP_NAME:08x}')
+        self.assertIsNone(self.table.value('string', 'loop'))
+
+    def test_sparse_type(self):
+        self.assertEqual(self.table.value('integer', 'count'), -5)
+        self.assertEqual(self.table.names('integer'), {'count': COUNT})
+
+    def test_bag(self):
+        entry = self.table.entry(APP_THEME)
+        self.assertEqual((entry.type_name, entry.name, entry.parent), ('style', 'AppTheme', 0x01030005))
+        self.assertIsNone(entry.value)
+        self.assertEqual({attribute: value.value for attribute, value in entry.bag.items()},
+                         {0x01010036: '#ff00ff00', 0x01010098: True})
+        self.assertIsNone(self.table.value('style', 'AppTheme'))
+
+    def test_invalid_table(self):
+        with self.assertRaises(InvalidResourceChunk):
+            ResourceTable(b'')
+        with self.assertRaises(InvalidResourceChunk):
+            ResourceTable(struct.pack('<HHI', ResChunk.XML_TYPE, 8, 8))
+
+
+class ResourceTableAPKTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_open_stored_and_deflated(self):
+        spec = SyntheticAPK(dex_size=16, resource_count=3, native_lib_count=0)
+        stored_path = os.path.join(self.folder, 'stored.apk')
+        write_apk(spec, stored_path)
+        deflated_path = os.path.join(self.folder, 'deflated.apk')
+        with zipfile.ZipFile(deflated_path, 'w', zipfile.ZIP_DEFLATED) as apk:
+            apk.writestr(ResourceTable.ARSC_PATH, write_resource_table(spec))
+
+        for file_path in (stored_path, deflated_path):
+            with ResourceTable.open(file_path) as table:
+                self.assertEqual(table.value('string', 'app_name', 'de'), 'Benchmark (de)')
+                self.assertEqual(table.value('drawable', 'image_2'), 'res/drawable/image_2.png')
+
+    def test_open_without_table(self):
+        file_path = os.path.join(self.folder, 'split.apk')
+        write_apk(SyntheticAPK(split_name='config.de', native_lib_count=0), file_path)
+        with self.assertRaises(InvalidResourceChunk):
+            ResourceTable.open(file_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+import contextlib
+import io
+import os
+import tarfile
+import tempfile
+import threading
+import unittest
+
+from apk_patcher.lib.artifact_cache import ArtifactCache, DirectoryBackend, HTTPBackend
+from apk_patcher.lib.artifact_server import create_artifact_server
+
+
+def write_file(file_path: str, data: bytes):
+    os.makedirs(os.path.dirname(file_path), 0o755, exist_ok=True)
+    with open(file_path, 'wb') as f:
+        f.write(data)
+
+
+def read_file(file_path: str) -> bytes:
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+
+def read_tree(root_folder_path: str):
+    return {
+        os.path.relpath(os.path.join(dir_path, file_name), root_folder_path):
+            read_file(os.path.join(dir_path, file_name))
+        for dir_path, _, file_names in os.walk(root_folder_path) for file_name in file_names
+    }
+
+
+class ArtifactCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+        self.local = DirectoryBackend(os.path.join(self.folder, 'local'))
+        self.shared = DirectoryBackend(os.path.join(self.folder, 'shared'))
+        self.file_path = os.path.join(self.folder, 'signed.apk')
+        write_file(self.file_path, os.urandom(5000))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_recipe_key(self):
+        key = ArtifactCache.recipe_key('sign', recipe=[{'stage': 'apk'}], target='base')
+        self.assertEqual(key, ArtifactCache.recipe_key('sign', target='base', recipe=[{'stage': 'apk'}]))
+        self.assertNotEqual(key, ArtifactCache.recipe_key('sign', recipe=[{'stage': 'apk'}], target='split'))
+        self.assertNotEqual(key, ArtifactCache.recipe_key('pack', recipe=[{'stage': 'apk'}], target='base'))
+
+    def test_store_and_fetch_file(self):
+        cache = ArtifactCache([self.local])
+        key = ArtifactCache.recipe_key('sign', target='base')
+        output_file_path = os.path.join(self.folder, 'out', 'signed.apk')
+        self.assertFalse(cache.fetch_file(key, output_file_path))
+        self.assertFalse(os.path.exists(output_file_path))
+
+        cache.store_file(key, self.file_path)
+        self.assertTrue(cache.fetch_file(key, output_file_path))
+        self.assertEqual(read_file(output_file_path), read_file(self.file_path))
+        self.assertFalse(ArtifactCache([]).fetch_file(key, output_file_path))
+
+    def test_parallel_puts_of_one_object(self):
+        write_file(self.file_path, os.urandom(4 * 1024 * 1024))
+        names = [ArtifactCache.blob_name(f'{i:064x}') for i in range(10)]
+        barrier = threading.Barrier(4)
+        errors = []
+
+        def put():
+            for name in names:
+                barrier.wait()
+                try:
+                    self.shared.put(name, self.file_path)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=put) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        for name in names:
+            self.assertEqual(read_file(self.shared.object_path(name)), read_file(self.file_path))
+        self.assertEqual([name for name in os.listdir(os.path.dirname(self.shared.object_path(names[0])))
+                          if name.endswith('.tmp')], [])
+
+    def test_same_content_is_stored_once(self):
+        cache = ArtifactCache([self.local])
+        cache.store_file(ArtifactCache.recipe_key('sign', target='base'), self.file_path)
+        cache.store_file(ArtifactCache.recipe_key('sign', target='copy'), self.file_path)
+
+        self.assertEqual(len(os.listdir(os.path.join(self.local.root_folder, 'refs'))), 2)
+        blobs = [file_names for _, _, file_names in os.walk(os.path.join(self.local.root_folder, 'blobs'))]
+        self.assertEqual(sum(len(file_names) for file_names in blobs), 1)
+
+    def test_hit_in_a_later_backend_is_copied_forward(self):
+        key = ArtifactCache.recipe_key('sign', target='base')
+        ArtifactCache([self.shared]).store_file(key, self.file_path)
+        cache = ArtifactCache([self.local, self.shared])
+
+        self.assertTrue(cache.fetch_file(key, os.path.join(self.folder, 'out.apk')))
+        digest = cache.resolve(key)
+        self.assertTrue(self.local.has(ArtifactCache.ref_name(key)))
+        self.assertTrue(self.local.has(ArtifactCache.blob_name(digest)))
+
+    def test_corrupt_blob_is_a_miss(self):
+        cache = ArtifactCache([self.local])
+        key = ArtifactCache.recipe_key('sign', target='base')
+        cache.store_file(key, self.file_path)
+        write_file(self.local.object_path(ArtifactCache.blob_name(cache.resolve(key))), b'corrupt')
+
+        output_file_path = os.path.join(self.folder, 'out.apk')
+        write_file(output_file_path, b'previous')
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(cache.fetch_file(key, output_file_path))
+        self.assertEqual(read_file(output_file_path), b'previous')
+
+    def test_store_and_fetch_tree(self):
+        cache = ArtifactCache([self.local])
+        tree_path = os.path.join(self.folder, 'decoded')
+        write_file(os.path.join(tree_path, 'AndroidManifest.xml'), b'<manifest/>')
+        write_file(os.path.join(tree_path, 'smali', 'com', 'example', 'Main.smali'),
+                   b'.class public Lcom/example/Main;')
+        os.makedirs(os.path.join(tree_path, 'assets'))
+        key = ArtifactCache.recipe_key('unpack', target='base')
+        cache.store_tree(key, tree_path)
+        digest = cache.resolve(key)
+
+        # Timestamps don't change the blob
+        os.utime(os.path.join(tree_path, 'AndroidManifest.xml'), (0, 0))
+        cache.store_tree(ArtifactCache.recipe_key('unpack', target='again'), tree_path)
+        self.assertEqual(cache.resolve(ArtifactCache.recipe_key('unpack', target='again')), digest)
+
+        output_folder_path = os.path.join(self.folder, 'restored')
+        write_file(os.path.join(output_folder_path, 'stale.txt'), b'stale')
+        self.assertTrue(cache.fetch_tree(key, output_folder_path))
+        self.assertEqual(read_tree(output_folder_path), read_tree(tree_path))
+        self.assertTrue(os.path.isdir(os.path.join(output_folder_path, 'assets')))
+
+    def store_tar(self, cache: ArtifactCache, key: str, members):
+        tar_file_path = os.path.join(self.folder, 'tree.tar.gz')
+        with tarfile.open(tar_file_path, 'w:gz') as tar:
+            for info, data in members:
+                tar.addfile(info, io.BytesIO(data) if data is not None else None)
+        cache.store_file(key, tar_file_path)
+
+    def test_unsafe_trees_are_rejected(self):
+        cache = ArtifactCache([self.local])
+        link = tarfile.TarInfo('smali')
+        link.type, link.linkname = tarfile.SYMTYPE, '/etc'
+        escape = tarfile.TarInfo('../escape.txt')
+        escape.size = 1
+        for name, members in (('link', [(link, None)]), ('escape', [(escape, b'x')])):
+            key = ArtifactCache.recipe_key('unpack', target=name)
+            self.store_tar(cache, key, members)
+            output_folder_path = os.path.join(self.folder, 'restored', name)
+            with self.assertRaisesRegex(Exception, 'unsafe'):
+                cache.fetch_tree(key, output_folder_path)
+            self.assertFalse(os.path.exists(output_folder_path))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'restored', 'escape.txt')))
+
+
+class HTTPBackendTest(unittest.TestCase):
+    TOKEN = 'secret'
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+        self.servers = []
+        self.file_path = os.path.join(self.folder, 'signed.apk')
+        write_file(self.file_path, os.urandom(5000))
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.tmp.cleanup()
+
+    def start_server(self, token=None) -> str:
+        server = create_artifact_server(os.path.join(self.folder, 'store'), port=0, token=token)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        return f'http://127.0.0.1:{server.server_address[1]}'
+
+    def test_shared_between_nodes(self):
+        url = self.start_server(self.TOKEN)
+        key = ArtifactCache.recipe_key('sign', target='base')
+        ArtifactCache([HTTPBackend(url, token=self.TOKEN)]).store_file(key, self.file_path)
+
+        output_file_path = os.path.join(self.folder, 'out.apk')
+        self.assertTrue(ArtifactCache([HTTPBackend(url)]).fetch_file(key, output_file_path))
+        self.assertEqual(read_file(output_file_path), read_file(self.file_path))
+        self.assertFalse(ArtifactCache([HTTPBackend(url)]).fetch_file(ArtifactCache.recipe_key('sign'),
+                                                                     output_file_path))
+
+    def test_put_needs_the_token(self):
+        key = ArtifactCache.recipe_key('sign', target='base')
+        for url, token, status in ((self.start_server(self.TOKEN), 'wrong', '401'),
+                                   (self.start_server(self.TOKEN), None, '401'),
+                                   (self.start_server(), self.TOKEN, '403')):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                # Failing to write the cache doesn't fail the build
+                ArtifactCache([HTTPBackend(url, token=token)]).store_file(key, self.file_path)
+            self.assertIn(status, output.getvalue())
+            self.assertFalse(HTTPBackend(url).has(ArtifactCache.ref_name(key)))
+            with self.assertRaisesRegex(Exception, status):
+                HTTPBackend(url, token=token).put(ArtifactCache.ref_name(key), self.file_path)
+
+    def test_invalid_object_name(self):
+        url = self.start_server(self.TOKEN)
+        backend = HTTPBackend(url, token=self.TOKEN)
+        self.assertFalse(backend.has('blobs/../../etc/passwd'))
+        with self.assertRaisesRegex(Exception, '400'):
+            backend.put('blobs/not-a-digest', self.file_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import multiprocessing
+import os
+import struct
+import tempfile
+import unittest
+import zipfile
+
+from apk_patcher.benchmark.synthetic import ANDROID_NS, SyntheticAPK, write_apk, write_axml, write_manifest
+from apk_patcher.lib.apk_inspector import InvalidAPK, inspect_apk, inspect_apks
+from apk_patcher.lib.axml import AXMLParser, InvalidResourceChunk, ResChunk, ResStringPool, ResValue
+
+
+def utf8_string_pool(strings) -> bytes:
+    data = bytearray()
+    offsets = []
+    for value in strings:
+        encoded = value.encode()
+        offsets.append(len(data))
+        for length in (len(value), len(encoded)):
+            data += bytes([length]) if length < 0x80 else bytes([0x80 | (length >> 8), length & 0xff])
+        data += encoded + b'\0'
+    while len(data) % 4 != 0:
+        data += b'\0'
+    header_size = 28
+    body = struct.pack(f'<{len(offsets)}I', *offsets) + bytes(data)
+    return struct.pack('<HHIIIIII', ResChunk.STRING_POOL_TYPE, header_size, header_size + len(body), len(strings),
+                       0, ResStringPool.UTF8_FLAG, header_size + 4 * len(offsets), 0) + body
+
+
+class AXMLParserTest(unittest.TestCase):
+    def test_manifest_elements(self):
+        spec = SyntheticAPK(package_name='com.example.app', version_code=42, version_name='4.2', min_sdk_version=23)
+        elements = list(AXMLParser(write_manifest(spec)).iter_elements())
+
+        self.assertEqual([(element.depth, element.name) for element in elements],
+                         [(0, 'manifest'), (1, 'uses-sdk'), (1, 'application')])
+        manifest = elements[0]
+        self.assertEqual(manifest.get('package').value, 'com.example.app')
+        self.assertEqual(manifest.get('versionName').value, '4.2')
+        version_code = manifest.get('', 0x0101021b)
+        self.assertEqual((version_code.namespace, version_code.name, version_code.value),
+                         (ANDROID_NS, 'versionCode', 42))
+        self.assertEqual(elements[1].get('minSdkVersion').value, 23)
+        self.assertIsNone(elements[2].get('label'))
+
+    def test_value_types(self):
+        data = write_axml([('root', [
+            (None, 'negative', None, ResValue.TYPE_INT_DEC, 0xffffffff),
+            (None, 'enabled', None, ResValue.TYPE_INT_BOOLEAN, 0xffffffff),
+            (None, 'label', None, ResValue.TYPE_REFERENCE, 0x7f010002)
+        ], [('child', [], [('grandchild', [], [])])])])
+        elements = list(AXMLParser(data).iter_elements())
+
+        self.assertEqual([attribute.value for attribute in elements[0].attributes], [-1, True, '@0x7f010002'])
+        self.assertEqual([element.depth for element in elements], [0, 1, 2])
+
+    def test_utf8_strings(self):
+        strings = ['root', 'name', 'é' * 200, 'ascii']
+        pool = ResStringPool(utf8_string_pool(strings), 0, 28)
+        self.assertTrue(pool.is_utf8)
+        self.assertEqual(list(pool), strings)
+        self.assertIsNone(pool.get(ResChunk.NO_ENTRY))
+        self.assertIsNone(pool.get(len(strings)))
+
+        body = struct.pack('<II', 1, ResChunk.NO_ENTRY) + \
+            struct.pack('<IIHHHHHH', ResChunk.NO_ENTRY, 0, 20, 20, 1, 0, 0, 0) + \
+            struct.pack('<IIIHBBI', ResChunk.NO_ENTRY, 1, 2, 8, 0, ResValue.TYPE_STRING, 2)
+        content = utf8_string_pool(strings) + \
+            struct.pack('<HHI', ResChunk.XML_START_ELEMENT_TYPE, 16, 8 + len(body)) + body
+        data = struct.pack('<HHI', ResChunk.XML_TYPE, 8, 8 + len(content)) + content
+        element, = AXMLParser(data).iter_elements()
+        self.assertEqual(element.get('name').value, 'é' * 200)
+
+    def test_invalid_xml(self):
+        with self.assertRaises(InvalidResourceChunk):
+            AXMLParser(b'')
+        with self.assertRaises(InvalidResourceChunk):
+            AXMLParser(struct.pack('<HHI', ResChunk.TABLE_TYPE, 8, 8))
+        with self.assertRaises(InvalidResourceChunk):
+            AXMLParser(b'<?xml version="1.0"?><manifest/>')
+
+
+def inspect_package_names(file_paths, package_names):
+    results = inspect_apks(file_paths, max_workers=2)
+    package_names.extend([result.package_name if not isinstance(result, Exception) else None
+                          for result in results.values()])
+
+
+class APKInspectorTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_base_apk(self):
+        file_path = os.path.join(self.folder, 'base.apk')
+        write_apk(SyntheticAPK(package_name='com.example.app', version_code=7, version_name='0.7',
+                               min_sdk_version=26, dex_count=3, dex_size=1024, resource_count=1,
+                               native_lib_count=1, native_lib_size=16, abis=['x86', 'arm64-v8a']), file_path)
+        metadata = inspect_apk(file_path)
+
+        self.assertEqual(metadata.package_name, 'com.example.app')
+        self.assertEqual((metadata.version_code, metadata.version_name), (7, '0.7'))
+        self.assertEqual(metadata.min_sdk_version, 26)
+        self.assertIsNone(metadata.target_sdk_version)
+        self.assertEqual(metadata.available_abi, ['arm64-v8a', 'x86'])
+        self.assertEqual(metadata.dex_files, ['classes.dex', 'classes2.dex', 'classes3.dex'])
+        self.assertEqual(metadata.file_size, os.path.getsize(file_path))
+        self.assertIsNone(metadata.split_name)
+
+    def test_split_apk(self):
+        file_path = os.path.join(self.folder, 'split.apk')
+        write_apk(SyntheticAPK(split_name='config.arm64_v8a', native_lib_count=1, native_lib_size=16,
+                               abis=['arm64-v8a']), file_path)
+        metadata = inspect_apk(file_path)
+
+        self.assertEqual(metadata.split_name, 'config.arm64_v8a')
+        self.assertEqual(metadata.dex_count, 0)
+
+    def test_inspect_many(self):
+        file_paths = []
+        for i in range(3):
+            file_paths.append(os.path.join(self.folder, f'{i}.apk'))
+            write_apk(SyntheticAPK(package_name=f'com.example{i}', dex_size=16, resource_count=1, native_lib_count=0),
+                      file_paths[-1])
+        file_paths.append(os.path.join(self.folder, 'broken.apk'))
+        with open(file_paths[-1], 'wb') as f:
+            f.write(b'not a zip')
+        expected = ['com.example0', 'com.example1', 'com.example2', None]
+
+        package_names = []
+        inspect_package_names(file_paths, package_names)
+        self.assertEqual(package_names, expected)
+
+        # Job service workers are daemon processes, which can't start worker processes of their own
+        with multiprocessing.get_context('spawn').Manager() as manager:
+            package_names = manager.list()
+            process = multiprocessing.get_context('spawn').Process(target=inspect_package_names,
+                                                                   args=(file_paths, package_names), daemon=True)
+            process.start()
+            process.join(60)
+            self.assertEqual(process.exitcode, 0)
+            self.assertEqual(list(package_names), expected)
+
+    def test_missing_manifest(self):
+        file_path = os.path.join(self.folder, 'no_manifest.apk')
+        with zipfile.ZipFile(file_path, 'w') as apk:
+            apk.writestr('classes.dex', b'dex\n035\0')
+        with self.assertRaises(InvalidAPK):
+            inspect_apk(file_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
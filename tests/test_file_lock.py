@@ -0,0 +1,180 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from apk_patcher.lib.file_lock import FileLock, LockTimeout, SharedFileLock, atomic_output
+
+
+def increment(lock_file_path: str, counter_file_path: str, times: int):
+    for _ in range(times):
+        with FileLock(lock_file_path):
+            with open(counter_file_path) as f:
+                value = int(f.read())
+            # Widens the window between read and write for a lost update
+            time.sleep(0.001)
+            with open(counter_file_path, 'w') as f:
+                f.write(str(value + 1))
+
+
+def hold(lock_file_path: str, locked, release):
+    with FileLock(lock_file_path):
+        locked.set()
+        release.wait(30)
+
+
+class FileLockTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+        self.lock_file_path = os.path.join(self.folder, 'locks', 'dist.lock')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_processes_exclude_each_other(self):
+        counter_file_path = os.path.join(self.folder, 'counter')
+        with open(counter_file_path, 'w') as f:
+            f.write('0')
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=increment, args=(self.lock_file_path, counter_file_path, 25))
+                     for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(60)
+            self.assertEqual(process.exitcode, 0)
+
+        with open(counter_file_path) as f:
+            self.assertEqual(f.read(), '100')
+
+    def test_timeout_while_another_process_holds_the_lock(self):
+        context = multiprocessing.get_context('spawn')
+        locked, release = context.Event(), context.Event()
+        process = context.Process(target=hold, args=(self.lock_file_path, locked, release))
+        process.start()
+        try:
+            self.assertTrue(locked.wait(30))
+            start = time.monotonic()
+            with self.assertRaises(LockTimeout):
+                FileLock(self.lock_file_path, timeout=0.3).acquire()
+            self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        finally:
+            release.set()
+            process.join(30)
+        with FileLock(self.lock_file_path, timeout=5):
+            pass
+
+    def test_reentrant_across_instances(self):
+        with FileLock(self.lock_file_path):
+            with FileLock(self.lock_file_path, timeout=0):
+                with FileLock(self.lock_file_path):
+                    pass
+            # Still held after the inner instances let go
+            acquired = []
+            thread = threading.Thread(target=self.try_acquire, args=(acquired,))
+            thread.start()
+            thread.join()
+            self.assertEqual(acquired, [False])
+
+        thread = threading.Thread(target=self.try_acquire, args=(acquired,))
+        thread.start()
+        thread.join()
+        self.assertEqual(acquired, [False, True])
+
+    def try_acquire(self, acquired):
+        try:
+            with FileLock(self.lock_file_path, timeout=0.2):
+                acquired.append(True)
+        except LockTimeout:
+            acquired.append(False)
+
+    def test_threads_exclude_each_other(self):
+        inside = []
+        overlaps = []
+
+        def run():
+            for _ in range(20):
+                with FileLock(self.lock_file_path):
+                    inside.append(1)
+                    overlaps.append(len(inside))
+                    time.sleep(0.001)
+                    inside.pop()
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(overlaps), 80)
+        self.assertEqual(max(overlaps), 1)
+
+
+def hold_shared(lock_file_path: str, locked, release):
+    with SharedFileLock(lock_file_path):
+        locked.set()
+        release.wait(30)
+
+
+class SharedFileLockTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.lock_file_path = os.path.join(self.tmp.name, 'apk.lock')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_shared_holders_block_exclusive(self):
+        context = multiprocessing.get_context('spawn')
+        locked, release = context.Event(), context.Event()
+        process = context.Process(target=hold_shared, args=(self.lock_file_path, locked, release))
+        process.start()
+        try:
+            self.assertTrue(locked.wait(30))
+            with SharedFileLock(self.lock_file_path):
+                pass
+            self.assertFalse(SharedFileLock(self.lock_file_path).try_acquire_exclusive())
+        finally:
+            release.set()
+            process.join(30)
+
+        exclusive = SharedFileLock(self.lock_file_path)
+        self.assertTrue(exclusive.try_acquire_exclusive())
+        self.assertFalse(SharedFileLock(self.lock_file_path).try_acquire_exclusive())
+        exclusive.release()
+        self.assertTrue(exclusive.try_acquire_exclusive())
+        exclusive.release()
+
+
+class AtomicOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp.name, 'index.json')
+        with open(self.file_path, 'w') as f:
+            f.write('old')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_replaces_on_success(self):
+        with atomic_output(self.file_path) as tmp_file_path, open(tmp_file_path, 'w') as f:
+            f.write('new')
+        with open(self.file_path) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertEqual(os.listdir(self.tmp.name), ['index.json'])
+
+    def test_keeps_the_old_file_on_error(self):
+        with self.assertRaises(ValueError):
+            with atomic_output(self.file_path) as tmp_file_path:
+                with open(tmp_file_path, 'w') as f:
+                    f.write('partial')
+                raise ValueError()
+        with open(self.file_path) as f:
+            self.assertEqual(f.read(), 'old')
+        self.assertEqual(os.listdir(self.tmp.name), ['index.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from apk_patcher.lib.job_queue import HTTPJobQueue, JobLeaseLost, JobNotFound, JobStatus, SQLiteJobQueue
+from apk_patcher.lib.job_server import create_job_server
+
+
+def claim_all(db_file_path: str, artifact_folder: str, worker: str, claimed):
+    queue = SQLiteJobQueue(db_file_path, artifact_folder)
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            return
+        claimed.put(job.id)
+        queue.complete(job.id, worker, {'worker': worker})
+
+
+class SQLiteJobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+        self.db_file_path = os.path.join(self.folder, 'db', 'jobs.sqlite')
+        self.artifact_folder = os.path.join(self.folder, 'artifacts')
+        self.queue = SQLiteJobQueue(self.db_file_path, self.artifact_folder)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_job_lifecycle(self):
+        first = self.queue.submit({'package_name': 'com.first'})
+        second = self.queue.submit({'package_name': 'com.second'})
+        self.assertEqual(self.queue.get(first.id).status, JobStatus.QUEUED)
+
+        job = self.queue.claim('worker-1')
+        self.assertEqual((job.id, job.status, job.worker, job.attempts), (first.id, JobStatus.RUNNING, 'worker-1', 1))
+        self.assertEqual(self.queue.claim('worker-2').id, second.id)
+        self.assertIsNone(self.queue.claim('worker-3'))
+
+        self.queue.heartbeat(first.id, 'worker-1')
+        with self.assertRaises(JobLeaseLost):
+            self.queue.heartbeat(first.id, 'worker-2')
+        self.queue.complete(first.id, 'worker-1', {'apk': 'out.apk'})
+        self.queue.fail(second.id, 'worker-2', 'broken')
+
+        done = self.queue.get(first.id)
+        self.assertEqual((done.status, done.result), (JobStatus.DONE, {'apk': 'out.apk'}))
+        failed = self.queue.get(second.id)
+        self.assertEqual((failed.status, failed.error), (JobStatus.FAILED, 'broken'))
+        self.assertEqual([job.id for job in self.queue.list(JobStatus.DONE)], [first.id])
+        with self.assertRaises(JobLeaseLost):
+            self.queue.complete(first.id, 'worker-1', {})
+        with self.assertRaises(JobNotFound):
+            self.queue.get('0' * 32)
+
+    def test_expired_lease_is_requeued_then_failed(self):
+        queue = SQLiteJobQueue(self.db_file_path, self.artifact_folder, lease_timeout=0.05, max_attempts=2)
+        job = queue.submit({'package_name': 'com.example'})
+        queue.claim('worker-1')
+        time.sleep(0.1)
+
+        retried = queue.claim('worker-2')
+        self.assertEqual((retried.id, retried.worker, retried.attempts), (job.id, 'worker-2', 2))
+        with self.assertRaises(JobLeaseLost):
+            queue.heartbeat(job.id, 'worker-1')
+
+        time.sleep(0.1)
+        self.assertIsNone(queue.claim('worker-3'))
+        failed = queue.get(job.id)
+        self.assertEqual((failed.status, failed.error), (JobStatus.FAILED, 'worker stopped responding'))
+
+    def test_each_job_is_claimed_once(self):
+        job_ids = {self.queue.submit({'package_name': f'com.example{i}'}).id for i in range(40)}
+        context = multiprocessing.get_context('spawn')
+        claimed = context.Queue()
+        workers = [context.Process(target=claim_all, args=(self.db_file_path, self.artifact_folder, f'worker-{i}',
+                                                           claimed)) for i in range(4)]
+        for worker in workers:
+            worker.start()
+        claimed_ids = [claimed.get(timeout=60) for _ in job_ids]
+        for worker in workers:
+            worker.join(60)
+
+        self.assertEqual(sorted(claimed_ids), sorted(job_ids))
+        self.assertTrue(all(job.status == JobStatus.DONE for job in self.queue.list(limit=100)))
+
+    def test_artifacts(self):
+        job = self.queue.submit({'package_name': 'com.example'})
+        file_path = os.path.join(self.folder, 'signed.apk')
+        with open(file_path, 'wb') as f:
+            f.write(b'apk')
+        self.queue.put_artifact(job.id, 'signed.apk', file_path)
+        self.queue.put_artifact(job.id, 'signed.apk', file_path)
+
+        output_file_path = os.path.join(self.folder, 'out.apk')
+        self.queue.get_artifact(job.id, 'signed.apk', output_file_path)
+        with open(output_file_path, 'rb') as f:
+            self.assertEqual(f.read(), b'apk')
+        self.assertEqual(self.queue.get(job.id).artifacts, ['signed.apk'])
+        for name in ('../jobs.sqlite', '.hidden'):
+            with self.assertRaises(Exception):
+                self.queue.put_artifact(job.id, name, file_path)
+
+    def test_parallel_artifact_uploads(self):
+        job = self.queue.submit({'package_name': 'com.example'})
+        file_path = os.path.join(self.folder, 'signed.apk')
+        content = os.urandom(4 * 1024 * 1024)
+        with open(file_path, 'wb') as f:
+            f.write(content)
+        barrier = threading.Barrier(4)
+        errors = []
+
+        def upload():
+            for i in range(20):
+                barrier.wait()
+                try:
+                    self.queue.put_artifact(job.id, f'signed-{i}.apk', file_path)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=upload) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.artifact_folder, job.id))),
+                         sorted(f'signed-{i}.apk' for i in range(20)))
+        with open(os.path.join(self.artifact_folder, job.id, 'signed-0.apk'), 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(sorted(self.queue.get(job.id).artifacts), sorted(f'signed-{i}.apk' for i in range(20)))
+
+
+class HTTPJobQueueTest(unittest.TestCase):
+    TOKEN = 'secret'
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+        self.local_queue = SQLiteJobQueue(os.path.join(self.folder, 'jobs.sqlite'),
+                                          os.path.join(self.folder, 'artifacts'))
+        self.servers = []
+        self.url = self.start_server(self.TOKEN)
+        self.queue = HTTPJobQueue(self.url, token=self.TOKEN)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.tmp.cleanup()
+
+    def start_server(self, token=None) -> str:
+        server = create_job_server(self.local_queue, port=0, token=token)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        return f'http://127.0.0.1:{server.server_address[1]}'
+
+    def test_remote_worker(self):
+        job = self.queue.submit({'package_name': 'com.example'})
+        claimed = self.queue.claim('remote-1')
+        self.assertEqual((claimed.id, claimed.status), (job.id, JobStatus.RUNNING))
+        self.assertIsNone(self.queue.claim('remote-2'))
+
+        self.queue.heartbeat(job.id, 'remote-1')
+        with self.assertRaises(JobLeaseLost):
+            self.queue.heartbeat(job.id, 'remote-2')
+        file_path = os.path.join(self.folder, 'signed.apk')
+        with open(file_path, 'wb') as f:
+            f.write(os.urandom(1000))
+        self.queue.put_artifact(job.id, 'signed.apk', file_path)
+        self.queue.complete(job.id, 'remote-1', {'apk': 'signed.apk'})
+
+        output_file_path = os.path.join(self.folder, 'out.apk')
+        self.queue.get_artifact(job.id, 'signed.apk', output_file_path)
+        with open(file_path, 'rb') as f, open(output_file_path, 'rb') as out:
+            self.assertEqual(f.read(), out.read())
+        done = self.queue.get(job.id)
+        self.assertEqual((done.status, done.result, done.artifacts), (JobStatus.DONE, {'apk': 'signed.apk'},
+                                                                       ['signed.apk']))
+        self.assertEqual([job.id for job in self.queue.list(JobStatus.DONE)], [job.id])
+        with self.assertRaises(JobNotFound):
+            self.queue.get('0' * 32)
+
+    def test_writes_need_the_token(self):
+        job = self.queue.submit({'package_name': 'com.example'})
+        file_path = os.path.join(self.folder, 'signed.apk')
+        with open(file_path, 'wb') as f:
+            f.write(b'apk')
+        for url, token, status in ((self.url, 'wrong', '401'),
+                                   (self.url, None, '401'),
+                                   (self.start_server(), self.TOKEN, '403')):
+            queue = HTTPJobQueue(url, token=token)
+            with self.assertRaisesRegex(Exception, status):
+                queue.submit({'package_name': 'com.example'})
+            with self.assertRaisesRegex(Exception, status):
+                queue.claim('remote-1')
+            with self.assertRaisesRegex(Exception, status):
+                queue.put_artifact(job.id, 'signed.apk', file_path)
+            # Reading stays open
+            self.assertEqual(queue.get(job.id).status, JobStatus.QUEUED)
+        self.assertEqual([job.id for job in self.local_queue.list()], [job.id])
+        self.assertEqual(self.local_queue.get(job.id).artifacts, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+
+from apk_patcher.benchmark.synthetic import SyntheticAPK, write_apk
+from apk_patcher.tools.local_folder import LocalFolder
+
+
+def refresh(root_folder: str, index_file_path: str):
+    LocalFolder(root_folder, index_file_path).refresh()
+
+
+class LocalFolderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root_folder = os.path.join(self.tmp.name, 'apks')
+        self.index_file_path = os.path.join(self.tmp.name, 'index.json')
+        for version_code in (1, 2):
+            write_apk(SyntheticAPK(package_name='com.example', version_code=version_code, dex_size=16,
+                                   resource_count=1, native_lib_count=0),
+                      os.path.join(self.root_folder, f'com.example-{version_code}.apk'))
+        write_apk(SyntheticAPK(package_name='com.example', version_code=2, split_name='config.arm64_v8a',
+                               native_lib_count=1, native_lib_size=16, abis=['arm64-v8a']),
+                  os.path.join(self.root_folder, 'splits', 'config.arm64_v8a.apk'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_newest_version_with_splits(self):
+        provider = LocalFolder(self.root_folder, self.index_file_path)
+        provider.refresh()
+        info = provider.get_apk_info('com.example', 30, ['arm64-v8a'])
+
+        self.assertEqual(info.version_code, 2)
+        self.assertEqual([split.name for split in info.splits], ['config.arm64_v8a'])
+        self.assertEqual(provider.get_apk_info('com.example', 30, ['x86']).splits, [])
+        # A new instance reads the saved index without inspecting the APK's again
+        self.assertEqual(len(LocalFolder(self.root_folder, self.index_file_path).index), 3)
+
+    def test_refresh_in_daemon_process(self):
+        # Job service workers are daemon processes, which can't start worker processes of their own
+        process = multiprocessing.get_context('spawn').Process(target=refresh,
+                                                               args=(self.root_folder, self.index_file_path),
+                                                               daemon=True)
+        process.start()
+        process.join(60)
+
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(len(LocalFolder(self.root_folder, self.index_file_path).index), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
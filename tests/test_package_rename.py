@@ -0,0 +1,219 @@
+import multiprocessing
+import os
+import tempfile
+import textwrap
+import unittest
+
+from apk_patcher.benchmark.synthetic import SyntheticAPK, write_decoded_tree
+from apk_patcher.lib.package_rename import PackageRenamer
+from apk_patcher.patches.change_package_name import ChangePackageName
+
+MANIFEST = '''\
+<?xml version="1.0" encoding="utf-8" standalone="no"?>
+<manifest xmlns:android="http://schemas.android.com/apk/res/android" package="com.example.app">
+    <permission android:name="com.example.app.permission.C2D_MESSAGE"/>
+    <uses-permission android:name="com.example.app.permission.C2D_MESSAGE"/>
+    <uses-permission android:name="android.permission.INTERNET"/>
+    <application android:name=".App" android:label="@string/app_name">
+        <activity android:name=".MainActivity"/>
+        <activity android:name="com.example.app.ui.Settings" android:parentActivityName="MainActivity"/>
+        <activity android:name="com.example.app2.Other"/>
+        <provider android:name="androidx.core.content.FileProvider"
+                  android:authorities="com.example.app.files;other.authority"/>
+        <meta-data android:name="com.example.app.Initializer" android:value="androidx.startup"/>
+    </application>
+</manifest>
+'''
+
+MAIN_ACTIVITY = '''\
+.class public Lcom/example/app/MainActivity;
+.super Landroid/app/Activity;
+
+.method public getAuthority()Ljava/lang/String;
+    .registers 2
+
+    const-string v0, "com.example.app.files"
+
+    return-object v0
+.end method
+
+.method public getOther()Ljava/lang/String;
+    .registers 2
+
+    const-string v0, "com.example.app2"
+
+    return-object v0
+.end method
+
+.method public getClassName()Ljava/lang/String;
+    .registers 2
+
+    const-string v0, "com.example.app.ui.Settings"
+
+    return-object v0
+.end method
+
+.method public getSettings()Lcom/example/app/ui/Settings;
+    .registers 2
+
+    new-instance v0, Lcom/example/app/ui/Settings;
+
+    return-object v0
+.end method
+'''
+
+LAYOUT = '''\
+<?xml version="1.0" encoding="utf-8"?>
+<LinearLayout xmlns:android="http://schemas.android.com/apk/res/android"\r
+    xmlns:app="http://schemas.android.com/apk/res-auto">\r
+    <com.example.app.ui.BadgeView android:layout_width="wrap_content"/>\r
+    <TextView android:tag="com.example.app"/>\r
+</LinearLayout>\r
+'''
+
+
+def write_tree(root_folder_path: str):
+    files = {
+        'AndroidManifest.xml': MANIFEST,
+        os.path.join('smali', 'com', 'example', 'app', 'MainActivity.smali'): MAIN_ACTIVITY,
+        os.path.join('smali_classes2', 'com', 'example', 'app2', 'Other.smali'):
+            '.class public Lcom/example/app2/Other;\n.super Ljava/lang/Object;\n',
+        os.path.join('res', 'layout', 'main.xml'): LAYOUT,
+        # Only smali and resource XML are rewritten
+        os.path.join('assets', 'config.txt'): 'com.example.app\n'
+    }
+    for path, content in files.items():
+        file_path = os.path.join(root_folder_path, path)
+        os.makedirs(os.path.dirname(file_path), 0o755, exist_ok=True)
+        with open(file_path, 'w', newline='') as f:
+            f.write(content)
+
+
+def read_tree(root_folder_path: str):
+    files = {}
+    for dir_path, _, file_names in os.walk(root_folder_path):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            with open(file_path, 'rb') as f:
+                files[os.path.relpath(file_path, root_folder_path)] = f.read().decode('utf-8', 'surrogateescape')
+    return files
+
+
+def rename_in_daemon(root_folder_path: str, new_package_name: str):
+    renamer = PackageRenamer(root_folder_path, new_package_name)
+    renamer.rewrite(renamer.index())
+
+
+class PackageRenamerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        write_tree(self.root)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def rename(self, rename_classes: bool = False):
+        renamer = PackageRenamer(self.root, 'org.renamed', rename_classes)
+        index = renamer.index()
+        renamer.rewrite(index)
+        return index, read_tree(self.root)
+
+    def test_rename_keeps_classes(self):
+        index, files = self.rename()
+
+        self.assertEqual(set(index.names), {'com.example.app.permission.C2D_MESSAGE', 'com.example.app.files'})
+        self.assertEqual(set(index.lines), {os.path.join('smali', 'com', 'example', 'app', 'MainActivity.smali'),
+                                            os.path.join('res', 'layout', 'main.xml')})
+        manifest = files['AndroidManifest.xml']
+        for expected in ('package="org.renamed"',
+                         'android:name="org.renamed.permission.C2D_MESSAGE"',
+                         'android:name="com.example.app.App"',
+                         'android:name="com.example.app.MainActivity"',
+                         'android:parentActivityName="com.example.app.MainActivity"',
+                         'android:name="com.example.app2.Other"',
+                         'android:authorities="org.renamed.files;other.authority"',
+                         'android:name="com.example.app.Initializer"',
+                         'android:name="android.permission.INTERNET"'):
+            self.assertIn(expected, manifest)
+
+        smali = files[os.path.join('smali', 'com', 'example', 'app', 'MainActivity.smali')]
+        self.assertIn('const-string v0, "org.renamed.files"', smali)
+        self.assertIn('const-string v0, "com.example.app2"', smali)
+        self.assertIn('const-string v0, "com.example.app.ui.Settings"', smali)
+        self.assertIn('.class public Lcom/example/app/MainActivity;', smali)
+
+        layout = files[os.path.join('res', 'layout', 'main.xml')]
+        self.assertEqual(layout, LAYOUT.replace('android:tag="com.example.app"', 'android:tag="org.renamed"'))
+        self.assertEqual(files[os.path.join('assets', 'config.txt')], 'com.example.app\n')
+
+    def test_rename_classes(self):
+        _, files = self.rename(rename_classes=True)
+
+        manifest = files['AndroidManifest.xml']
+        for expected in ('android:name="org.renamed.App"',
+                         'android:name="org.renamed.MainActivity"',
+                         'android:parentActivityName="org.renamed.MainActivity"',
+                         'android:name="org.renamed.ui.Settings"',
+                         'android:name="com.example.app2.Other"',
+                         'android:name="org.renamed.Initializer"'):
+            self.assertIn(expected, manifest)
+
+        smali = files[os.path.join('smali', 'com', 'example', 'app', 'MainActivity.smali')]
+        self.assertIn('.class public Lorg/renamed/MainActivity;', smali)
+        self.assertIn('new-instance v0, Lorg/renamed/ui/Settings;', smali)
+        self.assertIn('const-string v0, "org.renamed.ui.Settings"', smali)
+        self.assertIn('const-string v0, "com.example.app2"', smali)
+        self.assertEqual(files[os.path.join('smali_classes2', 'com', 'example', 'app2', 'Other.smali')],
+                         '.class public Lcom/example/app2/Other;\n.super Ljava/lang/Object;\n')
+        self.assertIn('<org.renamed.ui.BadgeView', files[os.path.join('res', 'layout', 'main.xml')])
+
+    def test_generated_tree(self):
+        root = os.path.join(self.root, 'generated')
+        spec = SyntheticAPK(smali_file_count=300, dex_count=2, resource_count=2, native_lib_count=0)
+        write_decoded_tree(spec, root)
+        renamer = PackageRenamer(root, 'org.renamed', rename_classes=True, max_workers=2)
+        index = renamer.index()
+        renamer.rewrite(index)
+
+        self.assertEqual(len(index.lines), spec.smali_file_count)
+        for path, content in read_tree(root).items():
+            if path.endswith('.smali'):
+                self.assertNotIn('com/benchmark/app', content, path)
+                self.assertNotIn('com.benchmark.app', content, path)
+                self.assertIn('Lorg/renamed/Class', content, path)
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), 'needs fork')
+    def test_rename_in_daemon_process(self):
+        # Daemon processes can't have children, the renamer falls back to threads
+        process = multiprocessing.get_context('fork').Process(target=rename_in_daemon,
+                                                              args=(self.root, 'org.renamed'), daemon=True)
+        process.start()
+        process.join(60)
+
+        self.assertEqual(process.exitcode, 0)
+        self.assertIn('package="org.renamed"', read_tree(self.root)['AndroidManifest.xml'])
+
+    def test_patch_unapply_restores_the_tree(self):
+        original = read_tree(self.root)
+        patch = ChangePackageName()
+        patch.config('org.renamed', rename_classes=True)
+        patch.apply(self.root)
+        self.assertIn('package="org.renamed"', read_tree(self.root)['AndroidManifest.xml'])
+
+        # Applying again starts from the original tree
+        patch.config('org.other')
+        patch.apply(self.root)
+        files = read_tree(self.root)
+        self.assertIn('package="org.other"', files['AndroidManifest.xml'])
+        self.assertIn('Lcom/example/app/MainActivity;', files[os.path.join('smali', 'com', 'example', 'app',
+                                                                           'MainActivity.smali')])
+
+        patch.unapply(self.root)
+        # Patch.restore_file keeps the manifest backup
+        self.assertEqual({path: content for path, content in read_tree(self.root).items()
+                          if not path.endswith('.backup')}, original)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import io
+import os
+import struct
+import tempfile
+import unittest
+import zipfile
+
+from apk_patcher.lib.raw_zip import RawZip, RawZipReader, RawZipWriter, UnsupportedZip, copy_entry, entry_alignment
+
+
+class RawZipTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name: str, entries, comment: bytes = b'') -> str:
+        file_path = os.path.join(self.folder, name)
+        with open(file_path, 'wb') as f:
+            writer = RawZipWriter(f, comment=comment)
+            for entry_name, data, compress_type, alignment in entries:
+                writer.write(entry_name, data, compress_type, alignment=alignment)
+            writer.close()
+        return file_path
+
+    def test_written_zip_reads_back(self):
+        entries = [
+            ('AndroidManifest.xml', b'manifest' * 100, RawZip.DEFLATED, 1),
+            ('resources.arsc', b'table' * 50, RawZip.STORED, 4),
+            ('lib/arm64-v8a/libnative.so', os.urandom(10000), RawZip.STORED, 4096),
+            ('assets/données.txt', 'é'.encode() * 10, RawZip.DEFLATED, 1),
+            ('assets/empty', b'', RawZip.STORED, 4)
+        ]
+        file_path = self.write('out.zip', entries, b'comment')
+
+        with zipfile.ZipFile(file_path) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(z.comment, b'comment')
+            self.assertEqual(z.namelist(), [name for name, _, _, _ in entries])
+            for name, data, compress_type, _ in entries:
+                self.assertEqual(z.read(name), data)
+                self.assertEqual(z.getinfo(name).compress_type, compress_type)
+
+        with RawZipReader(file_path) as reader:
+            self.assertEqual(reader.comment, b'comment')
+            by_name = reader.entries_by_name()
+            for name, data, _, alignment in entries:
+                entry = by_name[name]
+                self.assertEqual(reader.read(entry), data)
+                self.assertEqual(entry.data_offset % alignment, 0, name)
+
+    def test_copy_keeps_compressed_data_and_alignment(self):
+        source = self.write('in.zip', [
+            ('a.txt', b'a' * 5000, RawZip.DEFLATED, 1),
+            ('b.so', os.urandom(3000), RawZip.STORED, 4096),
+            ('c.bin', os.urandom(30), RawZip.STORED, 4)
+        ])
+        copy_path = os.path.join(self.folder, 'copy.zip')
+        with RawZipReader(source) as reader, open(copy_path, 'wb') as f:
+            # A leading entry moves every offset, alignment has to be recomputed
+            writer = RawZipWriter(f)
+            writer.write('first', b'x' * 3, RawZip.STORED)
+            for entry in reader.entries:
+                reader.read_local_header(entry)
+                copy_entry(reader, writer, entry, entry_alignment(entry))
+            writer.close()
+
+        with RawZipReader(source) as reader, RawZipReader(copy_path) as copy:
+            copied = copy.entries_by_name()
+            for entry in reader.entries:
+                copied_entry = copied[entry.name]
+                with reader.read_raw(entry) as data, copy.read_raw(copied_entry) as copied_data:
+                    self.assertEqual(bytes(data), bytes(copied_data))
+                self.assertEqual(copied_entry.crc32, entry.crc32)
+            self.assertEqual(copied['b.so'].data_offset % 4096, 0)
+            self.assertEqual(copied['c.bin'].data_offset % 4, 0)
+        with zipfile.ZipFile(copy_path) as z:
+            self.assertIsNone(z.testzip())
+
+    def test_zipfile_archive_is_read(self):
+        file_path = os.path.join(self.folder, 'zipfile.zip')
+        with zipfile.ZipFile(file_path, 'w') as z:
+            z.writestr('dir/', b'')
+            z.writestr('stored', b'stored data', zipfile.ZIP_STORED)
+            z.writestr('deflated', b'deflated data' * 100, zipfile.ZIP_DEFLATED)
+
+        with RawZipReader(file_path) as reader:
+            by_name = reader.entries_by_name()
+            self.assertTrue(by_name['dir/'].is_dir())
+            self.assertEqual(reader.read(by_name['stored']), b'stored data')
+            self.assertEqual(b''.join(reader.iter_content(by_name['deflated'], 7)), b'deflated data' * 100)
+
+    def test_alignment_extra_is_replaced(self):
+        extra = struct.pack('<HH', 0xcafe, 2) + b'ok' + struct.pack('<HHH', RawZip.ALIGNMENT_EXTRA_ID, 4, 4096) + \
+            bytes(2)
+        self.assertEqual(RawZip.get_alignment_extra(extra), 4096)
+        self.assertEqual(RawZip.strip_extra_field(extra, RawZip.ALIGNMENT_EXTRA_ID), extra[:6])
+
+    def test_unsupported_archives(self):
+        empty_path = os.path.join(self.folder, 'empty.zip')
+        open(empty_path, 'wb').close()
+        with self.assertRaises(UnsupportedZip):
+            RawZipReader(empty_path)
+
+        truncated_path = os.path.join(self.folder, 'truncated.zip')
+        with open(truncated_path, 'wb') as f:
+            f.write(RawZip.LOCAL_HEADER_SIGNATURE + bytes(100))
+        with self.assertRaises(UnsupportedZip):
+            RawZipReader(truncated_path)
+
+        with self.assertRaises(UnsupportedZip):
+            RawZipWriter(io.BytesIO()).write('a', b'a', compress_type=12)
+
+
+if __name__ == '__main__':
+    unittest.main()
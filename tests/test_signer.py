@@ -0,0 +1,208 @@
+import base64
+import hashlib
+import os
+import struct
+import tempfile
+import unittest
+import zipfile
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+
+from apk_patcher.benchmark.synthetic import SyntheticAPK, write_apk
+from apk_patcher.lib.certificate import Certificate
+from apk_patcher.lib.raw_zip import RawZip, RawZipReader
+from apk_patcher.lib.signer import ChunkDigester, Signer, SigningKey, UnsupportedSigning, sign_apk
+
+
+class VerifyError(Exception):
+    pass
+
+
+def read_length_prefixed(data: bytes, pos: int):
+    size = struct.unpack_from('<I', data, pos)[0]
+    return data[pos + 4:pos + 4 + size], pos + 4 + size
+
+
+def read_sequence(data: bytes):
+    items = []
+    pos = 0
+    while pos < len(data):
+        item, pos = read_length_prefixed(data, pos)
+        items.append(item)
+    return items
+
+
+def content_digest(apk: bytes, block_offset: int, cd_offset: int, end_record_offset: int) -> bytes:
+    chunk_digests = []
+    end_record = RawZip.end_record_with_cd_offset(apk[end_record_offset:], block_offset)
+    for section in (apk[:block_offset], apk[cd_offset:end_record_offset], end_record):
+        for pos in range(0, len(section), ChunkDigester.CHUNK_SIZE):
+            chunk_digests.append(ChunkDigester.chunk_digest(section[pos:pos + ChunkDigester.CHUNK_SIZE]))
+    return hashlib.sha256(b'\x5a' + struct.pack('<I', len(chunk_digests)) + b''.join(chunk_digests)).digest()
+
+
+def verify_signing_block(file_path: str, block_id: int) -> x509.Certificate:
+    """
+    Checks an APK Signature Scheme v2/v3 signer independently of Signer and returns its certificate
+    """
+    with open(file_path, 'rb') as f:
+        apk = f.read()
+    with RawZipReader(file_path) as reader:
+        cd_offset, end_record_offset = reader.cd_offset, reader.end_record_offset
+    if apk[cd_offset - 16:cd_offset] != Signer.SIGNING_BLOCK_MAGIC:
+        raise VerifyError('no APK Signing Block')
+    block_size = struct.unpack_from('<Q', apk, cd_offset - 24)[0]
+    block_offset = cd_offset - block_size - 8
+    if struct.unpack_from('<Q', apk, block_offset)[0] != block_size:
+        raise VerifyError('APK Signing Block sizes differ')
+
+    pairs = {}
+    pos = block_offset + 8
+    while pos < cd_offset - 24:
+        pair_size, pair_id = struct.unpack_from('<QI', apk, pos)
+        pairs[pair_id] = apk[pos + 12:pos + 8 + pair_size]
+        pos += 8 + pair_size
+    if block_id not in pairs:
+        raise VerifyError(f'no block {block_id:#x}')
+
+    signers = read_sequence(read_length_prefixed(pairs[block_id], 0)[0])
+    if len(signers) != 1:
+        raise VerifyError(f'{len(signers)} signers')
+    signed_data, pos = read_length_prefixed(signers[0], 0)
+    if block_id == Signer.V3_BLOCK_ID:
+        pos += 8
+    signatures, pos = read_length_prefixed(signers[0], pos)
+    public_key_data, _ = read_length_prefixed(signers[0], pos)
+
+    digests, pos = read_length_prefixed(signed_data, 0)
+    certificates, _ = read_length_prefixed(signed_data, pos)
+    certificate = x509.load_der_x509_certificate(read_sequence(certificates)[0])
+    public_key = serialization.load_der_public_key(public_key_data)
+    if public_key.public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo) != \
+            certificate.public_key().public_bytes(serialization.Encoding.DER,
+                                                  serialization.PublicFormat.SubjectPublicKeyInfo):
+        raise VerifyError('public key does not match the certificate')
+
+    for signature in read_sequence(signatures):
+        algorithm = struct.unpack_from('<I', signature)[0]
+        value, _ = read_length_prefixed(signature, 4)
+        try:
+            if isinstance(public_key, rsa.RSAPublicKey):
+                public_key.verify(value, signed_data, padding.PKCS1v15(), hashes.SHA256())
+            else:
+                public_key.verify(value, signed_data, ec.ECDSA(hashes.SHA256()))
+        except InvalidSignature:
+            raise VerifyError(f'bad signature for algorithm {algorithm:#x}')
+
+    expected = content_digest(apk, block_offset, cd_offset, end_record_offset)
+    for digest in read_sequence(digests):
+        value, _ = read_length_prefixed(digest, 4)
+        if value != expected:
+            raise VerifyError('content digest mismatch')
+    return certificate
+
+
+def verify_v1(file_path: str):
+    """
+    Checks the JAR signature digests, the PKCS #7 block itself is left to apksigner
+    """
+    def b64_digest(data: bytes) -> str:
+        return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+    with zipfile.ZipFile(file_path) as apk:
+        if apk.testzip() is not None:
+            raise VerifyError('bad CRC')
+        manifest = apk.read(Signer.MANIFEST_PATH)
+        signature_file = apk.read(f'META-INF/{Signer.V1_SIGNER_NAME}.SF').decode()
+        if f'SHA-256-Digest-Manifest: {b64_digest(manifest)}' not in signature_file:
+            raise VerifyError('manifest digest mismatch')
+        sections = manifest.decode().replace('\r\n ', '').split('\r\n\r\n')[1:]
+        digests = {}
+        for section in filter(None, sections):
+            attributes = dict(line.split(': ', 1) for line in section.split('\r\n') if line)
+            digests[attributes['Name']] = attributes['SHA-256-Digest']
+        names = {name for name in apk.namelist()
+                 if not name.endswith('/') and not Signer.is_v1_signature_file(name)}
+        if names != set(digests):
+            raise VerifyError('manifest does not list every entry')
+        for name in names:
+            if digests[name] != b64_digest(apk.read(name)):
+                raise VerifyError(f'digest mismatch for {name}')
+
+
+class SignerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name
+        self.key_path = os.path.join(self.folder, 'key.pk8')
+        self.cert_path = os.path.join(self.folder, 'cert.pem')
+        Certificate(2048).save(self.key_path, self.cert_path)
+        self.apk_path = os.path.join(self.folder, 'in.apk')
+        # A native library over 1 MB spans several digest chunks
+        write_apk(SyntheticAPK(dex_size=64 * 1024, resource_count=5, native_lib_count=1,
+                               native_lib_size=1536 * 1024, abis=['arm64-v8a']), self.apk_path)
+        self.signed_path = os.path.join(self.folder, 'signed.apk')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_signed_apk_verifies(self):
+        sign_apk(self.apk_path, self.signed_path, self.key_path, self.cert_path, 21)
+
+        signing_key = SigningKey.load(self.key_path, self.cert_path)
+        for block_id in (Signer.V2_BLOCK_ID, Signer.V3_BLOCK_ID):
+            self.assertEqual(verify_signing_block(self.signed_path, block_id), signing_key.certificate)
+        verify_v1(self.signed_path)
+        with zipfile.ZipFile(self.apk_path) as original, zipfile.ZipFile(self.signed_path) as signed:
+            for name in original.namelist():
+                self.assertEqual(original.read(name), signed.read(name))
+
+    def test_resigning_replaces_the_signature(self):
+        sign_apk(self.apk_path, self.signed_path, self.key_path, self.cert_path, 21)
+        other_key_path = os.path.join(self.folder, 'other.pk8')
+        other_cert_path = os.path.join(self.folder, 'other.pem')
+        Certificate(2048).save(other_key_path, other_cert_path)
+        resigned_path = os.path.join(self.folder, 'resigned.apk')
+        sign_apk(self.signed_path, resigned_path, other_key_path, other_cert_path, 21)
+
+        certificate = SigningKey.load(other_key_path, other_cert_path).certificate
+        self.assertEqual(verify_signing_block(resigned_path, Signer.V2_BLOCK_ID), certificate)
+        verify_v1(resigned_path)
+        with zipfile.ZipFile(resigned_path) as apk:
+            self.assertEqual(len([name for name in apk.namelist() if name.endswith('.SF')]), 1)
+
+    def test_tampered_apk_fails(self):
+        sign_apk(self.apk_path, self.signed_path, self.key_path, self.cert_path, 21)
+        with RawZipReader(self.signed_path) as reader:
+            entry = reader.entries_by_name()['resources.arsc']
+            reader.read_local_header(entry)
+            offset = entry.data_offset
+        with open(self.signed_path, 'r+b') as f:
+            f.seek(offset)
+            value = f.read(1)
+            f.seek(offset)
+            f.write(bytes([value[0] ^ 0xff]))
+
+        with self.assertRaisesRegex(VerifyError, 'content digest'):
+            verify_signing_block(self.signed_path, Signer.V2_BLOCK_ID)
+
+    def test_stored_entries_stay_aligned(self):
+        sign_apk(self.apk_path, self.signed_path, self.key_path, self.cert_path, 21)
+        with RawZipReader(self.signed_path) as reader:
+            for entry in reader.entries:
+                reader.read_local_header(entry)
+                if entry.compress_type == RawZip.STORED:
+                    self.assertEqual(entry.data_offset % 4, 0, entry.name)
+
+    def test_v1_below_sdk_18_is_unsupported(self):
+        with self.assertRaises(UnsupportedSigning):
+            sign_apk(self.apk_path, self.signed_path, self.key_path, self.cert_path, 17)
+        self.assertFalse(os.path.exists(self.signed_path))
+        self.assertFalse(os.path.exists(f'{self.signed_path}.tmp'))
+
+
+if __name__ == '__main__':
+    unittest.main()